@@ -1,10 +1,33 @@
+import hashlib
+import json
+import os
+import pickle
+import re
+import stat
+import threading
+from collections import OrderedDict
 from bids import BIDSLayout
-from typing import Callable, Dict, List, Optional, Union
+from bids.layout.models import BIDSFile, Entity, Tag
+from bids.utils import listify, natural_sort
+from typing import Any, BinaryIO, Callable, Dict, Iterable, List, Optional, Tuple, Union
 from pathlib import Path
 from shutil import rmtree
+from tempfile import mkdtemp
+from weakref import WeakKeyDictionary
+from .bids_indexer import DATABASE_NAME, INDEX_CACHE_NAME, STATE_NAME, index_fingerprint, load_layout
 
 
-LAYOUT_CACHE = dict()
+# maximum number of layouts kept in memory
+LAYOUT_CACHE_SIZE = 8
+
+# indices of each layout, so the parsers below share one set of bulk queries
+INDEX_CACHE: "WeakKeyDictionary[BIDSLayout, BIDSIndex]" = WeakKeyDictionary()
+
+# marks an entity filter that matches any value (including undefined)
+_ANY = object()
+
+# suffixes of files that can be field maps, as searched for by BIDSLayout.get_fieldmap
+FIELDMAP_SUFFIXES = "(phase1|phasediff|epi|fieldmap)"
 
 
 def parse_bids_dataset(
@@ -13,6 +36,7 @@ def parse_bids_dataset(
     reset_database: bool = False,
     participant_label: Optional[List[str]] = None,
     output_path: Optional[Path] = None,
+    session_label: Optional[List[str]] = None,
 ) -> Dict:
     """Parses a bids dataset using the given parser function.
 
@@ -26,6 +50,11 @@ def parse_bids_dataset(
         Whether to reset the pybids database, by default False
     participant_label : List[str], optional
         List of participant labels to include, by default None
+    output_path : Path, optional
+        Output directory to create subset views of the dataset in, required if participant_label or
+        session_label is given.
+    session_label : List[str], optional
+        List of session labels to include, by default None
 
     Returns
     -------
@@ -33,56 +62,494 @@ def parse_bids_dataset(
         Parse dataset return as a dictionary.
     """
     print("Loading BIDS dataset...")
-    # set database path
-    database_path = Path(bids_dir) / "layout_index.sqlite"
-
-    # check the participant labels if it is only a single participant create a symlink to the dataset so
-    # we don't have to search the whole thing... else pybids will be really slow
-    if participant_label and len(participant_label) == 1:
-        # create a copy of the dataset in the output_path
-        dataset_dir = output_path / "dataset"
-        dataset_dir.mkdir(exist_ok=True)
-
-        # create a dataset with just this subject
-        subject_dataset = dataset_dir / f"dataset_sub-{participant_label[0]}"
-
-        # if reset_database is true, delete the existing subject dataset
-        if reset_database:
-            rmtree(subject_dataset, ignore_errors=True)
-
-        # skip symlink create if subject dataset already exists
-        if not subject_dataset.exists():
-            subject_dataset.mkdir(exist_ok=True)
-
-            # now symlink all files from the bids_dir into the subject_dataset
-            # except for the layout_index.sqlite file
-            for f in Path(bids_dir).glob("*"):
-                if f.name != "layout_index.sqlite" and f.is_file():
-                    (subject_dataset / f.name).symlink_to(f)
-            # now symlink the subject folder
-            subject_dir = subject_dataset / f"sub-{participant_label[0]}"
-            (subject_dir).symlink_to(bids_dir / f"sub-{participant_label[0]}")
-
-        # set bids_dir to the subject_dataset
-        bids_dir = subject_dataset
-
-        # set database path
-        database_path = subject_dataset / "layout_index.sqlite"
-
-    # delete the existing database if it exists
-    if reset_database:
-        database_path.unlink(missing_ok=True)
-    # Create a BIDSLayout object for the dataset
-    if str(bids_dir) in LAYOUT_CACHE:
-        layout = LAYOUT_CACHE[str(bids_dir)]
-    else:
-        layout = BIDSLayout(bids_dir, database_path=bids_dir)
-        LAYOUT_CACHE[str(bids_dir)] = layout
+    # if only some participants (or sessions) are needed, index a view of the dataset with just those
+    # so we don't have to search the whole thing... else pybids will be really slow
+    if participant_label or session_label:
+        bids_dir = create_subset_view(
+            bids_dir, output_path / "dataset", participant_label, session_label, reset=reset_database
+        )
+
+    # Create a BIDSLayout object for the dataset, only re-indexing the subjects/sessions that changed
+    # since the database was last updated (or everything if reset_database is set)
+    layout = LAYOUT_CACHE.load(bids_dir, reset_database=reset_database)
 
     # Call the parser function on the layout and return the result
     return parser(layout)
 
 
+def subset_name(participant_label: Optional[List[str]] = None, session_label: Optional[List[str]] = None) -> str:
+    """Gets the directory name of the view of a subset of a dataset.
+
+    Parameters
+    ----------
+    participant_label : List[str], optional
+        Participant labels in the subset, by default all
+    session_label : List[str], optional
+        Session labels in the subset, by default all
+
+    Returns
+    -------
+    str
+        "dataset_sub-[label]" for a single participant, else "dataset_subset-[hash of the labels]".
+    """
+    if participant_label and len(participant_label) == 1 and not session_label:
+        return f"dataset_sub-{participant_label[0]}"
+    key = {"participants": sorted(set(participant_label or [])), "sessions": sorted(set(session_label or []))}
+    return f"dataset_subset-{hashlib.sha1(json.dumps(key).encode()).hexdigest()[:12]}"
+
+
+def _link_top_level_files(bids_dir: Path, view: Path) -> None:
+    """Symlinks the top level files of a dataset into a view, except for the layout index files."""
+    for f in bids_dir.glob("*"):
+        if f.name in (DATABASE_NAME, STATE_NAME) or not f.is_file() or (view / f.name).exists():
+            continue
+        try:
+            (view / f.name).symlink_to(f)
+        except FileExistsError:
+            # a concurrent run already linked it
+            pass
+
+
+def _symlink(link: Path, target: Path) -> None:
+    """Symlinks a path, unless it is already linked (e.g. by a concurrent run)."""
+    if link.is_symlink() or link.exists():
+        return
+    try:
+        link.symlink_to(target)
+    except FileExistsError:
+        pass
+
+
+def _link_subjects(
+    bids_dir: Path, view: Path, participant_label: Optional[List[str]], session_label: Optional[List[str]]
+) -> None:
+    """Symlinks the subjects (or only some sessions of them) of a dataset into a view, skipping links that exist.
+
+    Without session labels each subject directory is linked, otherwise everything of each subject but the
+    sessions that aren't in the subset. Subjects and sessions that don't exist (yet) are linked by a later call.
+    """
+    if participant_label:
+        subjects = [bids_dir / f"sub-{label}" for label in participant_label]
+    else:
+        subjects = sorted(bids_dir.glob("sub-*"))
+    for subject in subjects:
+        if not subject.is_dir():
+            continue
+        if not session_label:
+            _symlink(view / subject.name, subject)
+            continue
+        (view / subject.name).mkdir(exist_ok=True)
+        for child in subject.iterdir():
+            if child.name.startswith("ses-") and child.is_dir() and child.name[4:] not in session_label:
+                continue
+            _symlink(view / subject.name / child.name, child)
+
+
+def create_subset_view(
+    bids_dir: Union[Path, str],
+    dataset_dir: Path,
+    participant_label: Optional[List[str]] = None,
+    session_label: Optional[List[str]] = None,
+    reset: bool = False,
+) -> Path:
+    """Creates (or reuses) a symlinked view of a dataset with only some participants and sessions.
+
+    Each subset gets its own view directory, and so its own (incrementally updated) index, which is
+    reused by every run on the same subset. Views are built in a temporary directory and renamed into
+    place, so concurrent runs on the same subset never see (or index) a partially built view. Subjects,
+    sessions and top level files added to the dataset later are linked into the view on the next call.
+
+    Parameters
+    ----------
+    bids_dir : Union[Path, str]
+        BIDS dataset to create a view of.
+    dataset_dir : Path
+        Directory to create views in.
+    participant_label : List[str], optional
+        Participant labels to include, by default all
+    session_label : List[str], optional
+        Session labels to include, by default all
+    reset : bool, optional
+        Whether to delete and recreate an existing view (and its index), by default False
+
+    Returns
+    -------
+    Path
+        The view directory.
+    """
+    bids_dir = Path(bids_dir).absolute()
+    dataset_dir.mkdir(parents=True, exist_ok=True)
+    view = dataset_dir / subset_name(participant_label, session_label)
+
+    # if reset is true, delete the existing view
+    if reset:
+        rmtree(view, ignore_errors=True)
+
+    if not view.exists():
+        tmp_view = Path(mkdtemp(prefix=f".{view.name}.", dir=dataset_dir))
+        _link_top_level_files(bids_dir, tmp_view)
+        _link_subjects(bids_dir, tmp_view, participant_label, session_label)
+        (tmp_view / ".subset.json").write_text(
+            json.dumps({"participant_label": participant_label, "session_label": session_label}, indent=4)
+        )
+        try:
+            os.rename(tmp_view, view)
+        except OSError:
+            # another run created the view first
+            rmtree(tmp_view, ignore_errors=True)
+            if not view.exists():
+                raise
+
+    # pick up any top level files, subjects and sessions added since the view was created
+    _link_top_level_files(bids_dir, view)
+    _link_subjects(bids_dir, view, participant_label, session_label)
+    return view
+
+
+class BIDSIndex:
+    """In-memory index of the files and entities of a BIDS layout.
+
+    Every file and every tag (entity or sidecar metadata) of the layout is read with two bulk queries,
+    and files are grouped by subject and session. Queries are then answered in memory with the same
+    semantics as :meth:`BIDSLayout.get` (e.g. a filter value of None matches files without the entity),
+    instead of issuing an SQL query for each subject, session, task and run.
+
+    Parameters
+    ----------
+    layout : BIDSLayout
+        A pybids layout object
+    """
+
+    def __init__(self, layout: BIDSLayout):
+        session = layout.session
+        files = session.query(BIDSFile).filter_by(is_dir=False).all()
+        # sort by path, which is the order BIDSLayout.get returns files in
+        self.files: Dict[str, BIDSFile] = {f.path: f for f in sorted(files, key=lambda f: f.path)}
+        self.entities: Dict[str, Dict[str, Any]] = {path: {} for path in self.files}
+        self.metadata: Dict[str, Dict[str, Any]] = {path: {} for path in self.files}
+        # tag values as stored in the database, which is what queries compare against
+        self._stored: Dict[str, Dict[str, str]] = {path: {} for path in self.files}
+        for tag in session.query(Tag).all():
+            if tag.file_path not in self.files:
+                continue
+            tags = self.metadata if tag.is_metadata else self.entities
+            tags[tag.file_path][tag.entity_name] = tag.value
+            self._stored[tag.file_path][tag.entity_name] = tag._value
+        # type of each entity (kept instead of the Entity records, so the index can be pickled)
+        self._dtypes: Dict[str, Any] = {entity.name: entity.dtype for entity in session.query(Entity).all()}
+
+        # group files by subject and session (None if the file has no such entity)
+        self.groups: Dict[Tuple[Any, Any], List[str]] = {}
+        for path, entities in self.entities.items():
+            self.groups.setdefault((entities.get("subject"), entities.get("session")), []).append(path)
+        self._fieldmap_files: Dict[str, List[str]] = {}
+
+    def _candidates(self, subject: Any, session: Any) -> Iterable[str]:
+        """Gets the paths of files in the groups matching an exact subject/session filter."""
+        # only a single subject (and session) can be looked up directly
+        if not isinstance(subject, str) or not (session is _ANY or session is None or isinstance(session, str)):
+            return self.files
+        paths = []
+        for (group_subject, group_session), group_paths in self.groups.items():
+            if group_subject == subject and (session is _ANY or group_session == session):
+                paths.extend(group_paths)
+        return sorted(paths)
+
+    def _matches(self, path: str, filters: Dict[str, Any], regex_search: bool) -> bool:
+        """Checks a file against entity filters, as BIDSLayout.get does."""
+        for name, value in filters.items():
+            values = listify(value) if value is not None else [None]
+            if name == "extension":
+                values = [v if v is None or v.startswith(".") else "." + v for v in values]
+            # convert values to the type of the entity, as BIDSLayout.get does
+            if not regex_search and self._dtypes.get(name) is not None:
+                try:
+                    values = [v if v is None else self._dtypes[name](v) for v in values]
+                except Exception:
+                    pass
+            stored = self._stored[path].get(name)
+            if stored is None:
+                # undefined entities only match None
+                if None not in values:
+                    return False
+                continue
+            values = [v for v in values if v is not None]
+            if not values:
+                return False
+            if regex_search:
+                if not any(re.search(str(v), stored, re.I) for v in values):
+                    return False
+            elif isinstance(values[0], int):
+                if not stored.lstrip("-").isdigit() or int(stored) not in values:
+                    return False
+            elif stored not in values:
+                return False
+        return True
+
+    def get(self, regex_search: bool = False, **filters: Any) -> List[BIDSFile]:
+        """Gets the files matching the given entity filters.
+
+        Parameters
+        ----------
+        regex_search : bool, optional
+            Whether filter values are regular expressions (searched case insensitively), by default False
+        **filters : Any
+            Entity values to filter on, a value of None matches files without the entity.
+
+        Returns
+        -------
+        List[BIDSFile]
+            Matching files, sorted by path.
+        """
+        subject = filters.get("subject", _ANY)
+        session = filters.get("session", _ANY)
+        if regex_search:
+            subject = session = _ANY
+        return [
+            self.files[path]
+            for path in self._candidates(subject, session)
+            if self._matches(path, filters, regex_search)
+        ]
+
+    def ids(self, target: str, **filters: Any) -> List[Any]:
+        """Gets the unique values of an entity over the files matching the given filters.
+
+        Parameters
+        ----------
+        target : str
+            Entity to get values of (e.g. "subject", "session", "task" or "run").
+        **filters : Any
+            Entity values to filter on, see get.
+
+        Returns
+        -------
+        List[Any]
+            Naturally sorted values, as returned by BIDSLayout.get_subjects etc.
+        """
+        values = {self.entities[f.path][target] for f in self.get(**filters) if target in self.entities[f.path]}
+        return natural_sort(list(values))
+
+    def fieldmaps(self, path: str) -> List[Dict[str, str]]:
+        """Gets the field maps intended for a file, as BIDSLayout.get_fieldmap(path, return_list=True) does.
+
+        Parameters
+        ----------
+        path : str
+            Path of the file to get field maps for.
+
+        Returns
+        -------
+        List[Dict[str, str]]
+            Field maps, a dictionary of paths with a "suffix" key for each.
+        """
+        subject = self.entities[path]["subject"]
+        if subject not in self._fieldmap_files:
+            self._fieldmap_files[subject] = [
+                f.path
+                for f in self.get(
+                    regex_search=True, subject=subject, suffix=FIELDMAP_SUFFIXES, extension=[".nii.gz", ".nii"]
+                )
+            ]
+        fieldmap_set = []
+        for fmap_path in self._fieldmap_files[subject]:
+            metadata = self.metadata[fmap_path]
+            if "IntendedFor" not in metadata:
+                continue
+            if not any(path.endswith(str(Path(intended))) for intended in listify(metadata["IntendedFor"])):
+                continue
+            suffix = self.entities[fmap_path]["suffix"]
+            cur_fieldmap = {}
+            if suffix == "phasediff":
+                cur_fieldmap = {
+                    "phasediff": fmap_path,
+                    "magnitude1": fmap_path.replace(suffix, "magnitude1"),
+                    "suffix": "phasediff",
+                }
+                magnitude2 = fmap_path.replace(suffix, "magnitude2")
+                if Path(magnitude2).is_file():
+                    cur_fieldmap["magnitude2"] = magnitude2
+            elif suffix == "phase1":
+                cur_fieldmap["phase1"] = fmap_path
+                cur_fieldmap["magnitude1"] = fmap_path.replace(suffix, "magnitude1")
+                cur_fieldmap["phase2"] = fmap_path.replace(suffix, "phase2")
+                cur_fieldmap["magnitude2"] = fmap_path.replace(suffix, "magnitude2")
+                cur_fieldmap["suffix"] = "phase"
+            elif suffix == "epi":
+                cur_fieldmap["epi"] = fmap_path
+                cur_fieldmap["suffix"] = "epi"
+            elif suffix == "fieldmap":
+                cur_fieldmap["fieldmap"] = fmap_path
+                cur_fieldmap["magnitude"] = fmap_path.replace(suffix, "magnitude")
+                cur_fieldmap["suffix"] = "fieldmap"
+            fieldmap_set.append(cur_fieldmap)
+        return fieldmap_set
+
+
+def _trusted_file(f: BinaryIO) -> bool:
+    """Checks that an open file is owned by the current user and only writable by them."""
+    st = os.fstat(f.fileno())
+    return st.st_uid == os.getuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def load_index(layout: BIDSLayout) -> BIDSIndex:
+    """Loads the in-memory index of a layout from disk, or builds it (and saves it) if it is out of date.
+
+    The pickled index is stored in the dataset along with the fingerprint of the index it was built from
+    (see load_layout), so it is only reused while the database it was built from is unchanged. Since
+    unpickling can run arbitrary code and datasets are often shared, the index is only loaded if the
+    current user owns it and no one else can write to it (otherwise it is rebuilt and replaced).
+
+    Parameters
+    ----------
+    layout : BIDSLayout
+        A pybids layout object
+
+    Returns
+    -------
+    BIDSIndex
+        Index of the layout.
+    """
+    cache_path = Path(layout.root) / INDEX_CACHE_NAME
+    fingerprint = index_fingerprint(layout.root)
+    if fingerprint is None:
+        return BIDSIndex(layout)
+    try:
+        with open(cache_path, "rb") as f:
+            # the ownership is checked on the open file, so it can't be swapped after the check
+            cached = pickle.load(f) if _trusted_file(f) else None
+        if cached is not None and cached["root"] == layout.root and cached["fingerprint"] == fingerprint:
+            return cached["index"]
+    except Exception:
+        # missing, unreadable or from an incompatible version, rebuild it
+        pass
+    index = BIDSIndex(layout)
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}")
+    try:
+        # a new file only writable by us (not following a file or link someone else put in its place)
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644), "wb") as f:
+            pickle.dump({"root": layout.root, "fingerprint": fingerprint, "index": index}, f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        tmp_path.unlink(missing_ok=True)
+    return index
+
+
+def index_layout(layout: BIDSLayout) -> BIDSIndex:
+    """Gets the in-memory index of a layout, loading it on first use.
+
+    Parameters
+    ----------
+    layout : BIDSLayout
+        A pybids layout object
+
+    Returns
+    -------
+    BIDSIndex
+        Index of the layout.
+    """
+    if layout not in INDEX_CACHE:
+        INDEX_CACHE[layout] = load_index(layout)
+    return INDEX_CACHE[layout]
+
+
+class LayoutCache:
+    """LRU cache of the layouts of datasets (and subset views), keyed by dataset path.
+
+    At most maxsize layouts are kept, so batch drivers that go through many subset views don't keep
+    every layout (and its index) alive. Each layout is stored with the fingerprint of its index, and is
+    reloaded instead of reused once the index has been updated (e.g. by another run).
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Maximum number of layouts to keep, by default LAYOUT_CACHE_SIZE
+    """
+
+    def __init__(self, maxsize: int = LAYOUT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._layouts: "OrderedDict[str, Tuple[Optional[str], BIDSLayout]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._layouts)
+
+    def __contains__(self, bids_dir: Union[Path, str]) -> bool:
+        return str(bids_dir) in self._layouts
+
+    def get(self, bids_dir: Union[Path, str]) -> Optional[BIDSLayout]:
+        """Gets the cached layout of a dataset.
+
+        Parameters
+        ----------
+        bids_dir : Union[Path, str]
+            BIDS dataset.
+
+        Returns
+        -------
+        Optional[BIDSLayout]
+            The layout, None if it isn't cached or its index changed since it was cached.
+        """
+        key = str(bids_dir)
+        with self._lock:
+            if key not in self._layouts:
+                return None
+            fingerprint, layout = self._layouts[key]
+            if fingerprint != index_fingerprint(key):
+                del self._layouts[key]
+                return None
+            self._layouts.move_to_end(key)
+            return layout
+
+    def put(self, bids_dir: Union[Path, str], layout: BIDSLayout) -> None:
+        """Caches the layout of a dataset, evicting the least recently used layouts if the cache is full.
+
+        Parameters
+        ----------
+        bids_dir : Union[Path, str]
+            BIDS dataset.
+        layout : BIDSLayout
+            Layout of the dataset.
+        """
+        key = str(bids_dir)
+        with self._lock:
+            self._layouts[key] = (index_fingerprint(key), layout)
+            self._layouts.move_to_end(key)
+            while len(self._layouts) > self.maxsize:
+                self._layouts.popitem(last=False)
+
+    def clear(self) -> None:
+        """Removes every layout from the cache."""
+        with self._lock:
+            self._layouts.clear()
+
+    def load(self, bids_dir: Union[Path, str], reset_database: bool = False, full_scan: bool = False) -> BIDSLayout:
+        """Gets the layout of a dataset from the cache, or loads it with load_layout.
+
+        Parameters
+        ----------
+        bids_dir : Union[Path, str]
+            BIDS dataset.
+        reset_database : bool, optional
+            Whether to re-index the whole dataset (skipping the cache), by default False
+        full_scan : bool, optional
+            Whether to stat every file of the dataset to find changes (skipping the cache), see
+            load_layout, by default False
+
+        Returns
+        -------
+        BIDSLayout
+            Layout of the dataset.
+        """
+        layout = None if reset_database or full_scan else self.get(bids_dir)
+        if layout is None:
+            layout = load_layout(bids_dir, reset_database=reset_database, full_scan=full_scan)
+            self.put(bids_dir, layout)
+        return layout
+
+
+LAYOUT_CACHE = LayoutCache()
+
+
 def get_dataset_description(layout: BIDSLayout) -> Dict:
     """Retuns the dataset description from the BIDS layout.
 
@@ -141,19 +608,20 @@ def get_anatomicals(layout: BIDSLayout) -> Dict:
         See above description.
     """
     print("Extracting anatomicals...")
+    index = index_layout(layout)
 
     # Initialize empty dictionaries for T1w and T2w files
     t1w_dict = {}
     t2w_dict = {}
 
     # Loop through all subjects in the layout
-    for subject in layout.get_subjects():
+    for subject in index.ids("subject"):
         # Initialize empty dictionaries for T1w and T2w files for this subject
         t1w_subject_dict = {}
         t2w_subject_dict = {}
 
         # get subject sessions
-        sessions = layout.get_sessions(subject=subject)
+        sessions = index.ids("session", subject=subject)
         # if sessions empty, set to None
         if not sessions:
             sessions = [None]
@@ -161,14 +629,14 @@ def get_anatomicals(layout: BIDSLayout) -> Dict:
         # Loop through all sessions for this subject
         for session in sessions:
             # Get all T1w files for this session
-            t1w_files = layout.get(subject=subject, session=session, suffix="T1w", extension="nii.gz")
+            t1w_files = index.get(subject=subject, session=session, suffix="T1w", extension="nii.gz")
 
             # If there are any T1w files for this session, add them to the subject dictionary
             if t1w_files:
                 t1w_subject_dict[session] = t1w_files
 
             # Get all T2w files for this session
-            t2w_files = layout.get(subject=subject, session=session, suffix="T2w", extension="nii.gz")
+            t2w_files = index.get(subject=subject, session=session, suffix="T2w", extension="nii.gz")
 
             # If there are any T2w files for this session, add them to the subject dictionary
             if t2w_files:
@@ -228,17 +696,18 @@ def get_functionals(layout: BIDSLayout) -> Dict:
         See above description.
     """
     print("Extracting functionals...")
+    index = index_layout(layout)
 
     # Initialize an empty dictionary for functional files
     func_dict = {}
 
     # Loop through all subjects in the layout
-    for subject in layout.get_subjects():
+    for subject in index.ids("subject"):
         # Initialize an empty dictionary for functional files for this subject
         func_subject_dict = {}
 
         # get subject sessions
-        sessions = layout.get_sessions(subject=subject)
+        sessions = index.ids("session", subject=subject)
         # if sessions empty, set to None
         if not sessions:
             sessions = [None]
@@ -249,11 +718,11 @@ def get_functionals(layout: BIDSLayout) -> Dict:
             func_session_dict = {}
 
             # Loop through all tasks for this session
-            for task in layout.get_tasks(subject=subject, session=session):
+            for task in index.ids("task", subject=subject, session=session):
                 # Loop through all runs for this task
-                for run in layout.get_runs(subject=subject, session=session, task=task):
+                for run in index.ids("run", subject=subject, session=session, task=task):
                     # Get all functional files for this run
-                    func_files = layout.get(
+                    func_files = index.get(
                         subject=subject, session=session, task=task, run=run, suffix="bold", extension="nii.gz"
                     )
 
@@ -308,17 +777,18 @@ def get_fieldmaps(layout: BIDSLayout) -> Dict:
         See above description.
     """
     print("Extracting fieldmaps...")
+    index = index_layout(layout)
 
     # Initialize an empty dictionary for fieldmap files
     fmap_dict = {}
 
     # Loop through all subjects in the layout
-    for subject in layout.get_subjects():
+    for subject in index.ids("subject"):
         # Initialize an empty dictionary for fieldmap files for this subject
         fmap_subject_dict = {}
 
         # get subject sessions
-        sessions = layout.get_sessions(subject=subject)
+        sessions = index.ids("session", subject=subject)
         # if sessions empty, set to None
         if not sessions:
             sessions = [None]
@@ -329,17 +799,17 @@ def get_fieldmaps(layout: BIDSLayout) -> Dict:
             fmap_session_dict = {}
 
             # Loop through all tasks for this session
-            for task in layout.get_tasks(subject=subject, session=session):
+            for task in index.ids("task", subject=subject, session=session):
                 # Get all functional runs for this session
-                func_runs = layout.get_runs(
-                    subject=subject, session=session, task=task, suffix="bold", extension="nii.gz"
+                func_runs = index.ids(
+                    "run", subject=subject, session=session, task=task, suffix="bold", extension="nii.gz"
                 )
 
                 # Loop through all functional runs for this session
                 for run in func_runs:
                     # get the first echo functional image for the run
                     try:
-                        func_file = layout.get(
+                        func_file = index.get(
                             subject=subject,
                             session=session,
                             task=task,
@@ -352,22 +822,22 @@ def get_fieldmaps(layout: BIDSLayout) -> Dict:
                     except IndexError:
                         # if this failed this probably means this is single echo data
                         # try to get the functional images without the echo
-                        func_file = layout.get(
+                        func_file = index.get(
                             subject=subject, session=session, task=task, run=run, suffix="bold", extension="nii.gz"
                         )[0]
 
                     # Get all fieldmap files for this run
-                    fmap_files = layout.get_fieldmap(func_file.path, return_list=True)
+                    fmap_files = index.fieldmaps(func_file.path)
 
                     # just grab the first fieldmap file it we couldn't find any
                     if not fmap_files:
                         fmap_AP = Path(
-                            layout.get(
+                            index.get(
                                 subject=subject, session=session, direction="AP", datatype="fmap", extension="nii.gz"
                             )[0].path
                         )
                         fmap_PA = Path(
-                            layout.get(
+                            index.get(
                                 subject=subject, session=session, direction="PA", datatype="fmap", extension="nii.gz"
                             )[0].path
                         )
@@ -0,0 +1,436 @@
+"""Incremental indexing of BIDS datasets.
+
+pybids indexes a dataset by crawling every directory, matching entity patterns against every file and
+reading every JSON sidecar, and can only reuse its database as-is or rebuild it from scratch. Instead,
+:func:`load_layout` records a fingerprint of each subject/session directory next to the pybids database.
+On later loads only the directories whose fingerprint changed are re-indexed, with a layout scoped to
+those directories, and their records are swapped into the database in place, so a newly arrived session
+is indexed without crawling the rest of the dataset.
+
+To avoid a stat of every file of the dataset on each load, the directories of each subject/session are
+looked at first, and only those whose directory mtimes changed are walked to fingerprint their files.
+Adding, removing or renaming a file changes the mtime of its directory, but rewriting an existing file in
+place does not, so such edits are only picked up with ``full_scan`` (which stats every file) or when the
+database is reset. Files outside of subject directories are always stat'd.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import re
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple, Union
+from sqlalchemy import select
+from bids import BIDSLayout
+from bids.layout.index import BIDSLayoutIndexer
+from bids.layout.models import BIDSFile, Entity, FileAssociation, Tag
+from bids.layout.validation import DEFAULT_LOCATIONS_TO_IGNORE
+
+# name of the pybids database in the dataset directory
+DATABASE_NAME = "layout_index.sqlite"
+
+# name of the file the fingerprint of each subject/session directory is recorded in
+STATE_NAME = "layout_index_state.json"
+STATE_VERSION = 2
+
+# pickled in-memory index of the dataset (see me_pipeline.bids.BIDSIndex), valid for one state of the index
+# (only loaded if it is owned and only writable by the current user)
+INDEX_CACHE_NAME = ".layout_index_cache.pkl"
+
+# lock file held while the index of a dataset is being updated (hidden, so pybids doesn't index it)
+LOCK_NAME = ".layout_index.lock"
+
+# unit of the files outside of subject directories, a change to these (e.g. a top level sidecar
+# inherited by every run) requires the whole dataset to be re-indexed
+ROOT_UNIT = "."
+
+# top level directories pybids never indexes, so changes to them don't affect the index
+UNINDEXED_DIRS = {"code", "derivatives", "models", "sourcedata", "stimuli"}
+
+# number of paths per query when updating the database (sqlite limits the number of query parameters)
+QUERY_CHUNK = 500
+
+
+def _stat_entries(path: Path, prefix: str) -> List[Tuple[str, int, int]]:
+    """Gets the relative path, size and mtime of every file at or below path."""
+    if not path.is_dir():
+        try:
+            stat = path.stat()
+        except OSError:
+            return []
+        return [(prefix, stat.st_size, stat.st_mtime_ns)]
+    entries = []
+    for dirpath, _, filenames in os.walk(path, followlinks=True):
+        rel_dir = Path(prefix) / Path(dirpath).relative_to(path)
+        for filename in filenames:
+            try:
+                stat = os.stat(os.path.join(dirpath, filename))
+            except OSError:
+                continue
+            entries.append(((rel_dir / filename).as_posix(), stat.st_size, stat.st_mtime_ns))
+    return entries
+
+
+def _dir_entries(path: Path, prefix: str, skip: Iterable[str] = ()) -> List[Tuple[str, int]]:
+    """Gets the relative path and mtime of path and every directory below it (except the top level
+    directories in skip), without a stat of any file."""
+    entries = []
+    for dirpath, dirnames, _ in os.walk(path, followlinks=True):
+        if dirpath == str(path):
+            dirnames[:] = [dirname for dirname in dirnames if dirname not in skip]
+        try:
+            stat = os.stat(dirpath)
+        except OSError:
+            continue
+        entries.append(((Path(prefix) / Path(dirpath).relative_to(path)).as_posix(), stat.st_mtime_ns))
+    return entries
+
+
+def _fingerprint(entries: Iterable[Tuple]) -> str:
+    """Hashes the stat entries of a unit."""
+    return hashlib.sha1(json.dumps(sorted(entries)).encode()).hexdigest()
+
+
+class IndexState(NamedTuple):
+    """Fingerprints of the units of a dataset, as recorded when it was last indexed."""
+
+    # fingerprint of the files (names, sizes and mtimes) of each unit
+    units: Dict[str, str]
+    # fingerprint of the directories (names and mtimes) of each subject/session unit
+    dirs: Dict[str, str]
+
+
+def scan_units(
+    bids_dir: Union[Path, str], previous: Optional[IndexState] = None, full_scan: bool = False
+) -> IndexState:
+    """Fingerprints each subject/session directory of a BIDS dataset.
+
+    Subjects with session directories are split into a unit for each session and a unit for the files of
+    the subject outside of its sessions. Everything outside of subject directories is one unit
+    (ROOT_UNIT). Only file names, sizes and mtimes are looked at.
+
+    The files of a subject/session unit are only walked if the mtimes of its directories changed since
+    the previous state, otherwise its previous fingerprint is kept. Files rewritten in place (which
+    doesn't change the mtime of their directory) are therefore missed unless full_scan is set.
+
+    Parameters
+    ----------
+    bids_dir : Union[Path, str]
+        BIDS dataset to scan.
+    previous : Optional[IndexState], optional
+        State of the previous scan (e.g. from read_state), by default None (walk every unit)
+    full_scan : bool, optional
+        Whether to walk the files of every unit regardless of its directories, by default False
+
+    Returns
+    -------
+    IndexState
+        Fingerprint of each unit, keyed by its path relative to bids_dir (e.g. "sub-01/ses-1").
+    """
+    bids_dir = Path(bids_dir)
+    units = {}
+    dirs = {}
+
+    def scan(unit: str, dir_entries: List[Tuple[str, int]], paths: List[Tuple[Path, str]]) -> None:
+        dirs[unit] = _fingerprint(dir_entries)
+        unchanged = previous is not None and previous.dirs.get(unit) == dirs[unit] and unit in previous.units
+        if unchanged and not full_scan:
+            units[unit] = previous.units[unit]
+        else:
+            units[unit] = _fingerprint(entry for path, prefix in paths for entry in _stat_entries(path, prefix))
+
+    root_entries = []
+    for entry in sorted(os.scandir(bids_dir), key=lambda entry: entry.name):
+        if entry.name.startswith((DATABASE_NAME, STATE_NAME)):
+            continue
+        path = Path(entry.path)
+        if entry.name.startswith("sub-") and entry.is_dir():
+            sessions = sorted(p.name for p in path.iterdir() if p.name.startswith("ses-") and p.is_dir())
+            for session in sessions:
+                unit = f"{entry.name}/{session}"
+                scan(unit, _dir_entries(path / session, unit), [(path / session, unit)])
+            scan(
+                entry.name,
+                _dir_entries(path, entry.name, skip=sessions),
+                [(child, f"{entry.name}/{child.name}") for child in path.iterdir() if child.name not in sessions],
+            )
+        elif entry.name not in UNINDEXED_DIRS and not entry.name.startswith("."):
+            root_entries.extend(_stat_entries(path, entry.name))
+    units[ROOT_UNIT] = _fingerprint(root_entries)
+    return IndexState(units, dirs)
+
+
+def unit_of(relpath: str, units: Iterable[str]) -> str:
+    """Finds the unit a path (relative to the dataset) belongs to.
+
+    Parameters
+    ----------
+    relpath : str
+        Path relative to the dataset.
+    units : Iterable[str]
+        Known units (e.g. from scan_units).
+
+    Returns
+    -------
+    str
+        The unit of the path.
+    """
+    parts = relpath.split("/")
+    if not parts[0].startswith("sub-"):
+        return ROOT_UNIT
+    if len(parts) > 2 and f"{parts[0]}/{parts[1]}" in units:
+        return f"{parts[0]}/{parts[1]}"
+    return parts[0]
+
+
+def read_state(state_path: Union[Path, str]) -> Optional[IndexState]:
+    """Reads the unit fingerprints recorded when a dataset was last indexed.
+
+    Parameters
+    ----------
+    state_path : Union[Path, str]
+        Path to the state file.
+
+    Returns
+    -------
+    Optional[IndexState]
+        Fingerprints of the units, None if there is no (readable) state.
+    """
+    try:
+        state = json.loads(Path(state_path).read_text())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(state, dict) or state.get("version") != STATE_VERSION:
+        return None
+    return IndexState(state.get("units", {}), state.get("dirs", {}))
+
+
+def index_fingerprint(bids_dir: Union[Path, str]) -> Optional[str]:
+    """Fingerprints the index of a dataset, this changes whenever the index is updated.
+
+    Parameters
+    ----------
+    bids_dir : Union[Path, str]
+        BIDS dataset.
+
+    Returns
+    -------
+    Optional[str]
+        Hash of the recorded state of the index, None if there is none (e.g. it was never loaded with
+        load_layout).
+    """
+    try:
+        return hashlib.sha1((Path(bids_dir) / STATE_NAME).read_bytes()).hexdigest()
+    except OSError:
+        return None
+
+
+def write_state(state_path: Union[Path, str], state: IndexState) -> None:
+    """Records the unit fingerprints of a dataset (atomically).
+
+    Parameters
+    ----------
+    state_path : Union[Path, str]
+        Path to the state file.
+    state : IndexState
+        Fingerprints of the units (from scan_units).
+    """
+    state_path = Path(state_path)
+    tmp_path = state_path.with_name(f".{state_path.name}.{os.getpid()}")
+    state = {"version": STATE_VERSION, "units": state.units, "dirs": state.dirs}
+    tmp_path.write_text(json.dumps(state, indent=2, sort_keys=True))
+    os.replace(tmp_path, state_path)
+
+
+def changed_units(units: Dict[str, str], previous: Dict[str, str]) -> Set[str]:
+    """Finds the units that were added, removed or modified.
+
+    A modified subject level unit marks every session of the subject as changed, since its files (e.g.
+    sidecars) can be inherited by the files of its sessions.
+
+    Parameters
+    ----------
+    units : Dict[str, str]
+        Current fingerprint of each unit.
+    previous : Dict[str, str]
+        Previous fingerprint of each unit.
+
+    Returns
+    -------
+    Set[str]
+        Changed units.
+    """
+    changed = {unit for unit in set(units) | set(previous) if units.get(unit) != previous.get(unit)}
+    for unit in set(units) | set(previous):
+        if unit.split("/")[0] in changed:
+            changed.add(unit)
+    return changed
+
+
+def _chunks(items: List[str]) -> Iterable[List[str]]:
+    for start in range(0, len(items), QUERY_CHUNK):
+        yield items[start : start + QUERY_CHUNK]
+
+
+def _relpath(path: str, root: str) -> str:
+    return Path(path).relative_to(root).as_posix()
+
+
+def _delete_files(session, paths: List[str]) -> None:
+    """Deletes files, their tags and their associations from a pybids database."""
+    for chunk in _chunks(paths):
+        session.query(Tag).filter(Tag.file_path.in_(chunk)).delete(synchronize_session=False)
+        session.query(FileAssociation).filter(FileAssociation.src.in_(chunk)).delete(synchronize_session=False)
+        session.query(FileAssociation).filter(FileAssociation.dst.in_(chunk)).delete(synchronize_session=False)
+        session.query(BIDSFile).filter(BIDSFile.path.in_(chunk)).delete(synchronize_session=False)
+
+
+def _copy_files(source, target, paths: List[str]) -> None:
+    """Copies files, their tags and their associations from one pybids database to another."""
+    target_entities = {name for (name,) in target.query(Entity.name)}
+    entity_rows = [
+        dict(row._mapping)
+        for row in source.execute(select(Entity.__table__))
+        if row._mapping["name"] not in target_entities
+    ]
+    if entity_rows:
+        target.execute(Entity.__table__.insert(), entity_rows)
+
+    for chunk in _chunks(paths):
+        for table, column in [(BIDSFile.__table__, "path"), (Tag.__table__, "file_path")]:
+            rows = [dict(row._mapping) for row in source.execute(select(table).where(table.c[column].in_(chunk)))]
+            if rows:
+                target.execute(table.insert(), rows)
+
+    path_set = set(paths)
+    association_rows = [
+        dict(row._mapping)
+        for row in source.execute(select(FileAssociation.__table__))
+        if row._mapping["src"] in path_set or row._mapping["dst"] in path_set
+    ]
+    if association_rows:
+        target.execute(FileAssociation.__table__.insert(), association_rows)
+
+
+def update_layout(layout: BIDSLayout, changed: Set[str], units: Dict[str, str], validate: bool = True) -> None:
+    """Re-indexes the changed units of a layout, updating its database in place.
+
+    The records of files in changed units are deleted, then the units that still exist are indexed with
+    a layout that ignores every other subject/session directory and their records are copied over.
+    Associations created from the metadata of files outside of the changed units (e.g. an IntendedFor in
+    another session pointing into a changed session) are not recreated; metadata itself is unaffected.
+
+    Parameters
+    ----------
+    layout : BIDSLayout
+        Layout to update.
+    changed : Set[str]
+        Changed units (from changed_units), must not include ROOT_UNIT.
+    units : Dict[str, str]
+        Current fingerprint of each unit.
+    validate : bool, optional
+        Whether to validate files against the BIDS spec when indexing, by default True
+    """
+    session = layout.session
+    root = layout.root
+    known = set(units) | changed
+
+    # delete the records of the changed units
+    stale = [path for (path,) in session.query(BIDSFile.path) if unit_of(_relpath(path, root), known) in changed]
+    _delete_files(session, stale)
+
+    # index the units that still exist, ignoring every subject/session that didn't change
+    present = {unit for unit in changed if unit in units}
+    if present:
+        subjects = {unit.split("/")[0] for unit in present}
+        ignored = [
+            unit
+            for unit in units
+            if unit != ROOT_UNIT and unit not in present and (unit.split("/")[0] not in subjects or "/" in unit)
+        ]
+        ignore = list(DEFAULT_LOCATIONS_TO_IGNORE)
+        if ignored:
+            ignore.append(re.compile(r"^/(%s)(/|$)" % "|".join(re.escape(unit) for unit in sorted(ignored))))
+        scoped = BIDSLayout(
+            root,
+            validate=validate,
+            config=list(layout.config.keys()),
+            indexer=BIDSLayoutIndexer(validate=validate, ignore=ignore),
+        )
+        paths = [
+            path
+            for (path,) in scoped.session.query(BIDSFile.path)
+            if unit_of(_relpath(path, root), known) in present
+        ]
+        _copy_files(scoped.session, session, paths)
+    session.commit()
+    session.expire_all()
+
+
+@contextmanager
+def index_lock(bids_dir: Union[Path, str]) -> Iterator[None]:
+    """Holds an exclusive lock on the index of a dataset, so concurrent runs don't update it at once.
+
+    Parameters
+    ----------
+    bids_dir : Union[Path, str]
+        BIDS dataset to lock.
+    """
+    with open(Path(bids_dir) / LOCK_NAME, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def load_layout(
+    bids_dir: Union[Path, str], reset_database: bool = False, validate: bool = True, full_scan: bool = False
+) -> BIDSLayout:
+    """Loads the layout of a BIDS dataset, re-indexing only what changed since it was last loaded.
+
+    The dataset is fully indexed if it has no database or recorded state yet, if reset_database is set,
+    or if files outside of subject directories changed. Concurrent loads of the same dataset wait for
+    each other (see index_lock). Files of subject/session directories that were rewritten in place are
+    only picked up with full_scan (see scan_units).
+
+    Parameters
+    ----------
+    bids_dir : Union[Path, str]
+        BIDS dataset to load, the database and state are stored in it.
+    reset_database : bool, optional
+        Whether to re-index the whole dataset, by default False
+    validate : bool, optional
+        Whether to validate files against the BIDS spec when indexing, by default True
+    full_scan : bool, optional
+        Whether to stat every file of the dataset to find changes, instead of only the files of the
+        subject/session directories whose directory mtimes changed, by default False
+
+    Returns
+    -------
+    BIDSLayout
+        Up to date layout of the dataset.
+    """
+    bids_dir = Path(bids_dir)
+    state_path = bids_dir / STATE_NAME
+    with index_lock(bids_dir):
+        previous = None if reset_database else read_state(state_path)
+        state = scan_units(bids_dir, previous, full_scan)
+
+        if (
+            previous is None
+            or not (bids_dir / DATABASE_NAME).exists()
+            or previous.units.get(ROOT_UNIT) != state.units[ROOT_UNIT]
+        ):
+            (bids_dir / INDEX_CACHE_NAME).unlink(missing_ok=True)
+            layout = BIDSLayout(bids_dir, database_path=bids_dir, reset_database=True, validate=validate)
+        else:
+            layout = BIDSLayout(bids_dir, database_path=bids_dir, validate=validate)
+            changed = changed_units(state.units, previous.units)
+            if changed:
+                print(f"Re-indexing {len(changed)} changed subject/session directories...")
+                (bids_dir / INDEX_CACHE_NAME).unlink(missing_ok=True)
+                update_layout(layout, changed, state.units, validate)
+        write_state(state_path, state)
+    return layout
@@ -0,0 +1,227 @@
+"""Counts the frames (and gets the shapes) of functional images without loading them.
+
+Only the fixed size NIfTI header at the start of each file is read (for gzipped files, only the first
+block is decompressed), falling back to the JSON sidecar of the image if the header can't be read.
+Counts are cached by path, size and mtime, so each file is only read once per process while it is
+unchanged, and the files of a session are counted concurrently since the work is I/O bound.
+"""
+import gzip
+import json
+import os
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple, Union
+
+# sizes of NIfTI-1 and NIfTI-2 headers, these are also the first field (sizeof_hdr) of each header
+NIFTI1_HEADER_SIZE = 348
+NIFTI2_HEADER_SIZE = 540
+
+# offsets of the dim field (dim[0] is the number of dimensions, dim[1:] the size of each) in each header
+NIFTI1_DIM_OFFSET = 40
+NIFTI2_DIM_OFFSET = 16
+
+# sidecar keys that can hold the number of frames (e.g. dcmmeta_shape is written by dcmstack/heudiconv)
+SIDECAR_FRAME_KEYS = ("NumberOfVolumes", "dcmmeta_shape")
+
+# number of files read at once
+DEFAULT_WORKERS = 8
+
+# cached frame counts, keyed by path, size and mtime
+_FRAME_CACHE: Dict[Tuple[str, int, int], int] = {}
+_FRAME_CACHE_LOCK = threading.Lock()
+
+
+def _open(path: Union[Path, str]):
+    """Opens a (possibly gzipped) file for reading."""
+    if str(path).endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def read_header_shape(path: Union[Path, str]) -> Tuple[int, ...]:
+    """Reads the shape of a NIfTI-1/NIfTI-2 image from its header.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path to the .nii or .nii.gz image.
+
+    Returns
+    -------
+    Tuple[int, ...]
+        Size of each dimension of the image.
+
+    Raises
+    ------
+    ValueError
+        If the file doesn't start with a NIfTI-1/NIfTI-2 header.
+    """
+    with _open(path) as f:
+        header = f.read(NIFTI2_HEADER_SIZE)
+    for endian in "<>":
+        if len(header) < 4:
+            break
+        sizeof_hdr = struct.unpack(f"{endian}i", header[:4])[0]
+        if sizeof_hdr == NIFTI1_HEADER_SIZE and len(header) >= NIFTI1_HEADER_SIZE:
+            dim = struct.unpack(f"{endian}8h", header[NIFTI1_DIM_OFFSET : NIFTI1_DIM_OFFSET + 16])
+        elif sizeof_hdr == NIFTI2_HEADER_SIZE and len(header) >= NIFTI2_HEADER_SIZE:
+            dim = struct.unpack(f"{endian}8q", header[NIFTI2_DIM_OFFSET : NIFTI2_DIM_OFFSET + 64])
+        else:
+            continue
+        if not 0 < dim[0] <= 7:
+            raise ValueError(f"Invalid number of dimensions ({dim[0]}) in NIfTI header of {path}")
+        return tuple(int(size) for size in dim[1 : dim[0] + 1])
+    raise ValueError(f"{path} does not have a NIfTI header")
+
+
+def read_header_frames(path: Union[Path, str]) -> int:
+    """Reads the number of frames of a NIfTI-1/NIfTI-2 image from its header.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path to the .nii or .nii.gz image.
+
+    Returns
+    -------
+    int
+        Size of the 4th dimension of the image, 1 for 3D images.
+
+    Raises
+    ------
+    ValueError
+        If the file doesn't start with a NIfTI-1/NIfTI-2 header.
+    """
+    shape = read_header_shape(path)
+    return shape[3] if len(shape) >= 4 else 1
+
+
+def sidecar_path(path: Union[Path, str]) -> Path:
+    """Gets the path of the JSON sidecar of an image.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path to the .nii or .nii.gz image.
+
+    Returns
+    -------
+    Path
+        Path to the sidecar.
+    """
+    path = Path(path)
+    name = path.name
+    for ext in (".nii.gz", ".nii"):
+        if name.endswith(ext):
+            name = name[: -len(ext)]
+            break
+    return path.with_name(f"{name}.json")
+
+
+def read_sidecar_frames(path: Union[Path, str]) -> Optional[int]:
+    """Reads the number of frames of an image from its JSON sidecar.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path to the .nii or .nii.gz image.
+
+    Returns
+    -------
+    Optional[int]
+        Number of frames, None if there is no sidecar or it doesn't have them.
+    """
+    try:
+        metadata = json.loads(sidecar_path(path).read_text())
+    except (OSError, ValueError):
+        return None
+    for key in SIDECAR_FRAME_KEYS:
+        value = metadata.get(key)
+        if isinstance(value, list):
+            value = value[3] if len(value) >= 4 else 1
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def image_shape(path: Union[Path, str]) -> Optional[Tuple[int, ...]]:
+    """Gets the shape of an image from its header, or its JSON sidecar if the header can't be read.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path to the .nii or .nii.gz image.
+
+    Returns
+    -------
+    Optional[Tuple[int, ...]]
+        Size of each dimension of the image, None if it is unknown.
+    """
+    try:
+        return read_header_shape(path)
+    except (OSError, EOFError, ValueError, struct.error):
+        pass
+    try:
+        shape = json.loads(sidecar_path(path).read_text()).get("dcmmeta_shape")
+    except (OSError, ValueError, AttributeError):
+        return None
+    return tuple(int(size) for size in shape) if isinstance(shape, list) else None
+
+
+def count_frames(path: Union[Path, str]) -> int:
+    """Counts the frames of an image, reading its header (or sidecar) only if it isn't cached.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path to the .nii or .nii.gz image.
+
+    Returns
+    -------
+    int
+        Number of frames.
+    """
+    stat = os.stat(path)
+    key = (str(path), stat.st_size, stat.st_mtime_ns)
+    with _FRAME_CACHE_LOCK:
+        if key in _FRAME_CACHE:
+            return _FRAME_CACHE[key]
+    try:
+        frames = read_header_frames(path)
+    except (OSError, EOFError, ValueError, struct.error) as error:
+        frames = read_sidecar_frames(path)
+        if frames is None:
+            raise ValueError(f"Could not read the number of frames of {path}") from error
+    with _FRAME_CACHE_LOCK:
+        _FRAME_CACHE[key] = frames
+    return frames
+
+
+def count_frames_all(paths: Iterable[Union[Path, str]], max_workers: int = DEFAULT_WORKERS) -> Dict[str, int]:
+    """Counts the frames of many images concurrently.
+
+    Parameters
+    ----------
+    paths : Iterable[Union[Path, str]]
+        Paths to the images.
+    max_workers : int, optional
+        Number of files to read at once, by default DEFAULT_WORKERS
+
+    Returns
+    -------
+    Dict[str, int]
+        Number of frames of each image, keyed by path (as a string).
+    """
+    paths = list(dict.fromkeys(str(path) for path in paths))
+    if len(paths) <= 1 or max_workers <= 1:
+        return {path: count_frames(path) for path in paths}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(paths))) as executor:
+        return dict(zip(paths, executor.map(count_frames, paths)))
+
+
+def clear_cache() -> None:
+    """Clears the cached frame counts."""
+    with _FRAME_CACHE_LOCK:
+        _FRAME_CACHE.clear()
@@ -0,0 +1,163 @@
+import re
+from dataclasses import dataclass
+from pathlib import Path
+
+"""
+Finds the runs of a session (or of every session in a derivatives tree) that grayplots can be made for.
+
+A session directory has the layout that Functional_pp_batch_ME_NORDIC.csh leaves behind:
+
+    bold{run}/{patid}_b{run}_faln_xr3d_uwrp_on_{outspace}_Swgt_norm.4dfp.img
+    bold{run}/{patid}_b{run}.params
+    movement/{patid}_b{run}_xr3d.rdat (and .ddat)
+    atlas/{day1_patid}_{GM,WM,VENT}_on_{outspace}.4dfp.img
+    FCmaps/{day1_patid}_ExAxTissue_mask.4dfp.img
+"""
+
+# name of the final functional image of a run
+FUNCTIONAL_PATTERN = re.compile(
+    r"^(?P<patid>.+)_b(?P<run>[^_]+)_faln_xr3d_uwrp_on_(?P<outspace>.+)_Swgt_norm\.4dfp\.img$"
+)
+
+# matches "set key = value" lines in csh params files
+PARAMS_PATTERN = re.compile(r"^\s*set\s+(?P<key>\w+)\s*=\s*(?P<value>.*?)\s*$")
+
+
+@dataclass(frozen=True)
+class GrayplotRun:
+    """
+    A run to make grayplots for, along with the files and parameters GrayplotGenerator needs
+    """
+
+    session_dir: Path
+    patid: str
+    day1_patid: str
+    run: str
+    outspace: str
+    tr: float
+
+    @property
+    def functional_name(self):
+        name = f"{self.patid}_b{self.run}_faln_xr3d_uwrp_on_{self.outspace}_Swgt_norm.4dfp.img"
+        return self.session_dir / f"bold{self.run}" / name
+
+    @property
+    def rdat_name(self):
+        return self.session_dir / "movement" / f"{self.patid}_b{self.run}_xr3d.rdat"
+
+    @property
+    def ddat_name(self):
+        return self.session_dir / "movement" / f"{self.patid}_b{self.run}_xr3d.ddat"
+
+    @property
+    def mask_names(self):
+        """
+        Masks of each tissue class, shared by all runs of a session in the same output space
+        """
+
+        atlas_dir = self.session_dir / "atlas"
+        return {
+            "gray_matter": atlas_dir / f"{self.day1_patid}_GM_on_{self.outspace}.4dfp.img",
+            "white_matter": atlas_dir / f"{self.day1_patid}_WM_on_{self.outspace}.4dfp.img",
+            "csf": atlas_dir / f"{self.day1_patid}_VENT_on_{self.outspace}.4dfp.img",
+            "extra_axial": self.session_dir / "FCmaps" / f"{self.day1_patid}_ExAxTissue_mask.4dfp.img",
+        }
+
+    @property
+    def mask_key(self):
+        """
+        Key identifying the masks of the run, runs with the same key can share them
+        """
+
+        return (str(self.session_dir), self.day1_patid, self.outspace)
+
+    @property
+    def output_name(self):
+        """
+        The pdf GrayplotGenerator writes for the run
+        """
+
+        return self.functional_name.parent / self.functional_name.name.replace(".4dfp.img", "_grayplots.pdf")
+
+
+def read_params(params_file):
+    """
+    Reads the "set key = value" lines of a csh params file
+
+    Returns: params, a dictionary of strings (list values are left as they are written, e.g. "(1 2 3)")
+    """
+
+    params = {}
+    for line in Path(params_file).read_text().splitlines():
+        match = PARAMS_PATTERN.match(line.split("#")[0])
+        if match is not None:
+            params[match.group("key")] = match.group("value").strip("\"'")
+    return params
+
+
+def find_day1_patid(session_dir, outspace):
+    """
+    Finds the patid the atlas masks of a session were named with, from its gray matter mask
+
+    Returns: day1_patid, a string
+    """
+
+    suffix = f"_GM_on_{outspace}.4dfp.img"
+    candidates = sorted(p.name[: -len(suffix)] for p in (Path(session_dir) / "atlas").glob(f"*{suffix}"))
+    if len(candidates) != 1:
+        raise ValueError(f"Expected one gray matter mask in {session_dir}/atlas for {outspace}, found {candidates}")
+    return candidates[0]
+
+
+def find_sessions(root):
+    """
+    Finds every session directory (a directory with bold{run} outputs) at or below root
+
+    Returns: sessions, a sorted list of session directory paths
+    """
+
+    root = Path(root)
+    sessions = {
+        functional.parent.parent
+        for functional in root.glob("**/bold*/*_Swgt_norm.4dfp.img")
+        if FUNCTIONAL_PATTERN.match(functional.name) is not None
+    }
+    return sorted(sessions)
+
+
+def find_grayplot_runs(session_dir, day1_patid=None, tr=None, outspace=None):
+    """
+    Finds every run of a session that grayplots can be made for
+
+    Args:
+        session_dir: path to the session directory (the one with the bold{run}, movement, atlas and FCmaps directories)
+        day1_patid: patid the atlas masks were named with, found from the gray matter mask if not given
+        tr: repetition time of all runs, read from each run's params file if not given
+        outspace: only find runs in this output space
+
+    Returns: runs, a list of GrayplotRun
+    """
+
+    session_dir = Path(session_dir).absolute()
+    runs = []
+    for functional in sorted(session_dir.glob("bold*/*_Swgt_norm.4dfp.img")):
+        match = FUNCTIONAL_PATTERN.match(functional.name)
+        if match is None or functional.parent.name != f"bold{match.group('run')}":
+            continue
+        if outspace is not None and match.group("outspace") != outspace:
+            continue
+        run_tr = tr
+        if run_tr is None:
+            params_file = functional.parent / f"{match.group('patid')}_b{match.group('run')}.params"
+            run_tr = float(read_params(params_file)["TR_vol"])
+        runs.append(
+            GrayplotRun(
+                session_dir=session_dir,
+                patid=match.group("patid"),
+                day1_patid=day1_patid or find_day1_patid(session_dir, match.group("outspace")),
+                run=match.group("run"),
+                outspace=match.group("outspace"),
+                tr=run_tr,
+            )
+        )
+    return runs
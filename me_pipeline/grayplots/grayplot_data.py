@@ -0,0 +1,82 @@
+import numpy as np
+from .grayplot_helpers import read_image_4dfp
+
+"""
+Computes the data shown in grayplots in a single pass over a (memory-mapped) functional image.
+
+Only the rows that will actually be drawn are read, in float32, a chunk of frames at a time, so a
+run never has to be held in memory as a whole (or copied to float64) to plot it.
+"""
+
+# number of frames to read from the functional image at a time
+DEFAULT_CHUNK_FRAMES = 64
+
+
+def mask_rows(mask):
+    """
+    Finds the rows of a (voxels x frames) mask array that are nonzero in any frame
+
+    Returns: rows, a numpy array of row indices in increasing order
+    """
+
+    mask = np.asarray(mask)
+    return np.flatnonzero(mask.reshape(mask.shape[0], -1).any(axis=1))
+
+
+def read_mask_rows(mask_names):
+    """
+    Reads the nonzero rows of each mask in a dictionary of mask file paths, only these are needed to plot a run
+
+    Returns: rows, a dictionary of numpy arrays of row indices
+    """
+
+    return {name: mask_rows(read_image_4dfp(mask_name)) for name, mask_name in mask_names.items()}
+
+
+def select_rows(rows, step=1, max_rows=None):
+    """
+    Picks every step-th row, then evenly thins them out to at most max_rows rows (e.g. the pixel height of the plot),
+    since rows beyond that can't be displayed anyway
+
+    Returns: rows, a numpy array of the selected row indices
+    """
+
+    rows = np.asarray(rows)[::step]
+    if max_rows is not None and len(rows) > max_rows > 0:
+        rows = rows[np.linspace(0, len(rows) - 1, int(max_rows)).round().astype(int)]
+    return rows
+
+
+def axes_pixel_height(axes):
+    """
+    Gets the height of a matplotlib axes in pixels, at the dpi of its figure
+
+    Returns: height, an int
+    """
+
+    return max(int(np.ceil(axes.get_window_extent().height)), 1)
+
+
+def tissue_timecourses(functional_image, rows, chunk_frames=DEFAULT_CHUNK_FRAMES):
+    """
+    Given a (voxels x frames) functional image array (e.g. a memmap from read_image_4dfp) and a dictionary of row
+    indices for each tissue, computes the demeaned timecourse of every row in one pass over the frames of the image
+
+    Returns: timecourses, a dictionary of float32 numpy arrays (rows x frames) with the mean of each row removed
+    """
+
+    num_frames = functional_image.shape[1]
+
+    # read the rows of all tissues together, then split them back up
+    names = list(rows.keys())
+    all_rows = np.concatenate([np.asarray(rows[name], dtype=np.intp) for name in names])
+    data = np.empty((len(all_rows), num_frames), dtype=np.float32)
+    for start in range(0, num_frames, chunk_frames):
+        stop = min(start + chunk_frames, num_frames)
+        data[:, start:stop] = functional_image[all_rows, start:stop]
+
+    # remove the mean of each row, broadcasting it over the frames (accumulated in float64 for precision)
+    data -= data.mean(axis=1, dtype=np.float64, keepdims=True).astype(np.float32)
+
+    splits = np.cumsum([len(rows[name]) for name in names])[:-1]
+    return dict(zip(names, np.split(data, splits, axis=0)))
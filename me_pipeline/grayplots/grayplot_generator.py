@@ -6,17 +6,41 @@ import matplotlib.gridspec as gridspec
 from matplotlib.backends.backend_pdf import PdfPages
 import seaborn as sns
 from .grayplot_helpers import *
+from .grayplot_data import axes_pixel_height, read_mask_rows, select_rows, tissue_timecourses
 
 sns.set_theme(font_scale=0.5)  # type: ignore
 
+# grayplots are only ever written to files, so never start an interactive backend (e.g. on cluster nodes)
+mpl.use("Agg")
+
+# step between plotted rows, grid rows and y label of each grayplot panel, from top to bottom
+GRAYPLOT_PANELS = {
+    "gray_matter": (100, (0, 3), "Gray"),
+    "white_matter": (75, (3, 4), "White"),
+    "csf": (10, (4, 5), "Vent"),
+    "extra_axial": (100, (5, 6), "ExtraAx"),
+}
+
 
 class GrayplotGenerator:
     """
     Class for generating grayplots for a given set of images.
+
+    The rows of each mask can be given as mask_rows (see grayplot_data.read_mask_rows) when they were already read,
+    e.g. once for all runs of a session, in which case the mask images are not read again.
     """
 
     def __init__(
-        self, ddat_name, rdat_name, functional_name, gray_matter_name, white_matter_name, csf_name, extra_axial_name, tr
+        self,
+        ddat_name,
+        rdat_name,
+        functional_name,
+        gray_matter_name,
+        white_matter_name,
+        csf_name,
+        extra_axial_name,
+        tr,
+        mask_rows=None,
     ):
         # Load dat file names into variables
         self.ddat_name = ddat_name
@@ -27,13 +51,17 @@ class GrayplotGenerator:
         # Read functional image
         self.functional_image = read_image_4dfp(functional_name)
 
-        # Read all other images and store into images dictionary
-        self.images = {
-            "gray_matter": read_image_4dfp(gray_matter_name),
-            "white_matter": read_image_4dfp(white_matter_name),
-            "csf": read_image_4dfp(csf_name),
-            "extra_axial": read_image_4dfp(extra_axial_name),
-        }
+        # Read the voxels (rows) of all other images and store into mask rows dictionary
+        if mask_rows is None:
+            mask_rows = read_mask_rows(
+                {
+                    "gray_matter": gray_matter_name,
+                    "white_matter": white_matter_name,
+                    "csf": csf_name,
+                    "extra_axial": extra_axial_name,
+                }
+            )
+        self.mask_rows = mask_rows
 
         self.generate_pdf(tr)
 
@@ -63,48 +91,30 @@ class GrayplotGenerator:
         Returns: fig, a matplotlib figure with all grayplots on it
         """
 
-        # Calculate functional image demean
-        functional_image_demean = demean(self.functional_image)
-
-        # Calculate timecourses for each non-functional image
-        timecourses = {}
-        for image_name in self.images.keys():
-            timecourses[f"{image_name}_timecourse"] = get_timecourse(functional_image_demean, self.images[image_name])
-
         # Instantiate figure and grid
         fig = plt.figure()
         grid = gridspec.GridSpec(6, 1)
 
-        # Plot gray matter timecourse
-        self.plot_timecourse(
-            timecourse=timecourses["gray_matter_timecourse"], fig=fig, grid=grid, step=100, rows=(0, 3), y_label="Gray"
-        )
-
-        # Plot white matter timecourse
-        self.plot_timecourse(
-            timecourse=timecourses["white_matter_timecourse"],
-            fig=fig,
-            grid=grid,
-            step=75,
-            rows=(3, 4),
-            y_label="White",
-        )
-
-        # Plot ventricles timecourse
-        self.plot_timecourse(
-            timecourse=timecourses["csf_timecourse"], fig=fig, grid=grid, step=10, rows=(4, 5), y_label="Vent"
-        )
-
-        # Plot extra-axial timecourse
-        self.plot_timecourse(
-            timecourse=timecourses["extra_axial_timecourse"],
-            fig=fig,
-            grid=grid,
-            step=100,
-            rows=(5, 6),
-            y_label="ExtraAx",
-            xaxis=True,
-        )
+        # Create the axes of each timecourse first, so only the rows that fit in each of them need to be read
+        axes = {}
+        rows = {}
+        for image_name, (step, (row_start, row_end), _) in GRAYPLOT_PANELS.items():
+            axes[image_name] = fig.add_subplot(grid[row_start:row_end, :])
+            rows[image_name] = select_rows(
+                self.mask_rows[image_name], step=step, max_rows=axes_pixel_height(axes[image_name])
+            )
+
+        # Calculate the demeaned timecourses of all images in one pass over the functional image
+        timecourses = tissue_timecourses(self.functional_image, rows)
+
+        # Plot each timecourse, with the x axis on the last one
+        for n, (image_name, (_, _, y_label)) in enumerate(GRAYPLOT_PANELS.items()):
+            self.plot_timecourse(
+                timecourse=timecourses[image_name],
+                timecourse_plot=axes[image_name],
+                y_label=y_label,
+                xaxis=n == len(GRAYPLOT_PANELS) - 1,
+            )
 
         return fig
 
@@ -154,29 +164,22 @@ class GrayplotGenerator:
 
         return fig
 
-    def plot_timecourse(self, timecourse, fig, grid, step, rows, y_label, xaxis=False):
+    def plot_timecourse(self, timecourse, timecourse_plot, y_label, xaxis=False):
         """
         Generates plot for given timecourse
         Args:
-            timecourse: numpy array of specific image's timecourse
-            fig: matplotlib figure instance that all timecourses will be plotted on
-            grid: matplotlib gridspec instance that all timecourses will be plotted on
-            indices: tuple containing the upper bound and step amount for indexing timecourse
-            rows: tuple containing the grid row start and stop for the timecourse
+            timecourse: numpy array of the rows of a specific image's timecourse to plot
+            timecourse_plot: matplotlib axes instance that the timecourse will be plotted on
             y_label: string of the label for y axis
 
         Return: none
         """
 
-        row_start, row_end = rows
-        upper_bound = timecourse.shape[0]
         low_lim = -150
         high_lim = 150
 
-        timecourse_plot = fig.add_subplot(grid[row_start:row_end, :])
-
         timecourse_plot.imshow(
-            timecourse[0:upper_bound:step, :],
+            timecourse,
             vmin=low_lim,
             vmax=high_lim,
             cmap=mpl.colormaps["gist_gray"],  # type: ignore
@@ -1,8 +1,9 @@
 from pathlib import Path
 import numpy as np
-import scipy as sp
 import nibabel as nib
-import pandas as pd
+from me_pipeline.io.fourdfp import load_4dfp
+from me_pipeline.io.geometry import read_geometry
+from me_pipeline.motion import filter_motion, framewise_displacement, read_dat
 
 """
 All functions related to retreiving or mutating data used for grayplot generation.
@@ -34,27 +35,13 @@ def read_image_nibabel(image_file_path):
 
 def read_image_4dfp(image_file_path):
     """
-    Loads 4dfp image into numpy array for given file path
+    Memory maps 4dfp image as a numpy array for given file path
 
     Returns: image_data, a numpy array (row size = product of image i,j,k dimensions, column size = number of frames)
     """
 
-    # Determine image's corresponding ifh file
-    pth, fname = filename_finder(image_file_path)
-    ifh_name = pth / f"{fname}.ifh"
-
-    # Get dimensions of image from header
-    i_dim, j_dim, k_dim, num_frames = read_header_4dfp(ifh_name)
-
-    # Read image from file into data array
-    with open(image_file_path, "rb") as fid:
-        data_array = np.fromfile(fid, dtype="<f4")
-
-    # Calculate the total volume of voxels given the dimensions
-    voxel_volume = i_dim * j_dim * k_dim
-
-    # Convert image data to numpy array
-    image_data = np.reshape(data_array, newshape=(voxel_volume, num_frames), order="F")
+    # Map the image (in the byte order given by its ifh) without reading it into memory
+    image_data = load_4dfp(image_file_path).as_2d()
 
     return image_data
 
@@ -80,23 +67,8 @@ def read_header_4dfp(ifh_path):
     Returns: i_dim, j_dim, k_dim, num_frames integers that describe the 4 dimensions of the image
     """
 
-    # Parse the ifh into a dataframe, then store as a dictionary to access values
-    ifh_dataframe = pd.read_csv(
-        ifh_path,
-        delimiter=":=",
-        engine="python",
-        skiprows=1,
-        header=None,
-        names=["param", "value"],
-        converters={"param": lambda x: x.strip("\t"), "value": lambda x: x.strip()},
-    )
-    ifh_dict = dict(zip(ifh_dataframe["param"], ifh_dataframe["value"]))
-
-    # Retrieve relevant data points
-    i_dim = int(ifh_dict["matrix size [1]"])
-    j_dim = int(ifh_dict["matrix size [2]"])
-    k_dim = int(ifh_dict["matrix size [3]"])
-    num_frames = int(ifh_dict["matrix size [4]"])
+    # Parse the ifh (cached by path and modification time) and retrieve relevant data points
+    i_dim, j_dim, k_dim, num_frames = read_geometry(ifh_path).dims
 
     return i_dim, j_dim, k_dim, num_frames
 
@@ -107,18 +79,11 @@ def demean(functional_image):
     Returns: functional_image_demean, a numpy array the same size as the input image
     """
 
-    timepoints = functional_image.shape[1]
-
     # Compute mean of each row, results in array with one column
-    functional_image_mean = functional_image.mean(axis=1)
+    functional_image_mean = functional_image.mean(axis=1, keepdims=True)
 
-    # Create an array with the mean column repeated timepoints amount of times
-    repeated_mean = np.tile(
-        functional_image_mean.reshape(functional_image_mean.shape[0], 1, order="F"), (1, timepoints)
-    )
-
-    # Create an array of the the mean array subtracted from the functional image
-    functional_image_demean = functional_image - repeated_mean
+    # Subtract the mean column from every timepoint by broadcasting, rather than tiling a copy of it
+    functional_image_demean = functional_image - functional_image_mean
 
     return functional_image_demean
 
@@ -142,24 +107,8 @@ def dat_calculations(dat_file, radius=50):
     Returns: mvm, a numpy array (row size = signal length, column size = 6)
     """
 
-    # Load dat file into numpy array with comments stripped
-    dat_array = np.loadtxt(dat_file, comments="#")
-    if dat_array[0][0] != 1:
-        raise ValueError("ERROR: First frame of dat file is not 1.")
-
-    num_rows, num_cols = dat_array.shape
-
-    # Create an empty array of size num rows * 6 columns
-    mvm = np.zeros((num_rows, 6))
-
-    # Copy first three rows over directly and round to 4 decimal points
-    mvm[:, :3] = np.round(dat_array[:, 1:4], 4)
-
-    # Convert rows 4 through 6 of the dat file from rotational to mm
-    deg_to_mm_converter = np.vectorize(lambda x: x * (2 * radius * np.pi / 360))
-    mvm[:, 3:6] = np.round(deg_to_mm_converter(dat_array[:, 4:7]), 4)
-
-    return mvm
+    # Load dat file with comments stripped, converting rotations to mm
+    return read_dat(dat_file, radius)
 
 
 def modify_fft_array(signal_length, mvm_fft):
@@ -190,14 +139,8 @@ def transform_movement_frequency(mvm):
     Returns: mvm_fft, a numpy array containing complex values
     """
 
-    # Create an empty array
-    mvm_fft = np.empty((mvm.shape[0], mvm.shape[1]), dtype="complex_")
-
-    for col in range(6):
-        # Apply fast fourier transform to mvm array, columnwise
-        mvm_fft[:, col] = np.fft.fft(mvm[:, col], axis=0)
-
-    return mvm_fft
+    # Apply fast fourier transform to all columns of the mvm array at once
+    return np.fft.fft(mvm, axis=0)
 
 
 def filter_movement_frequency(mvm, tr):
@@ -205,34 +148,17 @@ def filter_movement_frequency(mvm, tr):
     Filters mvm array and then applies fast fourier transform and diff to filtered array
 
     Returns:
-        mvm_filt, a numpy array filtered with a linear digital filter
-        mvm_filt_fft, a numpy array with fast fourier transform applied to mvm_filt
-        ddt_mvm_filt, a numpy array containing differences between adjacent elements in mvm_filt
+        mvm_filt_fft, a numpy array with fast fourier transform applied to the filtered mvm array
+        FD_filt, a numpy array (1 x signal length) of the FD of the filtered mvm array
     """
 
-    # Create a first order Butterworth filter
-    lowpass_cut = 0.1
-    lowpass_Wn = lowpass_cut / (0.5 / tr)
-
-    # Compute Butterworth transfer function coefficients
-    b, a = sp.signal.butter(1, lowpass_Wn, "low")
-
-    # Create empty arrays
-    mvm_filt = np.empty((mvm.shape[0], mvm.shape[1]))
-    mvm_filt_fft = np.empty((mvm.shape[0], mvm.shape[1]), dtype="complex_")
-    ddt_mvm_filt = np.empty((mvm.shape[0] - 1, mvm.shape[1]))
-
-    for col in range(6):
-        # Apply filter using transfer function coefficients on mvm array
-        mvm_filt[:, col] = sp.signal.filtfilt(b, a, mvm[:, col], axis=0)
-
-        # Apply fast fourier transform on filtered mvm array
-        mvm_filt_fft[:, col] = np.fft.fft(mvm_filt[:, col], axis=0)
+    # Filter all columns with a first order Butterworth filter (coefficients are cached per TR)
+    mvm_filt = filter_motion(mvm, tr)
 
-        # Calculate differences between adjacent elements in filtered mvm array
-        ddt_mvm_filt[:, col] = np.diff(mvm_filt[:, col], axis=0)
+    # Apply fast fourier transform on filtered mvm array
+    mvm_filt_fft = np.fft.fft(mvm_filt, axis=0)
 
-    # Sum differences in ddt filter columnwise and transpose resulting matrix
-    FD_filt = np.insert((np.sum(np.abs(ddt_mvm_filt), axis=1, keepdims=True)), 0, 0, 0).T
+    # Sum differences between adjacent frames columnwise, with an FD of 0 for the first frame
+    FD_filt = framewise_displacement(mvm_filt)[np.newaxis, :]
 
     return mvm_filt_fft, FD_filt
@@ -8,7 +8,8 @@ install and invoke the heudiconv command line tool:
         -f heuristics.py -c dcm2niix -b --overwrite -o /path/to/output/directory
 
 """
-from typing import Any, Dict, List, Tuple, Union
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
 from types import SimpleNamespace
 
 
@@ -120,8 +121,73 @@ def check_in_sequence(items: Union[List[Any], Any], sequence: List[Any]) -> bool
     return any(item in sequence for item in items)
 
 
-# Dictionary to store extra metadata keyed by series uid
-EXTRA_METADATA = {}
+class EnhancedMetadata(NamedTuple):
+    """Metadata of an enhanced dicom series that is missing from its heudiconv seqinfo.
+
+    Parameters
+    ----------
+    sequence_name : str
+        Sequence name of the first frame.
+    image_type : Tuple[str, ...]
+        Image type of the first frame, this holds the echo (TE1, TE2, ...), the part (M/P) and the
+        multi-band (MB) flags used to sort multi-echo data.
+    """
+
+    sequence_name: str
+    image_type: Tuple[str, ...]
+
+
+# Dictionary to store the metadata of enhanced dicoms keyed by series uid
+EXTRA_METADATA: Dict[str, EnhancedMetadata] = {}
+
+# Values larger than this are only read if they are accessed when reading dicoms from a path
+DEFER_SIZE = "1 KB"
+
+
+def extract_enhanced_metadata(dcmdata: Any) -> Optional[EnhancedMetadata]:
+    """Extracts the metadata infotodict needs from an enhanced dicom.
+
+    Parameters
+    ----------
+    dcmdata : Any
+        The dicom data to extract from.
+
+    Returns
+    -------
+    Optional[EnhancedMetadata]
+        The metadata, None if the dicom doesn't have it.
+    """
+    try:
+        # the first item of the per-frame functional groups sequence
+        frame = dcmdata[0x5200, 0x9230][0]
+        sequence_name = frame[0x0018, 0x9226][0][0x0021, 0x1177].value
+        image_type = frame[0x0021, 0x11FE][0][0x0021, 0x1175].value
+    except (KeyError, IndexError, TypeError):
+        return None
+    # copy the values, so nothing references the dataset
+    if isinstance(image_type, str):
+        image_type = [image_type]
+    return EnhancedMetadata(str(sequence_name), tuple(str(value) for value in image_type))
+
+
+def read_enhanced_metadata(path: Union[Path, str], defer_size: Union[int, str, None] = DEFER_SIZE) -> Any:
+    """Reads a dicom without its pixel data, deferring the read of large values until they are accessed.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path to the dicom.
+    defer_size : Union[int, str, None], optional
+        Values larger than this (in bytes, or e.g. "1 KB") are read when accessed, by default DEFER_SIZE
+
+    Returns
+    -------
+    Any
+        The dicom data.
+    """
+    import pydicom
+
+    return pydicom.dcmread(str(path), stop_before_pixels=True, defer_size=defer_size, force=True)
 
 
 def filter_dicom(dcmdata: Any) -> bool:
@@ -131,25 +197,33 @@ def filter_dicom(dcmdata: Any) -> bool:
     currently available by default in the heudiconv seqinfo dictionary. This
     mainly applies to the enhanced dicoms in the new XA30 OS.
 
+    Only the fields infotodict needs are kept (see EnhancedMetadata), once
+    per series, so the dicom data can be released as soon as this returns.
+
     Parameters
     ----------
     dcmdata : Any
-        The dicom data to check.
+        The dicom data to check, or a path to the dicom (which is read
+        without its pixel data, see read_enhanced_metadata).
 
     Returns
     -------
     bool
         True if the dicom series should be filtered.
     """
+    if isinstance(dcmdata, (str, Path)):
+        dcmdata = read_enhanced_metadata(dcmdata)
     # check if the series is an enhanced dicom
     file_type = dcmdata.file_meta[0x0002, 0x0002].repval
     if "Enhanced MR Image Storage" in file_type:
         # get the series uid
         series_uid = dcmdata.SeriesInstanceUID
-        # store the dcmdata in the EXTRA_METADATA dictionary
+        # store the metadata in the EXTRA_METADATA dictionary
         # if it's not already there
         if series_uid not in EXTRA_METADATA:
-            EXTRA_METADATA[series_uid] = dcmdata
+            metadata = extract_enhanced_metadata(dcmdata)
+            if metadata is not None:
+                EXTRA_METADATA[series_uid] = metadata
 
     # always include the dicom
     return False
@@ -260,9 +334,9 @@ def infotodict(seqinfo):
         if s.series_uid in EXTRA_METADATA:
             # convert s to a mutable object
             s = SimpleNamespace(**s._asdict())
-            dcmdata = EXTRA_METADATA[s.series_uid]
-            s.sequence_name = dcmdata[0x5200, 0x9230][0][0x0018, 0x9226][0][0x0021, 0x1177].value
-            s.image_type = dcmdata[0x5200, 0x9230][0][0x0021, 0x11FE][0][0x0021, 0x1175].value
+            metadata = EXTRA_METADATA[s.series_uid]
+            s.sequence_name = metadata.sequence_name
+            s.image_type = metadata.image_type
 
         # skip all SBRefs
         if "SBRef" in s.series_description:
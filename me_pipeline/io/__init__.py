@@ -0,0 +1 @@
+"""Native readers and writers for the image formats used by the pipeline."""
@@ -0,0 +1,393 @@
+"""Memory-mapped reading and writing of 4dfp images.
+
+A 4dfp image is a headerless ``.4dfp.img`` file of 32-bit floats (x fastest, then y, z and
+frames) described by a ``.4dfp.ifh`` interfile header. The 4dfp tools also keep an Analyze
+``.4dfp.hdr`` header (written by ``ifh2hdr``) and a ``.4dfp.img.rec`` provenance record next
+to it. This module reads and writes all of these directly, so a single frame or slice of a
+run can be accessed through ``np.memmap`` without loading the whole run into memory.
+"""
+import os
+import sys
+from dataclasses import dataclass, field, replace
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+import nibabel as nib
+import numpy as np
+
+
+# suffixes of the files making up a 4dfp image
+FOURDFP_SUFFIXES = {"img": ".4dfp.img", "ifh": ".4dfp.ifh", "hdr": ".4dfp.hdr", "rec": ".4dfp.img.rec"}
+
+# maps the ifh byte order to a numpy byte order
+BYTE_ORDERS = {"bigendian": ">", "littleendian": "<"}
+
+
+@dataclass
+class IFH:
+    """Contents of a 4dfp interfile header (.ifh).
+
+    Keys that are not parsed into attributes are kept in ``extra`` so they can be written back.
+
+    Parameters
+    ----------
+    matrix_size : List[int]
+        Number of voxels along x, y, z and the number of frames.
+    scaling_factor : List[float]
+        Voxel sizes (mm/pixel) along x, y and z.
+    orientation : int, optional
+        4dfp orientation (2: transverse, 3: coronal, 4: sagittal), by default 2
+    byte_order : str, optional
+        Byte order of the image data, "bigendian" or "littleendian", by default the byte order of this machine
+    mmppix : Optional[List[float]], optional
+        Signed voxel sizes, by default None
+    center : Optional[List[float]], optional
+        Center of the image in mm, by default None
+    name_of_data_file : str, optional
+        Name of the .4dfp.img file, by default ""
+    conversion_program : str, optional
+        Program that wrote the image, by default "me_pipeline"
+    extra : Dict[str, str], optional
+        Any other keys in the header, by default {}
+    """
+
+    matrix_size: List[int]
+    scaling_factor: List[float]
+    orientation: int = 2
+    byte_order: str = f"{sys.byteorder}endian"
+    mmppix: Optional[List[float]] = None
+    center: Optional[List[float]] = None
+    name_of_data_file: str = ""
+    conversion_program: str = "me_pipeline"
+    extra: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def shape(self) -> Tuple[int, int, int, int]:
+        """Shape of the image data (x, y, z, frames)."""
+        return tuple(int(n) for n in self.matrix_size)  # type: ignore
+
+    @property
+    def dtype(self) -> np.dtype:
+        """Data type of the image data, including its byte order."""
+        return np.dtype(f"{BYTE_ORDERS[self.byte_order]}f4")
+
+
+def fourdfp_paths(path: Union[Path, str]) -> Dict[str, Path]:
+    """Gets the paths of the files making up a 4dfp image.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path to any of the 4dfp files, or the path without a suffix.
+
+    Returns
+    -------
+    Dict[str, Path]
+        Paths to the "img", "ifh", "hdr" and "rec" files.
+    """
+    base = str(path)
+    for suffix in sorted(FOURDFP_SUFFIXES.values(), key=len, reverse=True) + [".4dfp"]:
+        if base.endswith(suffix):
+            base = base[: -len(suffix)]
+            break
+    return {key: Path(f"{base}{suffix}") for key, suffix in FOURDFP_SUFFIXES.items()}
+
+
+def read_ifh(path: Union[Path, str]) -> IFH:
+    """Reads a 4dfp interfile header.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path to the 4dfp image (any of its files).
+
+    Returns
+    -------
+    IFH
+        Parsed header.
+    """
+    ifh_path = fourdfp_paths(path)["ifh"]
+    values = {}
+    with open(ifh_path, "r") as f:
+        for line in f:
+            if ":=" not in line:
+                continue
+            key, value = line.split(":=", 1)
+            values[key.strip()] = value.strip()
+
+    # only 32-bit floats are supported by the 4dfp tools
+    if values.get("number format", "float") != "float" or int(values.get("number of bytes per pixel", "4")) != 4:
+        raise ValueError(f"{ifh_path} does not describe a 32-bit float image")
+    byte_order = values.get("imagedata byte order", "bigendian")
+    if byte_order not in BYTE_ORDERS:
+        raise ValueError(f"Unknown byte order in {ifh_path}: {byte_order}")
+
+    # pop off the keys that are parsed into attributes, whatever is left goes into extra
+    matrix_size = [int(values.pop(f"matrix size [{n}]", "1")) for n in range(1, 5)]
+    scaling_factor = [float(values.pop(f"scaling factor (mm/pixel) [{n}]", "1")) for n in range(1, 4)]
+    mmppix = [float(v) for v in values.pop("mmppix").split()] if "mmppix" in values else None
+    center = [float(v) for v in values.pop("center").split()] if "center" in values else None
+    ifh = IFH(
+        matrix_size=matrix_size,
+        scaling_factor=scaling_factor,
+        orientation=int(values.pop("orientation", "2")),
+        byte_order=values.pop("imagedata byte order", byte_order),
+        mmppix=mmppix,
+        center=center,
+        name_of_data_file=values.pop("name of data file", ""),
+        conversion_program=values.pop("conversion program", ""),
+    )
+    for key in ("INTERFILE", "version of keys", "number format", "number of bytes per pixel", "number of dimensions"):
+        values.pop(key, None)
+    ifh.extra = values
+    return ifh
+
+
+def write_ifh(path: Union[Path, str], ifh: IFH) -> None:
+    """Writes a 4dfp interfile header.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path to the 4dfp image (any of its files).
+    ifh : IFH
+        Header to write.
+    """
+    paths = fourdfp_paths(path)
+    lines = [
+        ("INTERFILE", ""),
+        ("version of keys", "3.3"),
+        ("number format", "float"),
+        ("conversion program", ifh.conversion_program),
+        ("name of data file", ifh.name_of_data_file or paths["img"].name),
+        ("number of bytes per pixel", "4"),
+        ("imagedata byte order", ifh.byte_order),
+        ("orientation", str(ifh.orientation)),
+        ("number of dimensions", "4"),
+    ]
+    lines += [(f"matrix size [{n + 1}]", str(m)) for n, m in enumerate(ifh.shape)]
+    lines += [(f"scaling factor (mm/pixel) [{n + 1}]", f"{s:f}") for n, s in enumerate(ifh.scaling_factor)]
+    if ifh.mmppix is not None:
+        lines.append(("mmppix", "".join(f"{v:10.6f}" for v in ifh.mmppix)))
+    if ifh.center is not None:
+        lines.append(("center", "".join(f"{v:11.4f}" for v in ifh.center)))
+    lines += list(ifh.extra.items())
+    with open(paths["ifh"], "w") as f:
+        f.writelines(f"{key}\t:= {value}\n" for key, value in lines)
+
+
+def write_hdr(path: Union[Path, str], ifh: IFH, display_range: Optional[Tuple[float, float]] = None) -> None:
+    """Writes the Analyze header of a 4dfp image (ifh2hdr).
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path to the 4dfp image (any of its files).
+    ifh : IFH
+        Header of the image.
+    display_range : Optional[Tuple[float, float]], optional
+        Display range (glmin, glmax) to store in the header (ifh2hdr -r), by default None
+    """
+    header = nib.AnalyzeHeader(endianness=BYTE_ORDERS[ifh.byte_order])
+    header.set_data_shape(ifh.shape)
+    header.set_data_dtype(np.float32)
+    header.set_zooms([abs(s) for s in ifh.scaling_factor] + [1.0])
+    # analyze orientations are the 4dfp orientations offset by 2 (0: transverse, 1: coronal, 2: sagittal)
+    header["orient"] = bytes([max(ifh.orientation - 2, 0)])
+    if display_range is not None:
+        header["glmin"], header["glmax"] = display_range
+    with open(fourdfp_paths(path)["hdr"], "wb") as f:
+        f.write(header.binaryblock)
+
+
+def write_rec(path: Union[Path, str], lines: Sequence[str] = (), parents: Sequence[Union[Path, str]] = ()) -> None:
+    """Writes the rec file of a 4dfp image, appending the rec files of the images it was made from.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path to the 4dfp image (any of its files).
+    lines : Sequence[str], optional
+        Lines to record (e.g. the command that made the image), by default ()
+    parents : Sequence[Union[Path, str]], optional
+        4dfp images the image was made from, by default ()
+    """
+    paths = fourdfp_paths(path)
+    # try to get the login name, but if we fail, just use "unknown"
+    try:
+        login = os.getlogin()
+    except OSError:
+        login = "unknown"
+    with open(paths["rec"], "w") as f:
+        f.write(f"rec {paths['img']} {datetime.now().strftime('%c')} {login}@{os.uname().nodename}\n")
+        f.writelines(f"{line}\n" for line in lines)
+        for parent in parents:
+            parent_rec = fourdfp_paths(parent)["rec"]
+            if parent_rec.exists():
+                f.write(parent_rec.read_text())
+        f.write(f"endrec {datetime.now().strftime('%c')} {login}\n")
+
+
+class FourDFPImage:
+    """A memory-mapped 4dfp image.
+
+    The image data is exposed as a (x, y, z, frames) Fortran ordered ``np.memmap``, so indexing a
+    frame or slice only reads that part of the file from disk.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path to the 4dfp image (any of its files).
+    mode : str, optional
+        Mode to open the image data with (see np.memmap), by default "r"
+    """
+
+    def __init__(self, path: Union[Path, str], mode: str = "r"):
+        self.paths = fourdfp_paths(path)
+        self.ifh = read_ifh(self.paths["img"])
+        expected_size = int(np.prod(self.ifh.shape)) * 4
+        if mode != "w+" and self.paths["img"].stat().st_size < expected_size:
+            raise ValueError(f"{self.paths['img']} is smaller than the {expected_size} bytes described by its ifh")
+        self.data = np.memmap(self.paths["img"], dtype=self.ifh.dtype, mode=mode, shape=self.ifh.shape, order="F")
+
+    @property
+    def shape(self) -> Tuple[int, int, int, int]:
+        """Shape of the image data (x, y, z, frames)."""
+        return self.ifh.shape
+
+    @property
+    def n_frames(self) -> int:
+        """Number of frames in the image."""
+        return self.ifh.shape[3]
+
+    def frame(self, index: int) -> np.ndarray:
+        """Gets a view of a single frame.
+
+        Parameters
+        ----------
+        index : int
+            Frame index.
+
+        Returns
+        -------
+        np.ndarray
+            (x, y, z) view of the frame.
+        """
+        return self.data[..., index]
+
+    def slice(self, index: int, frame: Optional[int] = None) -> np.ndarray:
+        """Gets a view of a single z slice.
+
+        Parameters
+        ----------
+        index : int
+            Slice index.
+        frame : Optional[int], optional
+            Frame index, by default all frames
+
+        Returns
+        -------
+        np.ndarray
+            (x, y) view of the slice, or (x, y, frames) if no frame is given.
+        """
+        if frame is None:
+            return self.data[:, :, index, :]
+        return self.data[:, :, index, frame]
+
+    def as_2d(self) -> np.ndarray:
+        """Gets a (voxels, frames) view of the image data.
+
+        Returns
+        -------
+        np.ndarray
+            (x * y * z, frames) view of the image data, voxels in Fortran order.
+        """
+        return self.data.reshape((-1, self.n_frames), order="F")
+
+    def flush(self) -> None:
+        """Writes any changes to the image data to disk."""
+        self.data.flush()
+
+
+def load_4dfp(path: Union[Path, str], mode: str = "r") -> FourDFPImage:
+    """Opens a 4dfp image without reading its data into memory.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path to the 4dfp image (any of its files).
+    mode : str, optional
+        Mode to open the image data with (see np.memmap), by default "r"
+
+    Returns
+    -------
+    FourDFPImage
+        Memory-mapped image.
+    """
+    return FourDFPImage(path, mode)
+
+
+def create_4dfp(
+    path: Union[Path, str],
+    ifh: IFH,
+    display_range: Optional[Tuple[float, float]] = None,
+    rec_lines: Sequence[str] = (),
+    rec_parents: Sequence[Union[Path, str]] = (),
+) -> FourDFPImage:
+    """Creates a new 4dfp image (.img, .ifh, .hdr and .img.rec) and opens it for writing.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path to the 4dfp image (any of its files).
+    ifh : IFH
+        Header of the new image, its data file name is set to match path.
+    display_range : Optional[Tuple[float, float]], optional
+        Display range to store in the Analyze header, by default None
+    rec_lines : Sequence[str], optional
+        Lines to record in the rec file, by default ()
+    rec_parents : Sequence[Union[Path, str]], optional
+        4dfp images whose rec files are appended to the rec file, by default ()
+
+    Returns
+    -------
+    FourDFPImage
+        Memory-mapped image, opened in "w+" mode.
+    """
+    paths = fourdfp_paths(path)
+    ifh = replace(ifh, name_of_data_file=paths["img"].name)
+    write_ifh(paths["img"], ifh)
+    write_hdr(paths["img"], ifh, display_range)
+    write_rec(paths["img"], rec_lines, rec_parents)
+    return FourDFPImage(paths["img"], mode="w+")
+
+
+def save_4dfp(
+    path: Union[Path, str],
+    data: np.ndarray,
+    ifh: IFH,
+    display_range: Optional[Tuple[float, float]] = None,
+    rec_lines: Sequence[str] = (),
+    rec_parents: Sequence[Union[Path, str]] = (),
+) -> None:
+    """Writes an array to a 4dfp image.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path to the 4dfp image (any of its files).
+    data : np.ndarray
+        (x, y, z) or (x, y, z, frames) image data.
+    ifh : IFH
+        Header to use, its matrix size is updated to match data.
+    display_range : Optional[Tuple[float, float]], optional
+        Display range to store in the Analyze header, by default None
+    rec_lines : Sequence[str], optional
+        Lines to record in the rec file, by default ()
+    rec_parents : Sequence[Union[Path, str]], optional
+        4dfp images whose rec files are appended to the rec file, by default ()
+    """
+    data = data.reshape(*data.shape[:3], -1)
+    img = create_4dfp(path, replace(ifh, matrix_size=list(data.shape)), display_range, rec_lines, rec_parents)
+    img.data[:] = data
+    img.flush()
@@ -0,0 +1,180 @@
+"""In-process inspection of image geometry.
+
+Reads image dimensions, voxel sizes and the voxel to mm affine straight from image headers
+(``.4dfp.ifh`` for 4dfp images, the nibabel header for NIfTI/Analyze images) instead of running
+``ifh2hdr`` and ``fslinfo``. Results are cached by path and modification time, so stages that
+probe the same files again within a process don't re-read their headers.
+"""
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Sequence, Tuple, Union
+import nibabel as nib
+import numpy as np
+from .fourdfp import fourdfp_paths, read_ifh
+
+
+# maximum number of headers to keep cached
+GEOMETRY_CACHE_SIZE = 1024
+
+
+@dataclass(frozen=True, eq=False)
+class Geometry:
+    """Geometry of an image.
+
+    Parameters
+    ----------
+    dims : Tuple[int, int, int, int]
+        Number of voxels along x, y, z and the number of frames (fslinfo dim1-4).
+    pixdims : Tuple[float, float, float, float]
+        Voxel sizes along x, y and z and the frame duration (fslinfo pixdim1-4).
+    affine : np.ndarray
+        Voxel to mm affine. For 4dfp images this maps to the 4dfp (mmppix/center) coordinate frame.
+    """
+
+    dims: Tuple[int, int, int, int]
+    pixdims: Tuple[float, float, float, float]
+    affine: np.ndarray
+
+    @property
+    def n_frames(self) -> int:
+        """Number of frames in the image."""
+        return self.dims[3]
+
+    def matches(self, other: "Geometry", atol: float = 1e-4) -> bool:
+        """Checks whether two images share a grid.
+
+        Parameters
+        ----------
+        other : Geometry
+            Geometry to compare to.
+        atol : float, optional
+            Absolute tolerance for voxel sizes and the affine, by default 1e-4
+
+        Returns
+        -------
+        bool
+            True if the dims, voxel sizes and affines match.
+        """
+        return (
+            self.dims == other.dims
+            and np.allclose(self.pixdims, other.pixdims, atol=atol)
+            and np.allclose(self.affine, other.affine, atol=atol)
+        )
+
+
+def fourdfp_affine(matrix_size: Sequence[int], mmppix: Sequence[float], center: Sequence[float]) -> np.ndarray:
+    """Computes the voxel to mm affine of a 4dfp image.
+
+    4dfp places voxel i (0-indexed) at ``mmppix * (i + 1) - center`` along each axis.
+
+    Parameters
+    ----------
+    matrix_size : Sequence[int]
+        Number of voxels along x, y and z.
+    mmppix : Sequence[float]
+        Signed voxel sizes.
+    center : Sequence[float]
+        Center of the image in mm.
+
+    Returns
+    -------
+    np.ndarray
+        4x4 affine.
+    """
+    affine = np.eye(4)
+    affine[:3, :3] = np.diag(mmppix[:3])
+    affine[:3, 3] = np.asarray(mmppix[:3], dtype=float) - np.asarray(center[:3], dtype=float)
+    return affine
+
+
+def _fourdfp_geometry(path: Union[Path, str]) -> Geometry:
+    """Reads the geometry of a 4dfp image from its ifh."""
+    ifh = read_ifh(path)
+    mmppix = ifh.mmppix
+    if mmppix is None:
+        # transverse 4dfp images have their y and z axes flipped
+        mmppix = [ifh.scaling_factor[0], -ifh.scaling_factor[1], -ifh.scaling_factor[2]]
+    center = ifh.center
+    if center is None:
+        # without a center, the image is centered on the origin
+        center = [m * (n + 1) / 2 for m, n in zip(mmppix, ifh.shape)]
+    return Geometry(
+        dims=ifh.shape,
+        pixdims=(*(float(abs(s)) for s in ifh.scaling_factor), 1.0),  # type: ignore
+        affine=fourdfp_affine(ifh.shape, mmppix, center),
+    )
+
+
+def _nibabel_geometry(path: Union[Path, str]) -> Geometry:
+    """Reads the geometry of a NIfTI/Analyze image from its header."""
+    img = nib.load(str(path))
+    shape = tuple(img.shape) + (1,) * (4 - len(img.shape))
+    zooms = tuple(float(z) for z in img.header.get_zooms())
+    pixdims = zooms + (1.0,) * (4 - len(zooms))
+    return Geometry(dims=shape[:4], pixdims=pixdims[:4], affine=img.affine)  # type: ignore
+
+
+@lru_cache(maxsize=GEOMETRY_CACHE_SIZE)
+def _read_geometry(path: str, mtime_ns: int) -> Geometry:
+    """Reads the geometry of an image, cached by path and modification time."""
+    if path.endswith((".4dfp.img", ".4dfp.ifh", ".4dfp.hdr", ".4dfp")):
+        return _fourdfp_geometry(path)
+    return _nibabel_geometry(path)
+
+
+def read_geometry(path: Union[Path, str]) -> Geometry:
+    """Reads the geometry of an image from its header.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path to a 4dfp (any of its files), NIfTI or Analyze image.
+
+    Returns
+    -------
+    Geometry
+        Geometry of the image.
+    """
+    path = str(Path(path).resolve())
+    # 4dfp geometry lives in the ifh, so that is the file whose mtime invalidates the cache
+    header = fourdfp_paths(path)["ifh"] if ".4dfp" in Path(path).name else Path(path)
+    if not header.exists():
+        raise FileNotFoundError(f"Could not find {header}")
+    return _read_geometry(path, header.stat().st_mtime_ns)
+
+
+def check_geometries(paths: Sequence[Union[Path, str]]) -> Geometry:
+    """Checks that all images share the same geometry (e.g. all echoes of a run).
+
+    Parameters
+    ----------
+    paths : Sequence[Union[Path, str]]
+        Images to check.
+
+    Returns
+    -------
+    Geometry
+        The shared geometry.
+
+    Raises
+    ------
+    ValueError
+        If any image does not match the first.
+    """
+    if len(paths) == 0:
+        raise ValueError("No images to check")
+    geometries = [read_geometry(path) for path in paths]
+    first = geometries[0]
+    for path, geometry in zip(paths[1:], geometries[1:]):
+        if not first.matches(geometry):
+            raise ValueError(
+                f"Input data is not consistent: {paths[0]} {first.dims} {first.pixdims} != "
+                f"{path} {geometry.dims} {geometry.pixdims}"
+            )
+    return first
+
+
+def clear_geometry_cache() -> None:
+    """Clears cached geometries."""
+    _read_geometry.cache_clear()
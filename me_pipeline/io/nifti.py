@@ -0,0 +1,31 @@
+"""Frame level access to NIfTI images.
+
+Uncompressed NIfTI images are memory-mapped by nibabel, so frames can be taken as slices of a
+4D image without reading the rest of it, and only written out as single frame files when a
+tool outside of Python needs one.
+"""
+from pathlib import Path
+from typing import Union
+import nibabel as nib
+import numpy as np
+
+
+def write_frame(img: nib.Nifti1Image, index: int, path: Union[Path, str]) -> None:
+    """Writes a single frame of a 4D NIfTI image to its own file (like one output of fslsplit -t).
+
+    Parameters
+    ----------
+    img : nib.Nifti1Image
+        4D image to take the frame from.
+    index : int
+        Frame index.
+    path : Union[Path, str]
+        Output path.
+    """
+    header = img.header.copy()
+    frame = np.asarray(img.dataobj[..., index : index + 1])
+    # the frame has any scaling applied already, so store it as is
+    frame_img = nib.Nifti1Image(frame, img.affine, header)
+    frame_img.set_data_dtype(frame.dtype)
+    frame_img.header.set_slope_inter(1.0, 0.0)
+    frame_img.to_filename(str(path))
@@ -0,0 +1,568 @@
+"""Runs pipeline jobs on an executor backend.
+
+Two backends are available:
+
+    - ``local``: jobs run as subprocesses of this process (see ``me_pipeline.scheduler``)
+    - ``queue``: jobs are submitted to a job queue in a directory, and run by workers (started with
+      ``pipeline_queue worker``) on any node that can see that directory
+
+The queue keeps a JSON record for each job in a directory per state (pending, running, succeeded, failed
+and skipped), along with the pickled job. Workers claim a job by renaming its record from pending to running,
+which only one of them can do, so workers on several nodes can pull from the same queue without a lock
+server. A failed job goes back to pending until it ran ``retries + 1`` times. A job is only claimed once the
+jobs it runs after succeeded, and is skipped if any of them failed. A worker with a memory budget only claims
+a job if its estimated peak memory (see ``me_pipeline.profiles``) fits in the memory its running jobs left.
+"""
+import json
+import logging
+import os
+import pickle
+import re
+import socket
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import replace
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+from .profiles import ProfileDB
+from .scheduler import FAILED, QUEUED, SKIPPED, SUCCEEDED, JobResult, JobScheduler, PipelineJob, cpus_per_job
+
+# available executor backends
+EXECUTOR_BACKENDS = ("local", "queue")
+
+# states of jobs in a queue
+PENDING = "pending"
+RUNNING = "running"
+QUEUE_STATES = (PENDING, RUNNING, SUCCEEDED, FAILED, SKIPPED)
+FINISHED_STATES = (SUCCEEDED, FAILED, SKIPPED)
+
+# environment variables set by run_pipeline that are passed on to the jobs it submits to a queue
+SUBMIT_ENV_VARS = ("FS_LICENSE", "TMPDIR", "MEDIC_WRAP_LIMIT", "MEDIC_SKIP")
+
+# seconds between checks of a queue for new or finished jobs
+POLL_INTERVAL = 10.0
+
+
+def job_id(name: str) -> str:
+    """Gets the id of a job in a queue (its name, made safe to use as a file name)."""
+    return re.sub(r"[^\w.-]", "_", name.replace("/", "__"))
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+class JobExecutor:
+    """Runs pipeline jobs on a backend."""
+
+    def run(self, jobs: Sequence[PipelineJob]) -> List[JobResult]:
+        """Runs (or submits) jobs.
+
+        Parameters
+        ----------
+        jobs : Sequence[PipelineJob]
+            Jobs to run.
+
+        Returns
+        -------
+        List[JobResult]
+            Result of each job, in the order of jobs.
+        """
+        raise NotImplementedError
+
+
+class LocalExecutor(JobExecutor):
+    """Runs jobs as subprocesses of this process.
+
+    Parameters
+    ----------
+    max_jobs : int, optional
+        Maximum number of jobs to run at once, by default 1
+    cpu_budget : Optional[int], optional
+        Total number of CPUs to divide between running jobs, by default None
+    fail_fast : bool, optional
+        Stop starting jobs and terminate the running ones after the first failure, by default True
+    retries : int, optional
+        Number of times to run a failed job again, by default 0
+    memory_budget : Optional[float], optional
+        Memory (in MB) the running jobs may use together, by default None
+    profiles : Optional[ProfileDB], optional
+        Database of the resources jobs used, by default None
+    """
+
+    def __init__(
+        self,
+        max_jobs: int = 1,
+        cpu_budget: Optional[int] = None,
+        fail_fast: bool = True,
+        retries: int = 0,
+        memory_budget: Optional[float] = None,
+        profiles: Optional[ProfileDB] = None,
+    ):
+        self.scheduler = JobScheduler(max_jobs, cpu_budget, fail_fast, retries, memory_budget, profiles)
+
+    def run(self, jobs: Sequence[PipelineJob]) -> List[JobResult]:
+        return self.scheduler.run(jobs)
+
+
+class JobQueue:
+    """A job queue in a directory.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Directory of the queue, created if it doesn't exist.
+    """
+
+    def __init__(self, path: Union[Path, str]):
+        self.path = Path(path)
+        for state in (*QUEUE_STATES, "jobs"):
+            (self.path / state).mkdir(parents=True, exist_ok=True)
+
+    def _record_path(self, state: str, id: str) -> Path:
+        return self.path / state / f"{id}.json"
+
+    def _payload_path(self, id: str) -> Path:
+        return self.path / "jobs" / f"{id}.pkl"
+
+    def _write(self, state: str, record: Dict[str, Any]) -> None:
+        """Writes the record of a job to the directory of a state."""
+        path = self._record_path(state, record["id"])
+        tmp = path.with_name(f".{path.name}.{socket.gethostname()}.{os.getpid()}")
+        tmp.write_text(json.dumps(record, indent=4))
+        os.replace(tmp, path)
+
+    @staticmethod
+    def _read(path: Path) -> Optional[Dict[str, Any]]:
+        """Reads the record of a job, None if it was moved in the meantime."""
+        try:
+            return json.loads(path.read_text())
+        except (OSError, ValueError):
+            return None
+
+    def find(self, id: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """Finds a job in the queue.
+
+        Parameters
+        ----------
+        id : str
+            Id of the job.
+
+        Returns
+        -------
+        Optional[Tuple[str, Dict[str, Any]]]
+            State and record of the job, None if it isn't in the queue.
+        """
+        for state in QUEUE_STATES:
+            record = self._read(self._record_path(state, id))
+            if record is not None:
+                return state, record
+        return None
+
+    def records(self, state: str) -> List[Dict[str, Any]]:
+        """Gets the records of the jobs in a state, in the order they were submitted."""
+        records = [self._read(path) for path in (self.path / state).glob("*.json")]
+        return sorted((record for record in records if record is not None), key=lambda record: record["order"])
+
+    def submit(self, jobs: Sequence[PipelineJob], retries: int = 0) -> List[JobResult]:
+        """Submits jobs to the queue, replacing jobs of the same name that aren't running.
+
+        Parameters
+        ----------
+        jobs : Sequence[PipelineJob]
+            Jobs to submit. Their set_cpus and on_success callbacks must be picklable.
+        retries : int, optional
+            Number of times a worker runs a failed job again, by default 0
+
+        Returns
+        -------
+        List[JobResult]
+            A QUEUED result for each job.
+        """
+        env = {var: os.environ[var] for var in SUBMIT_ENV_VARS if var in os.environ}
+        for n, job in enumerate(jobs):
+            id = job_id(job.name)
+            found = self.find(id)
+            if found is not None and found[0] == RUNNING:
+                logging.warning(f"{job.name} is running in the queue, not submitting it again")
+                continue
+            for state in QUEUE_STATES:
+                if self._record_path(state, id).exists():
+                    self._record_path(state, id).unlink()
+            # the job runs with the environment it was submitted from
+            job = replace(job, env={**env, **job.env})
+            with open(self._payload_path(id), "wb") as f:
+                pickle.dump(job, f)
+            record = {
+                "id": id,
+                "name": job.name,
+                "after": [job_id(name) for name in job.after],
+                "command": [str(arg) for arg in job.command],
+                "cwd": str(job.cwd),
+                "log_file": str(job.log_file),
+                "profile": job.profile,
+                "size": job.size,
+                "order": time.time_ns() + n,
+                "submitted": _now(),
+                "attempts": 0,
+                "max_attempts": max(0, retries) + 1,
+                "history": [],
+            }
+            self._write(PENDING, record)
+            logging.info(f"Submitted {job.name} to {self.path}")
+        return [JobResult(job.name, QUEUED, None, 0.0, job.log_file, 0) for job in jobs]
+
+    def claim(
+        self, admit: Optional[Callable[[Dict[str, Any]], bool]] = None
+    ) -> Optional[Tuple[Dict[str, Any], PipelineJob]]:
+        """Claims the next pending job that can run, skipping jobs that run after a job that didn't succeed.
+
+        Parameters
+        ----------
+        admit : Optional[Callable[[Dict[str, Any]], bool]], optional
+            Called with the record of the next job that can run, the job (and every job after it) is left
+            pending if it returns False, by default every job is admitted
+
+        Returns
+        -------
+        Optional[Tuple[Dict[str, Any], PipelineJob]]
+            Record and job that was claimed, None if no job can run now.
+        """
+        for record in self.records(PENDING):
+            # jobs it runs after that were never submitted are ignored
+            after = [found for found in (self.find(id) for id in record["after"]) if found is not None]
+            path = self._record_path(PENDING, record["id"])
+            if any(state in (FAILED, SKIPPED) for state, _ in after):
+                try:
+                    os.rename(path, self._record_path(SKIPPED, record["id"]))
+                except FileNotFoundError:
+                    continue
+                record["finished"] = _now()
+                self._write(SKIPPED, record)
+                logging.info(f"Skipping {record['name']}: a job it runs after did not succeed")
+                continue
+            if not all(state == SUCCEEDED for state, _ in after):
+                continue
+            if admit is not None and not admit(record):
+                return None
+            try:
+                os.rename(path, self._record_path(RUNNING, record["id"]))
+            except FileNotFoundError:
+                # another worker claimed it first
+                continue
+            record.update(attempts=record["attempts"] + 1, host=socket.gethostname(), pid=os.getpid(), started=_now())
+            self._write(RUNNING, record)
+            with open(self._payload_path(record["id"]), "rb") as f:
+                return record, pickle.load(f)
+        return None
+
+    def finish(self, record: Dict[str, Any], result: JobResult) -> str:
+        """Records the result of a job that was claimed, putting it back in the queue if it can be retried.
+
+        Parameters
+        ----------
+        record : Dict[str, Any]
+            Record of the job, as claimed.
+        result : JobResult
+            Result of running the job.
+
+        Returns
+        -------
+        str
+            New state of the job.
+        """
+        record["history"].append(
+            {
+                "host": record["host"],
+                "started": record["started"],
+                "returncode": result.returncode,
+                "wall_time": result.wall_time,
+            }
+        )
+        record.update(returncode=result.returncode, wall_time=result.wall_time, finished=_now())
+        if result.status == SUCCEEDED:
+            state = SUCCEEDED
+        elif result.status == FAILED and record["attempts"] < record["max_attempts"]:
+            state = PENDING
+        elif result.status == SKIPPED:
+            # the worker stopped before running it, so the attempt doesn't count
+            record["attempts"] -= 1
+            state = PENDING
+        else:
+            state = FAILED
+        self._write(state, record)
+        self._record_path(RUNNING, record["id"]).unlink()
+        return state
+
+    def requeue(self, names: Optional[Iterable[str]] = None, states: Sequence[str] = (FAILED, SKIPPED)) -> List[str]:
+        """Puts jobs back in the queue, with their attempts reset.
+
+        Parameters
+        ----------
+        names : Optional[Iterable[str]], optional
+            Names of the jobs, by default all jobs in the states
+        states : Sequence[str], optional
+            States of the jobs to put back, by default FAILED and SKIPPED. Only put RUNNING jobs back if the
+            workers running them died.
+
+        Returns
+        -------
+        List[str]
+            Names of the jobs put back in the queue.
+        """
+        names = None if names is None else set(names)
+        requeued = []
+        for state in states:
+            for record in self.records(state):
+                if names is not None and record["name"] not in names:
+                    continue
+                record["attempts"] = 0
+                self._write(PENDING, record)
+                self._record_path(state, record["id"]).unlink()
+                requeued.append(record["name"])
+        return requeued
+
+    def results(self, names: Optional[Iterable[str]] = None) -> List[JobResult]:
+        """Gets the results of the jobs in the queue.
+
+        Parameters
+        ----------
+        names : Optional[Iterable[str]], optional
+            Names of the jobs, by default all jobs
+
+        Returns
+        -------
+        List[JobResult]
+            Result of each job, QUEUED for pending and running jobs.
+        """
+        results = {}
+        for state in QUEUE_STATES:
+            for record in self.records(state):
+                status = state if state in FINISHED_STATES else QUEUED
+                results[record["name"]] = JobResult(
+                    record["name"],
+                    status,
+                    record.get("returncode") if status != QUEUED else None,
+                    record.get("wall_time", 0.0),
+                    Path(record["log_file"]),
+                    record["attempts"],
+                )
+        if names is None:
+            return list(results.values())
+        return [results[name] for name in names if name in results]
+
+
+class QueueWorker:
+    """Runs the jobs of a queue.
+
+    Parameters
+    ----------
+    queue : JobQueue
+        Queue to run jobs from.
+    max_jobs : int, optional
+        Maximum number of jobs to run at once, by default 1
+    cpu_budget : Optional[int], optional
+        Total number of CPUs to divide between running jobs, by default None
+    poll_interval : float, optional
+        Seconds between checks of the queue for jobs that can run, by default POLL_INTERVAL
+    exit_when_idle : bool, optional
+        Exit once no pending jobs are left (instead of waiting for new ones), by default True
+    memory_budget : Optional[float], optional
+        Memory (in MB) the jobs this worker runs may use together, by default None
+    profiles : Optional[ProfileDB], optional
+        Database to record the resources jobs used in, and to estimate their peak memory from, by default None
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        max_jobs: int = 1,
+        cpu_budget: Optional[int] = None,
+        poll_interval: float = POLL_INTERVAL,
+        exit_when_idle: bool = True,
+        memory_budget: Optional[float] = None,
+        profiles: Optional[ProfileDB] = None,
+    ):
+        self.queue = queue
+        self.max_jobs = max(1, max_jobs)
+        self.cpu_budget = cpu_budget
+        self.poll_interval = poll_interval
+        self.exit_when_idle = exit_when_idle
+        self.memory_budget = memory_budget
+        self.profiles = profiles
+
+    def _idle(self) -> bool:
+        """Checks if the queue has no pending jobs that could still run."""
+        if not self.queue.records(PENDING):
+            return True
+        # pending jobs can only wait on running ones
+        return not self.queue.records(RUNNING)
+
+    def run(self) -> List[JobResult]:
+        """Runs jobs from the queue until it is idle (or forever if exit_when_idle is False).
+
+        Returns
+        -------
+        List[JobResult]
+            Result of each job this worker ran.
+        """
+        # retries are handled by the queue, so they can run on any worker
+        scheduler = JobScheduler(self.max_jobs, fail_fast=False, profiles=self.profiles)
+        cpus = None
+        if self.cpu_budget is not None:
+            cpus = cpus_per_job(self.cpu_budget, self.max_jobs, self.max_jobs)
+        results = []
+        running: Dict[Any, Dict[str, Any]] = {}
+        # estimated peak memory of the running jobs (0 if unknown)
+        reserved: Dict[Any, float] = {}
+
+        def admit(record: Dict[str, Any]) -> bool:
+            if not running or self.memory_budget is None or self.profiles is None or record.get("profile") is None:
+                return True
+            memory = self.profiles.estimate(record["profile"], record.get("size", 0.0)) or 0.0
+            return sum(reserved.values()) + memory <= self.memory_budget
+
+        with ThreadPoolExecutor(max_workers=self.max_jobs) as executor:
+            try:
+                while True:
+                    while len(running) < self.max_jobs:
+                        claimed = self.queue.claim(admit)
+                        if claimed is None:
+                            break
+                        record, job = claimed
+                        future = executor.submit(scheduler.run_job, job, cpus)
+                        running[future] = record
+                        reserved[future] = scheduler.estimate_memory(job) or 0.0
+                    if not running:
+                        if self.exit_when_idle and self._idle():
+                            break
+                        time.sleep(self.poll_interval)
+                        continue
+                    done, _ = wait(running, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        result = future.result()
+                        reserved.pop(future)
+                        self.queue.finish(running.pop(future), result)
+                        results.append(result)
+            except KeyboardInterrupt:
+                # put the jobs this worker was running back in the queue
+                scheduler.stop()
+                for record in running.values():
+                    stopped = JobResult(record["name"], SKIPPED, None, 0.0, Path(record["log_file"]), 0)
+                    self.queue.finish(record, stopped)
+                raise
+        return results
+
+
+class QueueExecutor(JobExecutor):
+    """Submits jobs to a job queue.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Directory of the queue.
+    retries : int, optional
+        Number of times a worker runs a failed job again, by default 0
+    wait : bool, optional
+        Wait for workers to finish the jobs, by default jobs are only submitted
+    poll_interval : float, optional
+        Seconds between checks of the queue while waiting, by default POLL_INTERVAL
+    """
+
+    def __init__(
+        self, path: Union[Path, str], retries: int = 0, wait: bool = False, poll_interval: float = POLL_INTERVAL
+    ):
+        self.queue = JobQueue(path)
+        self.retries = retries
+        self.wait = wait
+        self.poll_interval = poll_interval
+
+    def run(self, jobs: Sequence[PipelineJob]) -> List[JobResult]:
+        results = self.queue.submit(jobs, self.retries)
+        if not self.wait:
+            return results
+        names = [job.name for job in jobs]
+        while True:
+            results = self.queue.results(names)
+            if all(result.status != QUEUED for result in results):
+                return results
+            time.sleep(self.poll_interval)
+
+
+def make_executor(
+    backend: str = "local",
+    max_jobs: int = 1,
+    cpu_budget: Optional[int] = None,
+    fail_fast: bool = True,
+    retries: int = 0,
+    queue_dir: Optional[Union[Path, str]] = None,
+    wait: bool = False,
+    memory_budget: Optional[float] = None,
+    profiles: Optional[ProfileDB] = None,
+) -> JobExecutor:
+    """Makes an executor for a backend.
+
+    Parameters
+    ----------
+    backend : str, optional
+        One of "local" or "queue", by default "local"
+    max_jobs : int, optional
+        Maximum number of jobs to run at once (local), by default 1
+    cpu_budget : Optional[int], optional
+        Total number of CPUs to divide between running jobs (local), by default None
+    fail_fast : bool, optional
+        Stop after the first failure (local), by default True
+    retries : int, optional
+        Number of times to run a failed job again, by default 0
+    queue_dir : Optional[Union[Path, str]], optional
+        Directory of the job queue (queue), by default None
+    wait : bool, optional
+        Wait for workers to finish the submitted jobs (queue), by default False
+    memory_budget : Optional[float], optional
+        Memory (in MB) the running jobs may use together (local), by default None
+    profiles : Optional[ProfileDB], optional
+        Database of the resources jobs used (local, workers of a queue have their own), by default None
+
+    Returns
+    -------
+    JobExecutor
+        The executor.
+    """
+    if backend not in EXECUTOR_BACKENDS:
+        raise ValueError(f"Unknown executor backend: {backend}, expected one of {EXECUTOR_BACKENDS}")
+    if backend == "queue":
+        if queue_dir is None:
+            raise ValueError("The queue backend needs a queue directory.")
+        return QueueExecutor(queue_dir, retries, wait)
+    return LocalExecutor(max_jobs, cpu_budget, fail_fast, retries, memory_budget, profiles)
+
+
+def format_status(queue: JobQueue, verbose: bool = False) -> str:
+    """Formats the status of the jobs in a queue.
+
+    Parameters
+    ----------
+    queue : JobQueue
+        The queue.
+    verbose : bool, optional
+        List every job, by default only jobs that are running or failed
+
+    Returns
+    -------
+    str
+        Number of jobs in each state, followed by a line per listed job.
+    """
+    records = {state: queue.records(state) for state in QUEUE_STATES}
+    lines = [f"Queue {queue.path}: " + ", ".join(f"{len(records[state])} {state}" for state in QUEUE_STATES)]
+    for state in QUEUE_STATES:
+        if not verbose and state not in (RUNNING, FAILED):
+            continue
+        for record in records[state]:
+            details = [f"attempt {record['attempts']}/{record['max_attempts']}"]
+            if state == RUNNING:
+                details.append(f"on {record['host']} (pid {record['pid']}) since {record['started']}")
+            elif "returncode" in record:
+                details.append(f"return code {record['returncode']}")
+            lines.append(f"  {record['name']}: {state} ({', '.join(details)}, log: {record['log_file']})")
+    return "\n".join(lines)
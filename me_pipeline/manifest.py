@@ -0,0 +1,395 @@
+"""Records what each stage of a pipeline ran with, so a stage only runs again when that changes.
+
+Each working directory (a subject or session output directory) has a stage manifest, with an entry for each
+stage that completed there. An entry records:
+
+- the params fields the stage reads, found by scanning its section of the csh script (and the scripts it
+  calls) for variables, so changing a field that only e.g. FC_QC reads doesn't make FMRI_PP run again
+- content hashes of its input files: the files named by those fields and the declared inputs of the stage
+  (JSON inputs like runs.json can list more input files)
+- a hash of its csh code and the versions of the tools it runs
+- the digests of the entries of the stages it requires, and the paths of its outputs
+
+A stage is stale when any of these changed or one of its outputs is missing. File hashes are cached in the
+manifest by size and mtime, so each input file is only read again once it changes. Reads and updates of a
+manifest hold a file lock (see file_lock), since stages of a session can complete in different worker
+processes or nodes.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, FrozenSet, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+if TYPE_CHECKING:
+    from .stages import Stage
+
+MANIFEST_NAME = "stage_manifest.json"
+MANIFEST_VERSION = 1
+
+# params fields that don't change the outputs of a stage (num_cpus is set per job by the scheduler)
+IGNORED_FIELDS = ("num_cpus",)
+
+# the csh scripts of the pipelines
+BIN_DIR = Path(__file__).resolve().parent / "scripts" / "bin"
+
+# versions of tools, read from files in their install directories
+TOOL_VERSION_FILES = {
+    "fsl": ("FSLDIR", "etc/fslversion"),
+    "freesurfer": ("FREESURFER_HOME", "build-stamp.txt"),
+}
+
+# a field in a params file: "set name = value" or "@ name = value"
+PARAM_LINE = re.compile(r"^\s*(?:set|@)\s+(\w+)\s*=\s*(.*?)\s*$", re.MULTILINE)
+# a label of a csh script, the modules of a pipeline are labels its script jumps to
+LABEL = re.compile(r"^(\w+):[ \t]*$", re.MULTILINE)
+# a variable in a csh script: $name, ${name}, $#name or $?name
+VARIABLE = re.compile(r"\$[{?#]*(\w+)")
+# a call of another script
+SCRIPT_CALL = re.compile(r"[\w.-]+\.c?sh\b")
+
+
+@contextmanager
+def file_lock(path: Union[Path, str]) -> Iterator[None]:
+    """Holds an exclusive lock on a file that is read, modified and written by many processes (or nodes).
+
+    The lock is taken on a sidecar file (.<name>.lock next to the file), so the file itself can be replaced.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        File to lock.
+    """
+    path = Path(path)
+    with open(path.with_name(f".{path.name}.lock"), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_params(paths: Iterable[Union[Path, str]]) -> Dict[str, str]:
+    """Reads the fields of params files, later files overriding earlier ones.
+
+    Parameters
+    ----------
+    paths : Iterable[Union[Path, str]]
+        Paths to the params files.
+
+    Returns
+    -------
+    Dict[str, str]
+        Value of each field, as written in the file.
+    """
+    params = {}
+    for path in paths:
+        params.update(PARAM_LINE.findall(Path(path).read_text()))
+    return params
+
+
+def find_script(name: str) -> Optional[Path]:
+    """Finds a pipeline script, in BIN_DIR or on the PATH."""
+    if (BIN_DIR / name).exists():
+        return BIN_DIR / name
+    path = shutil.which(name)
+    return None if path is None else Path(path)
+
+
+def script_section(text: str, label: Optional[str] = None) -> str:
+    """Gets the code of a script that a module runs.
+
+    Parameters
+    ----------
+    text : str
+        Code of the script.
+    label : Optional[str], optional
+        Label of the module, by default the whole script
+
+    Returns
+    -------
+    str
+        Code before the first label (run by every module) and code from the label to the next one. The
+        whole script if it doesn't have the label.
+    """
+    labels = list(LABEL.finditer(text))
+    starts = [match.start() for match in labels]
+    for i, match in enumerate(labels):
+        if match.group(1) == label:
+            end = starts[i + 1] if i + 1 < len(starts) else len(text)
+            return text[: starts[0]] + text[match.start() : end]
+    return text
+
+
+@lru_cache(maxsize=None)
+def _read_script(path: str, mtime_ns: int) -> str:
+    """Reads a script, cached while it is unchanged."""
+    return Path(path).read_text(errors="replace")
+
+
+def script_code(name: str, label: Optional[str] = None) -> Tuple[FrozenSet[str], str]:
+    """Scans the code a module of a script runs, including the scripts it calls.
+
+    Parameters
+    ----------
+    name : str
+        Name of the script.
+    label : Optional[str], optional
+        Label of the module, by default the whole script
+
+    Returns
+    -------
+    FrozenSet[str]
+        Variables the code reads.
+    str
+        Hash of the code.
+    """
+    variables = set()
+    code = hashlib.sha1()
+    scanned = set()
+    queue = [(name, label)]
+    while queue:
+        script, section = queue.pop(0)
+        path = find_script(script)
+        if path is None or script in scanned:
+            continue
+        scanned.add(script)
+        text = script_section(_read_script(str(path), path.stat().st_mtime_ns), section)
+        variables.update(VARIABLE.findall(text))
+        code.update(f"{script}\n{text}".encode())
+        queue.extend((called, None) for called in sorted(set(SCRIPT_CALL.findall(text))))
+    return frozenset(variables), code.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def _tool_versions() -> Tuple[Tuple[str, str], ...]:
+    try:
+        from importlib.metadata import version
+
+        versions = {"me_pipeline": version("processing_pipeline")}
+    except ImportError:
+        versions = {"me_pipeline": "unknown"}
+    for tool, (variable, version_file) in TOOL_VERSION_FILES.items():
+        if variable in os.environ:
+            try:
+                versions[tool] = (Path(os.environ[variable]) / version_file).read_text().strip()
+            except OSError:
+                versions[tool] = "unknown"
+    return tuple(sorted(versions.items()))
+
+
+def tool_versions() -> Dict[str, str]:
+    """Gets the versions of me_pipeline and the tools its scripts run (if they are installed)."""
+    return dict(_tool_versions())
+
+
+def hash_file(path: Union[Path, str]) -> str:
+    """Hashes the contents of a file."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def value_files(value: str) -> Iterator[Path]:
+    """Gets the files named by the value of a params field.
+
+    Parameters
+    ----------
+    value : str
+        Value of the field, e.g. a path, a list of paths or a 4dfp image without extension.
+
+    Yields
+    ------
+    Path
+        Paths of the existing files.
+    """
+    for token in re.split(r"[\s(),]+", value):
+        if not token.startswith("/"):
+            continue
+        for path in (Path(token), Path(f"{token}.4dfp.img")):
+            if path.is_file():
+                yield path
+                break
+
+
+def json_files(path: Path) -> Iterator[Path]:
+    """Gets the files listed (as absolute paths) in a JSON file."""
+    try:
+        values = [json.loads(path.read_text())]
+    except (OSError, ValueError):
+        return
+    while values:
+        value = values.pop()
+        if isinstance(value, dict):
+            values.extend(value.values())
+        elif isinstance(value, list):
+            values.extend(value)
+        elif isinstance(value, str) and value.startswith("/") and Path(value).is_file():
+            yield Path(value)
+
+
+class StageManifest:
+    """The stage manifest of a working directory.
+
+    Parameters
+    ----------
+    cwd : Union[Path, str]
+        Working directory of the pipeline.
+    """
+
+    def __init__(self, cwd: Union[Path, str]):
+        self.cwd = Path(cwd)
+        self.path = self.cwd / MANIFEST_NAME
+
+    def read(self) -> Dict[str, Any]:
+        """Reads the manifest, an empty one if it doesn't exist (or is from another version)."""
+        try:
+            data = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            data = {}
+        if data.get("version") != MANIFEST_VERSION:
+            data = {"version": MANIFEST_VERSION, "stages": {}, "files": {}}
+        return data
+
+    def write(self, data: Dict[str, Any]) -> None:
+        """Writes the manifest."""
+        tmp = self.path.with_name(f".{self.path.name}.{os.getpid()}.{threading.get_ident()}")
+        tmp.write_text(json.dumps(data, indent=4, sort_keys=True))
+        os.replace(tmp, self.path)
+
+    def file_hash(self, path: Path, data: Dict[str, Any]) -> str:
+        """Hashes a file, reusing the hash cached in the manifest while its size and mtime are unchanged."""
+        stat = path.stat()
+        cached = data["files"].get(str(path))
+        if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+        digest = hash_file(path)
+        data["files"][str(path)] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def state(
+        self, pipeline: str, script: str, stage: "Stage", params_files: Sequence[Union[Path, str]], data: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """Gets the current state of what a stage runs with.
+
+        Parameters
+        ----------
+        pipeline : str
+            Name of the pipeline.
+        script : str
+            csh script that runs the pipeline.
+        stage : Stage
+            The stage.
+        params_files : Sequence[Union[Path, str]]
+            Params files of the pipeline.
+        data : Dict[str, Any]
+            The manifest (its file hash cache is updated).
+
+        Returns
+        -------
+        Dict[str, Any]
+            Params fields, input hashes, code hash, tool versions and the digests of required stages.
+        """
+        params = read_params(params_files)
+        variables, code = script_code(script, stage.name)
+        fields = {name: params[name] for name in sorted(variables) if name in params and name not in IGNORED_FIELDS}
+        inputs = {}
+        for value in fields.values():
+            for path in value_files(value):
+                inputs[str(path)] = self.file_hash(path, data)
+        for pattern in stage.inputs:
+            for path in sorted(self.cwd.glob(pattern)):
+                inputs[str(path)] = self.file_hash(path, data)
+                if path.suffix == ".json":
+                    for listed in json_files(path):
+                        inputs[str(listed)] = self.file_hash(listed, data)
+        entries = data["stages"].get(pipeline, {})
+        requires = {name: entries.get(name, {}).get("digest") for name in stage.requires}
+        return {"params": fields, "inputs": inputs, "code": code, "tools": tool_versions(), "requires": requires}
+
+    def stale(
+        self, pipeline: str, script: str, stages: Sequence["Stage"], params_files: Sequence[Union[Path, str]]
+    ) -> List[str]:
+        """Gets the stages whose entry is missing or out of date.
+
+        Parameters
+        ----------
+        pipeline : str
+            Name of the pipeline.
+        script : str
+            csh script that runs the pipeline.
+        stages : Sequence[Stage]
+            Stages to check.
+        params_files : Sequence[Union[Path, str]]
+            Params files of the pipeline.
+
+        Returns
+        -------
+        List[str]
+            Names of the stale stages.
+        """
+        with file_lock(self.path):
+            data = self.read()
+            entries = data["stages"].get(pipeline, {})
+            stale = []
+            for stage in stages:
+                entry = entries.get(stage.name)
+                if (
+                    entry is None
+                    or not all((self.cwd / output).exists() for output in entry["outputs"])
+                    or not all(any(self.cwd.glob(pattern)) for pattern in stage.outputs)
+                    or entry["state"] != self.state(pipeline, script, stage, params_files, data)
+                ):
+                    stale.append(stage.name)
+            # keep the file hashes for next time
+            if self.path.exists() or entries:
+                self.write(data)
+        return stale
+
+    def record(self, pipeline: str, script: str, stage: "Stage", params_files: Sequence[Union[Path, str]]) -> None:
+        """Records that a stage completed.
+
+        Parameters
+        ----------
+        pipeline : str
+            Name of the pipeline.
+        script : str
+            csh script that runs the pipeline.
+        stage : Stage
+            The stage.
+        params_files : Sequence[Union[Path, str]]
+            Params files of the pipeline.
+        """
+        with file_lock(self.path):
+            data = self.read()
+            outputs = sorted(
+                {str(path.relative_to(self.cwd)) for pattern in stage.outputs for path in self.cwd.glob(pattern)}
+            )
+            entry = {
+                "state": self.state(pipeline, script, stage, params_files, data),
+                "outputs": outputs,
+                "completed": datetime.now().isoformat(),
+            }
+            entry["digest"] = hashlib.sha1(json.dumps(entry, sort_keys=True).encode()).hexdigest()
+            data["stages"].setdefault(pipeline, {})[stage.name] = entry
+            self.write(data)
+
+    def remove(self, pipeline: str, names: Iterable[str]) -> None:
+        """Removes the entries of stages, e.g. before they run again."""
+        with file_lock(self.path):
+            data = self.read()
+            entries = data["stages"].get(pipeline, {})
+            names = [name for name in names if name in entries]
+            if names:
+                for name in names:
+                    del entries[name]
+                self.write(data)
@@ -0,0 +1,268 @@
+"""Motion analytics on realignment parameters.
+
+Reads ``.rdat``/``.ddat`` files from cross_realign3d_4dfp into (T, 6) arrays in mm (rotations
+converted to arc length on a sphere) and computes spectra, lowpass filtered motion and framewise
+displacement (FD) on whole arrays at once. Runs of the same length are stacked into (R, T, 6)
+arrays, so a cohort is processed with one FFT/filter call per group of runs rather than one per
+column of each run, and lowpass filter coefficients are shared by every run with the same TR.
+"""
+import csv
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+import numpy as np
+from scipy.signal import butter, filtfilt
+
+# radius of the sphere rotations are converted to mm on
+DEFAULT_RADIUS = 50
+
+# lowpass cutoff in Hz used to filter out respiration
+LOWPASS_CUTOFF = 0.1
+
+# FD threshold in mm for counting high motion frames
+FD_THRESHOLD = 0.2
+
+
+def read_dat(dat_file: Union[Path, str], radius: float = DEFAULT_RADIUS) -> np.ndarray:
+    """Reads the motion parameters of a .rdat/.ddat file in mm.
+
+    Parameters
+    ----------
+    dat_file : Union[Path, str]
+        Path to the dat file.
+    radius : float, optional
+        Radius in mm to convert rotations (in degrees) with, by default DEFAULT_RADIUS
+
+    Returns
+    -------
+    np.ndarray
+        (T, 6) translations and rotations in mm, rounded to 4 decimals.
+    """
+    dat_array = np.loadtxt(dat_file, comments="#", ndmin=2)
+    if dat_array[0][0] != 1:
+        raise ValueError("ERROR: First frame of dat file is not 1.")
+    mvm = np.empty((dat_array.shape[0], 6))
+    mvm[:, :3] = dat_array[:, 1:4]
+    mvm[:, 3:6] = dat_array[:, 4:7] * (2 * radius * np.pi / 360)
+    return np.round(mvm, 4)
+
+
+@lru_cache(maxsize=None)
+def lowpass_coefficients(tr: float, cutoff: float = LOWPASS_CUTOFF, order: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+    """Gets the coefficients of a lowpass Butterworth filter, cached by TR.
+
+    Parameters
+    ----------
+    tr : float
+        Repetition time in seconds.
+    cutoff : float, optional
+        Cutoff frequency in Hz, by default LOWPASS_CUTOFF
+    order : int, optional
+        Filter order, by default 1
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Numerator (b) and denominator (a) coefficients.
+    """
+    b, a = butter(order, cutoff / (0.5 / tr), "low")
+    # coefficients are shared between callers, so don't let them be modified
+    b.flags.writeable = False
+    a.flags.writeable = False
+    return b, a
+
+
+def filter_motion(mvm: np.ndarray, tr: float, cutoff: float = LOWPASS_CUTOFF) -> np.ndarray:
+    """Lowpass filters motion parameters forwards and backwards (zero phase).
+
+    Parameters
+    ----------
+    mvm : np.ndarray
+        (..., T, 6) motion parameters.
+    tr : float
+        Repetition time in seconds.
+    cutoff : float, optional
+        Cutoff frequency in Hz, by default LOWPASS_CUTOFF
+
+    Returns
+    -------
+    np.ndarray
+        Filtered motion parameters, same shape as mvm.
+    """
+    b, a = lowpass_coefficients(float(tr), float(cutoff))
+    return filtfilt(b, a, mvm, axis=-2)
+
+
+def amplitude_spectrum(mvm: np.ndarray) -> np.ndarray:
+    """Computes the single-sided amplitude spectrum of motion parameters.
+
+    Parameters
+    ----------
+    mvm : np.ndarray
+        (..., T, 6) motion parameters.
+
+    Returns
+    -------
+    np.ndarray
+        (..., T // 2 + 1, 6) amplitudes.
+    """
+    n_frames = mvm.shape[-2]
+    spectrum = np.abs(np.fft.rfft(mvm, axis=-2)) / n_frames
+    # everything but the DC and (for even lengths) Nyquist bins has a mirror image in the negative frequencies
+    last = spectrum.shape[-2] - 1 if n_frames % 2 == 0 else spectrum.shape[-2]
+    spectrum[..., 1:last, :] *= 2
+    return spectrum
+
+
+def spectrum_frequencies(n_frames: int, tr: float) -> np.ndarray:
+    """Gets the frequencies of the bins of amplitude_spectrum.
+
+    Parameters
+    ----------
+    n_frames : int
+        Number of frames.
+    tr : float
+        Repetition time in seconds.
+
+    Returns
+    -------
+    np.ndarray
+        (n_frames // 2 + 1,) frequencies in Hz.
+    """
+    return np.fft.rfftfreq(n_frames, d=tr)
+
+
+def framewise_displacement(mvm: np.ndarray, differences: bool = False) -> np.ndarray:
+    """Computes framewise displacement.
+
+    Parameters
+    ----------
+    mvm : np.ndarray
+        (..., T, 6) motion parameters.
+    differences : bool, optional
+        mvm already holds frame to frame differences (e.g. from a .ddat file), by default False
+
+    Returns
+    -------
+    np.ndarray
+        (..., T) FD in mm, the first frame of positions (differences=False) has an FD of 0.
+    """
+    if differences:
+        return np.abs(mvm).sum(axis=-1)
+    fd = np.zeros(mvm.shape[:-1])
+    fd[..., 1:] = np.abs(np.diff(mvm, axis=-2)).sum(axis=-1)
+    return fd
+
+
+@dataclass
+class MotionRun:
+    """Motion parameter files of a run.
+
+    Parameters
+    ----------
+    name : str
+        Name of the run, e.g. "sub-01_ses-01_run-1".
+    rdat : Union[Path, str]
+        Path to the .rdat file (positions).
+    tr : float
+        Repetition time in seconds.
+    ddat : Optional[Union[Path, str]], optional
+        Path to the .ddat file (differences), by default FD is computed from the rdat
+    """
+
+    name: str
+    rdat: Union[Path, str]
+    tr: float
+    ddat: Optional[Union[Path, str]] = None
+
+
+def group_runs(mvms: Sequence[np.ndarray], trs: Sequence[float]) -> Dict[Tuple[int, float], List[int]]:
+    """Groups runs that can be stacked into one array and filtered together.
+
+    Parameters
+    ----------
+    mvms : Sequence[np.ndarray]
+        (T, 6) motion parameters of each run.
+    trs : Sequence[float]
+        Repetition time of each run.
+
+    Returns
+    -------
+    Dict[Tuple[int, float], List[int]]
+        Indices of the runs with each (number of frames, TR).
+    """
+    groups: Dict[Tuple[int, float], List[int]] = {}
+    for n, (mvm, tr) in enumerate(zip(mvms, trs)):
+        groups.setdefault((mvm.shape[0], float(tr)), []).append(n)
+    return groups
+
+
+def motion_qc_table(
+    runs: Sequence[MotionRun],
+    fd_threshold: float = FD_THRESHOLD,
+    cutoff: float = LOWPASS_CUTOFF,
+    radius: float = DEFAULT_RADIUS,
+) -> List[Dict[str, Union[str, float, int]]]:
+    """Computes FD and spectral QC measures for many runs.
+
+    Parameters
+    ----------
+    runs : Sequence[MotionRun]
+        Runs to compute measures for.
+    fd_threshold : float, optional
+        FD threshold in mm for high motion frames, by default FD_THRESHOLD
+    cutoff : float, optional
+        Lowpass cutoff frequency in Hz, by default LOWPASS_CUTOFF
+    radius : float, optional
+        Radius in mm to convert rotations with, by default DEFAULT_RADIUS
+
+    Returns
+    -------
+    List[Dict[str, Union[str, float, int]]]
+        One row of measures per run, in the order of runs.
+    """
+    mvms = [read_dat(run.rdat, radius) for run in runs]
+    table: List[Dict[str, Union[str, float, int]]] = [{} for _ in runs]
+    for (n_frames, tr), indices in group_runs(mvms, [run.tr for run in runs]).items():
+        # every run in the group is processed at once
+        mvm = np.stack([mvms[n] for n in indices])
+        fd_filt = framewise_displacement(filter_motion(mvm, tr, cutoff))
+        power = amplitude_spectrum(mvm).sum(axis=-1) ** 2
+        frequencies = spectrum_frequencies(n_frames, tr)
+        above_cutoff = power[:, frequencies > cutoff].sum(axis=-1) / np.maximum(power[:, 1:].sum(axis=-1), 1e-12)
+        peak_frequency = frequencies[1:][np.argmax(power[:, 1:], axis=-1)] if n_frames > 1 else np.zeros(len(indices))
+        for k, n in enumerate(indices):
+            run = runs[n]
+            if run.ddat is not None:
+                fd = framewise_displacement(read_dat(run.ddat, radius), differences=True)
+            else:
+                fd = framewise_displacement(mvms[n])
+            table[n] = {
+                "name": run.name,
+                "n_frames": n_frames,
+                "tr": tr,
+                "fd_mean": float(fd.mean()),
+                "fd_filt_mean": float(fd_filt[k].mean()),
+                "fd_above_threshold": float((fd > fd_threshold).mean()),
+                "fd_filt_above_threshold": float((fd_filt[k] > fd_threshold).mean()),
+                "peak_frequency": float(peak_frequency[k]),
+                "power_above_cutoff": float(above_cutoff[k]),
+            }
+    return table
+
+
+def write_qc_table(table: Sequence[Dict[str, Union[str, float, int]]], path: Union[Path, str]) -> None:
+    """Writes a QC table (from motion_qc_table) to a tsv file.
+
+    Parameters
+    ----------
+    table : Sequence[Dict[str, Union[str, float, int]]]
+        Rows of the table.
+    path : Union[Path, str]
+        Path to write to.
+    """
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(table[0].keys()) if table else ["name"], delimiter="\t")
+        writer.writeheader()
+        writer.writerows(table)
@@ -1,9 +1,12 @@
+import os
 import json
+import threading
 import numpy as np
 from pathlib import Path
 from dataclasses import asdict, dataclass, field, fields, _MISSING_TYPE
 from typing import Any, Dict, List, Tuple, Union
 import toml
+from .frame_counts import count_frames_all
 
 
 # Define path to internal params file for copy
@@ -44,8 +47,10 @@ class RunsMap:
         self.fieldmaps = fieldmaps
 
         # for each run, filter out the runs that have < min_frames
+        # (frames are counted from the headers of all runs of the session at once)
+        frames = count_frames_all(i.path for img_data in func_runs.values() for i in img_data)
         self.runs = {
-            run_num: [i for i in img_data if i.get_image().shape[-1] > min_frames]
+            run_num: [i for i in img_data if frames[str(i.path)] > min_frames]
             for run_num, img_data in func_runs.items()
         }
         # delete keys that are empty
@@ -311,15 +316,28 @@ class Params:
     def save_params(self, path: Union[Path, str]) -> None:
         """Saves the parameters to a params file.
 
+        The file is written to a temporary file next to it and then moved into place, so scripts
+        sourcing it while it is saved (e.g. stages running at once) never read a partial file.
+
         Parameters
         ----------
         path : Union[Path, str]
             Path to save the params file.
         """
-        # path to save params file to
+        # path to save params file to, and the temporary file to write it to first
         path = Path(path)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
 
         # loop over fields writing each attribute to file
+        try:
+            self._write_params(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+    def _write_params(self, path: Path) -> None:
+        """Writes the parameters to a params file in place, see save_params."""
         with open(path, "w") as param_file:
             for field in fields(self):
                 # if the value of the field is None, then skip
@@ -0,0 +1,371 @@
+"""Plans a pipeline invocation and estimates what it will cost, without running it.
+
+A plan lists each job (subject or session) that would run, with its inputs (the matrix size, frames and
+echoes of each functional run, or the structural images), the stages that would run and the stages that
+would be skipped (with --stage_graph, stages that are up to date are skipped, see ``me_pipeline.stages``),
+and an estimate of its CPU hours, peak RAM and temp disk.
+
+Estimates come from the resource profiles of earlier jobs (see ``me_pipeline.profiles``) scaled to the size
+of the dataset, when every stage that would run has been profiled. Otherwise they come from a rough model of
+the pipelines: structural jobs have a fixed cost (FreeSurfer dominates), functional jobs scale with the
+voxel-frames (voxels x frames x echoes) of their runs. Temp disk always comes from the model, since it isn't
+profiled.
+"""
+import json
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Union
+from .frame_counts import image_shape
+from .profiles import ProfileDB
+from .stages import StageGraph
+
+# rough cost of a structural job (FreeSurfer dominates, so it barely depends on the images)
+STRUCTURAL_CPU_HOURS = 12.0
+STRUCTURAL_RAM_GB = 8.0
+STRUCTURAL_TEMP_DISK_GB = 2.0
+
+# rough costs of a functional job, per voxel-frame (voxel x frame x echo) of its runs
+FUNCTIONAL_CPU_HOURS_PER_GVOX = 2.0
+# NORDIC and MEDIC hold the magnitude and phase of every echo of a run in memory
+FUNCTIONAL_RAM_BYTES_PER_VOX = 16
+FUNCTIONAL_RAM_BASE_GB = 2.0
+# float32 intermediates of every run (about 3 copies)
+FUNCTIONAL_TEMP_BYTES_PER_VOX = 12
+
+GB = 1024**3
+
+
+@dataclass
+class Estimate:
+    """Estimated cost of a job.
+
+    Parameters
+    ----------
+    cpu_hours : float
+        CPU time, in hours.
+    peak_ram_gb : float
+        Peak memory, in GB.
+    temp_disk_gb : float
+        Peak temp disk usage, in GB.
+    source : str
+        "profile" (from the resource profiles of earlier jobs), "model" (from the size of the dataset) or "none"
+        (no stage runs).
+    """
+
+    cpu_hours: float
+    peak_ram_gb: float
+    temp_disk_gb: float
+    source: str
+
+
+@dataclass
+class JobPlan:
+    """The plan of a job.
+
+    Parameters
+    ----------
+    name : str
+        Name of the job, e.g. "sub-01_ses-1".
+    pipeline : str
+        Name of the pipeline, e.g. "functional".
+    output_dir : str
+        Working directory of the job.
+    inputs : List[Dict[str, Any]]
+        Functional runs (run id, echoes, frames, matrix size and voxel-frames) or structural images (file and
+        matrix size).
+    stages : List[str]
+        Stages that would run.
+    skipped : List[str]
+        Stages that would be skipped.
+    estimate : Estimate
+        Estimated cost.
+    size : float, optional
+        Size of the input images, in MB, by default 0.0
+    notes : List[str], optional
+        Caveats of the estimate, by default none
+    """
+
+    name: str
+    pipeline: str
+    output_dir: str
+    inputs: List[Dict[str, Any]]
+    stages: List[str]
+    skipped: List[str]
+    estimate: Estimate
+    size: float = 0.0
+    notes: List[str] = field(default_factory=list)
+
+
+def describe_images(paths: Iterable[Union[Path, str]]) -> List[Dict[str, Any]]:
+    """Describes structural images.
+
+    Parameters
+    ----------
+    paths : Iterable[Union[Path, str]]
+        Paths to the images.
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        File and matrix size (None if unknown) of each image.
+    """
+    images = []
+    for path in paths:
+        shape = image_shape(path)
+        images.append({"file": str(path), "matrix": None if shape is None else list(shape[:3])})
+    return images
+
+
+def describe_runs(runs: Dict[str, Dict[Any, List[str]]]) -> List[Dict[str, Any]]:
+    """Describes the functional runs of a session.
+
+    Parameters
+    ----------
+    runs : Dict[str, Dict[Any, List[str]]]
+        Magnitude and phase files of each run (e.g. RunsMap.runs_dict).
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        Run id, number of echoes, whether it has phase data, frames, matrix size and voxel-frames
+        (voxels x frames x echoes) of each run. Frames and matrix size are None if they are unknown.
+    """
+    described = []
+    for run, mag in runs["mag"].items():
+        phase = runs.get("phase", {}).get(run, [])
+        shape = image_shape(mag[0]) if mag else None
+        frames = None if shape is None else (shape[3] if len(shape) > 3 else 1)
+        matrix = None if shape is None else list(shape[:3])
+        voxel_frames = 0
+        if shape is not None:
+            voxel_frames = matrix[0] * matrix[1] * matrix[2] * frames * len(mag)
+        described.append(
+            {
+                "run": run,
+                "echoes": len(mag),
+                # single echo data without phase lists the magnitude files as phase files
+                "phase": bool(phase) and sorted(map(str, phase)) != sorted(map(str, mag)),
+                "frames": frames,
+                "matrix": matrix,
+                "voxel_frames": voxel_frames,
+            }
+        )
+    return described
+
+
+def stages_to_run(
+    graph: StageGraph,
+    cwd: Union[Path, str],
+    params_files: Sequence[Union[Path, str]],
+    start: Optional[str] = None,
+    only: bool = False,
+    stage_graph: bool = False,
+) -> List[str]:
+    """Gets the stages a job would run.
+
+    Parameters
+    ----------
+    graph : StageGraph
+        Stages of the pipeline.
+    cwd : Union[Path, str]
+        Working directory of the job.
+    params_files : Sequence[Union[Path, str]]
+        Params files of the job.
+    start : Optional[str], optional
+        Stage to start on, by default the first stage
+    only : bool, optional
+        Only run the start stage, by default False
+    stage_graph : bool, optional
+        Run the stages as a dependency graph, skipping stages that are up to date, by default the script
+        runs every stage from the start stage
+
+    Returns
+    -------
+    List[str]
+        Names of the stages, in the order the script runs them.
+    """
+    if stage_graph:
+        return graph.plan(cwd, params_files, start, only)
+    names = graph.names
+    start = start or names[0]
+    return [start] if only else names[names.index(start) :]
+
+
+def model_estimate(pipeline: str, inputs: List[Dict[str, Any]]) -> Estimate:
+    """Estimates the cost of a job that runs every stage of a pipeline from the size of its dataset.
+
+    Parameters
+    ----------
+    pipeline : str
+        "structural" or "functional".
+    inputs : List[Dict[str, Any]]
+        Inputs of the job, see describe_images and describe_runs.
+
+    Returns
+    -------
+    Estimate
+        The estimate.
+    """
+    if pipeline == "structural":
+        return Estimate(STRUCTURAL_CPU_HOURS, STRUCTURAL_RAM_GB, STRUCTURAL_TEMP_DISK_GB, "model")
+    voxel_frames = [run["voxel_frames"] for run in inputs]
+    return Estimate(
+        FUNCTIONAL_CPU_HOURS_PER_GVOX * sum(voxel_frames) / 1e9,
+        FUNCTIONAL_RAM_BASE_GB + FUNCTIONAL_RAM_BYTES_PER_VOX * max(voxel_frames or [0]) / GB,
+        FUNCTIONAL_TEMP_BYTES_PER_VOX * sum(voxel_frames) / GB,
+        "model",
+    )
+
+
+def plan_job(
+    name: str,
+    graph: StageGraph,
+    cwd: Union[Path, str],
+    params_files: Sequence[Union[Path, str]],
+    inputs: List[Dict[str, Any]],
+    size: float = 0.0,
+    profiles: Optional[ProfileDB] = None,
+    start: Optional[str] = None,
+    only: bool = False,
+    stage_graph: bool = False,
+) -> JobPlan:
+    """Plans a job.
+
+    Parameters
+    ----------
+    name : str
+        Name of the job.
+    graph : StageGraph
+        Stages of the pipeline.
+    cwd : Union[Path, str]
+        Working directory of the job.
+    params_files : Sequence[Union[Path, str]]
+        Params files of the job.
+    inputs : List[Dict[str, Any]]
+        Inputs of the job, see describe_images and describe_runs.
+    size : float, optional
+        Size of the input images in MB, to scale the resource profiles, by default unknown
+    profiles : Optional[ProfileDB], optional
+        Resource profiles of earlier jobs, by default only the model is used
+    start : Optional[str], optional
+        Stage to start on, by default the first stage
+    only : bool, optional
+        Only run the start stage, by default False
+    stage_graph : bool, optional
+        Run the stages as a dependency graph, by default False
+
+    Returns
+    -------
+    JobPlan
+        The plan.
+    """
+    stages = stages_to_run(graph, cwd, params_files, start, only, stage_graph)
+    skipped = [stage for stage in graph.names if stage not in stages]
+    model = model_estimate(graph.name, inputs)
+    notes = []
+    if not stages:
+        estimate = Estimate(0.0, 0.0, 0.0, "none")
+    else:
+        names = [f"{graph.name}/{stage}" for stage in stages] if stage_graph else [graph.profile(start, only)]
+        cpu_times = [profiles.estimate_cpu_time(profile, size) for profile in names] if profiles is not None else [None]
+        memory = [profiles.estimate(profile, size) for profile in names] if profiles is not None else [None]
+        if all(value is not None for value in cpu_times + memory):
+            estimate = Estimate(sum(cpu_times) / 3600, max(memory) / 1024, model.temp_disk_gb, "profile")
+        else:
+            estimate = model
+            if skipped:
+                notes.append("estimated as if every stage runs (the stages that would run aren't profiled yet)")
+    if any(run.get("frames", 0) is None or run.get("matrix", 0) is None for run in inputs):
+        notes.append("the shape of some images could not be read, so the estimate is too low")
+    return JobPlan(name, graph.name, str(cwd), inputs, stages, skipped, estimate, size, notes)
+
+
+def plan_totals(plans: Sequence[JobPlan], jobs: int = 1) -> Dict[str, Any]:
+    """Adds up the estimates of the jobs of a plan.
+
+    Parameters
+    ----------
+    plans : Sequence[JobPlan]
+        Plans of the jobs.
+    jobs : int, optional
+        Number of jobs that run at once, by default 1
+
+    Returns
+    -------
+    Dict[str, Any]
+        Number of jobs, runs and frames, total CPU hours, and peak RAM and temp disk of a single job and of the
+        jobs that run at once (the largest ones).
+    """
+    estimates = [plan.estimate for plan in plans]
+    jobs = max(1, jobs)
+    return {
+        "jobs": len(plans),
+        "jobs_to_run": sum(bool(plan.stages) for plan in plans),
+        "runs": sum(len(plan.inputs) for plan in plans if plan.pipeline == "functional"),
+        "frames": sum(run.get("frames") or 0 for plan in plans if plan.pipeline == "functional" for run in plan.inputs),
+        "cpu_hours": sum(estimate.cpu_hours for estimate in estimates),
+        "peak_ram_gb_per_job": max([estimate.peak_ram_gb for estimate in estimates] or [0.0]),
+        "temp_disk_gb_per_job": max([estimate.temp_disk_gb for estimate in estimates] or [0.0]),
+        "concurrent_jobs": jobs,
+        "peak_ram_gb": sum(sorted((estimate.peak_ram_gb for estimate in estimates), reverse=True)[:jobs]),
+        "temp_disk_gb": sum(sorted((estimate.temp_disk_gb for estimate in estimates), reverse=True)[:jobs]),
+    }
+
+
+def format_plan(plans: Sequence[JobPlan], jobs: int = 1) -> str:
+    """Formats a plan.
+
+    Parameters
+    ----------
+    plans : Sequence[JobPlan]
+        Plans of the jobs.
+    jobs : int, optional
+        Number of jobs that run at once, by default 1
+
+    Returns
+    -------
+    str
+        A few lines per job (its inputs, stages and estimate) and the totals.
+    """
+    lines = ["Execution plan:"]
+    for plan in plans:
+        estimate = plan.estimate
+        lines.append(
+            f"  {plan.name} ({plan.pipeline}): {estimate.cpu_hours:.1f} CPU hours, {estimate.peak_ram_gb:.1f} GB RAM, "
+            f"{estimate.temp_disk_gb:.1f} GB temp disk ({estimate.source})"
+        )
+        for item in plan.inputs:
+            matrix = "x".join(map(str, item["matrix"])) if item.get("matrix") else "unknown matrix"
+            if "run" in item:
+                phase = " + phase" if item["phase"] else ""
+                frames = item["frames"] if item["frames"] is not None else "unknown"
+                lines.append(f"    run {item['run']}: {item['echoes']} echoes{phase}, {frames} frames, {matrix}")
+            else:
+                lines.append(f"    {Path(item['file']).name}: {matrix}")
+        lines.append(f"    runs: {', '.join(plan.stages) or 'nothing (up to date)'}")
+        if plan.skipped:
+            lines.append(f"    skips: {', '.join(plan.skipped)}")
+        lines.extend(f"    note: {note}" for note in plan.notes)
+    totals = plan_totals(plans, jobs)
+    lines.append(
+        f"  Total: {totals['jobs_to_run']} of {totals['jobs']} jobs to run, {totals['cpu_hours']:.1f} CPU hours; "
+        f"with {totals['concurrent_jobs']} jobs at once up to {totals['peak_ram_gb']:.1f} GB RAM and "
+        f"{totals['temp_disk_gb']:.1f} GB temp disk"
+    )
+    return "\n".join(lines)
+
+
+def write_plan(plans: Sequence[JobPlan], path: Union[Path, str], jobs: int = 1) -> None:
+    """Writes a plan to a JSON file.
+
+    Parameters
+    ----------
+    plans : Sequence[JobPlan]
+        Plans of the jobs.
+    path : Union[Path, str]
+        Path to the JSON file.
+    jobs : int, optional
+        Number of jobs that run at once, by default 1
+    """
+    with open(path, "w") as f:
+        json.dump({"jobs": [asdict(plan) for plan in plans], "totals": plan_totals(plans, jobs)}, f, indent=4)
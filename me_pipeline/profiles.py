@@ -0,0 +1,190 @@
+"""Records the resources pipeline jobs used, to only run as many jobs at once as fit in memory.
+
+Stages of the pipelines peak at very different amounts of memory (e.g. FreeSurfer in SURFACE_CREATION,
+NORDIC and MEDIC in FMRI_PP), which also grow with the size of the dataset they process. The scheduler
+measures the peak RSS, CPU time and wall time of each job that succeeds, and records it in a profile
+database under the profile of the job (e.g. "functional/FMRI_PP") along with the size of its dataset (the
+total size of its input images).
+
+Before a job starts, its peak memory is estimated from the samples of its profile (each scaled to the size
+of its dataset), and the job is only admitted if it fits in the memory left by the running jobs. A job
+without samples is admitted whenever a job slot is free.
+
+The peak RSS of a job is the peak RSS of the largest process it ran (the csh scripts run their tools one
+after the other, so that is usually the tool that peaks highest).
+"""
+import json
+import os
+import sys
+import threading
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Union
+from .manifest import file_lock
+
+PROFILE_DB_NAME = "resource_profiles.json"
+PROFILE_DB_VERSION = 1
+
+# number of samples kept for each profile (the most recent ones)
+MAX_SAMPLES = 50
+
+# estimates are padded by this factor, since peaks vary from run to run
+MEMORY_MARGIN = 1.2
+
+
+@dataclass
+class ResourceUsage:
+    """Resources used by a job.
+
+    Parameters
+    ----------
+    peak_rss : float
+        Peak resident set size, in MB.
+    cpu_time : float
+        User and system CPU time, in seconds.
+    wall_time : float
+        Run time, in seconds.
+    """
+
+    peak_rss: float
+    cpu_time: float
+    wall_time: float
+
+    @classmethod
+    def from_rusage(cls, rusage: Any, wall_time: float) -> "ResourceUsage":
+        """Gets the resources used by a process from its rusage (e.g. returned by os.wait4)."""
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        peak_rss = rusage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+        return cls(peak_rss, rusage.ru_utime + rusage.ru_stime, wall_time)
+
+
+def dataset_size(paths: Iterable[Union[Path, str]]) -> float:
+    """Gets the total size of the files of a dataset, in MB (missing files are ignored)."""
+    size = 0
+    for path in set(str(path) for path in paths):
+        try:
+            size += os.stat(path).st_size
+        except OSError:
+            pass
+    return size / (1024 * 1024)
+
+
+def available_memory() -> float:
+    """Gets the memory available on this node for new processes, in MB."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / (1024 * 1024)
+
+
+class ProfileDB:
+    """A database of the resources used by jobs, as a JSON file.
+
+    Samples are recorded under a file lock, so workers (on any node) can share a database.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path to the database file, created when the first sample is recorded.
+    """
+
+    def __init__(self, path: Union[Path, str]):
+        self.path = Path(path)
+
+    def read(self) -> Dict[str, Any]:
+        """Reads the database, an empty one if it doesn't exist (or is from another version)."""
+        try:
+            data = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            data = {}
+        if data.get("version") != PROFILE_DB_VERSION:
+            data = {"version": PROFILE_DB_VERSION, "profiles": {}}
+        return data
+
+    def write(self, data: Dict[str, Any]) -> None:
+        """Writes the database."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f".{self.path.name}.{os.getpid()}.{threading.get_ident()}")
+        tmp.write_text(json.dumps(data, indent=4, sort_keys=True))
+        os.replace(tmp, self.path)
+
+    def samples(self, profile: str) -> List[Dict[str, Any]]:
+        """Gets the samples of a profile, oldest first."""
+        return self.read()["profiles"].get(profile, [])
+
+    def record(self, profile: str, size: float, usage: ResourceUsage) -> None:
+        """Records the resources a job used.
+
+        Parameters
+        ----------
+        profile : str
+            Profile of the job.
+        size : float
+            Size of the dataset of the job, in MB.
+        usage : ResourceUsage
+            Resources the job used.
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with file_lock(self.path):
+            data = self.read()
+            samples = data["profiles"].setdefault(profile, [])
+            samples.append({"size": size, **asdict(usage), "recorded": datetime.now().isoformat()})
+            del samples[:-MAX_SAMPLES]
+            self.write(data)
+
+    def estimate(self, profile: str, size: float = 0.0) -> Optional[float]:
+        """Estimates the peak memory of a job.
+
+        Each sample is scaled by the size of the dataset of the job relative to the size of its dataset, and
+        the largest scaled sample (padded by MEMORY_MARGIN) is the estimate.
+
+        Parameters
+        ----------
+        profile : str
+            Profile of the job.
+        size : float, optional
+            Size of the dataset of the job, in MB, by default unknown (samples aren't scaled)
+
+        Returns
+        -------
+        Optional[float]
+            Peak memory of the job in MB, None if the profile has no samples.
+        """
+        samples = self.samples(profile)
+        if not samples:
+            return None
+        peaks = [
+            sample["peak_rss"] * (size / sample["size"] if size > 0 and sample["size"] > 0 else 1.0)
+            for sample in samples
+        ]
+        return max(peaks) * MEMORY_MARGIN
+
+    def estimate_cpu_time(self, profile: str, size: float = 0.0) -> Optional[float]:
+        """Estimates the CPU time of a job.
+
+        Parameters
+        ----------
+        profile : str
+            Profile of the job.
+        size : float, optional
+            Size of the dataset of the job, in MB, by default unknown (samples aren't scaled)
+
+        Returns
+        -------
+        Optional[float]
+            Mean CPU time of the samples (each scaled like in estimate) in seconds, None if the profile has no
+            samples.
+        """
+        samples = self.samples(profile)
+        if not samples:
+            return None
+        cpu_times = [
+            sample["cpu_time"] * (size / sample["size"] if size > 0 and sample["size"] > 0 else 1.0)
+            for sample in samples
+        ]
+        return sum(cpu_times) / len(cpu_times)
@@ -0,0 +1,6 @@
+"""Python implementations of the one step resampling stage.
+
+The framewise one step resampling stage historically called out to FSL and 4dfp tools for every
+frame of every echo. The modules in this package implement the same operations in-process with
+NumPy/SciPy so that a run can be resampled without per-frame processes or temporary files.
+"""
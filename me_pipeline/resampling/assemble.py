@@ -0,0 +1,116 @@
+"""Streaming assembly of per frame outputs into 4D 4dfp images.
+
+Resampling one frame at a time leaves a 4dfp image per frame and echo (plus a warped bias
+field per frame). Rather than concatenating them with ``paste_4dfp -a`` and bias correcting
+the result with ``imgopr_4dfp -p -z -u``, which reads and rewrites every full 4D volume once
+per step, ``FrameAssembler`` writes each frame straight into a preallocated, memory-mapped
+output as soon as it is done, applying the bias field and undefined voxel handling in the
+same pass.
+"""
+from dataclasses import replace
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple, Union
+import numpy as np
+from me_pipeline.io.fourdfp import FourDFPImage, create_4dfp, fourdfp_paths, load_4dfp
+from .engine import multiply_defined, zero_undefined
+
+
+class FrameAssembler:
+    """Assembles per frame 4dfp images into one 4D 4dfp image per output.
+
+    The outputs are created when the first frame arrives, taking their geometry from it.
+    Frames can be added in any order.
+
+    Parameters
+    ----------
+    outputs : Sequence[Union[Path, str]]
+        Output 4dfp images, one per echo.
+    n_frames : int
+        Number of frames in each output.
+    bias_frames : Optional[Sequence[Union[Path, str]]], optional
+        Per frame 4dfp images to multiply each frame by (e.g. the warped inverse bias field), by default None
+    display_range : Optional[Tuple[float, float]], optional
+        Display range to store in the Analyze headers of the outputs, by default (0.0, 2000.0)
+    rec_parents : Optional[Sequence[Union[Path, str]]], optional
+        4dfp image whose rec file is appended to the rec file of each output, by default None
+    remove_frames : bool, optional
+        Delete the per frame images once they have been assembled, by default False
+    """
+
+    def __init__(
+        self,
+        outputs: Sequence[Union[Path, str]],
+        n_frames: int,
+        bias_frames: Optional[Sequence[Union[Path, str]]] = None,
+        display_range: Optional[Tuple[float, float]] = (0.0, 2000.0),
+        rec_parents: Optional[Sequence[Union[Path, str]]] = None,
+        remove_frames: bool = False,
+    ):
+        if bias_frames is not None and len(bias_frames) != n_frames:
+            raise ValueError(f"Expected {n_frames} bias frames, got {len(bias_frames)}")
+        if rec_parents is not None and len(rec_parents) != len(outputs):
+            raise ValueError(f"Expected {len(outputs)} rec parents, got {len(rec_parents)}")
+        self.outputs = list(outputs)
+        self.n_frames = n_frames
+        self.bias_frames = bias_frames
+        self.display_range = display_range
+        self.rec_parents = rec_parents
+        self.remove_frames = remove_frames
+        self.images: List[FourDFPImage] = []
+        self.written = np.zeros(n_frames, dtype=bool)
+
+    def _create_outputs(self, first_frame: FourDFPImage) -> None:
+        """Creates the outputs with the geometry of the first frame to arrive."""
+        ifh = replace(first_frame.ifh, matrix_size=[*first_frame.shape[:3], self.n_frames], extra={})
+        for k, output in enumerate(self.outputs):
+            parents = [self.rec_parents[k]] if self.rec_parents is not None else []
+            self.images.append(create_4dfp(output, ifh, self.display_range, rec_parents=parents))
+
+    def _remove(self, frame: Union[Path, str]) -> None:
+        """Deletes the files of a per frame image."""
+        for path in fourdfp_paths(frame).values():
+            if path.exists():
+                path.unlink()
+
+    def add_frame(self, index: int, frames: Sequence[Union[Path, str]]) -> None:
+        """Writes a frame of each output.
+
+        Parameters
+        ----------
+        index : int
+            Frame index.
+        frames : Sequence[Union[Path, str]]
+            Single frame 4dfp image for each output.
+        """
+        if len(frames) != len(self.outputs):
+            raise ValueError(f"Expected {len(self.outputs)} frames, got {len(frames)}")
+        if self.written[index]:
+            raise ValueError(f"Frame {index} has already been assembled")
+        imgs = [load_4dfp(frame) for frame in frames]
+        if not self.images:
+            self._create_outputs(imgs[0])
+        bias = None
+        if self.bias_frames is not None:
+            bias = np.asarray(load_4dfp(self.bias_frames[index]).frame(0), dtype=np.float32)
+        for img, output in zip(imgs, self.images):
+            if img.shape[:3] != output.shape[:3]:
+                raise ValueError(f"Frame {img.paths['img']} does not match output shape {output.shape[:3]}")
+            data = np.asarray(img.frame(0), dtype=np.float32)
+            # multiply by the bias field, setting voxels undefined in either to 0 (imgopr_4dfp -p -z -u)
+            output.data[..., index] = data if bias is None else multiply_defined(data, bias)
+            if bias is None:
+                zero_undefined(output.data[..., index])
+        self.written[index] = True
+        if self.remove_frames:
+            for frame in frames:
+                self._remove(frame)
+            if self.bias_frames is not None:
+                self._remove(self.bias_frames[index])
+
+    def close(self) -> None:
+        """Flushes the outputs to disk, checking that every frame was written."""
+        missing = np.flatnonzero(~self.written)
+        if missing.size > 0:
+            raise RuntimeError(f"Frames {missing.tolist()} were never assembled")
+        for image in self.images:
+            image.flush()
@@ -0,0 +1,674 @@
+"""Benchmark harness for framewise one step resampling.
+
+Generates a synthetic multi-echo run (4dfp echoes, a framewise field map, an ``xr3d.mat`` with
+small head motion, a reference, bias field and postmat), runs ``one_step_resampling_framewise`` on
+it in a subprocess and reports:
+
+    - the wall/CPU time of each stage (from the script's ``-stage_times`` output)
+    - frames per second, overall and for each stage
+    - peak resident memory of the script and the tools it ran
+    - the high-water mark of temporary and output disk usage
+
+FSL and 4dfp tools that are not on the PATH (or, for ``Resampling_AV.csh``, that run tools that are
+missing) are replaced by small Python stubs so that the benchmark runs anywhere. Stubs only reproduce
+the file outputs of each tool (not their cost), so results list which tools were stubbed and should
+only be compared between runs with the same stubs.
+"""
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+import nibabel as nib
+import numpy as np
+from me_pipeline.io.fourdfp import IFH, create_4dfp, load_4dfp, save_4dfp
+
+# tools that can be replaced by stubs
+STUB_TOOLS = ("nifti_4dfp", "convertwarp", "applywarp", "extract_frame_4dfp", "scale_4dfp", "Resampling_AV.csh")
+
+# tools that Resampling_AV.csh runs from the PATH and from $FSLDIR/bin (it ships on the PATH with the
+# pipeline, so it is stubbed whenever any of these are missing)
+RESAMPLING_AV_TOOLS = ("aff_conv", "nifti_4dfp", "maskimg_4dfp")
+RESAMPLING_AV_FSL_TOOLS = ("convert_xfm", "flirt", "fugue", "convertwarp", "fslmaths", "applywarp")
+
+# effective echo spacing, phase encoding direction and echo times of synthetic runs
+SYNTHETIC_DWELL = 0.00059
+SYNTHETIC_PED = "y-"
+SYNTHETIC_TES = (0.0143, 0.0387, 0.0631, 0.0875, 0.1119)
+
+# command that runs the resampling script with the current interpreter
+SCRIPT_COMMAND = [
+    sys.executable,
+    "-c",
+    "from me_pipeline.scripts.one_step_resampling_framewise import main; main()",
+]
+
+
+@dataclass
+class SyntheticRun:
+    """Files of a synthetic multi-echo run.
+
+    Parameters
+    ----------
+    directory : Path
+        Directory the run was written to.
+    epis : List[Path]
+        4dfp image of each echo.
+    phase : Path
+        Framewise field map (in Hz) NIfTI.
+    xr3dmat : Path
+        Per frame t4 transforms.
+    ref : Path
+        Path and prefix of the reference (with a 4dfp and a NIfTI).
+    bias : Path
+        Path and prefix of the 4dfp inverse bias field.
+    postmat : Path
+        FSL matrix from the EPI to the reference.
+    n_frames : int
+        Number of frames.
+    matrix : Tuple[int, int, int]
+        Matrix size of each frame.
+    dwell : float, optional
+        Effective echo spacing in seconds, by default SYNTHETIC_DWELL
+    ped : str, optional
+        Phase encoding direction, by default SYNTHETIC_PED
+    """
+
+    directory: Path
+    epis: List[Path]
+    phase: Path
+    xr3dmat: Path
+    ref: Path
+    bias: Path
+    postmat: Path
+    n_frames: int
+    matrix: Tuple[int, int, int]
+    dwell: float = SYNTHETIC_DWELL
+    ped: str = SYNTHETIC_PED
+
+    def script_args(self, engine: str = "native", parallel: int = 1, extra_args: Sequence[str] = ()) -> List[str]:
+        """Builds the arguments of one_step_resampling_framewise for this run.
+
+        Parameters
+        ----------
+        engine : str, optional
+            Resampling engine, by default "native"
+        parallel : int, optional
+            Number of parallel workers, by default 1
+        extra_args : Sequence[str], optional
+            Other arguments to pass to the script, by default none
+
+        Returns
+        -------
+        List[str]
+            Script arguments.
+        """
+        return [
+            "-i",
+            *[str(epi) for epi in self.epis],
+            "-xr3dmat",
+            str(self.xr3dmat),
+            "-phase",
+            str(self.phase),
+            "-ped",
+            self.ped,
+            "-dwell",
+            str(self.dwell),
+            "-ref",
+            str(self.ref),
+            "-bias",
+            str(self.bias),
+            "-postmat",
+            str(self.postmat),
+            "-parallel",
+            str(parallel),
+            "-trailer",
+            "bench",
+            "-engine",
+            engine,
+            *extra_args,
+        ]
+
+
+def _synthetic_ifh(matrix: Sequence[int], n_frames: int, voxel_size: float) -> IFH:
+    """Makes the ifh of a transverse 4dfp image centered on the origin."""
+    mmppix = [voxel_size, -voxel_size, -voxel_size]
+    return IFH(
+        matrix_size=[*matrix, n_frames],
+        scaling_factor=[voxel_size] * 3,
+        orientation=2,
+        mmppix=mmppix,
+        center=[m * (n + 1) / 2 for m, n in zip(mmppix, matrix)],
+    )
+
+
+def _create_nifti(path: Union[Path, str], shape: Sequence[int], affine: np.ndarray) -> np.memmap:
+    """Creates a float32 NIfTI and returns a writable memmap of its data, so large runs are never held in memory."""
+    header = nib.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype(np.float32)
+    header.set_qform(affine, 1)
+    header.set_sform(affine, 1)
+    header.set_xyzt_units("mm", "sec")
+    offset = 352
+    header.set_data_offset(offset)
+    with open(path, "wb") as f:
+        header.write_to(f)
+        f.write(b"\0" * (offset - f.tell()))
+        f.truncate(offset + 4 * int(np.prod(shape)))
+    return np.memmap(path, dtype=np.float32, mode="r+", offset=offset, shape=tuple(shape), order="F")
+
+
+def _fourdfp_nifti_affine(ifh: IFH) -> np.ndarray:
+    """Gets the affine of the NIfTI conversion of a transverse 4dfp image.
+
+    The NIfTI stores the y and z axes flipped, and maps its voxels to the same mm coordinates as the 4dfp.
+    """
+    mmppix = np.asarray(ifh.mmppix, dtype=float)
+    center = np.asarray(ifh.center, dtype=float)
+    n = np.asarray(ifh.shape[:3], dtype=float)
+    affine = np.diag([mmppix[0], -mmppix[1], -mmppix[2], 1.0])
+    affine[:3, 3] = [mmppix[0] - center[0], mmppix[1] * n[1] - center[1], mmppix[2] * n[2] - center[2]]
+    return affine
+
+
+def _nifti_fourdfp_ifh(img: nib.spatialimages.SpatialImage) -> IFH:
+    """Gets the ifh of the 4dfp conversion of a NIfTI written by _fourdfp_to_nifti (the inverse of its affine)."""
+    affine = img.affine
+    shape = tuple(img.shape) + (1,) * (4 - len(img.shape))
+    mmppix = [float(affine[0, 0]), -float(affine[1, 1]), -float(affine[2, 2])]
+    center = [
+        mmppix[0] - float(affine[0, 3]),
+        mmppix[1] * shape[1] - float(affine[1, 3]),
+        mmppix[2] * shape[2] - float(affine[2, 3]),
+    ]
+    return IFH(
+        matrix_size=list(shape[:4]),
+        scaling_factor=[abs(m) for m in mmppix],
+        orientation=2,
+        mmppix=mmppix,
+        center=center,
+    )
+
+
+def _nifti_path(path: Union[Path, str]) -> str:
+    """Adds a .nii suffix to a path that does not have one (as nifti_4dfp does)."""
+    path = str(path)
+    return path if path.endswith((".nii", ".nii.gz")) else path + ".nii"
+
+
+def _fourdfp_to_nifti(fourdfp: Union[Path, str], nifti: Union[Path, str]) -> None:
+    """Converts a transverse 4dfp image to NIfTI (stub of nifti_4dfp -n)."""
+    img = load_4dfp(fourdfp)
+    out = _create_nifti(_nifti_path(nifti), img.shape, _fourdfp_nifti_affine(img.ifh))
+    for t in range(img.n_frames):
+        out[..., t] = img.frame(t)[:, ::-1, ::-1]
+    out.flush()
+
+
+def _nifti_to_fourdfp(nifti: Union[Path, str], fourdfp: Union[Path, str]) -> None:
+    """Converts a NIfTI image to a transverse 4dfp (stub of nifti_4dfp -4)."""
+    img = nib.load(_nifti_path(nifti))
+    ifh = _nifti_fourdfp_ifh(img)
+    out = create_4dfp(fourdfp, ifh)
+    for t in range(ifh.shape[3]):
+        frame = img.dataobj[..., t] if len(img.shape) > 3 else img.dataobj
+        out.data[..., t] = np.asarray(frame, dtype=np.float32)[:, ::-1, ::-1]
+    out.flush()
+
+
+def _options(argv: Sequence[str]) -> Dict[str, str]:
+    """Parses FSL style --name=value options."""
+    return dict(arg[2:].split("=", 1) for arg in argv if arg.startswith("--") and "=" in arg)
+
+
+def _stub_resampling_av(argv: Sequence[str]) -> None:
+    """Stub of Resampling_AV.csh, writes each echo's frame (or zeros if it is not on the reference grid) to
+    the defined frame that one_step_resampling_framewise expects."""
+    directory, ref_prefix = Path(argv[0]), argv[1]
+    padded = argv[10]
+    ref_img = nib.load(str(directory / f"{ref_prefix}.nii"))
+    for epi in argv[12:]:
+        basename = Path(epi).name
+        frame = np.asarray(nib.load(str(directory / f"{basename}{padded}.nii")).dataobj, dtype=np.float32)
+        if frame.shape[:3] != ref_img.shape[:3]:
+            frame = np.zeros(ref_img.shape[:3], dtype=np.float32)
+        out = nib.Nifti1Image(frame.reshape(ref_img.shape[:3]), ref_img.affine)
+        out_nii = directory / f"{basename}_on_{ref_prefix}{padded}_defined.nii"
+        out.to_filename(str(out_nii))
+        _nifti_to_fourdfp(out_nii, directory / f"{basename}_on_{ref_prefix}{padded}_defined")
+        out_nii.unlink()
+
+
+def run_stub(tool: str, argv: Sequence[str]) -> int:
+    """Runs the stub of a tool.
+
+    Parameters
+    ----------
+    tool : str
+        Name of the tool, one of STUB_TOOLS.
+    argv : Sequence[str]
+        Arguments the tool was called with.
+
+    Returns
+    -------
+    int
+        Exit code.
+    """
+    if tool == "nifti_4dfp":
+        if argv[0] == "-n":
+            _fourdfp_to_nifti(argv[1], argv[2])
+        elif argv[0] == "-4":
+            _nifti_to_fourdfp(argv[1], argv[2])
+        else:
+            raise ValueError(f"Unsupported nifti_4dfp option: {argv[0]}")
+    elif tool == "convertwarp":
+        # a zero displacement field on the reference grid
+        options = _options(argv)
+        ref_img = nib.load(_nifti_path(options["ref"]))
+        warp = np.zeros((*ref_img.shape[:3], 3), dtype=np.float32)
+        nib.Nifti1Image(warp, ref_img.affine).to_filename(_nifti_path(options["out"]))
+    elif tool == "applywarp":
+        # the input, if it is already on the reference grid, otherwise ones
+        options = _options(argv)
+        ref_img = nib.load(_nifti_path(options["ref"]))
+        data = np.asarray(nib.load(_nifti_path(options["in"])).dataobj, dtype=np.float32)
+        if data.shape[:3] != ref_img.shape[:3]:
+            data = np.ones(ref_img.shape[:3], dtype=np.float32)
+        nib.Nifti1Image(data.reshape(ref_img.shape[:3]), ref_img.affine).to_filename(_nifti_path(options["out"]))
+    elif tool == "extract_frame_4dfp":
+        img = load_4dfp(argv[0])
+        out = next(arg[2:] for arg in argv[2:] if arg.startswith("-o"))
+        save_4dfp(out, img.frame(int(argv[1]) - 1)[..., np.newaxis], img.ifh)
+    elif tool == "scale_4dfp":
+        img = load_4dfp(argv[0], mode="r+")
+        offset = next((float(arg[2:]) for arg in argv[2:] if arg.startswith("-b")), 0.0)
+        img.data[:] = img.data * float(argv[1]) + offset
+        img.flush()
+    elif tool == "Resampling_AV.csh":
+        _stub_resampling_av(argv)
+    else:
+        raise ValueError(f"No stub for {tool}")
+    return 0
+
+
+def missing_tools(tool: str) -> List[str]:
+    """Gets the tools that are needed to run a tool but can't be found.
+
+    Parameters
+    ----------
+    tool : str
+        Name of the tool.
+
+    Returns
+    -------
+    List[str]
+        The tool itself if it is not on the PATH, and for Resampling_AV.csh, each tool it runs that is
+        not on the PATH or in $FSLDIR/bin.
+    """
+    missing = [tool] if shutil.which(tool) is None else []
+    if tool == "Resampling_AV.csh":
+        missing += [t for t in RESAMPLING_AV_TOOLS if shutil.which(t) is None]
+        fsl_bin = Path(os.environ["FSLDIR"]) / "bin" if os.environ.get("FSLDIR") else None
+        missing += [
+            f"$FSLDIR/bin/{t}"
+            for t in RESAMPLING_AV_FSL_TOOLS
+            if fsl_bin is None or not os.access(str(fsl_bin / t), os.X_OK)
+        ]
+    return missing
+
+
+def write_stubs(bin_dir: Union[Path, str], tools: Sequence[str] = STUB_TOOLS, force: bool = False) -> List[str]:
+    """Writes executable stubs for tools that are not on the PATH, or that run tools that are missing
+    (see missing_tools).
+
+    Parameters
+    ----------
+    bin_dir : Union[Path, str]
+        Directory to write stubs to (to be put at the front of the PATH).
+    tools : Sequence[str], optional
+        Tools to stub, by default STUB_TOOLS
+    force : bool, optional
+        Stub tools even if they are on the PATH, by default False
+
+    Returns
+    -------
+    List[str]
+        Tools that were stubbed.
+    """
+    bin_dir = Path(bin_dir)
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    # check every tool before any stub is written, so stubs don't count as the tools they replace
+    skipped = [] if force else [tool for tool in tools if not missing_tools(tool)]
+    stubbed = []
+    for tool in tools:
+        if tool in skipped:
+            continue
+        stub = bin_dir / tool
+        stub.write_text(
+            f"#!{sys.executable}\n"
+            "import sys\n"
+            "from me_pipeline.resampling.benchmark import run_stub\n"
+            f"sys.exit(run_stub({tool!r}, sys.argv[1:]))\n"
+        )
+        stub.chmod(0o755)
+        stubbed.append(tool)
+    return stubbed
+
+
+def _smooth_field(matrix: Sequence[int], centers: np.ndarray, widths: np.ndarray) -> np.ndarray:
+    """Sums gaussian blobs over a grid (coordinates normalized to [-1, 1])."""
+    grid = np.meshgrid(*[np.linspace(-1, 1, n, dtype=np.float32) for n in matrix], indexing="ij")
+    field = np.zeros(matrix, dtype=np.float32)
+    for center, width in zip(centers, widths):
+        distance = sum((g - c) ** 2 for g, c in zip(grid, center))
+        field += np.exp(-distance / (2 * width**2)).astype(np.float32)
+    return field
+
+
+def _write_xr3d(path: Union[Path, str], n_frames: int, rng: np.random.Generator) -> None:
+    """Writes an xr3d.mat with a small random walk of rigid body motion."""
+    angles = np.cumsum(rng.normal(scale=0.0005, size=(n_frames, 3)), axis=0)
+    translations = np.cumsum(rng.normal(scale=0.02, size=(n_frames, 3)), axis=0)
+    lines = []
+    for j, (angle, translation) in enumerate(zip(angles, translations), 1):
+        cx, cy, cz = np.cos(angle)
+        sx, sy, sz = np.sin(angle)
+        t4 = np.eye(4)
+        t4[:3, :3] = (
+            np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+            @ np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+            @ np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+        )
+        t4[:3, 3] = translation
+        lines.append(f"t4 frame {j}")
+        lines += ["".join(f"{v:12.6f}" for v in row) for row in t4]
+        lines += ["scale:    1.000000", ""]
+    Path(path).write_text("\n".join(lines))
+
+
+def make_synthetic_run(
+    directory: Union[Path, str],
+    n_frames: int = 20,
+    n_echoes: int = 3,
+    matrix: Sequence[int] = (64, 64, 40),
+    voxel_size: float = 3.0,
+    seed: int = 0,
+) -> SyntheticRun:
+    """Writes a synthetic multi-echo run.
+
+    Echoes are an ellipsoid "head" with T2* decay and noise, the field map is a slowly varying set of
+    gaussian blobs (in Hz) and the motion is a small random walk. Frames are written one at a time,
+    so runs larger than memory can be generated.
+
+    Parameters
+    ----------
+    directory : Union[Path, str]
+        Directory to write the run to.
+    n_frames : int, optional
+        Number of frames, by default 20
+    n_echoes : int, optional
+        Number of echoes, by default 3
+    matrix : Sequence[int], optional
+        Matrix size of each frame, by default (64, 64, 40)
+    voxel_size : float, optional
+        Voxel size in mm, by default 3.0
+    seed : int, optional
+        Seed of the random number generator, by default 0
+
+    Returns
+    -------
+    SyntheticRun
+        Files of the run.
+    """
+    if not 1 <= n_echoes <= len(SYNTHETIC_TES):
+        raise ValueError(f"n_echoes must be between 1 and {len(SYNTHETIC_TES)}")
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    matrix = tuple(int(n) for n in matrix)
+    rng = np.random.default_rng(seed)
+    ifh = _synthetic_ifh(matrix, n_frames, voxel_size)
+
+    # an ellipsoid head, with some smooth contrast inside it
+    grid = np.meshgrid(*[np.linspace(-1, 1, n, dtype=np.float32) for n in matrix], indexing="ij")
+    head = (sum(g**2 for g in grid) < 0.7).astype(np.float32)
+    contrast = 0.5 + _smooth_field(matrix, rng.uniform(-0.5, 0.5, (4, 3)), rng.uniform(0.1, 0.3, 4))
+    s0 = 1000 * head * contrast
+
+    # echoes, with a T2* of 40 ms
+    epis = []
+    for k, te in enumerate(SYNTHETIC_TES[:n_echoes], 1):
+        epi = directory / f"synthetic_echo{k}.4dfp.img"
+        img = create_4dfp(epi, ifh, display_range=(0.0, 2000.0))
+        signal = s0 * np.exp(-te / 0.04)
+        for t in range(n_frames):
+            img.data[..., t] = signal + rng.normal(scale=10.0, size=matrix).astype(np.float32)
+        img.flush()
+        epis.append(epi)
+
+    # field map in Hz on the nifti grid of the echoes, drifting a little over time
+    affine = _fourdfp_nifti_affine(ifh)
+    phase = directory / "synthetic_fmap.nii"
+    fmap = _create_nifti(phase, (*matrix, n_frames), affine)
+    blobs = 40 * _smooth_field(matrix, rng.uniform(-0.5, 0.5, (3, 3)), rng.uniform(0.2, 0.4, 3)) - 10
+    for t in range(n_frames):
+        fmap[..., t] = blobs * (1 + 0.05 * np.sin(2 * np.pi * t / max(n_frames, 1)))
+    fmap.flush()
+
+    # realignment transforms
+    xr3dmat = directory / "synthetic_xr3d.mat"
+    _write_xr3d(xr3dmat, n_frames, rng)
+
+    # reference, on the same grid as the echoes
+    ref = directory / "synthetic_ref"
+    save_4dfp(ref, s0[..., np.newaxis] * np.exp(-SYNTHETIC_TES[0] / 0.04), _synthetic_ifh(matrix, 1, voxel_size))
+    _fourdfp_to_nifti(ref.with_suffix(".4dfp.img"), ref.with_suffix(".nii"))
+
+    # inverse bias field, close to 1
+    bias = directory / "synthetic_invBF"
+    bias_field = 1 + 0.1 * _smooth_field(matrix, rng.uniform(-0.5, 0.5, (2, 3)), rng.uniform(0.3, 0.5, 2))
+    save_4dfp(bias, bias_field[..., np.newaxis], _synthetic_ifh(matrix, 1, voxel_size))
+
+    # the reference shares the grid of the echoes
+    postmat = directory / "synthetic_postmat.mat"
+    np.savetxt(postmat, np.eye(4), fmt="%.6f")
+
+    return SyntheticRun(directory, epis, phase, xr3dmat, ref, bias, postmat, n_frames, matrix)  # type: ignore
+
+
+def disk_usage(path: Union[Path, str]) -> int:
+    """Gets the disk space used by the files under a path.
+
+    Blocks actually allocated are counted where available, so sparse files are not over counted.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        File or directory.
+
+    Returns
+    -------
+    int
+        Bytes used.
+    """
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                stat = os.lstat(os.path.join(root, name))
+            except FileNotFoundError:
+                # files come and go while the script runs
+                continue
+            total += stat.st_blocks * 512 if hasattr(stat, "st_blocks") else stat.st_size
+    return total
+
+
+class DiskMonitor:
+    """Polls the disk usage of directories in a background thread and keeps the high-water mark of each.
+
+    Parameters
+    ----------
+    paths : Dict[str, Union[Path, str]]
+        Directories to monitor, by name.
+    interval : float, optional
+        Time between polls in seconds, by default 0.1
+    """
+
+    def __init__(self, paths: Dict[str, Union[Path, str]], interval: float = 0.1):
+        self.paths = paths
+        self.interval = interval
+        self.baseline = {name: disk_usage(path) for name, path in paths.items()}
+        self.peak = {name: 0 for name in paths}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+
+    def _sample(self) -> None:
+        """Records the current usage above the baseline of each directory."""
+        for name, path in self.paths.items():
+            self.peak[name] = max(self.peak[name], disk_usage(path) - self.baseline[name])
+
+    def _poll(self) -> None:
+        """Samples until stopped."""
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self) -> "DiskMonitor":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+
+def _run_measured(command: List[str], env: Dict[str, str], log: Union[Path, str]) -> Tuple[int, int]:
+    """Runs a command, returning its exit code and the peak RSS in bytes of it and the processes it waited on."""
+    with open(log, "w") as f:
+        process = subprocess.Popen(command, env=env, stdout=f, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+    # mark the process as reaped so Popen does not wait on it again
+    process.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, "waitstatus_to_exitcode") else status >> 8
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    peak_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    return process.returncode, peak_rss
+
+
+def run_benchmark(
+    n_frames: int = 20,
+    n_echoes: int = 3,
+    matrix: Sequence[int] = (64, 64, 40),
+    engine: str = "native",
+    parallel: int = 1,
+    extra_args: Sequence[str] = (),
+    stub: str = "auto",
+    work_dir: Optional[Union[Path, str]] = None,
+    seed: int = 0,
+    interval: float = 0.1,
+) -> Dict[str, Any]:
+    """Benchmarks one_step_resampling_framewise on a synthetic run.
+
+    Parameters
+    ----------
+    n_frames : int, optional
+        Number of frames, by default 20
+    n_echoes : int, optional
+        Number of echoes, by default 3
+    matrix : Sequence[int], optional
+        Matrix size of each frame, by default (64, 64, 40)
+    engine : str, optional
+        Resampling engine, by default "native"
+    parallel : int, optional
+        Number of parallel workers, by default 1
+    extra_args : Sequence[str], optional
+        Other arguments to pass to the script (e.g. -executor), by default none
+    stub : str, optional
+        Stub tools that are missing ("auto"), all of STUB_TOOLS ("all") or none of them ("none"),
+        by default "auto"
+    work_dir : Optional[Union[Path, str]], optional
+        Directory to write the run and temporary files to (and keep), by default a temporary directory
+    seed : int, optional
+        Seed of the synthetic run, by default 0
+    interval : float, optional
+        Time between disk usage polls in seconds, by default 0.1
+
+    Returns
+    -------
+    Dict[str, Any]
+        Benchmark results, JSON serializable.
+    """
+    if stub not in ("auto", "all", "none"):
+        raise ValueError(f"Unknown stub mode: {stub}")
+    tmp_dir = None
+    if work_dir is None:
+        tmp_dir = TemporaryDirectory()
+        work_dir = tmp_dir.name
+    work_dir = Path(work_dir)
+    try:
+        # generate the run
+        start = time.perf_counter()
+        run = make_synthetic_run(work_dir / "run", n_frames, n_echoes, matrix, seed=seed)
+        generate_time = time.perf_counter() - start
+
+        # stub tools and point the script's temporary files at a directory we can watch
+        stubbed = [] if stub == "none" else write_stubs(work_dir / "bin", force=stub == "all")
+        script_tmp = work_dir / "tmp"
+        script_tmp.mkdir(exist_ok=True)
+        stage_times = work_dir / "stage_times.json"
+        package_root = str(Path(__file__).resolve().parents[2])
+        env = dict(
+            os.environ,
+            PATH=os.pathsep.join([str(work_dir / "bin"), os.environ.get("PATH", "")]),
+            PYTHONPATH=os.pathsep.join(p for p in [package_root, os.environ.get("PYTHONPATH")] if p),
+            TMPDIR=str(script_tmp),
+        )
+        command = SCRIPT_COMMAND + run.script_args(engine, parallel, [*extra_args, "-stage_times", str(stage_times)])
+
+        # run the script
+        log = work_dir / "benchmark.log"
+        with DiskMonitor({"temp": script_tmp, "output": run.directory}, interval) as monitor:
+            start = time.perf_counter()
+            returncode, peak_rss = _run_measured(command, env, log)
+            wall_time = time.perf_counter() - start
+
+        stages = json.loads(stage_times.read_text()) if stage_times.exists() else {}
+        for record in stages.values():
+            record["frames_per_second"] = record["frames"] / record["wall_time"] if record["wall_time"] else None
+        results: Dict[str, Any] = {
+            "config": {
+                "n_frames": n_frames,
+                "n_echoes": n_echoes,
+                "matrix": list(run.matrix),
+                "engine": engine,
+                "parallel": parallel,
+                "extra_args": list(extra_args),
+                "seed": seed,
+            },
+            "host": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+            },
+            "stubbed_tools": stubbed,
+            "returncode": returncode,
+            "generate_time": generate_time,
+            "wall_time": wall_time,
+            "frames_per_second": n_frames / wall_time,
+            "stages": stages,
+            "peak_rss_bytes": peak_rss,
+            "temp_disk_peak_bytes": monitor.peak["temp"],
+            "output_disk_peak_bytes": monitor.peak["output"],
+        }
+        if returncode != 0:
+            results["log_tail"] = log.read_text().splitlines()[-20:]
+        return results
+    finally:
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
@@ -0,0 +1,399 @@
+"""Native engine for framewise one step resampling.
+
+This implements what ``Resampling_AV.csh`` and the bias field section of
+``one_step_resampling_framewise`` do with FSL (flirt, fugue, convertwarp, applywarp) and 4dfp
+(maskimg_4dfp, imgopr_4dfp) tools, but on whole arrays in memory. For each frame:
+
+    1. the field map of the frame is aligned to the frame (flirt -applyxfm, trilinear)
+    2. the aligned field map is converted to a shift map (fugue --saveshift)
+    3. the motion, shift and output space transforms are composed (convertwarp)
+    4. each echo of the frame is interpolated on the output grid (applywarp --interp=spline)
+    5. voxels mapped from outside the EPI field of view are set undefined (maskimg_4dfp -t0.8)
+    6. the frame is multiplied by the warped inverse bias field, setting voxels undefined in either
+       to 0 (imgopr_4dfp -p -z -u)
+
+All coordinates follow FSL's scaled mm convention, so the affine matrices and warps that are
+passed to the FSL tools can be used here unchanged.
+"""
+from dataclasses import replace
+from pathlib import Path
+from subprocess import run as subprocess_run
+from subprocess import DEVNULL
+from typing import List, Optional, Sequence, Tuple, Union
+import nibabel as nib
+import numpy as np
+from scipy.ndimage import map_coordinates
+from me_pipeline.io.fourdfp import IFH, create_4dfp, fourdfp_paths, load_4dfp, read_ifh
+from .shiftmap import parse_ped, shift_map
+
+
+# value 4dfp uses to mark undefined voxels
+UNDEFINED = np.float32(1.0e-37)
+
+# threshold on the resampled blank image below which a voxel is undefined (maskimg_4dfp -t0.8)
+DEFINED_THRESHOLD = 0.8
+
+# nifti intent codes for FSL spline coefficient warps (these can only be expanded by FSL)
+FSL_COEFFICIENT_INTENTS = (2007, 2008, 2009, 2010)
+
+
+def find_nifti(path: Union[Path, str]) -> Path:
+    """Resolves an image path the way FSL does, adding a .nii/.nii.gz extension if needed.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path to image, with or without extension.
+
+    Returns
+    -------
+    Path
+        Path to the existing nifti file.
+    """
+    path = Path(path)
+    for candidate in (path, path.with_name(path.name + ".nii"), path.with_name(path.name + ".nii.gz")):
+        if candidate.is_file():
+            return candidate
+    raise FileNotFoundError(f"Could not find nifti image for {path}")
+
+
+def fsl_scaled_mm(img: nib.spatialimages.SpatialImage) -> np.ndarray:
+    """Returns the voxel to FSL scaled mm matrix of an image.
+
+    FSL coordinates are voxel coordinates scaled by the voxel size, with the x axis flipped
+    when the image is stored in neurological order (positive affine determinant).
+
+    Parameters
+    ----------
+    img : nib.spatialimages.SpatialImage
+        Image to get matrix for.
+
+    Returns
+    -------
+    np.ndarray
+        4x4 voxel to FSL mm matrix.
+    """
+    vox2mm = np.diag([*[float(z) for z in img.header.get_zooms()[:3]], 1.0])
+    if np.linalg.det(img.affine[:3, :3]) > 0:
+        flip = np.eye(4)
+        flip[0, 0] = -1
+        flip[0, 3] = img.shape[0] - 1
+        vox2mm = vox2mm @ flip
+    return vox2mm
+
+
+def apply_affine(matrix: np.ndarray, points: np.ndarray) -> np.ndarray:
+    """Applies a 4x4 affine matrix to a (3, N) array of points."""
+    return matrix[:3, :3] @ points + matrix[:3, 3:]
+
+
+def is_undefined(image: np.ndarray) -> np.ndarray:
+    """Gets the voxels of an image that are undefined (marked UNDEFINED or NaN)."""
+    return (image == UNDEFINED) | np.isnan(image)
+
+
+def zero_undefined(image: np.ndarray) -> np.ndarray:
+    """Sets the undefined voxels of an image to 0 (imgopr_4dfp -z -u), in place."""
+    image[is_undefined(image)] = 0
+    return image
+
+
+def multiply_defined(image: np.ndarray, factor: np.ndarray) -> np.ndarray:
+    """Multiplies two images, setting voxels undefined in either input to 0 (imgopr_4dfp -p -z -u)."""
+    out = image * factor
+    out[is_undefined(image) | is_undefined(factor)] = 0
+    return out
+
+
+def fourdfp_layout(ref_img: nib.spatialimages.SpatialImage, tmp_dir: Union[Path, str]) -> Tuple[IFH, np.ndarray]:
+    """Gets the header and voxel order nifti_4dfp -4 gives 4dfp conversions of images in the space of ref_img.
+
+    An image of voxel indices is converted once, so frames can be written straight into 4dfp outputs (laid
+    out as nifti_4dfp -4 would lay them out) instead of converting every output afterwards.
+
+    Parameters
+    ----------
+    ref_img : nib.spatialimages.SpatialImage
+        Image defining the space of the outputs.
+    tmp_dir : Union[Path, str]
+        Directory for the intermediate images.
+
+    Returns
+    -------
+    IFH
+        Header of the 4dfp conversion of a (single frame) image in the space of ref_img.
+    np.ndarray
+        For each 4dfp voxel, the index of the nifti voxel it holds (both flattened in Fortran order).
+    """
+    shape = ref_img.shape[:3]
+    indices = np.arange(np.prod(shape), dtype=np.float32).reshape(shape, order="F")
+    probe = Path(tmp_dir) / "voxel_indices"
+    img = nib.Nifti1Image(indices, ref_img.affine, ref_img.header)
+    img.set_data_dtype(np.float32)
+    img.to_filename(str(probe.with_suffix(".nii")))
+    subprocess_run(["nifti_4dfp", "-4", str(probe.with_suffix(".nii")), str(probe)], check=True, stdout=DEVNULL)
+    converted = load_4dfp(probe)
+    order = np.rint(converted.frame(0)).astype(np.int64).ravel(order="F")
+    ifh = converted.ifh
+    for path in [probe.with_suffix(".nii"), *fourdfp_paths(probe).values()]:
+        if path.exists():
+            path.unlink()
+    if not np.array_equal(np.sort(order), np.arange(order.size)):
+        raise RuntimeError(f"nifti_4dfp -4 did not keep the voxels of {probe}.nii")
+    return ifh, order
+
+
+def nifti_layout(fourdfp: Union[Path, str], nifti: Union[Path, str]) -> Tuple[nib.Nifti1Image, np.ndarray]:
+    """Gets the header and voxel order nifti_4dfp -n gives the NIfTI conversion of a 4dfp image.
+
+    A single frame image of voxel indices with the header of fourdfp is converted, so frames can be read
+    straight from the (memory-mapped) 4dfp image instead of from a full NIfTI copy of it.
+
+    Parameters
+    ----------
+    fourdfp : Union[Path, str]
+        4dfp image (any of its files).
+    nifti : Union[Path, str]
+        Path and prefix to write the (single frame) NIfTI conversion to, it is kept so tools that only read
+        its header (e.g. aff_conv) can use it.
+
+    Returns
+    -------
+    nib.Nifti1Image
+        The single frame NIfTI conversion, only its header is meaningful.
+    np.ndarray
+        For each NIfTI voxel, the index of the 4dfp voxel it holds (both flattened in Fortran order).
+    """
+    ifh = read_ifh(fourdfp)
+    shape = ifh.shape[:3]
+    probe = Path(f"{nifti}_voxel_indices")
+    img = create_4dfp(probe, replace(ifh, matrix_size=[*shape, 1], extra={}))
+    img.data[..., 0] = np.arange(np.prod(shape), dtype=np.float32).reshape(shape, order="F")
+    img.flush()
+    del img
+    try:
+        subprocess_run(["nifti_4dfp", "-n", str(probe), str(nifti)], check=True, stdout=DEVNULL)
+    finally:
+        for path in fourdfp_paths(probe).values():
+            if path.exists():
+                path.unlink()
+    converted = nib.load(str(find_nifti(nifti)))
+    order = np.rint(np.asarray(converted.dataobj, dtype=np.float32)).astype(np.int64).ravel(order="F")
+    if not np.array_equal(np.sort(order), np.arange(order.size)):
+        raise RuntimeError(f"nifti_4dfp -n did not keep the voxels of {probe}")
+    return converted, order
+
+
+def frame_to_nifti(frame: np.ndarray, order: np.ndarray, shape: Sequence[int]) -> np.ndarray:
+    """Reorders a 4dfp frame to the voxel order of its NIfTI conversion (see nifti_layout).
+
+    Parameters
+    ----------
+    frame : np.ndarray
+        (x, y, z) frame of the 4dfp image, e.g. a view of its memmap.
+    order : np.ndarray
+        Voxel order from nifti_layout.
+    shape : Sequence[int]
+        Shape of the NIfTI conversion.
+
+    Returns
+    -------
+    np.ndarray
+        float32 frame, in the voxel order of the NIfTI conversion.
+    """
+    return np.asarray(frame, dtype=np.float32).ravel(order="F")[order].reshape(tuple(shape[:3]), order="F")
+
+
+class FramewiseResampler:
+    """Resamples the frames of a multi-echo run to an output space in one step.
+
+    Parameters
+    ----------
+    ref_img : nib.spatialimages.SpatialImage
+        Image defining the output space.
+    epi_img : nib.spatialimages.SpatialImage
+        Image defining the EPI space (any echo of the run).
+    dwell : float
+        Effective echo spacing in seconds.
+    ped : str
+        Phase encoding direction.
+    bias : np.ndarray, optional
+        Inverse bias field in EPI space, by default all ones.
+    postmat : np.ndarray, optional
+        FSL matrix from EPI space to the output space.
+    postwarp : nib.spatialimages.SpatialImage, optional
+        FSL relative displacement field (in output space) from EPI space to the output space.
+    """
+
+    def __init__(
+        self,
+        ref_img: nib.spatialimages.SpatialImage,
+        epi_img: nib.spatialimages.SpatialImage,
+        dwell: float,
+        ped: str,
+        bias: Optional[np.ndarray] = None,
+        postmat: Optional[np.ndarray] = None,
+        postwarp: Optional[nib.spatialimages.SpatialImage] = None,
+    ):
+        if (postmat is None) == (postwarp is None):
+            raise ValueError("Exactly one of postmat or postwarp must be given.")
+        self.dwell = float(dwell)
+        self.ped = ped
+        self.ref_shape = tuple(ref_img.shape[:3])
+        self.epi_shape = tuple(epi_img.shape[:3])
+        self.postmat = postmat
+
+        # voxel <-> FSL mm matrices
+        self.epi_vox2mm = fsl_scaled_mm(epi_img)
+        self.epi_mm2vox = np.linalg.inv(self.epi_vox2mm)
+
+        # voxel coordinates of the EPI grid, used to align field maps to each frame
+        self.epi_vox = np.indices(self.epi_shape, dtype=np.float32).reshape(3, -1)
+
+        # FSL mm coordinates of every voxel in the output grid
+        self.ref_mm = apply_affine(fsl_scaled_mm(ref_img), np.indices(self.ref_shape, dtype=np.float32).reshape(3, -1))
+
+        # for a postwarp, displace the output coordinates into the (motion corrected) EPI space
+        if postwarp is not None:
+            if int(postwarp.header.get("intent_code", 0)) in FSL_COEFFICIENT_INTENTS:
+                raise ValueError("Spline coefficient warps are not supported by the native engine; use -engine fsl.")
+            displacement = np.asarray(postwarp.dataobj, dtype=np.float32).reshape(*self.ref_shape, 3)
+            self.ref_mm = self.ref_mm + displacement.reshape(-1, 3).T
+
+        # a shift of one voxel along the phase encoding direction, in EPI voxel coordinates
+        axis, sign = parse_ped(ped)
+        step_mm = np.zeros(3)
+        step_mm[axis] = sign * float(epi_img.header.get_zooms()[axis])
+        self.shift_step = (self.epi_mm2vox[:3, :3] @ step_mm)[:, np.newaxis]
+
+        # all ones image used to keep track of defined voxels
+        self.blank = np.ones(self.epi_shape, dtype=np.float32)
+
+        # the bias field
+        if bias is None:
+            bias = self.blank
+        if tuple(bias.shape[:3]) != self.epi_shape:
+            raise ValueError(f"Bias field shape {bias.shape} does not match EPI shape {self.epi_shape}")
+        self.bias = np.asarray(bias, dtype=np.float32).reshape(self.epi_shape)
+
+    def align_field_map(self, fmap_rads: np.ndarray, frame_to_xr3d: np.ndarray) -> np.ndarray:
+        """Aligns a field map in the xr3d space to a frame (flirt -applyxfm, trilinear).
+
+        Parameters
+        ----------
+        fmap_rads : np.ndarray
+            Field map in rad/s.
+        frame_to_xr3d : np.ndarray
+            FSL matrix from the frame to the xr3d space.
+
+        Returns
+        -------
+        np.ndarray
+            Field map in the space of the frame.
+        """
+        coords = apply_affine(self.epi_mm2vox @ frame_to_xr3d @ self.epi_vox2mm, self.epi_vox)
+        return map_coordinates(fmap_rads, coords, order=1, mode="constant", cval=0.0, output=np.float32).reshape(
+            self.epi_shape
+        )
+
+    def warp_coordinates(
+        self,
+        shift: np.ndarray,
+        frame_to_xr3d: Optional[np.ndarray] = None,
+        out_to_frame: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """Composes all transforms into EPI voxel coordinates for each output voxel (convertwarp).
+
+        Parameters
+        ----------
+        shift : np.ndarray
+            Shift map in voxels, in the (undistorted) EPI space of the frame.
+        frame_to_xr3d : np.ndarray, optional
+            FSL matrix from the frame to the xr3d space (the --premat), by default no motion.
+        out_to_frame : np.ndarray, optional
+            Precomputed inverse of the affine part of the transform (see transforms.FrameTransforms),
+            by default computed from frame_to_xr3d and the postmat.
+
+        Returns
+        -------
+        np.ndarray
+            (3, N) EPI voxel coordinates to sample for each output voxel.
+        """
+        if out_to_frame is not None:
+            vox = apply_affine(self.epi_mm2vox @ out_to_frame, self.ref_mm)
+        elif self.postmat is not None:
+            total = self.postmat if frame_to_xr3d is None else self.postmat @ frame_to_xr3d
+            vox = apply_affine(self.epi_mm2vox @ np.linalg.inv(total), self.ref_mm)
+        elif frame_to_xr3d is not None:
+            vox = apply_affine(self.epi_mm2vox @ np.linalg.inv(frame_to_xr3d), self.ref_mm)
+        else:
+            vox = apply_affine(self.epi_mm2vox, self.ref_mm)
+
+        # the shift map is applied first, in undistorted coordinates
+        displacement = map_coordinates(shift, vox, order=1, mode="nearest", output=np.float32)
+        return vox + self.shift_step * displacement
+
+    def resample_bias(self, shift: np.ndarray) -> np.ndarray:
+        """Warps the bias field to the output space with the shift map of a frame.
+
+        Parameters
+        ----------
+        shift : np.ndarray
+            Shift map of the frame in voxels (in the xr3d space).
+
+        Returns
+        -------
+        np.ndarray
+            Flattened bias field in the output space.
+        """
+        coords = self.warp_coordinates(shift)
+        return map_coordinates(self.bias, coords, order=1, mode="constant", cval=0.0, output=np.float32)
+
+    def resample_frame(
+        self,
+        frames: Sequence[np.ndarray],
+        fmap_rads: np.ndarray,
+        frame_to_xr3d: np.ndarray,
+        shift: Optional[np.ndarray] = None,
+        out_to_frame: Optional[np.ndarray] = None,
+    ) -> List[np.ndarray]:
+        """Resamples one frame of every echo to the output space.
+
+        Parameters
+        ----------
+        frames : Sequence[np.ndarray]
+            The frame for each echo, in EPI space.
+        fmap_rads : np.ndarray
+            Field map of the frame in rad/s (in the xr3d space).
+        frame_to_xr3d : np.ndarray
+            FSL matrix from the frame to the xr3d space.
+        shift : np.ndarray, optional
+            Shift map of fmap_rads (e.g. from a batched computation), by default computed here.
+        out_to_frame : np.ndarray, optional
+            Precomputed inverse of the affine transform to the output space, by default computed here.
+
+        Returns
+        -------
+        List[np.ndarray]
+            The resampled, bias corrected frame for each echo, in the output space.
+        """
+        frame_shift = shift_map(self.align_field_map(fmap_rads, frame_to_xr3d), self.dwell, self.ped)
+        coords = self.warp_coordinates(frame_shift, frame_to_xr3d, out_to_frame)
+
+        # voxels that do not map well within the EPI field of view are undefined
+        defined = (
+            map_coordinates(self.blank, coords, order=3, mode="constant", cval=0.0, output=np.float32)
+            > DEFINED_THRESHOLD
+        )
+        if shift is None:
+            shift = shift_map(fmap_rads, self.dwell, self.ped)
+        bias = self.resample_bias(shift)
+
+        outputs = []
+        for frame in frames:
+            resampled = map_coordinates(
+                np.asarray(frame, dtype=np.float32), coords, order=3, mode="constant", cval=0.0, output=np.float32
+            )
+            resampled[~defined] = UNDEFINED
+            outputs.append(multiply_defined(resampled, bias).reshape(self.ref_shape))
+        return outputs
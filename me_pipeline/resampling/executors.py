@@ -0,0 +1,240 @@
+"""Executors for running framewise resampling tasks.
+
+Each task processes a contiguous chunk of frames. Three modes are available:
+
+    - ``thread``: tasks run in a thread pool, best when tasks launch subprocesses (FSL/4dfp tools)
+    - ``process``: tasks run in a process pool, for Python work that holds the GIL
+    - ``vectorized``: tasks run one after another in the calling thread, for the native engine
+      where NumPy/SciPy already vectorize over each chunk
+
+Only a bounded number of tasks are in flight at any time (back-pressure), so the per frame
+files the tasks leave on disk are consumed before more are produced. Workers can optionally be
+pinned to disjoint sets of CPUs so that tools with their own threading don't oversubscribe a node.
+"""
+import multiprocessing
+import os
+import shutil
+import threading
+from concurrent.futures import FIRST_COMPLETED, Executor, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from queue import Queue
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+
+# available executor modes
+EXECUTOR_MODES = ("thread", "process", "vectorized")
+
+# cpus the current worker is pinned to
+_WORKER = threading.local()
+
+
+def available_cpus() -> List[int]:
+    """Gets the CPUs this process is allowed to run on.
+
+    Returns
+    -------
+    List[int]
+        Sorted CPU ids.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def cpu_sets(n_workers: int) -> List[Set[int]]:
+    """Splits the available CPUs into disjoint sets, one per worker.
+
+    If there are fewer CPUs than workers, CPUs are shared round-robin.
+
+    Parameters
+    ----------
+    n_workers : int
+        Number of workers.
+
+    Returns
+    -------
+    List[Set[int]]
+        CPUs for each worker.
+    """
+    cpus = available_cpus()
+    if n_workers >= len(cpus):
+        return [{cpus[n % len(cpus)]} for n in range(n_workers)]
+    per_worker = len(cpus) // n_workers
+    return [set(cpus[n * per_worker : (n + 1) * per_worker]) for n in range(n_workers)]
+
+
+def worker_cpus() -> Optional[Set[int]]:
+    """Gets the CPUs the current worker is pinned to.
+
+    Returns
+    -------
+    Optional[Set[int]]
+        CPUs of the current worker, None if it is not pinned.
+    """
+    return getattr(_WORKER, "cpus", None)
+
+
+def pin_command(command: Union[str, List[str]]) -> Union[str, List[str]]:
+    """Prefixes a command with ``taskset`` so it runs on the CPUs of the current worker.
+
+    ``preexec_fn`` is not safe to use from threads, so subprocesses are pinned through taskset instead.
+    The command is returned unchanged if the worker is not pinned or taskset is not available.
+
+    Parameters
+    ----------
+    command : Union[str, List[str]]
+        Command to run, as a shell string or a list of arguments.
+
+    Returns
+    -------
+    Union[str, List[str]]
+        Command, pinned to the CPUs of the current worker.
+    """
+    cpus = worker_cpus()
+    if cpus is None or shutil.which("taskset") is None:
+        return command
+    cpu_list = ",".join(str(cpu) for cpu in sorted(cpus))
+    if isinstance(command, str):
+        return f"taskset -c {cpu_list} {command}"
+    return ["taskset", "-c", cpu_list, *command]
+
+
+def _pin_process(slots: Any) -> None:
+    """Process pool initializer, pins the worker process to the next free set of CPUs."""
+    _WORKER.cpus = slots.get()
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, _WORKER.cpus)
+
+
+def _run_pinned(slots: Queue, func: Callable, frames: List[int], args: Tuple) -> Any:
+    """Runs a task in a thread, holding a set of CPUs while it runs."""
+    _WORKER.cpus = slots.get()
+    try:
+        return func(frames, *args)
+    finally:
+        slots.put(_WORKER.cpus)
+        _WORKER.cpus = None
+
+
+def frame_chunks(n_frames: int, frames_per_task: int) -> List[List[int]]:
+    """Splits frames into contiguous chunks.
+
+    Parameters
+    ----------
+    n_frames : int
+        Number of frames.
+    frames_per_task : int
+        Number of frames in each chunk.
+
+    Returns
+    -------
+    List[List[int]]
+        Frame indices of each chunk.
+    """
+    return [list(range(s, min(s + frames_per_task, n_frames))) for s in range(0, n_frames, frames_per_task)]
+
+
+class FrameExecutor:
+    """Runs a function over chunks of frames with bounded parallelism and back-pressure.
+
+    Parameters
+    ----------
+    mode : str, optional
+        One of "thread", "process" or "vectorized", by default "thread"
+    max_workers : int, optional
+        Number of workers, by default 1
+    frames_per_task : int, optional
+        Number of frames given to each task, by default 1
+    max_pending : Optional[int], optional
+        Maximum number of tasks in flight, by default twice the number of workers
+    pin_cpus : bool, optional
+        Pin each worker (and the subprocesses it launches with pin_command) to its own CPUs, by default False
+    """
+
+    def __init__(
+        self,
+        mode: str = "thread",
+        max_workers: int = 1,
+        frames_per_task: int = 1,
+        max_pending: Optional[int] = None,
+        pin_cpus: bool = False,
+    ):
+        if mode not in EXECUTOR_MODES:
+            raise ValueError(f"Unknown executor mode: {mode}, expected one of {EXECUTOR_MODES}")
+        if max_workers < 1 or frames_per_task < 1:
+            raise ValueError("max_workers and frames_per_task must be at least 1")
+        self.mode = mode
+        self.max_workers = max_workers
+        self.frames_per_task = frames_per_task
+        self.max_pending = max(max_pending if max_pending is not None else 2 * max_workers, 1)
+        self.pin_cpus = pin_cpus
+
+    def _pool(self) -> Tuple[Executor, Optional[Queue]]:
+        """Creates the pool, along with the queue of CPU sets used to pin its workers."""
+        if self.mode == "process":
+            # process workers are pinned once, when they start
+            if self.pin_cpus:
+                process_slots = multiprocessing.get_context().Queue()
+                for cpus in cpu_sets(self.max_workers):
+                    process_slots.put(cpus)
+                return ProcessPoolExecutor(self.max_workers, initializer=_pin_process, initargs=(process_slots,)), None
+            return ProcessPoolExecutor(self.max_workers), None
+        # thread workers take a set of cpus for each task they run
+        slots: Optional[Queue] = None
+        if self.pin_cpus:
+            slots = Queue()
+            for cpus in cpu_sets(self.max_workers):
+                slots.put(cpus)
+        return ThreadPoolExecutor(self.max_workers), slots
+
+    def run(self, func: Callable, n_frames: int, *args: Any) -> Iterator[Tuple[List[int], Any]]:
+        """Runs ``func(frames, *args)`` on every chunk of frames.
+
+        Results are yielded as tasks complete, which may not be in frame order. New tasks are only
+        submitted as results are consumed, so at most max_pending tasks are ever outstanding.
+
+        Parameters
+        ----------
+        func : Callable
+            Function taking a list of frame indices followed by args. Must be picklable in "process" mode.
+        n_frames : int
+            Number of frames.
+        *args : Any
+            Extra arguments to pass to func.
+
+        Yields
+        ------
+        Tuple[List[int], Any]
+            Frames of the completed task and the value func returned for them.
+        """
+        chunks = frame_chunks(n_frames, self.frames_per_task)
+
+        # run in the calling thread
+        if self.mode == "vectorized":
+            for frames in chunks:
+                yield frames, func(frames, *args)
+            return
+
+        pool, slots = self._pool()
+        with pool:
+            pending: Dict[Any, List[int]] = {}
+            remaining = iter(chunks)
+            try:
+                while True:
+                    # top up the tasks in flight
+                    while len(pending) < self.max_pending:
+                        frames = next(remaining, None)
+                        if frames is None:
+                            break
+                        if slots is not None:
+                            pending[pool.submit(_run_pinned, slots, func, frames, args)] = frames
+                        else:
+                            pending[pool.submit(func, frames, *args)] = frames
+                    if not pending:
+                        break
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield pending.pop(future), future.result()
+            finally:
+                # don't start anything new if we were interrupted (e.g. a task failed)
+                for future in pending:
+                    future.cancel()
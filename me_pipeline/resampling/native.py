@@ -0,0 +1,169 @@
+"""Framewise one step resampling of a whole run with the native engine.
+
+Runs the steps of :mod:`me_pipeline.resampling.engine` over every frame of a multi-echo run:
+the shift maps of each task's frames are computed at once, each frame of every echo is read from
+the memory-mapped 4dfp echo, resampled to the output space and written straight into preallocated
+4dfp outputs, so no NIfTI copy of the echoes is ever written. Tasks run on the
+workers of a :class:`~me_pipeline.resampling.executors.FrameExecutor`, so frames are resampled
+in parallel (NumPy and SciPy release the GIL, so thread workers run concurrently).
+"""
+import sys
+from dataclasses import replace
+from pathlib import Path
+from subprocess import run as subprocess_run
+from subprocess import DEVNULL
+from typing import Optional, Sequence, Union
+import nibabel as nib
+import numpy as np
+from me_pipeline.io.fourdfp import create_4dfp, fourdfp_paths, load_4dfp
+from .engine import FramewiseResampler, find_nifti, fourdfp_layout, frame_to_nifti, nifti_layout
+from .executors import FrameExecutor
+from .shiftmap import read_frame_chunk, shift_map
+from .stages import StageTimer
+from .transforms import load_frame_transforms
+
+
+def flush_stdout() -> None:
+    """Flushes stdout, ignoring non-blocking pipes that are not ready"""
+    try:
+        sys.stdout.flush()
+    except BlockingIOError:
+        pass
+
+
+def _prefix(path: Union[Path, str]) -> str:
+    """Gets the path and prefix of a 4dfp image (any of its files)."""
+    return str(fourdfp_paths(path)["img"])[: -len(".4dfp.img")]
+
+
+def native_resampling(
+    epis: Sequence[Union[Path, str]],
+    outputs: Sequence[Union[Path, str]],
+    ref: Union[Path, str],
+    phase: Union[Path, str],
+    xr3dmat: Union[Path, str],
+    dwell: float,
+    ped: str,
+    n_frames: int,
+    tmp_dir: Union[Path, str],
+    executor: FrameExecutor,
+    bias: Optional[Union[Path, str]] = None,
+    postmat: Optional[Union[Path, str]] = None,
+    postwarp: Optional[Union[Path, str]] = None,
+    timer: Optional[StageTimer] = None,
+) -> None:
+    """Resamples all frames of all echoes of a run in-process with the native engine.
+
+    Parameters
+    ----------
+    epis : Sequence[Union[Path, str]]
+        4dfp image of each echo.
+    outputs : Sequence[Union[Path, str]]
+        4dfp image to write for each echo.
+    ref : Union[Path, str]
+        Path and prefix of the reference, a .nii or .4dfp.img.
+    phase : Union[Path, str]
+        Framewise field maps (in Hz), with or without extension.
+    xr3dmat : Union[Path, str]
+        Per frame t4 transforms.
+    dwell : float
+        Effective echo spacing in seconds.
+    ped : str
+        Phase encoding direction.
+    n_frames : int
+        Number of frames.
+    tmp_dir : Union[Path, str]
+        Directory to write intermediates to.
+    executor : FrameExecutor
+        Executor to run the tasks of frames on, in "thread" or "vectorized" mode.
+    bias : Optional[Union[Path, str]], optional
+        4dfp inverse bias field on the grid of the echoes, by default None (all ones)
+    postmat : Optional[Union[Path, str]], optional
+        FSL matrix from the EPI to the reference, by default None
+    postwarp : Optional[Union[Path, str]], optional
+        FSL warp from the EPI to the reference, by default None
+    timer : Optional[StageTimer], optional
+        Timer to record the time of each stage in, by default None
+    """
+    if executor.mode == "process":
+        raise ValueError("The native engine writes into shared outputs, it can't run in process workers")
+    timer = StageTimer() if timer is None else timer
+    tmp_dir = Path(tmp_dir)
+
+    # open each echo, frames are read from its memmap as they are needed, in the voxel order of its nifti
+    # conversion (only a single frame is converted, to get the header and voxel order)
+    echoes = [load_4dfp(epi) for epi in epis]
+    epi_nii = tmp_dir / Path(_prefix(epis[0])).name
+    with timer.stage("conversion"):
+        epi_img, epi_order = nifti_layout(epis[0], epi_nii)
+
+    # load the reference, converting it to nifti if needed
+    ref_nii = Path(f"{ref}.nii")
+    ref_4dfp = Path(f"{ref}.4dfp.img")
+    if not ref_nii.exists():
+        if not ref_4dfp.exists():
+            raise FileNotFoundError(f"Could not find {ref_nii} or {ref_4dfp}")
+        ref_nii = tmp_dir / f"{Path(str(ref)).name}.nii"
+        with timer.stage("conversion"):
+            subprocess_run(["nifti_4dfp", "-n", str(ref_4dfp), str(ref_nii)], check=True, stdout=DEVNULL)
+    ref_img = nib.load(str(ref_nii))
+
+    # load the field maps (in Hz)
+    phase_img = nib.load(str(find_nifti(phase)))
+
+    # load the bias field, which is on the grid of the echoes
+    bias_data = None
+    if bias is not None:
+        bias_data = frame_to_nifti(load_4dfp(bias).frame(0), epi_order, epi_img.shape)
+
+    # get the transforms of every frame, composed with the postmat and inverted up front
+    print("Converting xr3d transforms...")
+    flush_stdout()
+    postmat_fsl = np.loadtxt(postmat) if postmat else None
+    with timer.stage("transforms", n_frames):
+        transforms = load_frame_transforms(
+            xr3dmat, _prefix(epis[0]), epi_nii, n_frames, tmp_dir, postmat_fsl, order=epi_order
+        )
+
+    # setup the resampler
+    resampler = FramewiseResampler(
+        ref_img,
+        epi_img,
+        float(dwell),
+        ped,
+        bias=bias_data,
+        postmat=postmat_fsl,
+        postwarp=nib.load(str(find_nifti(postwarp))) if postwarp else None,
+    )
+
+    # create an output 4dfp for each echo (laid out as nifti_4dfp -4 would) and resample each frame directly into it
+    with timer.stage("conversion"):
+        ifh, order = fourdfp_layout(ref_img, tmp_dir)
+    ifh = replace(ifh, matrix_size=[*ifh.shape[:3], n_frames], extra={})
+    images = [create_4dfp(str(o), ifh, (0.0, 2000.0), rec_parents=[str(e)]) for o, e in zip(outputs, epis)]
+    print("Resampling EPIs...")
+    flush_stdout()
+
+    def resample_frames(frames):
+        # field maps (in Hz) are converted to rad/s and shift maps for all frames of the task at once
+        with timer.stage("shift_maps", len(frames)):
+            fmap_rads = read_frame_chunk(phase_img, frames[0], frames[-1] + 1, scale=2 * np.pi)
+            shift = shift_map(fmap_rads, float(dwell), ped)
+        for n, i in enumerate(frames):
+            epi_frames = [frame_to_nifti(echo.frame(i), epi_order, epi_img.shape) for echo in echoes]
+            resampled = resampler.resample_frame(
+                epi_frames, fmap_rads[..., n], transforms.frame_to_xr3d[i], shift[..., n], transforms.out_to_frame[i]
+            )
+            # each task writes its own frames, so workers never write to the same part of the outputs
+            for image, frame in zip(images, resampled):
+                image.data[..., i] = frame.ravel(order="F")[order].reshape(ifh.shape[:3], order="F")
+
+    with timer.stage("resampling", n_frames):
+        for frames, _ in executor.run(resample_frames, n_frames):
+            print(f"Resampled EPI frames {frames[0]}-{frames[-1]}")
+            flush_stdout()
+
+    # write the outputs to disk
+    with timer.stage("paste", n_frames):
+        for image in images:
+            image.flush()
@@ -0,0 +1,243 @@
+"""Batched conversion of field maps to shift maps.
+
+``fugue --saveshift`` only scales a field map by the dwell time and the number of voxels along
+the phase encoding direction. This module applies that scaling to whole 4D field maps at once,
+streaming chunks of frames so memory use stays bounded for long runs.
+"""
+from pathlib import Path
+from typing import Iterator, List, Tuple, Union
+import nibabel as nib
+import numpy as np
+
+
+# maps a phase encoding direction to an array axis
+PED_AXES = {"x": 0, "y": 1, "z": 2}
+
+# default number of frames to hold in memory at once
+DEFAULT_CHUNK_SIZE = 64
+
+
+def parse_ped(ped: str) -> Tuple[int, float]:
+    """Parses an FSL phase encoding direction (e.g. "y-") into an axis and sign.
+
+    Parameters
+    ----------
+    ped : str
+        Phase encoding direction, one of x, y, z, x-, y-, z-.
+
+    Returns
+    -------
+    Tuple[int, float]
+        Array axis and sign (1.0 or -1.0) of the phase encoding direction.
+    """
+    ped = ped.strip()
+    if len(ped) == 0 or ped[0] not in PED_AXES or ped[1:] not in ("", "-"):
+        raise ValueError(f"Invalid phase encoding direction: {ped}")
+    return PED_AXES[ped[0]], -1.0 if ped.endswith("-") else 1.0
+
+
+def shift_map(fmap_rads: np.ndarray, dwell: float, ped: str) -> np.ndarray:
+    """Converts a field map in rad/s to a shift map in voxels (fugue --saveshift).
+
+    The field map may be a single frame or a (x, y, z, t) stack of frames.
+
+    Parameters
+    ----------
+    fmap_rads : np.ndarray
+        Field map(s) in rad/s.
+    dwell : float
+        Effective echo spacing in seconds.
+    ped : str
+        Phase encoding direction.
+
+    Returns
+    -------
+    np.ndarray
+        Shift along the phase encoding axis in voxels.
+    """
+    axis, _ = parse_ped(ped)
+    return fmap_rads * np.float32(float(dwell) * fmap_rads.shape[axis] / (2 * np.pi))
+
+
+def read_frame_chunk(img: nib.spatialimages.SpatialImage, start: int, stop: int, scale: float = 1.0) -> np.ndarray:
+    """Reads a contiguous range of frames from a 4D image.
+
+    Parameters
+    ----------
+    img : nib.spatialimages.SpatialImage
+        4D image to read.
+    start : int
+        Index of the first frame.
+    stop : int
+        Index one past the last frame.
+    scale : float, optional
+        Factor to scale the data by, by default 1.0
+
+    Returns
+    -------
+    np.ndarray
+        (x, y, z, t) float32 chunk.
+    """
+    if len(img.shape) > 3:
+        chunk = np.asarray(img.dataobj[..., start:stop], dtype=np.float32)
+    else:
+        # a 3D image is a single frame
+        chunk = np.asarray(img.dataobj, dtype=np.float32)[..., np.newaxis][..., start:stop]
+    chunk = chunk.reshape(*img.shape[:3], -1)
+    if scale != 1.0:
+        # float32 images come back as read-only memmaps, so scale out of place
+        chunk = chunk * np.float32(scale)
+    return chunk
+
+
+def iter_frame_chunks(
+    img: nib.spatialimages.SpatialImage, chunk_size: int = DEFAULT_CHUNK_SIZE, scale: float = 1.0
+) -> Iterator[Tuple[int, np.ndarray]]:
+    """Streams chunks of frames from a 4D image.
+
+    Parameters
+    ----------
+    img : nib.spatialimages.SpatialImage
+        4D image to read.
+    chunk_size : int, optional
+        Number of frames per chunk, by default DEFAULT_CHUNK_SIZE
+    scale : float, optional
+        Factor to scale the data by, by default 1.0
+
+    Yields
+    ------
+    Tuple[int, np.ndarray]
+        Index of the first frame in the chunk and the (x, y, z, t) float32 chunk.
+    """
+    n_frames = img.shape[3] if len(img.shape) > 3 else 1
+    for start in range(0, n_frames, chunk_size):
+        yield start, read_frame_chunk(img, start, start + chunk_size, scale)
+
+
+def iter_shift_maps(
+    fmap_img: nib.spatialimages.SpatialImage,
+    dwell: float,
+    ped: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    scale: float = 1.0,
+) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+    """Streams chunks of field maps along with their shift maps.
+
+    Parameters
+    ----------
+    fmap_img : nib.spatialimages.SpatialImage
+        4D field map image.
+    dwell : float
+        Effective echo spacing in seconds.
+    ped : str
+        Phase encoding direction.
+    chunk_size : int, optional
+        Number of frames per chunk, by default DEFAULT_CHUNK_SIZE
+    scale : float, optional
+        Factor converting the field map to rad/s (e.g. 2 * pi for Hz), by default 1.0
+
+    Yields
+    ------
+    Tuple[int, np.ndarray, np.ndarray]
+        Index of the first frame in the chunk, field maps in rad/s and shift maps in voxels.
+    """
+    for start, fmap_rads in iter_frame_chunks(fmap_img, chunk_size, scale):
+        yield start, fmap_rads, shift_map(fmap_rads, dwell, ped)
+
+
+def _write_frame_maps(
+    fmap_img: nib.spatialimages.SpatialImage,
+    start: int,
+    fmap_rads: np.ndarray,
+    shift: np.ndarray,
+    phase_base: Union[Path, str],
+) -> List[Tuple[str, str]]:
+    """Writes each frame of a chunk of field maps and shift maps."""
+    written = []
+    for n in range(fmap_rads.shape[3]):
+        frame = start + n
+        outputs = ((fmap_rads, f"{phase_base}_{frame:04d}.nii"), (shift, f"{phase_base}_shift_{frame:04d}.nii"))
+        for data, name in outputs:
+            img = nib.Nifti1Image(data[..., n], fmap_img.affine, fmap_img.header)
+            img.set_data_dtype(np.float32)
+            img.to_filename(name)
+        written.append((outputs[0][1], outputs[1][1]))
+    return written
+
+
+def write_shift_maps(
+    phase_rads: Union[Path, str],
+    dwell: float,
+    ped: str,
+    phase_base: Union[Path, str],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    scale: float = 1.0,
+) -> int:
+    """Splits a 4D field map into per frame field maps and shift maps.
+
+    This writes the same files as running ``fslroi`` and ``fugue --saveshift`` on every frame:
+    ``{phase_base}_{i:04d}.nii`` and ``{phase_base}_shift_{i:04d}.nii``.
+
+    Parameters
+    ----------
+    phase_rads : Union[Path, str]
+        4D field map in rad/s (or in other units, see scale).
+    dwell : float
+        Effective echo spacing in seconds.
+    ped : str
+        Phase encoding direction.
+    phase_base : Union[Path, str]
+        Path and prefix of the per frame outputs.
+    chunk_size : int, optional
+        Number of frames to hold in memory at once, by default DEFAULT_CHUNK_SIZE
+    scale : float, optional
+        Factor converting the field map to rad/s (e.g. 2 * pi for Hz), by default 1.0
+
+    Returns
+    -------
+    int
+        Number of frames written.
+    """
+    fmap_img = nib.load(str(phase_rads))
+    n_frames = 0
+    for start, fmap_rads, shift in iter_shift_maps(fmap_img, dwell, ped, chunk_size, scale):
+        n_frames += len(_write_frame_maps(fmap_img, start, fmap_rads, shift, phase_base))
+    return n_frames
+
+
+def write_frame_shift_maps(
+    phase_rads: Union[Path, str],
+    start: int,
+    stop: int,
+    dwell: float,
+    ped: str,
+    phase_base: Union[Path, str],
+    scale: float = 1.0,
+) -> List[Tuple[str, str]]:
+    """Writes the per frame field maps and shift maps of a range of frames (see write_shift_maps).
+
+    Parameters
+    ----------
+    phase_rads : Union[Path, str]
+        4D field map in rad/s (or in other units, see scale).
+    start : int
+        Index of the first frame.
+    stop : int
+        Index one past the last frame.
+    dwell : float
+        Effective echo spacing in seconds.
+    ped : str
+        Phase encoding direction.
+    phase_base : Union[Path, str]
+        Path and prefix of the per frame outputs.
+    scale : float, optional
+        Factor converting the field map to rad/s (e.g. 2 * pi for Hz), by default 1.0
+
+    Returns
+    -------
+    List[Tuple[str, str]]
+        Field map and shift map written for each frame.
+    """
+    fmap_img = nib.load(str(phase_rads))
+    fmap_rads = read_frame_chunk(fmap_img, start, stop, scale)
+    return _write_frame_maps(fmap_img, start, fmap_rads, shift_map(fmap_rads, dwell, ped), phase_base)
@@ -0,0 +1,72 @@
+"""Per stage timing of framewise resampling.
+
+The resampling script wraps each of its stages (conversion, shift maps, resampling, ...) in
+:meth:`StageTimer.stage`, and writes the timings out as JSON when asked to, so that benchmarks can
+attribute time to stages without parsing logs. Stages that run more than once (e.g. the per frame
+paste into the outputs) accumulate.
+"""
+import json
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Union
+
+
+class StageTimer:
+    """Accumulates wall and CPU time for named stages, in the order they first ran."""
+
+    def __init__(self):
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str, frames: int = 0) -> Iterator[None]:
+        """Times a block of code as (part of) a stage.
+
+        Blocks timed from several threads at once each add their own time to the stage.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage.
+        frames : int, optional
+            Number of frames processed by the block, by default 0
+        """
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._add(name, time.perf_counter() - wall, time.process_time() - cpu, frames)
+
+    def _add(self, name: str, wall_time: float, cpu_time: float, frames: int) -> None:
+        """Adds a timed block to a stage."""
+        record = self.stages.setdefault(name, {"wall_time": 0.0, "cpu_time": 0.0, "calls": 0, "frames": 0})
+        record["wall_time"] += wall_time
+        record["cpu_time"] += cpu_time
+        record["calls"] += 1
+        record["frames"] += frames
+
+    def to_dict(self) -> Dict[str, Dict[str, float]]:
+        """Gets the timings of each stage.
+
+        Returns
+        -------
+        Dict[str, Dict[str, float]]
+            Wall time, CPU time (of this process only), number of calls and frames for each stage.
+        """
+        return {name: dict(record) for name, record in self.stages.items()}
+
+    def write(self, path: Optional[Union[Path, str]]) -> None:
+        """Writes the timings of each stage to a JSON file.
+
+        Parameters
+        ----------
+        path : Optional[Union[Path, str]]
+            Path to write to, nothing is written if None.
+        """
+        if path is None:
+            return
+        Path(path).write_text(json.dumps(self.to_dict(), indent=2))
@@ -0,0 +1,326 @@
+"""Vectorized framewise transforms for one step resampling.
+
+``Resampling_AV.csh`` greps the t4 of its frame out of the ``xr3d.mat`` file, converts it to an
+FSL matrix with ``aff_conv`` and then composes and inverts it with ``convert_xfm``, which is
+several processes per frame. This module parses the whole ``xr3d.mat`` once into an (N, 4, 4)
+array and does the same conversions for every frame at once with NumPy.
+
+A t4 maps 4dfp mm coordinates of an image to those of its target. FSL matrices map FSL scaled mm
+coordinates instead, so a t4 is converted by changing its coordinates on both sides:
+``F = C_target @ T4 @ inv(C_source)``, where ``C`` maps 4dfp mm to FSL scaled mm.
+"""
+import re
+import shutil
+from dataclasses import dataclass
+from pathlib import Path
+from subprocess import run as subprocess_run
+from subprocess import DEVNULL
+from typing import Optional, Sequence, Union
+import nibabel as nib
+import numpy as np
+from me_pipeline.io.fourdfp import read_ifh
+from me_pipeline.io.geometry import fourdfp_affine
+from .engine import find_nifti, fsl_scaled_mm
+
+
+def read_xr3d(xr3dmat: Union[Path, str]) -> np.ndarray:
+    """Parses every t4 in an xr3d.mat file.
+
+    Each frame's t4 is the 4 lines that follow its ``t4 frame j`` header (grep -x -A4, as in
+    Resampling_AV.csh).
+
+    Parameters
+    ----------
+    xr3dmat : Union[Path, str]
+        Path to xr3d.mat file produced by cross_realign3d_4dfp.
+
+    Returns
+    -------
+    np.ndarray
+        (N, 4, 4) t4 matrices, ordered by frame number.
+    """
+    lines = Path(xr3dmat).read_text().splitlines()
+    t4s = {}
+    for n, line in enumerate(lines):
+        match = re.fullmatch(r"t4 frame (\d+)", line)
+        if match is not None:
+            t4s[int(match.group(1))] = np.array([row.split() for row in lines[n + 1 : n + 5]], dtype=float)
+    if not t4s:
+        raise ValueError(f"Could not find any t4 frames in {xr3dmat}")
+    frames = sorted(t4s)
+    if frames != list(range(1, len(frames) + 1)):
+        raise ValueError(f"Frames in {xr3dmat} are not numbered 1 to {len(frames)}")
+    return np.stack([t4s[j] for j in frames])
+
+
+def fourdfp_voxel_map(order: np.ndarray, fourdfp_shape: Sequence[int], nifti_shape: Sequence[int]) -> np.ndarray:
+    """Gets the matrix from 4dfp voxel to NIfTI voxel coordinates of an image from its voxel order.
+
+    nifti_4dfp only reorders and flips the axes of an image, so the voxel order from
+    engine.nifti_layout is an affine map of voxel coordinates, for any 4dfp orientation.
+
+    Parameters
+    ----------
+    order : np.ndarray
+        For each NIfTI voxel, the index of the 4dfp voxel it holds (see engine.nifti_layout).
+    fourdfp_shape : Sequence[int]
+        Shape of the 4dfp image.
+    nifti_shape : Sequence[int]
+        Shape of its NIfTI conversion.
+
+    Returns
+    -------
+    np.ndarray
+        4x4 matrix from 4dfp voxel to NIfTI voxel coordinates.
+    """
+    fourdfp_shape = tuple(int(n) for n in fourdfp_shape[:3])
+    nifti_shape = tuple(int(n) for n in nifti_shape[:3])
+    # the nifti voxel of each 4dfp voxel
+    nifti_index = np.empty_like(order)
+    nifti_index[order] = np.arange(order.size)
+    nifti_vox = np.array(np.unravel_index(nifti_index, nifti_shape, order="F"), dtype=float)
+    fourdfp_vox = np.array(np.unravel_index(np.arange(order.size), fourdfp_shape, order="F"), dtype=float)
+
+    # the first voxel, then a step along each 4dfp axis (axes of a single voxel map to the remaining nifti axis)
+    voxel_map = np.eye(4)
+    voxel_map[:3, 3] = nifti_vox[:, 0]
+    free = set(range(3))
+    for axis in range(3):
+        if fourdfp_shape[axis] > 1:
+            step = nifti_vox[:, np.ravel_multi_index(np.eye(3, dtype=int)[axis], fourdfp_shape, order="F")]
+            voxel_map[:3, axis] = step - nifti_vox[:, 0]
+            free -= set(np.flatnonzero(voxel_map[:3, axis]))
+    for axis in range(3):
+        if fourdfp_shape[axis] == 1:
+            voxel_map[:3, axis] = 0
+            voxel_map[free.pop(), axis] = 1
+    if not np.allclose(voxel_map[:3, :3] @ fourdfp_vox + voxel_map[:3, 3:], nifti_vox):
+        raise ValueError("The nifti conversion does not only reorder and flip the axes of the 4dfp image")
+    return voxel_map
+
+
+def fourdfp_to_fsl_mm(
+    fourdfp: Union[Path, str], nifti_img: nib.spatialimages.SpatialImage, order: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Gets the matrix from 4dfp mm to FSL scaled mm coordinates of an image.
+
+    The NIfTI image is expected to be the ``nifti_4dfp -n`` conversion of the 4dfp image. Without the
+    voxel order of the conversion, only transverse images are supported (their nifti stores the y and z
+    axes flipped relative to the 4dfp voxel order).
+
+    Parameters
+    ----------
+    fourdfp : Union[Path, str]
+        Path to the 4dfp image.
+    nifti_img : nib.spatialimages.SpatialImage
+        NIfTI conversion of the 4dfp image.
+    order : Optional[np.ndarray], optional
+        Voxel order of the conversion (see engine.nifti_layout), by default None
+
+    Returns
+    -------
+    np.ndarray
+        4x4 matrix from 4dfp mm to FSL scaled mm.
+    """
+    ifh = read_ifh(fourdfp)
+    if ifh.mmppix is None or ifh.center is None:
+        raise ValueError(f"{fourdfp} has no mmppix/center in its ifh")
+
+    # 4dfp mm -> 4dfp voxel -> nifti voxel -> FSL mm
+    fourdfp_vox2mm = fourdfp_affine(ifh.shape, ifh.mmppix, ifh.center)
+    if order is not None:
+        voxel_map = fourdfp_voxel_map(order, ifh.shape, nifti_img.shape)
+    else:
+        if ifh.orientation != 2:
+            raise NotImplementedError(f"Only transverse 4dfp images are supported, {fourdfp} is {ifh.orientation}")
+        if tuple(nifti_img.shape[:3]) != ifh.shape[:3]:
+            raise ValueError(f"{fourdfp} and its nifti do not have the same shape")
+        # y and z flipped
+        voxel_map = np.diag([1.0, -1.0, -1.0, 1.0])
+        voxel_map[1:3, 3] = np.array(ifh.shape[1:3]) - 1
+    return fsl_scaled_mm(nifti_img) @ voxel_map @ np.linalg.inv(fourdfp_vox2mm)
+
+
+def t4_to_fsl(t4: np.ndarray, source_to_fsl: np.ndarray, target_to_fsl: Optional[np.ndarray] = None) -> np.ndarray:
+    """Converts t4 matrices to FSL matrices (aff_conv xf).
+
+    Parameters
+    ----------
+    t4 : np.ndarray
+        (..., 4, 4) t4 matrices.
+    source_to_fsl : np.ndarray
+        4dfp mm to FSL mm matrix of the source image.
+    target_to_fsl : Optional[np.ndarray], optional
+        4dfp mm to FSL mm matrix of the target image, by default the same as the source
+
+    Returns
+    -------
+    np.ndarray
+        (..., 4, 4) FSL matrices.
+    """
+    if target_to_fsl is None:
+        target_to_fsl = source_to_fsl
+    return target_to_fsl @ t4 @ np.linalg.inv(source_to_fsl)
+
+
+@dataclass
+class FrameTransforms:
+    """All the per frame matrices of a run, in FSL scaled mm.
+
+    Parameters
+    ----------
+    frame_to_xr3d : np.ndarray
+        (N, 4, 4) matrices from each frame to the xr3d (realignment target) space.
+    postmat : Optional[np.ndarray], optional
+        Matrix from the xr3d space to the output space, by default None (a postwarp follows instead)
+    """
+
+    frame_to_xr3d: np.ndarray
+    postmat: Optional[np.ndarray] = None
+
+    def __post_init__(self):
+        self.frame_to_xr3d = np.asarray(self.frame_to_xr3d, dtype=float)
+        # convert_xfm -inverse, used to align the field map (in xr3d space) to each frame
+        self.xr3d_to_frame = np.linalg.inv(self.frame_to_xr3d)
+        # convert_xfm -concat, the affine part of the transform to the output space
+        self.frame_to_out = self.frame_to_xr3d if self.postmat is None else self.postmat @ self.frame_to_xr3d
+        self.out_to_frame = np.linalg.inv(self.frame_to_out)
+
+    def __len__(self) -> int:
+        return self.frame_to_xr3d.shape[0]
+
+    @classmethod
+    def from_xr3d(
+        cls,
+        xr3dmat: Union[Path, str],
+        epi: Union[Path, str],
+        epi_nii: nib.spatialimages.SpatialImage,
+        postmat: Optional[np.ndarray] = None,
+        order: Optional[np.ndarray] = None,
+    ) -> "FrameTransforms":
+        """Reads and converts the transforms of every frame of an xr3d.mat file.
+
+        Parameters
+        ----------
+        xr3dmat : Union[Path, str]
+            Path to xr3d.mat file.
+        epi : Union[Path, str]
+            4dfp EPI the xr3d.mat file was computed on.
+        epi_nii : nib.spatialimages.SpatialImage
+            NIfTI conversion of the EPI.
+        postmat : Optional[np.ndarray], optional
+            Matrix from the xr3d space to the output space, by default None
+        order : Optional[np.ndarray], optional
+            Voxel order of the NIfTI conversion (see fourdfp_to_fsl_mm), by default None
+
+        Returns
+        -------
+        FrameTransforms
+            Transforms of every frame.
+        """
+        return cls(t4_to_fsl(read_xr3d(xr3dmat), fourdfp_to_fsl_mm(epi, epi_nii, order)), postmat)
+
+
+def xr3d_to_fsl(
+    xr3dmat: Union[Path, str],
+    epi: Union[Path, str],
+    epi_nii: Union[Path, str],
+    n_frames: int,
+    tmp_dir: Union[Path, str],
+) -> np.ndarray:
+    """Converts the t4 of each frame in an xr3d.mat file to an FSL matrix with aff_conv.
+
+    Parameters
+    ----------
+    xr3dmat : Union[Path, str]
+        Path to xr3d.mat file.
+    epi : Union[Path, str]
+        Path and prefix of the 4dfp EPI.
+    epi_nii : Union[Path, str]
+        Path and prefix of the nifti EPI.
+    n_frames : int
+        Number of frames to convert (the first n_frames).
+    tmp_dir : Union[Path, str]
+        Directory for the intermediate t4/mat files.
+
+    Returns
+    -------
+    np.ndarray
+        (n_frames, 4, 4) array of frame to xr3d FSL matrices.
+    """
+    t4s = read_xr3d(xr3dmat)
+    if len(t4s) < n_frames:
+        raise ValueError(f"{xr3dmat} has {len(t4s)} frames, expected {n_frames}")
+    t4 = Path(tmp_dir) / "frame_t4"
+    mat = Path(tmp_dir) / "frame_to_xr3d.mat"
+    frame_to_xr3d = np.empty((n_frames, 4, 4))
+    for i in range(n_frames):
+        rows = ["".join(f"{v:14.8f}" for v in row) for row in t4s[i]]
+        t4.write_text("\n".join(rows + ["scale:    1.000000"]) + "\n")
+        subprocess_run(
+            ["aff_conv", "xf", str(epi), str(epi), str(t4), str(epi_nii), str(epi_nii), str(mat)],
+            check=True,
+            stdout=DEVNULL,
+        )
+        frame_to_xr3d[i] = np.loadtxt(mat)
+    t4.unlink()
+    mat.unlink()
+    return frame_to_xr3d
+
+
+def load_frame_transforms(
+    xr3dmat: Union[Path, str],
+    epi: Union[Path, str],
+    epi_nii: Union[Path, str],
+    n_frames: int,
+    tmp_dir: Union[Path, str],
+    postmat: Optional[np.ndarray] = None,
+    atol: float = 1e-3,
+    order: Optional[np.ndarray] = None,
+) -> FrameTransforms:
+    """Gets the transforms of every frame, converting them in NumPy when it agrees with aff_conv.
+
+    The first frame is converted with aff_conv (when it is available) as a check on the vectorized
+    conversion. If they disagree, or the EPI is not one the vectorized conversion supports, every
+    frame is converted with aff_conv instead.
+
+    Parameters
+    ----------
+    xr3dmat : Union[Path, str]
+        Path to xr3d.mat file.
+    epi : Union[Path, str]
+        Path and prefix of the 4dfp EPI.
+    epi_nii : Union[Path, str]
+        Path and prefix of the NIfTI conversion of the EPI (only its header is used, so e.g. a single
+        frame conversion from nifti_layout will do).
+    n_frames : int
+        Number of frames.
+    tmp_dir : Union[Path, str]
+        Directory for the intermediate files of aff_conv.
+    postmat : Optional[np.ndarray], optional
+        Matrix from the xr3d space to the output space, by default None
+    atol : float, optional
+        Absolute tolerance when comparing against aff_conv, by default 1e-3
+    order : Optional[np.ndarray], optional
+        Voxel order of the NIfTI conversion (see engine.nifti_layout), needed to convert non-transverse
+        EPIs without aff_conv, by default None
+
+    Returns
+    -------
+    FrameTransforms
+        Transforms of every frame.
+    """
+    try:
+        epi_img = nib.load(str(find_nifti(epi_nii)))
+        transforms = FrameTransforms.from_xr3d(xr3dmat, f"{epi}.4dfp.img", epi_img, postmat, order)
+    except (NotImplementedError, ValueError) as error:
+        print(f"Falling back to aff_conv: {error}")
+        return FrameTransforms(xr3d_to_fsl(xr3dmat, epi, epi_nii, n_frames, tmp_dir), postmat)
+    if len(transforms) != n_frames:
+        raise ValueError(f"{xr3dmat} has {len(transforms)} frames, expected {n_frames}")
+    if shutil.which("aff_conv") is not None:
+        reference = xr3d_to_fsl(xr3dmat, epi, epi_nii, 1, tmp_dir)[0]
+        if not np.allclose(transforms.frame_to_xr3d[0], reference, atol=atol):
+            print("Vectorized t4 conversion does not match aff_conv, falling back to aff_conv")
+            return FrameTransforms(xr3d_to_fsl(xr3dmat, epi, epi_nii, n_frames, tmp_dir), postmat)
+    return transforms
@@ -0,0 +1,408 @@
+"""Runs pipeline jobs (e.g. one per subject or session) concurrently.
+
+Each job is a command (usually a csh pipeline script) run in its own working directory, with its output
+written to its own log file. At most ``max_jobs`` jobs run at once, and a CPU budget is divided evenly
+between them: each job is told how many CPUs it may use before it starts (e.g. by writing ``num_cpus``
+to its instructions file) and the usual threading environment variables are set to match, so concurrent
+jobs don't oversubscribe a node.
+
+Jobs can depend on other jobs (e.g. the stages of a pipeline, see ``me_pipeline.stages``): a job only
+starts once the jobs it runs after have succeeded, and is skipped if any of them didn't.
+
+With a memory budget, a job only starts if its peak memory (estimated from the resources earlier jobs of
+its profile used, see ``me_pipeline.profiles``) fits in the memory left by the running jobs. Jobs with a
+trace file are traced (see ``me_pipeline.tracing``).
+
+Failures are handled with one of two policies: fail fast (stop starting jobs and terminate the running
+ones after the first failure) or continue on error (run every job that doesn't depend on a failed one).
+Either way a result is returned for every job, for a final summary.
+"""
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from .profiles import ProfileDB, ResourceUsage
+from .tracing import JobTracer
+
+# environment variables that control the number of threads tools use
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+)
+
+# job statuses
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+SKIPPED = "skipped"
+QUEUED = "queued"
+
+
+@dataclass
+class PipelineJob:
+    """A command to run as a job.
+
+    Parameters
+    ----------
+    name : str
+        Name of the job, e.g. "sub-01_ses-1".
+    command : List[str]
+        Command to run.
+    cwd : Path
+        Directory to run the command in.
+    log_file : Path
+        File the output of the command is written to.
+    set_cpus : Optional[Callable[[int], None]], optional
+        Called with the number of CPUs the job may use right before it starts, by default None
+    env : Dict[str, str], optional
+        Extra environment variables for the command, by default none
+    after : List[str], optional
+        Names of the jobs that must succeed before this job starts, by default none
+    on_success : Optional[Callable[[], None]], optional
+        Called after the command succeeded, by default None
+    profile : Optional[str], optional
+        Profile the resources the job uses are recorded under (and estimated from), e.g.
+        "functional/FMRI_PP", by default the job isn't profiled
+    size : float, optional
+        Size of the dataset the job processes in MB, to scale the estimates of its profile, by default unknown
+    trace_file : Optional[Path], optional
+        File to write a trace of the stages and tools of the job to, by default the job isn't traced
+    """
+
+    name: str
+    command: List[str]
+    cwd: Path
+    log_file: Path
+    set_cpus: Optional[Callable[[int], None]] = None
+    env: Dict[str, str] = field(default_factory=dict)
+    after: List[str] = field(default_factory=list)
+    on_success: Optional[Callable[[], None]] = None
+    profile: Optional[str] = None
+    size: float = 0.0
+    trace_file: Optional[Path] = None
+
+
+@dataclass
+class JobResult:
+    """The outcome of a job.
+
+    Parameters
+    ----------
+    name : str
+        Name of the job.
+    status : str
+        SUCCEEDED, FAILED, SKIPPED (not started because an earlier job, or a job it runs after, failed) or
+        QUEUED (submitted to a job queue, to be run by its workers).
+    returncode : Optional[int]
+        Return code of the command, None if it didn't run.
+    wall_time : float
+        Run time in seconds.
+    log_file : Path
+        Log file of the job.
+    attempts : int, optional
+        Number of times the command was run, by default 1
+    usage : Optional[ResourceUsage], optional
+        Resources the last run of the command used, by default None
+    """
+
+    name: str
+    status: str
+    returncode: Optional[int]
+    wall_time: float
+    log_file: Path
+    attempts: int = 1
+    usage: Optional[ResourceUsage] = None
+
+
+def cpus_per_job(cpu_budget: int, max_jobs: int, n_jobs: int) -> int:
+    """Divides a CPU budget between the jobs that run at once.
+
+    Parameters
+    ----------
+    cpu_budget : int
+        Total number of CPUs to use.
+    max_jobs : int
+        Maximum number of jobs to run at once.
+    n_jobs : int
+        Number of jobs.
+
+    Returns
+    -------
+    int
+        CPUs for each job, at least 1.
+    """
+    active = max(1, min(max_jobs, n_jobs))
+    return max(1, cpu_budget // active)
+
+
+class JobScheduler:
+    """Runs jobs concurrently within a CPU budget.
+
+    Parameters
+    ----------
+    max_jobs : int, optional
+        Maximum number of jobs to run at once, by default 1
+    cpu_budget : Optional[int], optional
+        Total number of CPUs to divide between running jobs, by default jobs are not told how many CPUs
+        to use (and use whatever they are configured with)
+    fail_fast : bool, optional
+        Stop starting jobs and terminate the running ones after the first failure, by default True
+    retries : int, optional
+        Number of times to run a failed job again before it counts as failed, by default 0
+    memory_budget : Optional[float], optional
+        Memory (in MB) the running jobs may use together, by default jobs are started regardless of memory
+    profiles : Optional[ProfileDB], optional
+        Database to record the resources jobs with a profile used in, and to estimate their peak memory from,
+        by default None
+    """
+
+    def __init__(
+        self,
+        max_jobs: int = 1,
+        cpu_budget: Optional[int] = None,
+        fail_fast: bool = True,
+        retries: int = 0,
+        memory_budget: Optional[float] = None,
+        profiles: Optional[ProfileDB] = None,
+    ):
+        self.max_jobs = max(1, max_jobs)
+        self.cpu_budget = cpu_budget
+        self.fail_fast = fail_fast
+        self.retries = max(0, retries)
+        self.memory_budget = memory_budget
+        self.profiles = profiles
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._running: Dict[str, subprocess.Popen] = {}
+
+    def _attempt(self, job: PipelineJob, env: Dict[str, str], attempt: int) -> Optional[Tuple[int, ResourceUsage]]:
+        """Runs the command of a job once, returns its return code and the resources it used (None if the
+        scheduler was stopped)."""
+        tracer = None
+        if job.trace_file is not None:
+            tracer = JobTracer(job.name, job.trace_file, job.profile, env.get("TMPDIR"))
+        # the first attempt starts a new log, retries are appended to it
+        with open(job.log_file, "w" if attempt == 1 else "a") as log:
+            if attempt > 1:
+                log.write(f"\n# attempt {attempt}\n")
+                log.flush()
+            with self._lock:
+                if self._stop.is_set():
+                    return None
+                if tracer is not None:
+                    env = tracer.env(env)
+                # each job gets its own process group, so it can be terminated along with its children
+                process = subprocess.Popen(
+                    job.command, cwd=str(job.cwd), env=env, stdout=log, stderr=subprocess.STDOUT, start_new_session=True
+                )
+                self._running[job.name] = process
+            if tracer is not None:
+                tracer.start(process.pid)
+            start = time.perf_counter()
+            # wait4 gets the resources used by the command (and the processes it waited for)
+            _, status, rusage = os.wait4(process.pid, 0)
+            usage = ResourceUsage.from_rusage(rusage, time.perf_counter() - start)
+            process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        if tracer is not None:
+            tracer.stop(process.returncode, usage)
+        with self._lock:
+            del self._running[job.name]
+        return process.returncode, usage
+
+    def run_job(self, job: PipelineJob, cpus: Optional[int] = None) -> JobResult:
+        """Runs a single job (retrying it if it fails), unless the scheduler was stopped.
+
+        This always returns a result: a job that can't be started (e.g. its set_cpus callback fails) is
+        failed, and errors of the callbacks after a job succeeded (on_success and recording its resource
+        profile) are logged as warnings.
+
+        Parameters
+        ----------
+        job : PipelineJob
+            Job to run.
+        cpus : Optional[int], optional
+            Number of CPUs the job may use, by default the job isn't told
+
+        Returns
+        -------
+        JobResult
+            Result of the job.
+        """
+        try:
+            return self._run_job(job, cpus)
+        except Exception as error:
+            logging.exception(f"Could not run {job.name}: {error}")
+            if self.fail_fast:
+                self.stop()
+            return JobResult(job.name, FAILED, None, 0.0, job.log_file, 0)
+
+    def _run_job(self, job: PipelineJob, cpus: Optional[int] = None) -> JobResult:
+        """Runs a single job, see run_job."""
+        if self._stop.is_set():
+            return JobResult(job.name, SKIPPED, None, 0.0, job.log_file, 0)
+        env = dict(os.environ)
+        env.update(job.env)
+        if cpus is not None:
+            if job.set_cpus is not None:
+                job.set_cpus(cpus)
+            env.update({var: str(cpus) for var in THREAD_ENV_VARS})
+
+        Path(job.log_file).parent.mkdir(parents=True, exist_ok=True)
+        start = time.perf_counter()
+        for attempt in range(1, self.retries + 2):
+            logging.info(f"Starting {job.name} (log: {job.log_file})" + (f", attempt {attempt}" if attempt > 1 else ""))
+            ran = self._attempt(job, env, attempt)
+            if ran is None:
+                return JobResult(job.name, SKIPPED, None, time.perf_counter() - start, job.log_file, attempt - 1)
+            returncode, usage = ran
+            if returncode == 0 or self._stop.is_set():
+                break
+        wall_time = time.perf_counter() - start
+
+        status = SUCCEEDED if returncode == 0 else FAILED
+        if status == SUCCEEDED and job.on_success is not None:
+            try:
+                job.on_success()
+            except Exception as error:
+                logging.warning(f"{job.name} succeeded, but its on_success callback failed: {error}")
+        if status == SUCCEEDED and job.profile is not None and self.profiles is not None:
+            try:
+                self.profiles.record(job.profile, job.size, usage)
+            except Exception as error:
+                logging.warning(f"Could not record the resource profile of {job.name}: {error}")
+        logging.info(
+            f"Finished {job.name}: {status} (return code {returncode}, {wall_time:.1f} s, "
+            f"peak memory {usage.peak_rss:.0f} MB)"
+        )
+        if status == FAILED and self.fail_fast:
+            self.stop()
+        return JobResult(job.name, status, returncode, wall_time, job.log_file, attempt, usage)
+
+    def estimate_memory(self, job: PipelineJob) -> Optional[float]:
+        """Estimates the peak memory of a job in MB, None if it has no profile with samples."""
+        if job.profile is None or self.profiles is None:
+            return None
+        return self.profiles.estimate(job.profile, job.size)
+
+    def stop(self) -> None:
+        """Stops starting jobs and terminates the running ones."""
+        with self._lock:
+            self._stop.set()
+            for process in self._running.values():
+                try:
+                    os.killpg(process.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+    def run(self, jobs: Sequence[PipelineJob]) -> List[JobResult]:
+        """Runs jobs, at most max_jobs at a time, in the given order once the jobs they run after succeeded.
+
+        With a memory budget, a job waits (along with the jobs after it) until its estimated peak memory fits
+        in the budget left by the running jobs. A job always starts if no other job is running.
+
+        Parameters
+        ----------
+        jobs : Sequence[PipelineJob]
+            Jobs to run. Names in the after list of a job that aren't the name of one of the jobs are ignored.
+
+        Returns
+        -------
+        List[JobResult]
+            Result of each job, in the order of jobs.
+
+        Raises
+        ------
+        ValueError
+            If job names aren't unique or the jobs depend on each other in a cycle.
+        """
+        names = [job.name for job in jobs]
+        if len(set(names)) != len(names):
+            raise ValueError("Job names must be unique.")
+        cpus = None
+        if self.cpu_budget is not None:
+            cpus = cpus_per_job(self.cpu_budget, self.max_jobs, len(jobs))
+            logging.info(f"Running {len(jobs)} jobs, {self.max_jobs} at a time with {cpus} CPUs each")
+
+        results: Dict[str, JobResult] = {}
+        pending = list(jobs)
+        running: Dict[Future, PipelineJob] = {}
+        # estimated peak memory of the running jobs (0 if unknown)
+        reserved: Dict[Future, float] = {}
+        with ThreadPoolExecutor(max_workers=self.max_jobs) as executor:
+            try:
+                while pending or running:
+                    # start the jobs whose dependencies are done, skip the ones whose dependencies failed
+                    # (repeated until nothing changes, since skipping a job can skip the jobs after it)
+                    # jobs that are ready start in order, until one doesn't fit in the job slots or memory left
+                    changed = True
+                    admitting = True
+                    while changed:
+                        changed = False
+                        for job in list(pending):
+                            after = [results.get(name) for name in job.after if name in names]
+                            if any(result is not None and result.status != SUCCEEDED for result in after):
+                                logging.info(f"Skipping {job.name}: a job it runs after did not succeed")
+                                results[job.name] = JobResult(job.name, SKIPPED, None, 0.0, job.log_file, 0)
+                            elif admitting and all(result is not None for result in after):
+                                memory = self.estimate_memory(job) or 0.0
+                                if len(running) >= self.max_jobs or (
+                                    running
+                                    and self.memory_budget is not None
+                                    and sum(reserved.values()) + memory > self.memory_budget
+                                ):
+                                    admitting = False
+                                    continue
+                                future = executor.submit(self.run_job, job, cpus)
+                                running[future] = job
+                                reserved[future] = memory
+                            else:
+                                continue
+                            pending.remove(job)
+                            changed = True
+                    if not running:
+                        if pending:
+                            raise ValueError(f"Jobs depend on each other in a cycle: {[job.name for job in pending]}")
+                        break
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        reserved.pop(future)
+                        results[running.pop(future).name] = future.result()
+            except KeyboardInterrupt:
+                self.stop()
+                raise
+        return [results[job.name] for job in jobs]
+
+
+def format_summary(results: Sequence[JobResult]) -> str:
+    """Formats a summary of the results of jobs.
+
+    Parameters
+    ----------
+    results : Sequence[JobResult]
+        Results of the jobs.
+
+    Returns
+    -------
+    str
+        One line per job and a line with the number of jobs with each status.
+    """
+    lines = ["Job summary:"]
+    for result in results:
+        returncode = "-" if result.returncode is None else result.returncode
+        attempts = f", {result.attempts} attempts" if result.attempts > 1 else ""
+        memory = f", peak memory {result.usage.peak_rss:.0f} MB" if result.usage is not None else ""
+        lines.append(
+            f"  {result.name}: {result.status} (return code {returncode}, {result.wall_time:.1f} s{attempts}"
+            f"{memory}, log: {result.log_file})"
+        )
+    statuses = (SUCCEEDED, FAILED, SKIPPED) + ((QUEUED,) if any(result.status == QUEUED for result in results) else ())
+    counts = {status: sum(result.status == status for result in results) for status in statuses}
+    lines.append("  " + ", ".join(f"{count} {status}" for status, count in counts.items()))
+    return "\n".join(lines)
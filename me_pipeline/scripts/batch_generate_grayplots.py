@@ -0,0 +1,73 @@
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from me_pipeline.grayplots.grayplot_batch import find_grayplot_runs, find_sessions
+from me_pipeline.grayplots.grayplot_data import read_mask_rows
+from me_pipeline.grayplots.grayplot_generator import GrayplotGenerator
+
+# rows of the masks of each session/output space, set in each worker when it starts
+MASK_ROWS = {}
+
+
+def init_worker(mask_rows):
+    # masks are read once in the main process and handed to each worker once, not once per run
+    MASK_ROWS.update(mask_rows)
+
+
+def render_run(run):
+    mask_names = run.mask_names
+    GrayplotGenerator(
+        ddat_name=str(run.ddat_name),
+        rdat_name=str(run.rdat_name),
+        functional_name=str(run.functional_name),
+        gray_matter_name=str(mask_names["gray_matter"]),
+        white_matter_name=str(mask_names["white_matter"]),
+        csf_name=str(mask_names["csf"]),
+        extra_axial_name=str(mask_names["extra_axial"]),
+        tr=run.tr,
+        mask_rows=MASK_ROWS[run.mask_key],
+    )
+    return run.output_name
+
+
+def main():
+    parser = ArgumentParser(description="Generate grayplots for every run of sessions or of a whole derivatives tree")
+    parser.add_argument("paths", nargs="+", help="Session directories, or directories to search for sessions in.")
+    parser.add_argument("-n", "--num_workers", help="The number of processes to use.", default=1, type=int)
+    parser.add_argument("--day1_patid", help="Patid the atlas masks were named with (default: found per session).")
+    parser.add_argument("--tr", type=float, help="Repetition time of all runs (default: read from run params).")
+    parser.add_argument("--outspace", help="Only make grayplots for runs in this output space.")
+    parser.add_argument("--overwrite", action="store_true", help="Remake grayplots that already exist.")
+
+    # parse the arguments
+    args = parser.parse_args()
+
+    # find every run
+    runs = []
+    for path in args.paths:
+        for session_dir in find_sessions(path):
+            runs.extend(find_grayplot_runs(session_dir, args.day1_patid, args.tr, args.outspace))
+    if not args.overwrite:
+        runs = [run for run in runs if not run.output_name.exists()]
+    print(f"Generating grayplots for {len(runs)} runs")
+
+    # read the masks shared by the runs of each session once
+    mask_rows = {}
+    for run in runs:
+        if run.mask_key not in mask_rows:
+            mask_rows[run.mask_key] = read_mask_rows(run.mask_names)
+
+    # render runs in parallel, reporting failures at the end
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.num_workers, initializer=init_worker, initargs=(mask_rows,)) as executor:
+        futures = {executor.submit(render_run, run): run for run in runs}
+        for future in as_completed(futures):
+            run = futures[future]
+            try:
+                print(f"Wrote {future.result()}")
+            except Exception as error:
+                print(f"Failed to generate grayplots for {run.functional_name}: {error}")
+                failed.append(run)
+    if failed:
+        print(f"{len(failed)} of {len(runs)} runs failed")
+        sys.exit(1)
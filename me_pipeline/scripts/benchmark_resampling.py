@@ -0,0 +1,58 @@
+import argparse
+import json
+import sys
+from pathlib import Path
+from me_pipeline.resampling.benchmark import run_benchmark
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark one_step_resampling_framewise on synthetic multi-echo runs. Missing FSL/4dfp tools "
+        "are stubbed, and results (per stage times, frames/sec, peak RSS and temp disk usage) are written as JSON.",
+        epilog="Arguments after -- are passed on to one_step_resampling_framewise (e.g. -- -executor thread).",
+    )
+    parser.add_argument("-frames", type=int, default=20, help="Number of frames.")
+    parser.add_argument("-echoes", type=int, default=3, help="Number of echoes.")
+    parser.add_argument("-matrix", type=int, nargs=3, default=[64, 64, 40], help="Matrix size of each frame.")
+    parser.add_argument("-engine", choices=["native", "fsl"], default="native", help="Resampling engine.")
+    parser.add_argument("-parallel", type=int, default=1, help="Number of parallel workers.")
+    parser.add_argument("-repeats", type=int, default=1, help="Number of times to run the benchmark.")
+    parser.add_argument(
+        "-stub",
+        choices=["auto", "all", "none"],
+        default="auto",
+        help="Stub the FSL/4dfp tools that are missing (auto), all of them (all) or none of them (none).",
+    )
+    parser.add_argument("-work_dir", help="Directory to write the run to and keep (default: a temporary directory).")
+    parser.add_argument("-seed", type=int, default=0, help="Seed of the synthetic run.")
+    parser.add_argument("-output", help="JSON file to write results to (default: stdout).")
+    parser.add_argument("script_args", nargs=argparse.REMAINDER)
+
+    # parse arguments
+    args = parser.parse_args()
+    script_args = args.script_args[1:] if args.script_args[:1] == ["--"] else args.script_args
+
+    runs = []
+    for repeat in range(args.repeats):
+        work_dir = Path(args.work_dir) / f"repeat{repeat}" if args.work_dir else None
+        runs.append(
+            run_benchmark(
+                args.frames,
+                args.echoes,
+                args.matrix,
+                args.engine,
+                args.parallel,
+                script_args,
+                args.stub,
+                work_dir,
+                args.seed,
+            )
+        )
+    results = json.dumps({"benchmark": "one_step_resampling_framewise", "runs": runs}, indent=2)
+
+    # write results
+    if args.output:
+        Path(args.output).write_text(results)
+    else:
+        print(results)
+    sys.exit(max(abs(run["returncode"]) for run in runs) and 1)
@@ -3,188 +3,118 @@
 TODO: REFACTOR and/or REPLACE with something better!
 """
 import os
-import sys
 import argparse
 import shutil
-from datetime import datetime
 from tempfile import TemporaryDirectory
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from subprocess import run as subprocess_run
-from subprocess import PIPE, STDOUT, DEVNULL
-from typing import List
+from subprocess import STDOUT, DEVNULL
 import nibabel as nib
 import numpy as np
 from memori.pathman import PathManager as PathMan
 from memori.helpers import create_symlink_to_path
-
-
-def check_consistency(data: List) -> None:
-    """Checks the consistency of the input data
-
-    If all elements contain the same value, the this function will return
-    successfully. If the elements contain different values, a ValueError will
-    be raised.
-
-    Parameters
-    ----------
-    data : List
-        Data list to check
-    """
-    # get first element
-    first = data[0]
-    for d in data:
-        for i, j in zip(first, d):
-            if i != j:
-                raise ValueError(f"Input data is not consistent: {first} != {d}")
-
-
-def bias_field_run(i, tmp_dir, ped, dwell, ref_tmp, bias_nii, phase_base, phase_rads, strwarp):
+from me_pipeline.io.fourdfp import read_ifh, write_hdr
+from me_pipeline.io.geometry import check_geometries
+from me_pipeline.io.nifti import write_frame
+from me_pipeline.resampling.assemble import FrameAssembler
+from me_pipeline.resampling.engine import find_nifti
+from me_pipeline.resampling.executors import EXECUTOR_MODES, FrameExecutor, pin_command
+from me_pipeline.resampling.native import flush_stdout, native_resampling
+from me_pipeline.resampling.stages import StageTimer
+from me_pipeline.resampling.shiftmap import DEFAULT_CHUNK_SIZE, write_frame_shift_maps
+
+
+def warp_bias_field(i, tmp_dir, ped, ref_tmp, bias_nii, phase_base, strwarp):
+    # warp the bias field with the shift map of the frame, keeping only the 4dfp of the result
     bias_field_warp = PathMan(tmp_dir) / f"bias_field_warp_{i:04d}.nii"
     bias_field = PathMan(bias_nii).repath(tmp_dir).get_path_and_prefix().append_suffix(f"_{i:04d}.nii")
-    subprocess_run(["fslroi", phase_rads, f"{phase_base}_{i:04d}.nii", str(i), "1"], check=True)
-
     subprocess_run(
-        [
-            "fugue",
-            f"--loadfmap={phase_base}_{i:04d}.nii",
-            f"--dwell={dwell}",
-            f"--unwarpdir={ped}",
-            f"--saveshift={phase_base}_shift_{i:04d}.nii",
-        ],
+        pin_command(
+            [
+                "convertwarp",
+                f"--shiftmap={phase_base}_shift_{i:04d}.nii",
+                f"--ref={ref_tmp}",
+                f"--shiftdir={ped}",
+                f"{strwarp}",
+                f"--out={bias_field_warp}",
+            ]
+        ),
         check=True,
     )
-    subprocess_run(
-        [
-            "convertwarp",
-            f"--shiftmap={phase_base}_shift_{i:04d}.nii",
-            f"--ref={ref_tmp}",
-            f"--shiftdir={ped}",
-            f"{strwarp}",
-            f"--out={bias_field_warp}",
-        ],
-        check=True,
-    )
-    subprocess_run(
-        ["applywarp", f"--ref={ref_tmp}", f"--in={bias_nii}", f"--warp={bias_field_warp}", f"--out={bias_field}"],
-        check=True,
-    )
-    subprocess_run(
-        ["nifti_4dfp", "-4", f"{bias_field}", f"{bias_field.get_path_and_prefix()}"], check=True, stdout=DEVNULL
-    )
-
-
-def resampling_run(STRresample, padded, j, epi_list):
-    return subprocess_run(
-        f"Resampling_AV.csh {STRresample} {padded} {j} {epi_list}", shell=True, check=True, stdout=True, stderr=STDOUT
-    )
-
-
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-i", "--inputs", nargs="+", required=True)
-    parser.add_argument("-xr3dmat", required=True)
-    parser.add_argument("-phase", required=True)
-    parser.add_argument("-ped", required=True)
-    parser.add_argument("-dwell", required=True)
-    parser.add_argument("-ref", required=True)
-    parser.add_argument("-bias")
-    postxfm = parser.add_mutually_exclusive_group(required=True)
-    postxfm.add_argument("-postmat")
-    postxfm.add_argument("-postwarp")
-    parser.add_argument("-parallel", type=int, required=True)
-    parser.add_argument("-trailer", required=True)
-
-    # parse arguments
-    args = parser.parse_args()
-
-    # set fsl output type
-    os.environ["FSLOUTPUTTYPE"] = "NIFTI"
-
-    # get epi images
-    epis = [PathMan(i) for i in args.inputs]
-
-    # make list to store outputs
-    out = []
-    dims = []
-    pixdims = []
-
-    # make a temporary directory
-    tmp_dir = TemporaryDirectory(dir=os.environ.get("TMPDIR", "/tmp"))
-
-    # loop over epis
-    for i, epi in enumerate(epis):
-        epi_img = epi.with_suffix(".img")
-        epi_hdr = epi.with_suffix(".hdr")
-        epi_nii = epi.get_path_and_prefix().with_suffix(".nii")
-
-        # check if epi exists
-        if not epi_img.exists():
-            raise FileNotFoundError(f"Could not find {epi_img}")
+    try:
+        subprocess_run(
+            pin_command(
+                [
+                    "applywarp",
+                    f"--ref={ref_tmp}",
+                    f"--in={bias_nii}",
+                    f"--warp={bias_field_warp}",
+                    f"--out={bias_field}",
+                ]
+            ),
+            check=True,
+        )
+    finally:
+        os.remove(str(bias_field_warp))
+    try:
+        subprocess_run(
+            ["nifti_4dfp", "-4", f"{bias_field}", f"{bias_field.get_path_and_prefix()}"], check=True, stdout=DEVNULL
+        )
+    finally:
+        os.remove(str(bias_field))
 
-        # convert  ifh to header, if it exists, override the header
-        if epi_hdr.exists():
-            epi_hdr.unlink()
-        subprocess_run(["ifh2hdr", str(epi_img)])
 
-        # setup output filename
-        out.append(epi.append_suffix(f"_{args.trailer}"))
+def resampling_run(
+    frames, phase, dwell, ped, bias_args, epi_niis, frame_dir, STRresample, phase_base, STRoptions, epi_list
+):
+    # the field and shift maps of a task's frames are only written once the task starts, and each frame's
+    # maps are removed as soon as it is resampled, so temporary files stay bounded by the tasks in flight
+    frame_maps = write_frame_shift_maps(phase, frames[0], frames[-1] + 1, dwell, ped, phase_base, scale=2 * np.pi)
 
-        # get the input geometries
-        fslinfo_out = (
-            subprocess_run(["fslinfo", epi_hdr], stdout=PIPE, stderr=STDOUT, check=True).stdout.decode().strip()
-        )
-        # parse output
-        parsed = [tab for line in fslinfo_out.split("\n") for tab in line.split("\t") if tab != ""]
-        dim = [0, 0, 0, 0]
-        pixdim = [0.0, 0.0, 0.0, 0.0]
-        for n, p in enumerate(parsed):
-            if p == "dim1":
-                dim[0] = int(parsed[n + 1])
-            elif p == "dim2":
-                dim[1] = int(parsed[n + 1])
-            elif p == "dim3":
-                dim[2] = int(parsed[n + 1])
-            elif p == "dim4":
-                dim[3] = int(parsed[n + 1])
-            elif p == "pixdim1":
-                pixdim[0] = float(parsed[n + 1])
-            elif p == "pixdim2":
-                pixdim[1] = float(parsed[n + 1])
-            elif p == "pixdim3":
-                pixdim[2] = float(parsed[n + 1])
-            elif p == "pixdim4":
-                pixdim[3] = float(parsed[n + 1])
-
-        # store geometries
-        pixdims.append(pixdim)
-        dims.append(dim)
-
-        # convert the 4dfp to nifti
-        print(f"Converting {epi} to {epi_nii}")
+    # frames are read as slices of each echo, and only written out while Resampling_AV.csh needs them
+    epi_imgs = [nib.load(epi_nii) for epi_nii in epi_niis]
+    for i, maps in zip(frames, frame_maps):
+        frame_files = []
         try:
-            sys.stdout.flush()
-        except BlockingIOError:
-            pass
-        subprocess_run(["nifti_4dfp", "-n", str(epi), str(epi_nii)], check=True)
-
-        # now load the nifti and save each frame as a separate volume
-        path_prefix = PathMan(tmp_dir.name) / "split_volumes"
-        path_prefix.mkdir(exist_ok=True)
-        frame_prefix = str(epi.get_path_and_prefix().repath(path_prefix.path))
-        print(f"Splitting frames from {epi_nii} to {frame_prefix}")
-        try:
-            sys.stdout.flush()
-        except BlockingIOError:
-            pass
-        subprocess_run(["fslsplit", str(epi_nii), f"{frame_prefix}", "-t"], check=True)
+            warp_bias_field(i, *bias_args)
+            for epi_nii, epi_img in zip(epi_niis, epi_imgs):
+                frame_files.append(os.path.join(frame_dir, f"{PathMan(epi_nii).get_prefix().path}{i:04d}.nii"))
+                write_frame(epi_img, i, frame_files[-1])
+
+            # the field map of the frame goes between the reference and the remaining options
+            command = (
+                f"Resampling_AV.csh {STRresample} {phase_base}_{i:04d}.nii {STRoptions} {i:04d} {i + 1} {epi_list}"
+            )
+            print(command)
+            flush_stdout()
+            subprocess_run(pin_command(command), shell=True, check=True, stdout=True, stderr=STDOUT)
+        finally:
+            for path in [*frame_files, *maps]:
+                if os.path.exists(path):
+                    os.remove(path)
 
-    # check data consistency
-    check_consistency(dims)
-    check_consistency(pixdims)
 
-    # get the number of frames
-    n_frames = dims[0][3]
-    print("Number of frames: ", n_frames)
+def fsl_resampling(args, epis, out, n_frames, tmp_dir, timer):
+    """Resamples each frame with FSL and Resampling_AV.csh, one set of processes per frame
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Parsed script arguments
+    epis : List[PathMan]
+        Input 4dfp epis (one per echo)
+    out : List[PathMan]
+        Output 4dfp images (one per echo)
+    n_frames : int
+        Number of frames
+    tmp_dir : TemporaryDirectory
+        Temporary directory to write intermediates to
+    timer : StageTimer
+        Timer to record the time of each stage in
+    """
+    # tasks of frames_per_task frames, with at most max_pending tasks (and their temp files) in flight
+    executor = FrameExecutor(
+        args.executor or "thread", args.parallel, args.frames_per_task or 1, args.max_pending, args.pin_cpus
+    )
 
     # add to transform string
     strwarp = ""
@@ -196,9 +126,8 @@ def main():
         strwarp = f"--warp1={args.postwarp}"
         warpmode = 2
 
-    # transform the field map to radians
+    # name for the field map in radians
     phase_rads = PathMan(args.phase).repath(tmp_dir.name).append_suffix("_rads").path
-    subprocess_run(["fslmaths", args.phase, "-mul", str(np.pi * 2), phase_rads], check=True)
 
     # check ref
     ref = PathMan(args.ref)
@@ -235,58 +164,15 @@ def main():
         args.bias = (PathMan(tmp_bias_dir.path) / "bias").path
         subprocess_run(["nifti_4dfp", "-4", str(PathMan(tmp_bias_dir.path) / "bias.nii"), args.bias], check=True)
 
-    # for each frame, undistort the bias field for that frame
-    # first get a nifti of the bias field
+    # each task undistorts the bias field for its own frames (see warp_bias_field), from a nifti of the bias field
     bias_nii = PathMan(args.bias).repath(tmp_bias_dir.path).append_suffix(".nii").path
     subprocess_run(["nifti_4dfp", "-n", str(args.bias), bias_nii], check=True)
     phase_base = PathMan(phase_rads).get_path_and_prefix().repath(tmp_bias_dir.path)
-    framesout_bias = PathMan(tmp_bias_dir.path) / f"framesout_bias.lst"
-    print("Generating shift maps...")
-    try:
-        sys.stdout.flush()
-    except BlockingIOError:
-        pass
-    with ThreadPoolExecutor(max_workers=args.parallel) as executor:
-        futures = {}
-        for i in range(n_frames):
-            print(f"Submitting job for: Generating shift map frame {i}")
-            try:
-                sys.stdout.flush()
-            except BlockingIOError:
-                pass
-
-            bias_field = (
-                PathMan(bias_nii).repath(tmp_bias_dir.path).get_path_and_prefix().append_suffix(f"_{i:04d}.nii")
-            )
-            with open(framesout_bias, "a") as f:
-                f.write(f"{bias_field.get_path_and_prefix()}\n")
-            futures[
-                executor.submit(
-                    bias_field_run,
-                    i,
-                    tmp_bias_dir.path,
-                    args.ped,
-                    args.dwell,
-                    ref_tmp,
-                    bias_nii,
-                    phase_base,
-                    phase_rads,
-                    strwarp,
-                )
-            ] = i
-
-        print("Waiting for jobs to complete...")
-        try:
-            sys.stdout.flush()
-        except BlockingIOError:
-            pass
-        for future in as_completed(futures):
-            future.result()
-            print(f"Completed job for: Generating shift map frame {futures[future]}")
-            try:
-                sys.stdout.flush()
-            except BlockingIOError:
-                pass
+    bias_frames = [
+        PathMan(bias_nii).repath(tmp_bias_dir.path).get_path_and_prefix().append_suffix(f"_{i:04d}").path
+        for i in range(n_frames)
+    ]
+    bias_args = (tmp_bias_dir.path, args.ped, str(ref_tmp), bias_nii, str(phase_base), strwarp)
 
     # create a blank 4dfp to keep track of undefined voxels
     tmp_blank_path = PathMan(tmp_dir.name) / "blank_tmp"
@@ -299,8 +185,12 @@ def main():
     subprocess_run(["nifti_4dfp", "-n", str(blank), str(blank)], check=True)
     blank = blank.append_suffix(".nii").path
 
+    # frames are bias corrected and written into the outputs as soon as they are resampled
+    assembler = FrameAssembler(
+        [str(o) for o in out], n_frames, bias_frames, rec_parents=[str(e) for e in epis], remove_frames=True
+    )
+
     # for each frame
-    frameout_list = []
     PathMan("onestep_FAILED").unlink(missing_ok=True)  # reset the failed flag file
     print("Resampling EPIs...")
 
@@ -308,127 +198,178 @@ def main():
     tmp_epi_path = PathMan(tmp_dir.name) / "resampled_epis"
     tmp_epi_path.mkdir(exist_ok=True)
 
-    try:
-        sys.stdout.flush()
-    except BlockingIOError:
-        pass
-    with ThreadPoolExecutor(max_workers=args.parallel) as executor:
-        futures = {}
-        # symlink ref to tmp epi dir
-        create_symlink_to_path(ref.path + ".nii", tmp_epi_path.path)
-        for i in range(n_frames):
-            print(f"Submitting job for: Resampling EPI frame {i}")
-            try:
-                sys.stdout.flush()
-            except BlockingIOError:
-                pass
-            j = i + 1
-            padded = f"{i:04d}"
-
-            # get the phase for the frame
-            phase_frame = phase_base.append_suffix(f"_{i:04d}.nii").path
-
-            # create STRresample string
-            STRresample = (
-                f"{tmp_epi_path.path} {ref.get_prefix()} {phase_frame} {args.dwell} {args.ped}"
-                f" 1 {blank} {args.xr3dmat} {warpmode}"
-            )
+    flush_stdout()
+    # symlink ref to tmp epi dir
+    create_symlink_to_path(ref.path + ".nii", tmp_epi_path.path)
+    frames_out = {}
+    for i in range(n_frames):
+        padded = f"{i:04d}"
+
+        # for each epi
+        frames_out[i] = []
+        for k in range(len(epis)):
+            epi_basename = epis[k].get_prefix().path
+            ref_basename = ref_tmp.get_prefix().path
+            name = PathMan(tmp_epi_path.path) / f"{epi_basename}_on_{ref_basename}{padded}_defined"
+            frames_out[i].append(name.path)
+
+    # create STRresample strings, the per frame field map goes between them
+    STRresample = f"{tmp_epi_path.path} {ref.get_prefix()}"
+    STRoptions = f"{args.dwell} {args.ped} 1 {blank} {args.xr3dmat} {warpmode}"
+    if args.postmat:
+        STRoptions += f" {args.postmat}"
+    elif args.postwarp:
+        STRoptions += f" {args.postwarp}"
+
+    # run resampling script, assembling frames as they complete (the shift maps and bias fields of each
+    # frame are made by its task, so only the tasks in flight have temporary files)
+    epi_list = " ".join([str(epi.get_path_and_prefix()) for epi in epis])
+    epi_niis = [epi.get_path_and_prefix().with_suffix(".nii").path for epi in epis]
+    resampling_args = (
+        str(find_nifti(args.phase)),
+        args.dwell,
+        args.ped,
+        bias_args,
+        epi_niis,
+        tmp_epi_path.path,
+        STRresample,
+        str(phase_base),
+        STRoptions,
+        epi_list,
+    )
+    with timer.stage("resampling", n_frames):
+        for frames, _ in executor.run(resampling_run, n_frames, *resampling_args):
+            # bias correction happens as each frame is pasted into the outputs
+            with timer.stage("paste", len(frames)):
+                for i in frames:
+                    assembler.add_frame(i, frames_out[i])
+            print(f"Completed job for: Resampling EPI frames {frames[0]}-{frames[-1]}")
+            flush_stdout()
+    with timer.stage("paste"):
+        assembler.close()
 
-            if args.postmat:
-                STRresample += f" {args.postmat}"
-            elif args.postwarp:
-                STRresample += f" {args.postwarp}"
-
-            # for each epi
-            for k in range(len(epis)):
-                epi_basename = epis[k].get_prefix().path
-                ref_basename = ref_tmp.get_prefix().path
-                name = PathMan(tmp_epi_path.path) / f"{epi_basename}_on_{ref_basename}{padded}_defined"
-                frameout = PathMan(tmp_epi_path.path) / f"framesout_{k}.lst"
-                frameout_list.append(frameout)
-                with open(frameout, "a") as f:
-                    f.write(f"{name}\n")
-
-                # symlink split volumes to the resampled path
-                epi_prefix = PathMan(tmp_dir.name) / "split_volumes" / epi_basename
-                epi_split_vol = epi_prefix.append_suffix(f"{padded}.nii")
-                create_symlink_to_path(epi_split_vol.path, tmp_epi_path.path)
-
-            # run resampling script
-            epi_list = " ".join([str(epi.get_path_and_prefix()) for epi in epis])
-            print(f"Resampling_AV.csh {STRresample} {padded} {j} {epi_list}")
-            try:
-                sys.stdout.flush()
-            except BlockingIOError:
-                pass
-            futures[
-                executor.submit(
-                    resampling_run,
-                    STRresample,
-                    padded,
-                    j,
-                    epi_list,
-                )
-            ] = i
-
-        print("Waiting for jobs to complete...")
-        try:
-            sys.stdout.flush()
-        except BlockingIOError:
-            pass
-        for future in as_completed(futures):
-            future.result()
-            print(f"Completed job for: Resampling EPI frame {futures[future]}")
-            try:
-                sys.stdout.flush()
-            except BlockingIOError:
-                pass
-
-    # merge the split volumes and then do intensity normalization
-    # combine split bias fields
-    print("Combining bias fields...")
-    try:
-        sys.stdout.flush()
-    except BlockingIOError:
-        pass
-    print(" ".join(["paste_4dfp", "-a", str(framesout_bias), str(PathMan(tmp_bias_dir.path) / "combined_bias_field")]))
-    subprocess_run(
-        ["paste_4dfp", "-a", framesout_bias, PathMan(tmp_bias_dir.path) / "combined_bias_field"],
-        stdout=DEVNULL,
-        check=True,
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--inputs", nargs="+", required=True)
+    parser.add_argument("-xr3dmat", required=True)
+    parser.add_argument("-phase", required=True)
+    parser.add_argument("-ped", required=True)
+    parser.add_argument("-dwell", required=True)
+    parser.add_argument("-ref", required=True)
+    parser.add_argument("-bias")
+    postxfm = parser.add_mutually_exclusive_group(required=True)
+    postxfm.add_argument("-postmat")
+    postxfm.add_argument("-postwarp")
+    parser.add_argument("-parallel", type=int, required=True)
+    parser.add_argument("-trailer", required=True)
+    parser.add_argument(
+        "-engine",
+        choices=["native", "fsl"],
+        default="native",
+        help="Resample in-process with NumPy/SciPy (native) or per frame with FSL tools (fsl, for validation).",
     )
-    combined_bias = str((PathMan(tmp_bias_dir.path) / "combined_bias_field").with_suffix(".4dfp.img"))
-    print("Intensity normalizing EPIs...")
-    try:
-        sys.stdout.flush()
-    except BlockingIOError:
-        pass
-    for k in range(len(epis)):
-        # combine split volumes
-        temp_out = PathMan(tmp_epi_path.path) / f"temp_out_{k}"
-        print(" ".join(["paste_4dfp", "-a", str(frameout_list[k]), str(temp_out)]))
-        subprocess_run(["paste_4dfp", "-a", frameout_list[k], temp_out], stdout=DEVNULL, check=True)
-        subprocess_run(["imgopr_4dfp", f"-p{out[k]}", temp_out, combined_bias, "-R", "-z", "-u"], check=True)
-        subprocess_run(["ifh2hdr", "-r2000", out[k]], check=True, stdout=False)
-        with open(f"{os.path.splitext(out[k])[0]}.4dfp.img.rec", "w") as f:
-            # try to get the login name, but if we fail, just use "unknown"
-            try:
-                login = os.getlogin()
-            except OSError:
-                login = "unknown"
-            f.write(
-                f"rec {os.path.splitext(out[k])[0]}.4dfp.img {datetime.now().strftime('%c')} "  # type: ignore
-                f"{login}@{os.uname().nodename}\n"
-            )
-            if os.path.isfile(f"{epis[k]}.4dfp.img.rec"):
-                with open(f"{epis[k]}.4dfp.img.rec") as epi_rec_file:
-                    f.write(epi_rec_file.read())
-            f.write(f"endrec {datetime.now().strftime('%c')} {login}\n")  # type: ignore
+    parser.add_argument(
+        "-frame_chunk",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help="Number of field map frames to hold in memory when computing shift maps.",
+    )
+    parser.add_argument(
+        "-executor",
+        choices=EXECUTOR_MODES,
+        help="How to run frame tasks: thread (default), process (fsl engine only), or vectorized "
+        "(one task at a time in the main thread).",
+    )
+    parser.add_argument(
+        "-frames_per_task",
+        type=int,
+        help="Number of frames per task (default: 1 for the fsl engine, the frames split evenly over -parallel "
+        "workers, at most -frame_chunk, for the native engine).",
+    )
+    parser.add_argument(
+        "-max_pending",
+        type=int,
+        help="Maximum number of tasks in flight, bounds the number of temporary files (default: 2 * -parallel).",
+    )
+    parser.add_argument(
+        "-pin_cpus", action="store_true", help="Pin each worker and the tools it runs to its own set of CPUs."
+    )
+    parser.add_argument("-stage_times", help="Write the time spent in each stage to this JSON file.")
+
+    # parse arguments
+    args = parser.parse_args()
+    if args.engine == "native" and args.executor == "process":
+        parser.error("-executor process is only supported with -engine fsl")
+
+    # set fsl output type
+    os.environ["FSLOUTPUTTYPE"] = "NIFTI"
+
+    # get epi images
+    epis = [PathMan(i) for i in args.inputs]
+
+    # make list to store outputs
+    out = []
+
+    # make a temporary directory
+    tmp_dir = TemporaryDirectory(dir=os.environ.get("TMPDIR", "/tmp"))
+
+    # time spent in each stage
+    timer = StageTimer()
+
+    # loop over epis
+    for i, epi in enumerate(epis):
+        epi_img = epi.with_suffix(".img")
+        epi_nii = epi.get_path_and_prefix().with_suffix(".nii")
+
+        # check if epi exists
+        if not epi_img.exists():
+            raise FileNotFoundError(f"Could not find {epi_img}")
+
+        # setup output filename
+        out.append(epi.append_suffix(f"_{args.trailer}"))
+
+        # the fsl engine works on a nifti conversion of each echo (the native engine reads the 4dfp directly)
+        if args.engine == "fsl":
+            print(f"Converting {epi} to {epi_nii}")
+            flush_stdout()
+            with timer.stage("conversion"):
+                # rewrite the analyze header from the ifh
+                write_hdr(epi_img, read_ifh(epi_img))
+                subprocess_run(["nifti_4dfp", "-n", str(epi), str(epi_nii)], check=True)
+
+    # check that the geometries of all echoes match, and get the number of frames
+    n_frames = check_geometries([epi.with_suffix(".img").path for epi in epis]).n_frames
+    print("Number of frames: ", n_frames)
+
+    # resample the epis
+    if args.engine == "native":
+        # tasks of frames run on -parallel threads, each resampling its own frames into the shared outputs
+        frames_per_task = args.frames_per_task or min(args.frame_chunk, -(-n_frames // args.parallel))
+        executor = FrameExecutor(
+            args.executor or "thread", args.parallel, frames_per_task, args.max_pending, args.pin_cpus
+        )
+        native_resampling(
+            [str(epi) for epi in epis],
+            [str(o) for o in out],
+            args.ref,
+            args.phase,
+            args.xr3dmat,
+            float(args.dwell),
+            args.ped,
+            n_frames,
+            tmp_dir.name,
+            executor,
+            bias=args.bias,
+            postmat=args.postmat,
+            postwarp=args.postwarp,
+            timer=timer,
+        )
+    else:
+        fsl_resampling(args, epis, out, n_frames, tmp_dir, timer)
 
     # close the temporary directory
     tmp_dir.cleanup()
+    timer.write(args.stage_times)
     print("Done!")
-    try:
-        sys.stdout.flush()
-    except BlockingIOError:
-        pass
+    flush_stdout()
@@ -0,0 +1,96 @@
+import os
+import argparse
+from pathlib import Path
+from memori.logging import setup_logging
+from me_pipeline.job_queue import FAILED, POLL_INTERVAL, RUNNING, SKIPPED, JobQueue, QueueWorker, format_status
+from me_pipeline.profiles import PROFILE_DB_NAME, ProfileDB, available_memory
+from me_pipeline.scheduler import format_summary
+from . import epilog
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs and inspects the job queue run_pipeline submits to with --executor queue.",
+        epilog=f"{epilog} 12/09/2022",
+    )
+    subparser = parser.add_subparsers(title="command", dest="command", required=True, help="command to run")
+
+    status = subparser.add_parser("status", help="Show the state of the jobs in a queue")
+    status.add_argument("queue_dir", help="Path to queue directory.")
+    status.add_argument("--verbose", action="store_true", help="List every job, not only running and failed ones.")
+
+    worker = subparser.add_parser("worker", help="Run jobs from a queue (start one on each node)")
+    worker.add_argument("queue_dir", help="Path to queue directory.")
+    worker.add_argument("--jobs", type=int, default=1, help="Number of jobs to run at once. Default: 1")
+    worker.add_argument(
+        "--cpu_budget", type=int, help="Total number of CPUs to divide between the jobs running at once."
+    )
+    worker.add_argument(
+        "--memory_budget",
+        type=float,
+        help="Memory (in GB) the jobs running at once may use together: a job is only claimed if the peak memory "
+        "it is estimated to use fits. Default: all available memory if --jobs > 1",
+    )
+    worker.add_argument(
+        "--profile_db",
+        help="Path to the database of the resources jobs used. Default: $queue_dir/resource_profiles.json",
+    )
+    worker.add_argument(
+        "--poll_interval",
+        type=float,
+        default=POLL_INTERVAL,
+        help=f"Seconds between checks of the queue for jobs. Default: {POLL_INTERVAL}",
+    )
+    worker.add_argument(
+        "--keep_alive", action="store_true", help="Keep waiting for new jobs instead of exiting when none are left."
+    )
+    worker.add_argument("--log_file", help="Path to log file")
+    worker.add_argument("--fs_license", help="Path to freesurfer license file.")
+
+    requeue = subparser.add_parser("requeue", help="Put failed and skipped jobs back in a queue")
+    requeue.add_argument("queue_dir", help="Path to queue directory.")
+    requeue.add_argument("names", nargs="*", help="Names of the jobs to put back. Default: all")
+    requeue.add_argument(
+        "--running",
+        action="store_true",
+        help="Also put back running jobs (only use this if the workers running them died).",
+    )
+
+    # parse arguments
+    args = parser.parse_args()
+
+    queue_dir = Path(args.queue_dir).absolute().resolve()
+    if not queue_dir.exists():
+        raise FileNotFoundError(f"queue_dir {queue_dir} does not exist.")
+    queue = JobQueue(queue_dir)
+
+    if args.command == "status":
+        print(format_status(queue, args.verbose))
+    elif args.command == "requeue":
+        states = (FAILED, SKIPPED, RUNNING) if args.running else (FAILED, SKIPPED)
+        requeued = queue.requeue(args.names or None, states)
+        print(f"Put {len(requeued)} jobs back in {queue_dir}.")
+    elif args.command == "worker":
+        # setup logging
+        setup_logging(args.log_file)
+
+        # setup the FS_LICENSE environment variable
+        if args.fs_license is not None:
+            os.environ["FS_LICENSE"] = args.fs_license
+
+        memory_budget = args.memory_budget * 1024 if args.memory_budget is not None else None
+        if memory_budget is None and args.jobs > 1:
+            memory_budget = available_memory()
+        profile_db = args.profile_db if args.profile_db is not None else queue_dir / PROFILE_DB_NAME
+
+        results = QueueWorker(
+            queue,
+            args.jobs,
+            args.cpu_budget,
+            args.poll_interval,
+            not args.keep_alive,
+            memory_budget,
+            ProfileDB(Path(profile_db).absolute().resolve()),
+        ).run()
+        if results:
+            print(format_summary(results))
@@ -0,0 +1,24 @@
+import json
+import argparse
+from me_pipeline.tracing import format_report, summarize_traces
+from . import epilog
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Summarizes the traces of pipeline jobs (run with run_pipeline --trace), to find the modules and "
+        "tools a cohort spends the most time in.",
+        epilog=f"{epilog} 12/09/2022",
+    )
+    parser.add_argument("paths", nargs="+", help="Trace files, or directories to find trace files in (e.g. the logs).")
+    parser.add_argument("--top", type=int, default=20, help="Number of modules/tools to list. Default: 20")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON instead of tables.")
+
+    # parse arguments
+    args = parser.parse_args()
+
+    summary = summarize_traces(args.paths)
+    if args.json:
+        print(json.dumps(summary, indent=4))
+    else:
+        print(format_report(summary, args.top))
@@ -6,10 +6,11 @@ import json
 import toml
 import logging
 from pathlib import Path
-from typing import Tuple, Union
+from dataclasses import replace
+from functools import partial
+from typing import List, Tuple, Union
 from memori.pathman import PathManager as PathMan
-from memori.logging import setup_logging, run_process
-from memori.helpers import working_directory
+from memori.logging import setup_logging
 from me_pipeline.bids import (
     parse_bids_dataset,
     get_dataset_description,
@@ -19,11 +20,19 @@ from me_pipeline.bids import (
 )
 from me_pipeline.params import (
     generate_instructions,
+    Instructions,
     StructuralParams,
     FunctionalParams,
     RunsMap,
     PARAMS_FILE,
 )
+from me_pipeline.resampling.executors import available_cpus
+from me_pipeline.job_queue import EXECUTOR_BACKENDS, make_executor
+from me_pipeline.manifest import json_files
+from me_pipeline.planner import JobPlan, describe_images, describe_runs, format_plan, plan_job, write_plan
+from me_pipeline.profiles import PROFILE_DB_NAME, ProfileDB, available_memory, dataset_size
+from me_pipeline.scheduler import FAILED, QUEUED, PipelineJob, format_summary
+from me_pipeline.stages import FUNCTIONAL_STAGES, STRUCTURAL_STAGES
 from . import epilog
 
 
@@ -74,6 +83,86 @@ FMRI_PP_MODULES = [
 ]
 
 
+def set_num_cpus(instructions: Instructions, instructions_file: Path, num_cpus: int) -> None:
+    """Sets the number of CPUs a job may use in its instructions file.
+
+    Stages of a session that run at once share the instructions, so they are copied rather than
+    changed, and save_params replaces the file atomically.
+    """
+    replace(instructions, num_cpus=num_cpus).save_params(instructions_file)
+
+
+def profile_db(args: argparse.Namespace) -> ProfileDB:
+    """Gets the resource profile database given on the command line (by default in the output directory)."""
+    path = args.profile_db if args.profile_db is not None else Path(args.output_dir) / PROFILE_DB_NAME
+    return ProfileDB(Path(path).absolute().resolve())
+
+
+def report_plan(plans: List[JobPlan], args: argparse.Namespace, pipeline: str) -> None:
+    """Logs the execution plan of a dry run, and writes it to <output_dir>/<pipeline>_plan.json.
+
+    Parameters
+    ----------
+    plans : List[JobPlan]
+        Plans of the jobs.
+    args : argparse.Namespace
+        Parsed command line arguments.
+    pipeline : str
+        Name of the pipeline, for the name of the plan file.
+    """
+    if not plans:
+        return
+    logging.info(format_plan(plans, args.jobs))
+    plan_file = Path(args.output_dir).absolute().resolve() / f"{pipeline.lower()}_plan.json"
+    write_plan(plans, plan_file, args.jobs)
+    logging.info(f"Wrote execution plan to {plan_file}")
+
+
+def run_jobs(jobs: List[PipelineJob], args: argparse.Namespace, pipeline: str) -> None:
+    """Runs the jobs of a pipeline with the executor and scheduling options given on the command line.
+
+    Parameters
+    ----------
+    jobs : List[PipelineJob]
+        Jobs to run.
+    args : argparse.Namespace
+        Parsed command line arguments.
+    pipeline : str
+        Name of the pipeline, for messages.
+    """
+    if not jobs:
+        return
+    if args.trace:
+        # each job writes its trace next to its log
+        for job in jobs:
+            job.trace_file = job.log_file.with_suffix(".trace.json")
+    cpu_budget = args.cpu_budget
+    if cpu_budget is None and args.jobs > 1:
+        cpu_budget = len(available_cpus())
+    memory_budget = args.memory_budget * 1024 if args.memory_budget is not None else None
+    if memory_budget is None and args.jobs > 1:
+        memory_budget = available_memory()
+    queue_dir = args.queue_dir if args.queue_dir is not None else Path(args.output_dir) / "queue"
+    executor = make_executor(
+        args.executor,
+        max_jobs=args.jobs,
+        cpu_budget=cpu_budget,
+        fail_fast=not args.continue_on_error,
+        retries=args.retries,
+        queue_dir=Path(queue_dir).absolute().resolve(),
+        wait=args.queue_wait,
+        memory_budget=memory_budget,
+        profiles=profile_db(args),
+    )
+    results = executor.run(jobs)
+    logging.info(format_summary(results))
+    if any(result.status == QUEUED for result in results):
+        logging.info(f"Run the queued jobs with: pipeline_queue worker {queue_dir}")
+    failed = [result.name for result in results if result.status == FAILED]
+    if failed:
+        raise RuntimeError(f"{pipeline} pipeline failed for: {', '.join(failed)}.")
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="TODO",
@@ -88,15 +177,77 @@ def main():
         "--participant_label", nargs="+", help="Participant label(s) to run pipeline on. Default: all"
     )
     structural.add_argument(
-        "--module_start", default="T1_DCM", help="Module to start pipeline on.", choices=STRUCTURAL_MODULES
+        "--module_start",
+        help="Module to start pipeline on (with --stage_graph, the module to run again along with the modules "
+        "that depend on it). Default: T1_DCM",
+        choices=STRUCTURAL_MODULES,
     )
     structural.add_argument("--config", help="Path to configuration (params) file.")
     structural.add_argument("--module_exit", action="store_true", help="Exit after module is run.")
     structural.add_argument("--log_file", help="Path to log file")
     structural.add_argument("--reset_database", action="store_true", help="Reset database on BIDS dataset.")
-    structural.add_argument("--dry_run", action="store_true", help="Creates params files, but don't run pipeline.")
+    structural.add_argument(
+        "--dry_run",
+        action="store_true",
+        help="Creates params files and reports an execution plan (inputs, stages to run and estimated CPU hours, "
+        "peak RAM and temp disk, also written to $output_dir/structural_plan.json), but don't run pipeline.",
+    )
     structural.add_argument("--tmp_dir", help="Path to temporary directory. Default: $output_dir/tmp")
     structural.add_argument("--fs_license", help="Path to freesurfer license file.")
+    structural.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of subjects/sessions (modules with --stage_graph) to run at once. Default: 1",
+    )
+    structural.add_argument(
+        "--cpu_budget",
+        type=int,
+        help="Total number of CPUs to divide between the subjects/sessions running at once (overrides num_cpus). "
+        "Default: all available CPUs if --jobs > 1",
+    )
+    structural.add_argument(
+        "--memory_budget",
+        type=float,
+        help="Memory (in GB) the subjects/sessions running at once may use together: a job only starts if the peak "
+        "memory it is estimated to use (from the jobs that ran before it) fits. Default: all available memory if "
+        "--jobs > 1",
+    )
+    structural.add_argument(
+        "--profile_db",
+        help="Path to the database of the resources jobs used. Default: $output_dir/resource_profiles.json",
+    )
+    structural.add_argument(
+        "--continue_on_error",
+        action="store_true",
+        help="Keep running the other subjects/sessions when one fails, instead of stopping at the first failure.",
+    )
+    structural.add_argument("--job_log_dir", help="Path to write the log of each job to. Default: $output_dir/logs")
+    structural.add_argument(
+        "--executor",
+        default="local",
+        choices=EXECUTOR_BACKENDS,
+        help="Run jobs here (local) or submit them to a job queue that workers on any node run (queue, see "
+        "pipeline_queue). Default: local",
+    )
+    structural.add_argument("--queue_dir", help="Path to the job queue of --executor queue. Default: $output_dir/queue")
+    structural.add_argument(
+        "--queue_wait", action="store_true", help="Wait for the workers to finish the jobs submitted to the queue."
+    )
+    structural.add_argument("--retries", type=int, default=0, help="Number of times to retry a failed job. Default: 0")
+    structural.add_argument(
+        "--trace",
+        action="store_true",
+        help="Trace the modules and tools each job runs (wall time, CPU time, peak memory and temp disk usage) to a "
+        "trace file next to its log. Summarize traces with pipeline_report.",
+    )
+    structural.add_argument(
+        "--stage_graph",
+        action="store_true",
+        help="Run each module as its own job after the modules it depends on, so independent modules run in parallel "
+        "(up to --jobs at once), and skip the modules whose params, inputs, code and tools didn't change since they "
+        "completed (as recorded in stage_manifest.json in each output directory).",
+    )
     structural.add_argument(
         "--save_struct_config",
         help="Save struct config files to path. Use with --dry_run option.",
@@ -110,7 +261,10 @@ def main():
         "--participant_label", nargs="+", help="Participant label(s) to run pipeline on. Default: all"
     )
     functional.add_argument(
-        "--module_start", default="FMRI_PP", help="Module to start pipeline on.", choices=FUNCTIONAL_MODULES
+        "--module_start",
+        help="Module to start pipeline on (with --stage_graph, the module to run again along with the modules "
+        "that depend on it). Default: FMRI_PP",
+        choices=FUNCTIONAL_MODULES,
     )
     functional.add_argument(
         "--fmri_pp_module", default="", help="Module to start fmri_pp module on.", choices=FMRI_PP_MODULES
@@ -119,9 +273,68 @@ def main():
     functional.add_argument("--module_exit", action="store_true", help="Exit after module is run.")
     functional.add_argument("--log_file", help="Path to log file")
     functional.add_argument("--reset_database", action="store_true", help="Reset database on BIDS dataset.")
-    functional.add_argument("--dry_run", action="store_true", help="Creates params files, but don't run pipeline.")
+    functional.add_argument(
+        "--dry_run",
+        action="store_true",
+        help="Creates params files and reports an execution plan (inputs, stages to run and estimated CPU hours, "
+        "peak RAM and temp disk, also written to $output_dir/functional_plan.json), but don't run pipeline.",
+    )
     functional.add_argument("--tmp_dir", help="Path to temporary directory. Default: $output_dir/tmp")
     functional.add_argument("--fs_license", help="Path to freesurfer license file.")
+    functional.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of subjects/sessions (modules with --stage_graph) to run at once. Default: 1",
+    )
+    functional.add_argument(
+        "--cpu_budget",
+        type=int,
+        help="Total number of CPUs to divide between the subjects/sessions running at once (overrides num_cpus). "
+        "Default: all available CPUs if --jobs > 1",
+    )
+    functional.add_argument(
+        "--memory_budget",
+        type=float,
+        help="Memory (in GB) the subjects/sessions running at once may use together: a job only starts if the peak "
+        "memory it is estimated to use (from the jobs that ran before it) fits. Default: all available memory if "
+        "--jobs > 1",
+    )
+    functional.add_argument(
+        "--profile_db",
+        help="Path to the database of the resources jobs used. Default: $output_dir/resource_profiles.json",
+    )
+    functional.add_argument(
+        "--continue_on_error",
+        action="store_true",
+        help="Keep running the other subjects/sessions when one fails, instead of stopping at the first failure.",
+    )
+    functional.add_argument("--job_log_dir", help="Path to write the log of each job to. Default: $output_dir/logs")
+    functional.add_argument(
+        "--executor",
+        default="local",
+        choices=EXECUTOR_BACKENDS,
+        help="Run jobs here (local) or submit them to a job queue that workers on any node run (queue, see "
+        "pipeline_queue). Default: local",
+    )
+    functional.add_argument("--queue_dir", help="Path to the job queue of --executor queue. Default: $output_dir/queue")
+    functional.add_argument(
+        "--queue_wait", action="store_true", help="Wait for the workers to finish the jobs submitted to the queue."
+    )
+    functional.add_argument("--retries", type=int, default=0, help="Number of times to retry a failed job. Default: 0")
+    functional.add_argument(
+        "--trace",
+        action="store_true",
+        help="Trace the modules and tools each job runs (wall time, CPU time, peak memory and temp disk usage) to a "
+        "trace file next to its log. Summarize traces with pipeline_report.",
+    )
+    functional.add_argument(
+        "--stage_graph",
+        action="store_true",
+        help="Run each module as its own job after the modules it depends on, so independent modules run in parallel "
+        "(up to --jobs at once), and skip the modules whose params, inputs, code and tools didn't change since they "
+        "completed (as recorded in stage_manifest.json in each output directory).",
+    )
     functional.add_argument("--ses_label", help="For paper, will likely be removed later.")
     functional.add_argument(
         "--save_func_config", help="Save functional config files to path. Use with --dry_run option."
@@ -174,6 +387,12 @@ def main():
     tmpdir.mkdir(exist_ok=True, parents=True)
     os.environ["TMPDIR"] = str(tmpdir)
 
+    # setup the directory for the logs of each job
+    if args.job_log_dir is not None:
+        log_dir = Path(args.job_log_dir).absolute().resolve()
+    else:
+        log_dir = output_path / "logs"
+
     if args.pipeline == "structural":
         # load subject config files if any
         user_struct_dict = {}
@@ -196,6 +415,8 @@ def main():
         )
 
         # loop over subjects
+        jobs = []
+        plans = []
         for subject_id, sessions in anatomicals["T1w"].items():
             # only process subjects in participant_label (if not None)
             if args.participant_label is not None and subject_id not in args.participant_label:
@@ -206,7 +427,7 @@ def main():
             output_dir.mkdir(exist_ok=True, parents=True)
 
             # set instructions file
-            instructions_file, _ = generate_instructions(output_dir, args.config)
+            instructions_file, instructions = generate_instructions(output_dir, args.config)
 
             # combine files from all sessions
             mpr_files = []
@@ -253,25 +474,59 @@ def main():
                 sp.save(out)
 
             # skip if dry run
-            if not args.dry_run:
-                # change to subject directory
-                with working_directory(str(output_dir)):
-                    # run the structural pipeline
-                    if (
-                        run_process(
-                            [
-                                "Structural_pp.csh",
-                                str(struct_params),
-                                str(instructions_file),
-                                args.module_start,
-                                "1" if args.module_exit else "0",
-                            ]
-                        )
-                        != 0
-                    ):
-                        raise RuntimeError("Structural pipeline failed.")
+            if not args.dry_run and args.stage_graph:
+                # queue the structural modules that need to run for this subject
+                jobs.extend(
+                    STRUCTURAL_STAGES.jobs(
+                        f"sub-{subject_id}",
+                        output_dir,
+                        [str(struct_params), str(instructions_file)],
+                        log_dir,
+                        start=args.module_start,
+                        only=args.module_exit,
+                        set_cpus=partial(set_num_cpus, instructions, instructions_file),
+                        size=dataset_size(mpr_files + t2w_files),
+                    )
+                )
+            elif not args.dry_run:
+                # queue the structural pipeline for this subject
+                jobs.append(
+                    PipelineJob(
+                        name=f"sub-{subject_id}",
+                        command=[
+                            "Structural_pp.csh",
+                            str(struct_params),
+                            str(instructions_file),
+                            args.module_start or STRUCTURAL_MODULES[0],
+                            "1" if args.module_exit else "0",
+                        ],
+                        cwd=output_dir,
+                        log_file=log_dir / f"sub-{subject_id}_structural.log",
+                        set_cpus=partial(set_num_cpus, instructions, instructions_file),
+                        profile=STRUCTURAL_STAGES.profile(args.module_start, args.module_exit),
+                        size=dataset_size(mpr_files + t2w_files),
+                    )
+                )
             else:
-                logging.info(f"Dry run: skipping structural pipeline for {subject_id}.")
+                # plan the structural pipeline for this subject
+                plans.append(
+                    plan_job(
+                        f"sub-{subject_id}",
+                        STRUCTURAL_STAGES,
+                        output_dir,
+                        [struct_params, instructions_file],
+                        describe_images(mpr_files + t2w_files),
+                        size=dataset_size(mpr_files + t2w_files),
+                        profiles=profile_db(args),
+                        start=args.module_start,
+                        only=args.module_exit,
+                        stage_graph=args.stage_graph,
+                    )
+                )
+
+        # run the structural pipeline for all subjects (or report the plan of a dry run)
+        run_jobs(jobs, args, "Structural")
+        report_plan(plans, args, "Structural")
 
     elif args.pipeline == "functional":
         # setup wrap limit variable
@@ -311,14 +566,21 @@ def main():
             args.reset_database,
             participant_label=args.participant_label,
             output_path=output_path,
+            session_label=args.session_filter,
         )
 
         # get fieldmaps
         fieldmaps = parse_bids_dataset(
-            bids_path, get_fieldmaps, participant_label=args.participant_label, output_path=output_path
+            bids_path,
+            get_fieldmaps,
+            participant_label=args.participant_label,
+            output_path=output_path,
+            session_label=args.session_filter,
         )
 
         # loop over subjects
+        jobs = []
+        plans = []
         for subject_id, func_sessions in functionals.items():
             # only process subjects in participant_label (if not None)
             if args.participant_label is not None and subject_id not in args.participant_label:
@@ -452,23 +714,58 @@ def main():
                     logging.info(f"Saved runs map config to {runs_map_config}")
 
                 # skip if dry run
-                if not args.dry_run:
-                    # change to session directory
-                    with working_directory(str(func_out)):
-                        # run the functional pipeline
-                        if (
-                            run_process(
-                                [
-                                    "Functional_pp_batch_ME_NORDIC.csh",
-                                    str(func_params),
-                                    str(instructions_file),
-                                    args.module_start,
-                                    "1" if args.module_exit else "0",
-                                    args.fmri_pp_module,
-                                ]
-                            )
-                            != 0
-                        ):
-                            raise RuntimeError("Functional pipeline failed.")
+                if not args.dry_run and args.stage_graph:
+                    # queue the functional modules that need to run for this session
+                    jobs.extend(
+                        FUNCTIONAL_STAGES.jobs(
+                            f"sub-{subject_id}_ses-{session_id}{suffix}",
+                            func_out,
+                            [str(func_params), str(instructions_file)],
+                            log_dir,
+                            start=args.module_start,
+                            only=args.module_exit,
+                            extra_args=[args.fmri_pp_module],
+                            set_cpus=partial(set_num_cpus, instructions, instructions_file),
+                            size=dataset_size(json_files(func_out / "runs.json")),
+                        )
+                    )
+                elif not args.dry_run:
+                    # queue the functional pipeline for this session
+                    jobs.append(
+                        PipelineJob(
+                            name=f"sub-{subject_id}_ses-{session_id}{suffix}",
+                            command=[
+                                "Functional_pp_batch_ME_NORDIC.csh",
+                                str(func_params),
+                                str(instructions_file),
+                                args.module_start or FUNCTIONAL_MODULES[0],
+                                "1" if args.module_exit else "0",
+                                args.fmri_pp_module,
+                            ],
+                            cwd=func_out,
+                            log_file=log_dir / f"sub-{subject_id}_ses-{session_id}{suffix}_functional.log",
+                            set_cpus=partial(set_num_cpus, instructions, instructions_file),
+                            profile=FUNCTIONAL_STAGES.profile(args.module_start, args.module_exit),
+                            size=dataset_size(json_files(func_out / "runs.json")),
+                        )
+                    )
                 else:
-                    logging.info(f"Dry run: skipping functional pipeline for {subject_id}.")
+                    # plan the functional pipeline for this session
+                    plans.append(
+                        plan_job(
+                            f"sub-{subject_id}_ses-{session_id}{suffix}",
+                            FUNCTIONAL_STAGES,
+                            func_out,
+                            [func_params, instructions_file],
+                            describe_runs(runs_map.runs_dict),
+                            size=dataset_size(json_files(func_out / "runs.json")),
+                            profiles=profile_db(args),
+                            start=args.module_start,
+                            only=args.module_exit,
+                            stage_graph=args.stage_graph,
+                        )
+                    )
+
+        # run the functional pipeline for all sessions (or report the plan of a dry run)
+        run_jobs(jobs, args, "Functional")
+        report_plan(plans, args, "Functional")
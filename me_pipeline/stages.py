@@ -0,0 +1,276 @@
+"""Declares the modules of the csh pipelines as dependency graphs.
+
+Structural_pp.csh and Functional_pp_batch_ME_NORDIC.csh jump to the module given on the command line and
+run every module after it strictly in order (or exit right after it). Most modules only read the outputs of
+a few of the modules before them though, so here each module is declared as a stage, with the stages whose
+outputs it reads and the outputs it leaves in its working directory.
+
+Each stage runs as its own job (the csh script entered at the module and exited after it), so stages that
+don't depend on each other run in parallel (e.g. FC_QC and CIFTI_CREATION). When a stage succeeds, what it
+ran with is recorded in the stage manifest of the working directory (see ``me_pipeline.manifest``), so a
+later run only runs the stages that are stale (their params fields, inputs, code or tools changed, or an
+output is missing) and the stages that depend on them.
+"""
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional, Sequence, Set, Tuple, Union
+from .manifest import StageManifest
+from .scheduler import PipelineJob
+
+
+@dataclass(frozen=True)
+class Stage:
+    """A module of a csh pipeline.
+
+    Parameters
+    ----------
+    name : str
+        Name of the module (the label the csh script jumps to).
+    requires : Tuple[str, ...], optional
+        Stages whose outputs this stage reads, by default none
+    outputs : Tuple[str, ...], optional
+        Glob patterns (relative to the working directory) of outputs that must exist for the stage to be
+        complete, by default none
+    inputs : Tuple[str, ...], optional
+        Glob patterns (relative to the working directory) of input files that aren't named in the params
+        files or made by a required stage, by default none
+    """
+
+    name: str
+    requires: Tuple[str, ...] = ()
+    outputs: Tuple[str, ...] = ()
+    inputs: Tuple[str, ...] = ()
+
+
+class StageGraph:
+    """The stages of a csh pipeline and their dependencies.
+
+    Parameters
+    ----------
+    name : str
+        Name of the pipeline, e.g. "structural".
+    script : str
+        csh script that runs the pipeline.
+    stages : Sequence[Stage]
+        Stages of the pipeline, in the order the script runs them.
+
+    Raises
+    ------
+    ValueError
+        If stage names aren't unique, a stage requires an unknown stage, or a stage requires a stage that
+        comes after it.
+    """
+
+    def __init__(self, name: str, script: str, stages: Sequence[Stage]):
+        self.name = name
+        self.script = script
+        self.stages = OrderedDict((stage.name, stage) for stage in stages)
+        if len(self.stages) != len(stages):
+            raise ValueError(f"Stage names of the {name} pipeline must be unique.")
+        # stages are declared in the order the script runs them, so this also rules out cycles
+        seen: Set[str] = set()
+        for stage in stages:
+            for required in stage.requires:
+                if required not in self.stages:
+                    raise ValueError(f"Stage {stage.name} requires unknown stage {required}.")
+                if required not in seen:
+                    raise ValueError(f"Stage {stage.name} requires stage {required}, which comes after it.")
+            seen.add(stage.name)
+
+    @property
+    def names(self) -> List[str]:
+        """Names of the stages, in the order the script runs them."""
+        return list(self.stages)
+
+    def dependents(self, names: Iterable[str]) -> Set[str]:
+        """Gets stages and every stage that (directly or indirectly) depends on them.
+
+        Parameters
+        ----------
+        names : Iterable[str]
+            Names of the stages.
+
+        Returns
+        -------
+        Set[str]
+            Names of the stages and their dependents.
+        """
+        found = set(names)
+        for stage in self.stages.values():
+            if found.intersection(stage.requires):
+                found.add(stage.name)
+        return found
+
+    def profile(self, start: Optional[str] = None, only: bool = False) -> str:
+        """Gets the resource profile of a job that runs the script from a stage (or only that stage).
+
+        Parameters
+        ----------
+        start : Optional[str], optional
+            Stage the script starts on, by default the first stage
+        only : bool, optional
+            The script exits after the start stage, by default False
+
+        Returns
+        -------
+        str
+            Name of the profile: "pipeline/stage" for a single stage (as for stage jobs), "pipeline/from_stage"
+            otherwise.
+        """
+        start = start or self.names[0]
+        return f"{self.name}/{start}" if only else f"{self.name}/from_{start}"
+
+    def stale(self, cwd: Union[Path, str], params_files: Sequence[Union[Path, str]]) -> List[str]:
+        """Gets the stages that are stale in a working directory.
+
+        Parameters
+        ----------
+        cwd : Union[Path, str]
+            Working directory of the pipeline.
+        params_files : Sequence[Union[Path, str]]
+            Params files of the pipeline.
+
+        Returns
+        -------
+        List[str]
+            Names of the stages that didn't complete or completed with other params, inputs, code or tools.
+        """
+        return StageManifest(cwd).stale(self.name, self.script, list(self.stages.values()), params_files)
+
+    def plan(
+        self,
+        cwd: Union[Path, str],
+        params_files: Sequence[Union[Path, str]],
+        start: Optional[str] = None,
+        only: bool = False,
+    ) -> List[str]:
+        """Gets the stages to run in a working directory.
+
+        Parameters
+        ----------
+        cwd : Union[Path, str]
+            Working directory of the pipeline.
+        params_files : Sequence[Union[Path, str]]
+            Params files of the pipeline.
+        start : Optional[str], optional
+            Stage to run again even if it isn't stale (along with its dependents), by default None
+        only : bool, optional
+            Only run the start stage, by default False
+
+        Returns
+        -------
+        List[str]
+            Names of the stages to run, in the order the script runs them.
+        """
+        if start is not None and start not in self.stages:
+            raise ValueError(f"Unknown stage {start} of the {self.name} pipeline.")
+        if only:
+            if start is None:
+                raise ValueError("A start stage is needed to only run one stage.")
+            return [start]
+        to_run = self.dependents(self.stale(cwd, params_files) + ([start] if start is not None else []))
+        return [name for name in self.stages if name in to_run]
+
+    def jobs(
+        self,
+        name: str,
+        cwd: Path,
+        args: Sequence[str],
+        log_dir: Path,
+        start: Optional[str] = None,
+        only: bool = False,
+        extra_args: Sequence[str] = (),
+        set_cpus: Optional[Callable[[int], None]] = None,
+        size: float = 0.0,
+    ) -> List[PipelineJob]:
+        """Makes a job for each stage to run in a working directory.
+
+        The manifest entries of the stages to run are removed, so stages that don't finish are run again by
+        the next run.
+
+        Parameters
+        ----------
+        name : str
+            Name of the subject/session, prefixed to the name of each job (e.g. "sub-01_ses-1/FC_QC").
+        cwd : Path
+            Working directory of the pipeline.
+        args : Sequence[str]
+            Arguments of the script before the module to start on: the params files of the pipeline (e.g. the
+            params and instructions files).
+        log_dir : Path
+            Directory to write the log of each stage to.
+        start : Optional[str], optional
+            Stage to run again even if it isn't stale (along with its dependents), by default None
+        only : bool, optional
+            Only run the start stage, by default False
+        extra_args : Sequence[str], optional
+            Arguments of the script after the module exit flag, by default none
+        set_cpus : Optional[Callable[[int], None]], optional
+            Called with the number of CPUs a stage may use right before it starts, by default None
+        size : float, optional
+            Size of the dataset in MB, to estimate the resources of each stage from its profile (named
+            "pipeline/stage"), by default unknown
+
+        Returns
+        -------
+        List[PipelineJob]
+            Jobs of the stages to run, each running after the jobs of the stages it requires.
+        """
+        stages = self.plan(cwd, args, start, only)
+        manifest = StageManifest(cwd)
+        manifest.remove(self.name, stages)
+        return [
+            PipelineJob(
+                name=f"{name}/{stage}",
+                command=[self.script, *args, stage, "1", *extra_args],
+                cwd=cwd,
+                log_file=log_dir / f"{name}_{self.name}_{stage}.log",
+                set_cpus=set_cpus,
+                after=[f"{name}/{required}" for required in self.stages[stage].requires if required in stages],
+                on_success=partial(manifest.record, self.name, self.script, self.stages[stage], list(args)),
+                profile=f"{self.name}/{stage}",
+                size=size,
+            )
+            for stage in stages
+        ]
+
+
+# modules of Structural_pp.csh, see lines 142 to 154
+STRUCTURAL_STAGES = StageGraph(
+    "structural",
+    "Structural_pp.csh",
+    [
+        Stage("T1_DCM", outputs=("T1/*_T1w_*_debias.4dfp.img",)),
+        Stage("T1_AVG", ("T1_DCM",)),
+        Stage("T2_DCM", outputs=("T2/*_T2w_*_debias.4dfp.img",)),
+        Stage("T2_AVG", ("T2_DCM",)),
+        Stage("T1_REG2ATL", ("T1_AVG", "T2_AVG"), ("T1/atlas/*_T1w_*_on_*.4dfp.img",)),
+        Stage("T2toT1REG", ("T1_REG2ATL",)),
+        Stage("SURFACE_CREATION", ("T2toT1REG",)),
+        Stage("POSTFREESURFER", ("SURFACE_CREATION",)),
+        Stage("SEG2ATL", ("T1_REG2ATL", "POSTFREESURFER")),
+        Stage("SUBCORTICAL_MASK", ("SEG2ATL",), ("subcortical_mask/*.nii*",)),
+        Stage("POSTFREESURFER2ATL", ("POSTFREESURFER",)),
+        Stage("CREATE_RIBBON", ("POSTFREESURFER2ATL",)),
+        Stage("IMAGEREG_CHECK", ("T2toT1REG", "POSTFREESURFER2ATL")),
+    ],
+)
+
+# modules of Functional_pp_batch_ME_NORDIC.csh, see lines 120 to 127
+# (FMRI_PP runs all of ME_cross_bold_pp.csh, whose modules loop over every run, so it is a single stage)
+FUNCTIONAL_STAGES = StageGraph(
+    "functional",
+    "Functional_pp_batch_ME_NORDIC.csh",
+    [
+        Stage("FMRI_PP", outputs=("bold*/*_Swgt_norm.4dfp.img",), inputs=("runs.json",)),
+        Stage("NIFTI", ("FMRI_PP",), ("bold*/*_Swgt_norm_avg.nii.gz",)),
+        Stage("IMAGEREG_CHECK", ("NIFTI",), ("bold*/*_regcheck.png",)),
+        Stage("GOODVOXELS", ("FMRI_PP",)),
+        Stage("FCMRI_PP", ("FMRI_PP",)),
+        Stage("FORMAT_CONVERT", ("FCMRI_PP",)),
+        Stage("FC_QC", ("FORMAT_CONVERT",)),
+        Stage("CIFTI_CREATION", ("GOODVOXELS", "FCMRI_PP")),
+    ],
+)
@@ -0,0 +1,488 @@
+"""Traces the stages and tools of pipeline jobs, and reports where a cohort spends its time.
+
+A traced job writes a trace file (in the Chrome trace event format, so it can be opened in Perfetto or
+chrome://tracing) with an event for:
+
+- the job, with its wall time, CPU time, peak memory and return code
+- each module of the csh scripts it ran: the scripts write a line ("script label time") to the file named
+  by ME_PIPELINE_TRACE when they enter a module, so the modules of scripts called by other scripts (e.g. the
+  BOLD4 module of ME_cross_bold_pp.csh in the FMRI_PP module of Functional_pp_batch_ME_NORDIC.csh) nest in
+  the modules of their callers
+- each process the job ran (the tools the scripts call and the scripts themselves), found by sampling the
+  processes in the session of the job, with their CPU time and peak RSS
+
+and counters of the temp disk usage of the job (each traced job gets its own TMPDIR). Processes are only
+seen while they run during a sample, so tools that run for less than the sample interval may be missing,
+and the end of each process is only known to within the sample interval.
+
+Processes are sampled from /proc, so only modules and the totals of the job are traced on other systems.
+"""
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+from .profiles import ResourceUsage
+
+# environment variable naming the file the csh scripts write the modules they enter to
+STAGE_TRACE_VAR = "ME_PIPELINE_TRACE"
+
+# seconds between samples of the processes and the temp disk usage of a job
+SAMPLE_INTERVAL = 2.0
+DISK_INTERVAL = 30.0
+
+# interpreters whose processes are named after the script they run
+INTERPRETERS = re.compile(r"^(sh|bash|csh|tcsh|perl|python[\d.]*)$")
+# processes that run a script
+SCRIPT = re.compile(r"\.(c?sh|py)$")
+
+# start times of processes are only known to within a few clock ticks, so a process that started up to this
+# many seconds before a module was entered is in the module
+CLOCK_SLACK = 0.05
+
+# statistics of each name in a summary of traces
+STATS = ("count", "wall_time", "max_wall_time", "cpu_time", "peak_rss", "peak_disk")
+
+# trace event categories
+JOB = "job"
+STAGE = "stage"
+SCRIPT_CATEGORY = "script"
+TOOL = "tool"
+
+
+def _boot_time() -> float:
+    # /proc/uptime is more precise than the btime of /proc/stat
+    with open("/proc/uptime") as f:
+        return time.time() - float(f.read().split()[0])
+
+
+def process_name(cmdline: List[str], comm: str) -> str:
+    """Gets the name of a process: the tool it runs, or the script its interpreter runs."""
+    if not cmdline:
+        return comm
+    name = os.path.basename(cmdline[0])
+    if INTERPRETERS.match(name):
+        for arg in cmdline[1:]:
+            # the interpreter runs a command, not a script
+            if arg == "-c":
+                break
+            if not arg.startswith("-"):
+                return os.path.basename(arg)
+    return name
+
+
+def session_processes(session: int) -> Dict[Tuple[int, int], Dict[str, Any]]:
+    """Gets the processes in a session.
+
+    Parameters
+    ----------
+    session : int
+        Session id (the pid of the process that started the session).
+
+    Returns
+    -------
+    Dict[Tuple[int, int], Dict[str, Any]]
+        Name, start time (seconds since the epoch), CPU time (seconds) and peak RSS (MB) of each process, by
+        pid and start time (in clock ticks since boot).
+    """
+    ticks = os.sysconf("SC_CLK_TCK")
+    boot_time = _boot_time()
+    processes = {}
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry.name}/stat") as f:
+                stat = f.read()
+            # the name of the process is in parentheses and can contain spaces
+            comm = stat[stat.index("(") + 1 : stat.rindex(")")]
+            fields = stat[stat.rindex(")") + 2 :].split()
+            if int(fields[3]) != session:
+                continue
+            with open(f"/proc/{entry.name}/cmdline", "rb") as f:
+                cmdline = [arg.decode(errors="replace") for arg in f.read().split(b"\0") if arg]
+            peak_rss = 0.0
+            with open(f"/proc/{entry.name}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        peak_rss = int(line.split()[1]) / 1024
+        except (OSError, ValueError, IndexError):
+            # the process exited
+            continue
+        start = int(fields[19])
+        processes[(int(entry.name), start)] = {
+            "name": process_name(cmdline, comm),
+            "start": boot_time + start / ticks,
+            "cpu_time": (int(fields[11]) + int(fields[12])) / ticks,
+            "peak_rss": peak_rss,
+        }
+    return processes
+
+
+def disk_usage(path: Union[Path, str]) -> float:
+    """Gets the disk space the files under a directory use, in MB."""
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+    return size / (1024 * 1024)
+
+
+def read_stages(path: Path, end: float) -> List[Dict[str, Any]]:
+    """Reads the modules the csh scripts of a job entered.
+
+    Parameters
+    ----------
+    path : Path
+        File the scripts wrote the modules they entered to.
+    end : float
+        End time of the job.
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        Script, label, start and end time and nesting depth of each module. A module ends when its script
+        enters another module (ending the modules of the scripts it called) or the job ends.
+    """
+    stages: List[Dict[str, Any]] = []
+    open_stages: List[Dict[str, Any]] = []
+    try:
+        lines = path.read_text().splitlines()
+    except OSError:
+        lines = []
+    for line in lines:
+        try:
+            script, label, start = line.split()
+            # date +%s.%N only has a whole number of seconds where date doesn't support %N
+            start_time = float(re.sub(r"\.\D.*$", "", start))
+        except ValueError:
+            continue
+        for depth, stage in enumerate(open_stages):
+            if stage["script"] == script:
+                for closed in open_stages[depth:]:
+                    closed["end"] = start_time
+                del open_stages[depth:]
+                break
+        stage = {"script": script, "label": label, "start": start_time, "end": end, "depth": len(open_stages)}
+        open_stages.append(stage)
+        stages.append(stage)
+    return stages
+
+
+def _lanes(spans: List[Dict[str, Any]]) -> List[int]:
+    """Assigns spans to lanes, so spans in the same lane don't overlap."""
+    lane_ends: List[float] = []
+    lanes = []
+    for span in spans:
+        for lane, lane_end in enumerate(lane_ends):
+            if lane_end <= span["start"]:
+                break
+        else:
+            lane = len(lane_ends)
+            lane_ends.append(0.0)
+        lane_ends[lane] = span["end"]
+        lanes.append(lane)
+    return lanes
+
+
+def _us(seconds: float) -> int:
+    return int(seconds * 1e6)
+
+
+class JobTracer:
+    """Traces the stages and tools of a job.
+
+    Parameters
+    ----------
+    name : str
+        Name of the job.
+    trace_file : Path
+        File to write the trace to.
+    profile : Optional[str], optional
+        Profile of the job (e.g. "functional/FMRI_PP"), jobs are summarized by profile, by default None
+    tmp_dir : Optional[Union[Path, str]], optional
+        Directory to make the temp directory of the job in, by default the system temp directory
+    interval : float, optional
+        Seconds between samples of the processes of the job, by default SAMPLE_INTERVAL
+    disk_interval : float, optional
+        Seconds between samples of the temp disk usage of the job, by default DISK_INTERVAL
+    """
+
+    def __init__(
+        self,
+        name: str,
+        trace_file: Path,
+        profile: Optional[str] = None,
+        tmp_dir: Optional[Union[Path, str]] = None,
+        interval: float = SAMPLE_INTERVAL,
+        disk_interval: float = DISK_INTERVAL,
+    ):
+        self.name = name
+        self.trace_file = Path(trace_file)
+        self.profile = profile
+        self.stage_file = self.trace_file.with_name(f".{self.trace_file.name}.stages")
+        base = Path(tmp_dir) if tmp_dir is not None else Path(tempfile.gettempdir())
+        self.tmp_dir = base / self.trace_file.name.split(".")[0]
+        self.interval = interval
+        self.disk_interval = disk_interval
+        self.processes: Dict[Tuple[int, int], Dict[str, Any]] = {}
+        self.disk: List[Tuple[float, float]] = []
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def env(self, env: Dict[str, str]) -> Dict[str, str]:
+        """Sets up the environment of the job, so its scripts write the modules they enter and its tools write
+        temp files to its own temp directory."""
+        self.trace_file.parent.mkdir(parents=True, exist_ok=True)
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+        self.stage_file.write_text("")
+        return {**env, STAGE_TRACE_VAR: str(self.stage_file), "TMPDIR": str(self.tmp_dir)}
+
+    def start(self, pid: int) -> None:
+        """Starts sampling the processes of a job.
+
+        Parameters
+        ----------
+        pid : int
+            Pid of the job, which must have started a new session.
+        """
+        self.start_time = time.time()
+        self._thread = threading.Thread(target=self._sample, args=(pid,), daemon=True)
+        self._thread.start()
+
+    def _sample(self, pid: int) -> None:
+        next_disk = 0.0
+        while True:
+            now = time.time()
+            if os.path.isdir("/proc"):
+                for key, process in session_processes(pid).items():
+                    seen = self.processes.setdefault(key, process)
+                    seen.update(cpu_time=process["cpu_time"], peak_rss=process["peak_rss"], end=now)
+            if now >= next_disk:
+                self.disk.append((now, disk_usage(self.tmp_dir)))
+                next_disk = now + self.disk_interval
+            if self._stop.wait(self.interval):
+                break
+
+    def stop(self, returncode: int, usage: ResourceUsage) -> None:
+        """Stops sampling and writes the trace of the job.
+
+        Parameters
+        ----------
+        returncode : int
+            Return code of the job.
+        usage : ResourceUsage
+            Resources the job used.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        end = time.time()
+        self.disk.append((end, disk_usage(self.tmp_dir)))
+        try:
+            self.trace_file.write_text(json.dumps(self.trace(end, returncode, usage)))
+        except OSError as error:
+            logging.warning(f"Could not write the trace of {self.name}: {error}")
+        # the temp directory is only removed if the job cleaned up after itself
+        try:
+            self.stage_file.unlink()
+            self.tmp_dir.rmdir()
+        except OSError:
+            pass
+
+    def _peak_disk(self, start: float, end: float) -> float:
+        return max([usage for sample_time, usage in self.disk if start <= sample_time <= end] or [0.0])
+
+    def trace(self, end: float, returncode: int, usage: ResourceUsage) -> Dict[str, Any]:
+        """Makes the trace of the job.
+
+        Parameters
+        ----------
+        end : float
+            End time of the job.
+        returncode : int
+            Return code of the job.
+        usage : ResourceUsage
+            Resources the job used.
+
+        Returns
+        -------
+        Dict[str, Any]
+            Trace events of the job, its stages and processes and its temp disk usage.
+        """
+        stages = read_stages(self.stage_file, end)
+        processes = sorted(
+            ({**process, "end": process.get("end", process["start"])} for process in self.processes.values()),
+            key=lambda process: process["start"],
+        )
+        for process in processes:
+            process["category"] = SCRIPT_CATEGORY if SCRIPT.search(process["name"]) else TOOL
+            process["peak_disk"] = self._peak_disk(process["start"], process["end"])
+            # the innermost module the process started in
+            process["stage"] = None
+            for stage in stages:
+                if stage["start"] - CLOCK_SLACK <= process["start"] < stage["end"] - CLOCK_SLACK:
+                    if process["stage"] is None or stage["depth"] >= process["stage"]["depth"]:
+                        process["stage"] = stage
+        for stage in stages:
+            inside = [process for process in processes if process["stage"] is stage]
+            stage["cpu_time"] = sum(process["cpu_time"] for process in inside)
+            stage["peak_rss"] = max([process["peak_rss"] for process in inside] or [0.0])
+            stage["peak_disk"] = self._peak_disk(stage["start"], stage["end"])
+
+        events: List[Dict[str, Any]] = [
+            {"name": "process_name", "ph": "M", "pid": 1, "args": {"name": self.name}},
+            {"name": "thread_name", "ph": "M", "pid": 1, "tid": 0, "args": {"name": "job"}},
+            {
+                "name": self.name,
+                "cat": JOB,
+                "ph": "X",
+                "ts": _us(self.start_time),
+                "dur": _us(end - self.start_time),
+                "pid": 1,
+                "tid": 0,
+                "args": {
+                    "profile": self.profile,
+                    "returncode": returncode,
+                    "cpu_time": usage.cpu_time,
+                    "peak_rss": usage.peak_rss,
+                    "peak_disk": self._peak_disk(self.start_time, end),
+                },
+            },
+        ]
+        for depth in sorted({stage["depth"] for stage in stages}):
+            events.append(
+                {"name": "thread_name", "ph": "M", "pid": 1, "tid": 1 + depth, "args": {"name": f"modules {depth}"}}
+            )
+        for stage in stages:
+            events.append(
+                {
+                    "name": stage["label"],
+                    "cat": STAGE,
+                    "ph": "X",
+                    "ts": _us(stage["start"]),
+                    "dur": _us(stage["end"] - stage["start"]),
+                    "pid": 1,
+                    "tid": 1 + stage["depth"],
+                    "args": {key: stage[key] for key in ("script", "cpu_time", "peak_rss", "peak_disk")},
+                }
+            )
+        lanes = _lanes(processes)
+        for lane in sorted(set(lanes)):
+            events.append(
+                {"name": "thread_name", "ph": "M", "pid": 1, "tid": 100 + lane, "args": {"name": f"processes {lane}"}}
+            )
+        for process, lane in zip(processes, lanes):
+            stage = process["stage"]
+            events.append(
+                {
+                    "name": process["name"],
+                    "cat": process["category"],
+                    "ph": "X",
+                    "ts": _us(process["start"]),
+                    "dur": _us(process["end"] - process["start"]),
+                    "pid": 1,
+                    "tid": 100 + lane,
+                    "args": {
+                        "cpu_time": process["cpu_time"],
+                        "peak_rss": process["peak_rss"],
+                        "peak_disk": process["peak_disk"],
+                        "stage": None if stage is None else f"{stage['script']}:{stage['label']}",
+                    },
+                }
+            )
+        for sample_time, usage_mb in self.disk:
+            events.append({"name": "tmp_disk", "ph": "C", "ts": _us(sample_time), "pid": 1, "args": {"MB": usage_mb}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def trace_files(paths: Iterable[Union[Path, str]]) -> List[Path]:
+    """Finds trace files: the given files and the trace files in the given directories (recursively)."""
+    found = []
+    for path in map(Path, paths):
+        found.extend(sorted(path.rglob("*.trace.json")) if path.is_dir() else [path])
+    return found
+
+
+def summarize_traces(paths: Iterable[Union[Path, str]]) -> Dict[str, Dict[str, Dict[str, float]]]:
+    """Aggregates the events of traces, to find the stages and tools a cohort spends its time in.
+
+    Parameters
+    ----------
+    paths : Iterable[Union[Path, str]]
+        Trace files, or directories with trace files.
+
+    Returns
+    -------
+    Dict[str, Dict[str, Dict[str, float]]]
+        For each category (job, stage, script and tool), the number of events, total and longest wall time,
+        total CPU time, peak RSS and peak temp disk usage of each name (stages are named "script:label").
+    """
+    summary: Dict[str, Dict[str, Dict[str, float]]] = {category: {} for category in (JOB, STAGE, SCRIPT_CATEGORY, TOOL)}
+    for path in trace_files(paths):
+        try:
+            events = json.loads(path.read_text())["traceEvents"]
+        except (OSError, ValueError, KeyError):
+            logging.warning(f"Could not read trace {path}")
+            continue
+        for event in events:
+            if event.get("ph") != "X" or event.get("cat") not in summary:
+                continue
+            name = event["name"]
+            if event["cat"] == STAGE:
+                name = f"{event['args']['script']}:{name}"
+            elif event["cat"] == JOB:
+                # jobs are summarized by profile (e.g. all FMRI_PP stages), not by subject/session
+                name = event["args"].get("profile") or name
+            stats = summary[event["cat"]].setdefault(name, dict.fromkeys(STATS, 0.0))
+            wall_time = event["dur"] / 1e6
+            stats["count"] += 1
+            stats["wall_time"] += wall_time
+            stats["max_wall_time"] = max(stats["max_wall_time"], wall_time)
+            stats["cpu_time"] += event["args"].get("cpu_time", 0.0)
+            stats["peak_rss"] = max(stats["peak_rss"], event["args"].get("peak_rss", 0.0))
+            stats["peak_disk"] = max(stats["peak_disk"], event["args"].get("peak_disk", 0.0))
+    return summary
+
+
+def format_report(summary: Dict[str, Dict[str, Dict[str, float]]], top: int = 20) -> str:
+    """Formats the hot spots of a summary of traces.
+
+    Parameters
+    ----------
+    summary : Dict[str, Dict[str, Dict[str, float]]]
+        Summary of traces, see summarize_traces.
+    top : int, optional
+        Number of names to list for each category, by default 20
+
+    Returns
+    -------
+    str
+        A table per category, with the names that took the most total wall time first.
+    """
+    lines = []
+    for category, names in summary.items():
+        if not names:
+            continue
+        total = sum(stats["wall_time"] for stats in names.values()) or 1.0
+        lines.append(f"{category.capitalize()}s by total wall time:")
+        lines.append(
+            f"  {'name':<40} {'count':>6} {'wall (h)':>9} {'share':>6} {'max (h)':>8} {'cpu (h)':>8} "
+            f"{'rss (GB)':>9} {'tmp (GB)':>9}"
+        )
+        ranked = sorted(names.items(), key=lambda item: item[1]["wall_time"], reverse=True)
+        for name, stats in ranked[:top]:
+            lines.append(
+                f"  {name[:40]:<40} {stats['count']:>6.0f} {stats['wall_time'] / 3600:>9.2f} "
+                f"{stats['wall_time'] / total:>6.1%} {stats['max_wall_time'] / 3600:>8.2f} "
+                f"{stats['cpu_time'] / 3600:>8.2f} {stats['peak_rss'] / 1024:>9.2f} {stats['peak_disk'] / 1024:>9.2f}"
+            )
+        lines.append("")
+    return "\n".join(lines).rstrip()
@@ -0,0 +1,93 @@
+import json
+import time
+import numpy as np
+import nibabel as nib
+import pytest
+from me_pipeline.io.fourdfp import load_4dfp
+from me_pipeline.resampling.benchmark import *
+from me_pipeline.resampling.benchmark import _fourdfp_to_nifti, _nifti_to_fourdfp
+from me_pipeline.resampling.stages import StageTimer
+from me_pipeline.resampling.transforms import read_xr3d
+
+
+def test_make_synthetic_run(tmp_path):
+    run = make_synthetic_run(tmp_path, n_frames=5, n_echoes=2, matrix=(12, 14, 10))
+    assert len(run.epis) == 2
+    for epi in run.epis:
+        assert load_4dfp(epi).shape == (12, 14, 10, 5)
+    # later echoes decay
+    assert load_4dfp(run.epis[0]).data.mean() > load_4dfp(run.epis[1]).data.mean()
+    assert nib.load(str(run.phase)).shape == (12, 14, 10, 5)
+    assert read_xr3d(run.xr3dmat).shape == (5, 4, 4)
+    assert np.allclose(np.loadtxt(run.postmat), np.eye(4))
+    assert nib.load(str(run.ref.with_suffix(".nii"))).shape[:3] == (12, 14, 10)
+    assert "-postmat" in run.script_args()
+
+
+def test_nifti_4dfp_stub(tmp_path):
+    # converting to nifti and back gives back the same image and header
+    run = make_synthetic_run(tmp_path, n_frames=2, n_echoes=1, matrix=(8, 10, 6))
+    _fourdfp_to_nifti(run.epis[0], tmp_path / "echo")
+    _nifti_to_fourdfp(tmp_path / "echo.nii", tmp_path / "echo_4dfp")
+    original = load_4dfp(run.epis[0])
+    converted = load_4dfp(tmp_path / "echo_4dfp")
+    assert np.array_equal(original.data, converted.data)
+    assert np.allclose(original.ifh.center, converted.ifh.center)
+    assert np.allclose(original.ifh.mmppix, converted.ifh.mmppix)
+
+
+def test_write_stubs(tmp_path):
+    stubbed = write_stubs(tmp_path, tools=["nifti_4dfp", "ls"])
+    assert "ls" not in stubbed
+    assert (tmp_path / "nifti_4dfp").exists() == ("nifti_4dfp" in stubbed)
+    assert write_stubs(tmp_path, tools=["ls"], force=True) == ["ls"]
+
+
+def test_write_stubs_resampling_av(tmp_path, monkeypatch):
+    # Resampling_AV.csh is on the PATH with the pipeline, but is stubbed while the tools it runs are missing
+    for tool in ["Resampling_AV.csh", *RESAMPLING_AV_TOOLS]:
+        (tmp_path / "path" / tool).parent.mkdir(exist_ok=True)
+        (tmp_path / "path" / tool).write_text("#!/bin/sh\n")
+        (tmp_path / "path" / tool).chmod(0o755)
+    monkeypatch.setenv("PATH", str(tmp_path / "path"))
+    monkeypatch.setenv("FSLDIR", str(tmp_path / "fsl"))
+    assert missing_tools("Resampling_AV.csh") == [f"$FSLDIR/bin/{t}" for t in RESAMPLING_AV_FSL_TOOLS]
+    assert write_stubs(tmp_path / "bin", tools=["Resampling_AV.csh"]) == ["Resampling_AV.csh"]
+
+    # with FSL installed it runs as is
+    (tmp_path / "fsl" / "bin").mkdir(parents=True)
+    for tool in RESAMPLING_AV_FSL_TOOLS:
+        (tmp_path / "fsl" / "bin" / tool).write_text("#!/bin/sh\n")
+        (tmp_path / "fsl" / "bin" / tool).chmod(0o755)
+    assert missing_tools("Resampling_AV.csh") == []
+    assert write_stubs(tmp_path / "bin2", tools=["Resampling_AV.csh"]) == []
+
+
+def test_stage_timer(tmp_path):
+    timer = StageTimer()
+    for _ in range(2):
+        with timer.stage("resampling", frames=3):
+            time.sleep(0.01)
+    timer.write(tmp_path / "stages.json")
+    stages = json.loads((tmp_path / "stages.json").read_text())
+    assert stages["resampling"]["calls"] == 2
+    assert stages["resampling"]["frames"] == 6
+    assert stages["resampling"]["wall_time"] >= 0.02
+
+
+def test_disk_monitor(tmp_path):
+    # files that are written and removed again still count towards the high-water mark
+    with DiskMonitor({"temp": tmp_path}, interval=0.01) as monitor:
+        (tmp_path / "frame.img").write_bytes(b"\1" * (1 << 20))
+        time.sleep(0.1)
+        (tmp_path / "frame.img").unlink()
+    assert monitor.peak["temp"] >= 1 << 20
+
+
+def test_run_benchmark(tmp_path):
+    pytest.importorskip("memori")
+    results = run_benchmark(n_frames=3, n_echoes=2, matrix=(12, 14, 10), work_dir=tmp_path)
+    assert results["returncode"] == 0
+    assert results["stages"]["resampling"]["frames"] == 3
+    assert results["peak_rss_bytes"] > 0
+    json.dumps(results)
@@ -0,0 +1,104 @@
+import json
+import pytest
+from bids.layout import BIDSLayout
+from me_pipeline.bids import *
+
+
+def touch(root, name, metadata=None):
+    path = root / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"")
+    if metadata is not None:
+        Path(str(path).replace(".nii.gz", ".json")).write_text(json.dumps(metadata))
+
+
+@pytest.fixture
+def layout(tmp_path):
+    root = tmp_path / "dataset"
+    root.mkdir()
+    (root / "dataset_description.json").write_text(json.dumps({"Name": "test", "BIDSVersion": "1.8.0"}))
+    # multi-echo subjects with sessions and IntendedFor set on their field maps
+    for subject in ["01", "02", "10"]:
+        for session in ["1", "2"]:
+            prefix = f"sub-{subject}/ses-{session}"
+            touch(root, f"{prefix}/anat/sub-{subject}_ses-{session}_T1w.nii.gz")
+            if session == "1":
+                touch(root, f"{prefix}/anat/sub-{subject}_ses-{session}_T2w.nii.gz")
+            intended_for = []
+            for task in ["rest", "motor"]:
+                for run in [1, 2]:
+                    for echo in [1, 2]:
+                        name = f"sub-{subject}_ses-{session}_task-{task}_run-{run:02d}_echo-{echo}_part-mag_bold"
+                        touch(root, f"{prefix}/func/{name}.nii.gz", {"EchoTime": 0.01 * echo})
+                        intended_for.append(f"ses-{session}/func/{name}.nii.gz")
+            for direction in ["AP", "PA"]:
+                touch(
+                    root,
+                    f"{prefix}/fmap/sub-{subject}_ses-{session}_dir-{direction}_epi.nii.gz",
+                    {"IntendedFor": intended_for},
+                )
+    # single echo subject without sessions or IntendedFor
+    touch(root, "sub-03/anat/sub-03_T1w.nii.gz")
+    touch(root, "sub-03/func/sub-03_task-rest_run-1_bold.nii.gz", {"RepetitionTime": 2.0})
+    touch(root, "sub-03/func/sub-03_task-rest_bold.nii.gz", {"RepetitionTime": 2.0})
+    for direction in ["AP", "PA"]:
+        touch(root, f"sub-03/fmap/sub-03_dir-{direction}_epi.nii.gz", {})
+    return BIDSLayout(root, validate=False)
+
+
+def test_index_get(layout):
+    index = BIDSIndex(layout)
+    queries = [
+        dict(subject="01", session="1", suffix="T1w", extension="nii.gz"),
+        dict(subject="03", session=None, suffix="T1w", extension="nii.gz"),
+        dict(subject="01", session=None),
+        dict(subject="02", session="2", task="rest", run=2, suffix="bold", extension="nii.gz", part="mag", echo=1),
+        dict(subject="03", session=None, task="rest", run=1, suffix="bold", extension="nii.gz", echo=1),
+        dict(subject="03", direction="PA", datatype="fmap", extension="nii.gz"),
+        dict(suffix="bold", extension=[".nii.gz", ".json"]),
+    ]
+    for query in queries:
+        assert index.get(**query) == layout.get(**query)
+    regex_query = dict(subject="0", suffix=FIELDMAP_SUFFIXES, extension=[".nii.gz", ".nii"])
+    assert index.get(regex_search=True, **regex_query) == layout.get(regex_search=True, **regex_query)
+
+
+def test_index_ids(layout):
+    index = BIDSIndex(layout)
+    assert index.ids("subject") == layout.get_subjects()
+    for subject in layout.get_subjects():
+        assert index.ids("session", subject=subject) == layout.get_sessions(subject=subject)
+        assert index.ids("task", subject=subject, session=None) == layout.get_tasks(subject=subject, session=None)
+        runs = index.ids("run", subject=subject, task="rest", suffix="bold", extension="nii.gz")
+        assert runs == layout.get_runs(subject=subject, task="rest", suffix="bold", extension="nii.gz")
+        assert [str(run) for run in runs] == [str(run) for run in layout.get_runs(subject=subject, task="rest")]
+
+
+def test_index_fieldmaps(layout):
+    index = BIDSIndex(layout)
+    for bold in layout.get(suffix="bold", extension="nii.gz"):
+        assert index.fieldmaps(bold.path) == layout.get_fieldmap(bold.path, return_list=True)
+
+
+def test_parsers(layout):
+    anatomicals = get_anatomicals(layout)
+    assert sorted(anatomicals["T1w"]) == ["01", "02", "03", "10"]
+    assert list(anatomicals["T1w"]["03"]) == [None]
+    assert list(anatomicals["T2w"]["01"]) == ["1"]
+    assert anatomicals["T1w"]["02"]["2"] == layout.get(subject="02", session="2", suffix="T1w", extension="nii.gz")
+
+    functionals = get_functionals(layout)
+    assert list(functionals["01"]["1"]) == ["motor01", "motor02", "rest01", "rest02"]
+    assert functionals["10"]["2"]["rest02"] == layout.get(
+        subject="10", session="2", task="rest", run=2, suffix="bold", extension="nii.gz"
+    )
+    # bold files without a run aren't included
+    assert [f.filename for f in functionals["03"][None]["rest1"]] == ["sub-03_task-rest_run-1_bold.nii.gz"]
+
+    fieldmaps = get_fieldmaps(layout)
+    assert [f.name for f in fieldmaps["01"]["2"]["motor01"]] == [
+        "sub-01_ses-2_dir-AP_epi.nii.gz",
+        "sub-01_ses-2_dir-PA_epi.nii.gz",
+    ]
+    # without IntendedFor the first AP/PA field maps are used
+    assert [f.name for f in fieldmaps["03"][None]["rest1"]] == ["sub-03_dir-AP_epi.nii.gz", "sub-03_dir-PA_epi.nii.gz"]
@@ -0,0 +1,209 @@
+import json
+import os
+import pytest
+from bids.layout import BIDSLayout
+from bids.layout.models import BIDSFile, FileAssociation, Tag
+from me_pipeline import bids, bids_indexer
+from me_pipeline.bids import LayoutCache, create_subset_view, parse_bids_dataset, subset_name
+from me_pipeline.bids_indexer import *
+
+
+def touch(root, name, metadata=None):
+    path = root / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"")
+    if metadata is not None:
+        Path(str(path).replace(".nii.gz", ".json")).write_text(json.dumps(metadata))
+
+
+def add_session(root, subject, session):
+    prefix = f"sub-{subject}/ses-{session}"
+    touch(root, f"{prefix}/anat/sub-{subject}_ses-{session}_T1w.nii.gz")
+    name = f"sub-{subject}_ses-{session}_task-rest_run-01_bold"
+    touch(root, f"{prefix}/func/{name}.nii.gz", {"EchoTime": 0.03})
+    touch(
+        root,
+        f"{prefix}/fmap/sub-{subject}_ses-{session}_dir-AP_epi.nii.gz",
+        {"IntendedFor": [f"ses-{session}/func/{name}.nii.gz"]},
+    )
+
+
+def records(layout):
+    session = layout.session
+    return (
+        sorted(path for (path,) in session.query(BIDSFile.path)),
+        sorted((t.file_path, t.entity_name, t._value, t.is_metadata) for t in session.query(Tag)),
+        sorted((a.src, a.dst, a.kind) for a in session.query(FileAssociation)),
+    )
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    root = tmp_path / "dataset"
+    root.mkdir()
+    (root / "dataset_description.json").write_text(json.dumps({"Name": "test", "BIDSVersion": "1.8.0"}))
+    (root / "task-rest_bold.json").write_text(json.dumps({"RepetitionTime": 1.7}))
+    for subject in ["01", "02"]:
+        add_session(root, subject, "1")
+    return root
+
+
+def test_scan_units(dataset, monkeypatch):
+    state = scan_units(dataset)
+    units = state.units
+    assert sorted(units) == [".", "sub-01", "sub-01/ses-1", "sub-02", "sub-02/ses-1"]
+    assert scan_units(dataset) == state
+    add_session(dataset, "01", "2")
+    changed = changed_units(scan_units(dataset).units, units)
+    assert changed == {"sub-01/ses-2"}
+    assert unit_of("sub-01/ses-2/func/x.nii.gz", scan_units(dataset).units) == "sub-01/ses-2"
+    assert unit_of("dataset_description.json", units) == ROOT_UNIT
+
+    # only the files of units whose directories changed are walked
+    state = scan_units(dataset)
+    walked = []
+    stat_entries = bids_indexer._stat_entries
+
+    def record_walk(path, prefix):
+        walked.append(prefix)
+        return stat_entries(path, prefix)
+
+    monkeypatch.setattr(bids_indexer, "_stat_entries", record_walk)
+    (dataset / "sub-02" / "ses-1" / "func" / "sub-02_ses-1_task-rest_run-02_bold.json").write_text("{}")
+    assert changed_units(scan_units(dataset, state).units, state.units) == {"sub-02/ses-1"}
+    assert [prefix for prefix in walked if prefix.startswith("sub-")] == ["sub-02/ses-1"]
+
+    # files rewritten in place are only found by a full scan
+    state = scan_units(dataset)
+    (dataset / "sub-02" / "ses-1" / "func" / "sub-02_ses-1_task-rest_run-02_bold.json").write_text('{"a": 1}')
+    assert scan_units(dataset, state) == state
+    assert changed_units(scan_units(dataset, state, full_scan=True).units, state.units) == {"sub-02/ses-1"}
+
+
+def test_load_layout_incremental(dataset):
+    layout = load_layout(dataset)
+    assert (dataset / STATE_NAME).exists()
+    assert records(layout) == records(BIDSLayout(dataset))
+
+    # a new session, a modified sidecar and a removed subject are updated in place (a sidecar rewritten in
+    # place doesn't change the mtime of its directory, so it needs a full scan)
+    add_session(dataset, "01", "2")
+    (dataset / "sub-02" / "ses-1" / "func" / "sub-02_ses-1_task-rest_run-01_bold.json").write_text(
+        json.dumps({"EchoTime": 0.05})
+    )
+    layout = load_layout(dataset)
+    assert layout.get_subjects(session="2") == ["01"]
+    assert layout.get_metadata(layout.get(subject="02", suffix="bold", extension="nii.gz")[0].path)["EchoTime"] == 0.03
+    layout = load_layout(dataset, full_scan=True)
+    assert records(layout) == records(BIDSLayout(dataset))
+    assert layout.get_metadata(layout.get(subject="02", suffix="bold", extension="nii.gz")[0].path)["EchoTime"] == 0.05
+
+    for path in sorted((dataset / "sub-02").glob("**/*"), reverse=True):
+        path.rmdir() if path.is_dir() else path.unlink()
+    (dataset / "sub-02").rmdir()
+    layout = load_layout(dataset)
+    assert records(layout) == records(BIDSLayout(dataset))
+    assert layout.get_subjects() == ["01"]
+
+
+def test_load_layout_root_change(dataset, monkeypatch):
+    load_layout(dataset)
+    (dataset / "task-rest_bold.json").write_text(json.dumps({"RepetitionTime": 2.0}))
+
+    # a change outside of the subject directories re-indexes everything
+    def fail(*args, **kwargs):
+        raise AssertionError("expected a full re-index")
+
+    monkeypatch.setattr("me_pipeline.bids_indexer.update_layout", fail)
+    layout = load_layout(dataset)
+    assert records(layout) == records(BIDSLayout(dataset))
+
+
+def test_subset_views(dataset, tmp_path):
+    add_session(dataset, "01", "2")
+    add_session(dataset, "03", "1")
+    views = tmp_path / "output" / "dataset"
+
+    # a single participant keeps its old view name
+    assert create_subset_view(dataset, views, ["02"]) == views / "dataset_sub-02"
+
+    view = create_subset_view(dataset, views, ["01", "03"], ["2"])
+    assert view.name == subset_name(["03", "01"], ["2"])
+    assert (view / "dataset_description.json").is_symlink()
+    assert sorted(p.name for p in view.glob("sub-*/ses-*")) == ["ses-2"]
+    assert create_subset_view(dataset, views, ["03", "01"], ["2"]) == view
+    assert not list(views.glob(".dataset_*"))
+
+    # top level files added to the dataset later are linked into existing views
+    (dataset / "participants.tsv").write_text("participant_id\n")
+    create_subset_view(dataset, views, ["01", "03"], ["2"])
+    assert (view / "participants.tsv").is_symlink()
+
+    # so are selected sessions and participants that arrive later
+    add_session(dataset, "03", "2")
+    create_subset_view(dataset, views, ["01", "03"], ["2"])
+    assert sorted(str(p.relative_to(view)) for p in view.glob("sub-*/ses-*")) == ["sub-01/ses-2", "sub-03/ses-2"]
+    late_view = create_subset_view(dataset, views, ["02", "05"])
+    assert not (late_view / "sub-05").exists()
+    add_session(dataset, "05", "1")
+    create_subset_view(dataset, views, ["02", "05"])
+    assert (late_view / "sub-05").is_symlink()
+
+    output_path = tmp_path / "output"
+    subjects = parse_bids_dataset(dataset, lambda layout: layout.get_subjects(), False, ["01", "02"], output_path)
+    assert subjects == ["01", "02"]
+    assert (views / subset_name(["01", "02"]) / STATE_NAME).exists()
+
+
+def test_layout_cache(dataset, tmp_path):
+    cache = LayoutCache(maxsize=2)
+    views = tmp_path / "output" / "dataset"
+    view_01 = create_subset_view(dataset, views, ["01"])
+    view_02 = create_subset_view(dataset, views, ["02"])
+    layout = cache.load(dataset)
+    assert cache.load(dataset) is layout
+    cache.load(view_01)
+    cache.load(view_02)
+    # the least recently used layout is evicted
+    assert len(cache) == 2 and dataset not in cache and view_01 in cache
+
+    # a layout is reloaded once its index was updated by someone else
+    layout_02 = cache.load(view_02)
+    add_session(dataset, "02", "2")
+    load_layout(view_02)
+    assert cache.get(view_02) is None
+    assert cache.load(view_02) is not layout_02
+    assert cache.load(view_02, reset_database=True) is not layout_02
+
+
+def test_load_index(dataset, monkeypatch):
+    layout = load_layout(dataset)
+    index = bids.load_index(layout)
+    assert (dataset / INDEX_CACHE_NAME).exists()
+
+    # a fresh layout of the same index reuses the pickled index instead of querying the database
+    def fail(*args, **kwargs):
+        raise AssertionError("expected the pickled index")
+
+    with monkeypatch.context() as m:
+        m.setattr(bids.BIDSIndex, "__init__", fail)
+        cached = bids.load_index(load_layout(dataset))
+    assert [f.path for f in cached.get(suffix="bold")] == [f.path for f in index.get(suffix="bold")]
+    assert cached.ids("run", subject="01") == index.ids("run", subject="01")
+
+    # an index others can write to is never unpickled
+    os.chmod(dataset / INDEX_CACHE_NAME, 0o666)
+    loads = []
+    with monkeypatch.context() as m:
+        m.setattr(bids.pickle, "load", loads.append)
+        rebuilt = bids.load_index(load_layout(dataset))
+    assert not loads
+    assert [f.path for f in rebuilt.get(suffix="bold")] == [f.path for f in index.get(suffix="bold")]
+    assert not os.stat(dataset / INDEX_CACHE_NAME).st_mode & 0o022
+
+    # updating the index invalidates it
+    add_session(dataset, "01", "2")
+    layout = load_layout(dataset)
+    assert not (dataset / INDEX_CACHE_NAME).exists()
+    assert bids.get_functionals(layout)["01"]["2"]["rest01"][0].filename == "sub-01_ses-2_task-rest_run-01_bold.nii.gz"
+    assert sorted(bids.load_index(layout).ids("session", subject="01")) == ["1", "2"]
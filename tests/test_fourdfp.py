@@ -0,0 +1,79 @@
+import os
+from pathlib import Path
+import numpy as np
+import nibabel as nib
+import pytest
+from me_pipeline.io.fourdfp import *
+from me_pipeline.io.geometry import *
+
+
+EYES_333 = Path(__file__).resolve().parent.parent / "tools" / "refdir_extras" / "eyes_333z_not.4dfp.img"
+
+
+def test_fourdfp_paths():
+    for name in ("sub.4dfp.img", "sub.4dfp.ifh", "sub.4dfp.img.rec", "sub.4dfp", "sub"):
+        paths = fourdfp_paths(Path("dir") / name)
+        assert paths["img"] == Path("dir/sub.4dfp.img")
+        assert paths["rec"] == Path("dir/sub.4dfp.img.rec")
+
+
+def test_read_ifh():
+    ifh = read_ifh(EYES_333)
+    assert ifh.shape == (48, 64, 48, 1)
+    assert ifh.scaling_factor == [3.0, 3.0, 3.0]
+    assert ifh.byte_order == "bigendian"
+    assert ifh.dtype == np.dtype(">f4")
+    assert ifh.orientation == 2
+    assert ifh.mmppix == [3.0, -3.0, -3.0]
+    assert ifh.center == [73.5, -87.0, -84.0]
+
+
+def test_load_4dfp():
+    img = load_4dfp(EYES_333)
+    data = np.fromfile(EYES_333, dtype=">f4").reshape(img.shape, order="F")
+    assert isinstance(img.data, np.memmap)
+    assert np.array_equal(img.frame(0), data[..., 0])
+    assert np.array_equal(img.slice(10, 0), data[:, :, 10, 0])
+    assert img.as_2d().shape == (48 * 64 * 48, 1)
+
+
+def test_save_4dfp(tmp_path):
+    ifh = read_ifh(EYES_333)
+    data = np.random.default_rng(0).random((48, 64, 48, 3)).astype(np.float32)
+    save_4dfp(tmp_path / "out.4dfp.img", data, ifh, display_range=(0.0, 2000.0), rec_parents=[EYES_333])
+
+    # header, data and rec should all round trip
+    img = load_4dfp(tmp_path / "out")
+    assert img.ifh.shape == (48, 64, 48, 3)
+    assert img.ifh.center == ifh.center
+    assert img.ifh.name_of_data_file == "out.4dfp.img"
+    assert np.array_equal(img.data, data)
+    hdr = nib.AnalyzeHeader.from_fileobj(open(tmp_path / "out.4dfp.hdr", "rb"))
+    assert hdr.endianness == ">"
+    assert list(hdr["dim"][:5]) == [4, 48, 64, 48, 3]
+    assert hdr["glmax"] == 2000
+    rec = (tmp_path / "out.4dfp.img.rec").read_text()
+    assert rec.startswith("rec ") and rec.strip().splitlines()[-1].startswith("endrec")
+
+
+def test_read_geometry():
+    geometry = read_geometry(EYES_333)
+    assert geometry.dims == (48, 64, 48, 1)
+    assert geometry.pixdims == (3.0, 3.0, 3.0, 1.0)
+    # the first voxel sits at mmppix - center
+    assert np.allclose(geometry.affine @ [0, 0, 0, 1], [-70.5, 84.0, 81.0, 1])
+    assert read_geometry(EYES_333) is geometry
+
+
+def test_check_geometries(tmp_path):
+    ifh = read_ifh(EYES_333)
+    data = np.zeros((48, 64, 48, 2), dtype=np.float32)
+    save_4dfp(tmp_path / "echo1", data, ifh)
+    save_4dfp(tmp_path / "echo2", data, ifh)
+    assert check_geometries([tmp_path / "echo1.4dfp.img", tmp_path / "echo2.4dfp.img"]).n_frames == 2
+
+    # rewriting a header invalidates its cached geometry
+    save_4dfp(tmp_path / "echo2", data[..., :1], ifh)
+    os.utime(tmp_path / "echo2.4dfp.ifh", ns=(0, 0))
+    with pytest.raises(ValueError):
+        check_geometries([tmp_path / "echo1.4dfp.img", tmp_path / "echo2.4dfp.img"])
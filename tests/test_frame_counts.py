@@ -0,0 +1,79 @@
+import json
+import os
+from types import SimpleNamespace
+import nibabel as nib
+import numpy as np
+import pytest
+from me_pipeline.frame_counts import *
+from me_pipeline.params import RunsMap
+
+
+def write_image(path, shape, image_class=nib.Nifti1Image):
+    nib.save(image_class(np.zeros(shape, dtype=np.int16), np.eye(4)), str(path))
+    return path
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    clear_cache()
+    yield
+    clear_cache()
+
+
+def test_read_header_frames(tmp_path):
+    for name, shape, image_class in [
+        ("a.nii.gz", (4, 5, 6, 7), nib.Nifti1Image),
+        ("b.nii", (4, 5, 6, 60), nib.Nifti1Image),
+        ("c.nii.gz", (4, 5, 6, 9), nib.Nifti2Image),
+        ("d.nii.gz", (4, 5, 6), nib.Nifti1Image),
+    ]:
+        path = write_image(tmp_path / name, shape, image_class)
+        expected = shape[3] if len(shape) > 3 else 1
+        assert read_header_frames(path) == expected
+        assert count_frames(path) == expected
+
+    # big endian headers
+    header = nib.Nifti1Header(endianness=">")
+    header.set_data_shape((2, 2, 2, 3))
+    (tmp_path / "e.nii").write_bytes(header.binaryblock)
+    assert read_header_frames(tmp_path / "e.nii") == 3
+
+
+def test_sidecar_fallback(tmp_path):
+    path = tmp_path / "sub-01_task-rest_bold.nii.gz"
+    path.write_bytes(b"not a nifti file")
+    with pytest.raises(ValueError):
+        count_frames(path)
+    (tmp_path / "sub-01_task-rest_bold.json").write_text(json.dumps({"dcmmeta_shape": [4, 5, 6, 120]}))
+    assert count_frames(path) == 120
+
+
+def test_count_frames_cache(tmp_path):
+    path = write_image(tmp_path / "a.nii.gz", (2, 2, 2, 5))
+    assert count_frames(path) == 5
+    # an unchanged file is not read again
+    stat = os.stat(path)
+    path.write_bytes(b"x" * stat.st_size)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert count_frames(path) == 5
+    # a modified file is
+    write_image(path, (2, 2, 2, 8))
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert count_frames(path) == 8
+
+
+def test_runs_map_min_frames(tmp_path):
+    def bids_file(name, frames):
+        path = write_image(tmp_path / name, (2, 2, 2, frames))
+        return SimpleNamespace(path=str(path), filename=name)
+
+    func_runs = {
+        run: [bids_file(f"{run}_echo-1_part-{part}_bold.nii.gz", frames) for part in ["mag", "phase"]]
+        for run, frames in [("rest01", 60), ("rest02", 20)]
+    }
+    fieldmaps = {"rest01": ["ap", "pa"], "rest02": ["ap", "pa"]}
+    frames = count_frames_all(f.path for files in func_runs.values() for f in files)
+    assert sorted(frames.values()) == [20, 20, 60, 60]
+    runs_map = RunsMap(func_runs, fieldmaps, min_frames=50)
+    assert list(runs_map.runs) == ["rest01"]
+    assert runs_map.runs_dict["mag"] == {1: [func_runs["rest01"][0].path]}
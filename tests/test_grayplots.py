@@ -0,0 +1,54 @@
+import numpy as np
+from me_pipeline.grayplots.grayplot_batch import *
+from me_pipeline.grayplots.grayplot_data import *
+from me_pipeline.grayplots.grayplot_helpers import demean, get_timecourse
+
+
+def test_tissue_timecourses(tmp_path):
+    rng = np.random.default_rng(0)
+    functional = rng.normal(1000, 50, size=(500, 30)).astype(">f4")
+    path = tmp_path / "func.img"
+    functional.T.tofile(path)
+    # a memmap in the layout read_image_4dfp gives
+    functional_image = np.memmap(path, dtype=">f4", mode="r", shape=(500, 30), order="F")
+    masks = {"gray": rng.random((500, 1)) > 0.5, "csf": rng.random((500, 1)) > 0.9}
+
+    # the same rows as the old demean/get_timecourse path, read a few frames at a time
+    rows = {name: select_rows(mask_rows(mask), step=3) for name, mask in masks.items()}
+    timecourses = tissue_timecourses(functional_image, rows, chunk_frames=7)
+    for name, mask in masks.items():
+        expected = get_timecourse(demean(functional.astype(np.float64)), mask)[::3]
+        assert timecourses[name].dtype == np.float32
+        assert np.allclose(timecourses[name], expected, atol=1e-3)
+
+
+def test_select_rows():
+    rows = np.arange(0, 1000, 2)
+    assert np.array_equal(select_rows(rows, step=10), rows[::10])
+    thinned = select_rows(rows, step=1, max_rows=100)
+    assert len(thinned) == 100
+    assert thinned[0] == rows[0] and thinned[-1] == rows[-1]
+    assert np.all(np.diff(thinned) > 0)
+
+
+def test_find_grayplot_runs(tmp_path):
+    session = tmp_path / "sub-01" / "ses-01"
+    for run in ("1", "2"):
+        (session / f"bold{run}").mkdir(parents=True)
+        (session / f"bold{run}" / f"sub01_b{run}_faln_xr3d_uwrp_on_MNI152_2mm_Swgt_norm.4dfp.img").touch()
+        (session / f"bold{run}" / f"sub01_b{run}.params").write_text(f"set TR_vol = {run}.5\nset runID = (1 2)\n")
+    (session / "atlas").mkdir()
+    (session / "atlas" / "sub01day1_GM_on_MNI152_2mm.4dfp.img").touch()
+
+    assert find_sessions(tmp_path) == [session]
+    runs = find_grayplot_runs(session)
+    assert [(run.run, run.tr, run.day1_patid, run.outspace) for run in runs] == [
+        ("1", 1.5, "sub01day1", "MNI152_2mm"),
+        ("2", 2.5, "sub01day1", "MNI152_2mm"),
+    ]
+    # all runs of the session share their masks
+    assert runs[0].mask_key == runs[1].mask_key
+    assert runs[0].mask_names["csf"].name == "sub01day1_VENT_on_MNI152_2mm.4dfp.img"
+    assert runs[0].rdat_name == session / "movement" / "sub01_b1_xr3d.rdat"
+    assert runs[1].output_name.name == "sub01_b2_faln_xr3d_uwrp_on_MNI152_2mm_Swgt_norm_grayplots.pdf"
+    assert find_grayplot_runs(session, outspace="711-2B_333") == []
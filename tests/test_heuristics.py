@@ -0,0 +1,60 @@
+from collections import namedtuple
+import pytest
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian
+from me_pipeline.heuristics import *
+
+SeqInfo = namedtuple("SeqInfo", ["series_uid", "series_id", "series_description", "series_files", "image_type"])
+
+IMAGE_TYPE = ["ORIGINAL", "PRIMARY", "M", "MB", "TE2", "NORM", "ND", "MOSAIC"]
+
+
+def enhanced_dicom(series_uid, frames=3):
+    dcmdata = Dataset()
+    dcmdata.file_meta = FileMetaDataset()
+    dcmdata.file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.4.1"  # Enhanced MR Image Storage
+    dcmdata.file_meta.MediaStorageSOPInstanceUID = f"{series_uid}.1"
+    dcmdata.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dcmdata.preamble = b"\0" * 128
+    dcmdata.SeriesInstanceUID = series_uid
+    items = []
+    for _ in range(frames):
+        modifier, image = Dataset(), Dataset()
+        modifier.add_new((0x0021, 0x1177), "LO", "epfid2d1_72")
+        image.add_new((0x0021, 0x1175), "CS", IMAGE_TYPE)
+        frame = Dataset()
+        frame.add_new((0x0018, 0x9226), "SQ", Sequence([modifier]))
+        frame.add_new((0x0021, 0x11FE), "SQ", Sequence([image]))
+        items.append(frame)
+    dcmdata.add_new((0x5200, 0x9230), "SQ", Sequence(items))
+    return dcmdata
+
+
+@pytest.fixture(autouse=True)
+def empty_metadata():
+    EXTRA_METADATA.clear()
+    yield
+    EXTRA_METADATA.clear()
+
+
+def test_filter_dicom(tmp_path):
+    # only the fields infotodict needs are kept
+    assert filter_dicom(enhanced_dicom("1.2.3")) is False
+    assert EXTRA_METADATA == {"1.2.3": EnhancedMetadata("epfid2d1_72", tuple(IMAGE_TYPE))}
+
+    # dicoms without the metadata aren't recorded
+    dcmdata = enhanced_dicom("1.2.4")
+    del dcmdata[0x5200, 0x9230]
+    assert filter_dicom(dcmdata) is False and "1.2.4" not in EXTRA_METADATA
+
+    # dicoms can be read from a path
+    dcmdata = enhanced_dicom("1.2.5")
+    dcmdata.save_as(tmp_path / "enhanced.dcm")
+    assert filter_dicom(tmp_path / "enhanced.dcm") is False
+    assert EXTRA_METADATA["1.2.5"].image_type == tuple(IMAGE_TYPE)
+
+    # infotodict sorts series with the metadata
+    seqinfo = [SeqInfo("1.2.3", "7-rest", "rest_ep2d_bold_ME", 400, ())]
+    info = infotodict(seqinfo)
+    assert [items for items in info.values() if items] == [[{"item": "7-rest", "part": "mag"}]]
@@ -0,0 +1,64 @@
+import pytest
+from me_pipeline.job_queue import *
+from me_pipeline.scheduler import QUEUED
+from .test_scheduler import fail_callback, make_job
+
+
+def test_job_queue_claim_and_retry(tmp_path):
+    queue = JobQueue(tmp_path / "queue")
+    jobs = [make_job(tmp_path, "sub-01/A", "exit 1"), make_job(tmp_path, "sub-01/B", "true")]
+    jobs[1].after = ["sub-01/A"]
+    results = queue.submit(jobs, retries=1)
+    assert [result.status for result in results] == [QUEUED, QUEUED]
+    assert job_id("sub-01/A") == "sub-01__A"
+
+    # B waits for A, and A goes back to pending until it ran retries + 1 times
+    record, job = queue.claim()
+    assert job.name == "sub-01/A" and queue.claim() is None
+    assert queue.finish(record, JobResult(job.name, FAILED, 1, 0.1, job.log_file)) == PENDING
+    record, job = queue.claim()
+    assert record["attempts"] == 2
+    assert queue.finish(record, JobResult(job.name, FAILED, 1, 0.1, job.log_file)) == FAILED
+
+    # B is skipped since A failed, requeue puts both back
+    assert queue.claim() is None
+    assert [result.status for result in queue.results()] == [FAILED, SKIPPED]
+    assert "1 failed" in format_status(queue) and "sub-01/A" in format_status(queue)
+    assert sorted(queue.requeue()) == ["sub-01/A", "sub-01/B"]
+    assert [result.status for result in queue.results(["sub-01/B", "sub-01/A"])] == [QUEUED, QUEUED]
+
+
+def test_queue_worker(tmp_path):
+    jobs = [
+        make_job(tmp_path, "a", "sleep 0.2; touch a"),
+        make_job(tmp_path, "b", "test -e a && touch b"),
+        make_job(tmp_path, "c", "exit 1"),
+        make_job(tmp_path, "d", "touch d"),
+    ]
+    jobs[1].after = ["a"]
+    jobs[3].after = ["c"]
+    executor = make_executor("queue", queue_dir=tmp_path / "queue")
+    assert [result.status for result in executor.run(jobs)] == [QUEUED] * 4
+    assert not (tmp_path / "a").exists()
+
+    results = QueueWorker(JobQueue(tmp_path / "queue"), max_jobs=2, poll_interval=0.05).run()
+    assert sorted(result.name for result in results) == ["a", "b", "c"]
+    statuses = [result.status for result in JobQueue(tmp_path / "queue").results([job.name for job in jobs])]
+    assert statuses == [SUCCEEDED, SUCCEEDED, FAILED, SKIPPED]
+    assert (tmp_path / "b").exists() and not (tmp_path / "d").exists()
+
+    # a callback that fails doesn't kill the worker or leave the job running
+    job = make_job(tmp_path, "e", "true")
+    job.on_success = fail_callback
+    JobQueue(tmp_path / "queue").submit([job])
+    results = QueueWorker(JobQueue(tmp_path / "queue"), poll_interval=0.05).run()
+    assert [result.status for result in results] == [SUCCEEDED]
+    assert not JobQueue(tmp_path / "queue").records(RUNNING)
+
+
+def test_make_executor(tmp_path):
+    assert isinstance(make_executor("local", max_jobs=2), LocalExecutor)
+    with pytest.raises(ValueError):
+        make_executor("queue")
+    with pytest.raises(ValueError):
+        make_executor("slurm", queue_dir=tmp_path)
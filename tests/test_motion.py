@@ -0,0 +1,62 @@
+import numpy as np
+import scipy.signal
+from me_pipeline.grayplots.grayplot_helpers import dat_calculations, filter_movement_frequency
+from me_pipeline.motion import *
+
+
+def write_dat(path, n_frames, seed):
+    rng = np.random.default_rng(seed)
+    params = np.cumsum(rng.normal(scale=0.05, size=(n_frames, 6)), axis=0)
+    frames = np.arange(1, n_frames + 1)[:, np.newaxis]
+    np.savetxt(path, np.hstack([frames, params]), fmt="%.6f", header="frame dx dy dz X Y Z")
+    return path
+
+
+def test_read_dat(tmp_path):
+    dat = write_dat(tmp_path / "run.rdat", 10, 0)
+    raw = np.loadtxt(dat)
+    mvm = read_dat(dat, radius=50)
+    assert mvm.shape == (10, 6)
+    assert np.allclose(mvm[:, :3], raw[:, 1:4], atol=1e-4)
+    assert np.allclose(mvm[:, 3:], raw[:, 4:7] * 2 * 50 * np.pi / 360, atol=1e-4)
+    assert np.array_equal(dat_calculations(dat), mvm)
+
+
+def test_filter_movement_frequency(tmp_path):
+    # the same as filtering, transforming and differencing one column at a time
+    mvm = read_dat(write_dat(tmp_path / "run.rdat", 50, 1))
+    b, a = scipy.signal.butter(1, 0.1 / (0.5 / 2.0), "low")
+    columns = [scipy.signal.filtfilt(b, a, mvm[:, col]) for col in range(6)]
+    expected_fft = np.stack([np.fft.fft(column) for column in columns], axis=1)
+    expected_fd = np.insert(np.sum(np.abs(np.diff(np.stack(columns, axis=1), axis=0)), axis=1), 0, 0)
+    mvm_filt_fft, fd_filt = filter_movement_frequency(mvm, 2.0)
+    assert np.allclose(mvm_filt_fft, expected_fft)
+    assert fd_filt.shape == (1, 50)
+    assert np.allclose(fd_filt[0], expected_fd)
+    assert lowpass_coefficients(2.0) is lowpass_coefficients(2.0)
+
+
+def test_amplitude_spectrum():
+    # a unit sine at a bin frequency has an amplitude of 1 in that bin
+    t = np.arange(64)
+    mvm = np.repeat(np.sin(2 * np.pi * 8 * t / 64)[:, np.newaxis], 6, axis=1)
+    spectrum = amplitude_spectrum(mvm)
+    assert spectrum.shape == (33, 6)
+    assert np.allclose(spectrum[8], 1)
+    assert np.isclose(spectrum_frequencies(64, 2.0)[8], 8 / 128)
+
+
+def test_motion_qc_table(tmp_path):
+    runs = [
+        MotionRun(f"run{n}", write_dat(tmp_path / f"run{n}.rdat", n_frames, n), tr)
+        for n, (n_frames, tr) in enumerate([(40, 2.0), (40, 2.0), (30, 1.5)])
+    ]
+    table = motion_qc_table(runs)
+    assert [row["name"] for row in table] == ["run0", "run1", "run2"]
+    # batched results match running each run on its own
+    for run, row in zip(runs, table):
+        (single,) = motion_qc_table([run])
+        assert single == row
+        assert np.isclose(row["fd_mean"], framewise_displacement(read_dat(run.rdat)).mean())
+    write_qc_table(table, tmp_path / "motion.tsv")
+    assert (tmp_path / "motion.tsv").read_text().splitlines()[0].split("\t")[0] == "name"
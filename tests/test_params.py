@@ -0,0 +1,27 @@
+import threading
+from me_pipeline.params import Instructions
+
+
+def test_save_params_atomic(tmp_path):
+    # sources of the file while other threads save it always read a whole file
+    path = tmp_path / "instructions.params"
+    Instructions().save_params(path)
+    expected = len(path.read_text().splitlines())
+    stop = threading.Event()
+
+    def save(num_cpus):
+        instructions = Instructions(num_cpus=num_cpus)
+        while not stop.is_set():
+            instructions.save_params(path)
+
+    threads = [threading.Thread(target=save, args=(n,)) for n in (2, 4)]
+    for thread in threads:
+        thread.start()
+    try:
+        for _ in range(200):
+            assert len(path.read_text().splitlines()) == expected
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    assert [p.name for p in tmp_path.iterdir()] == ["instructions.params"]
@@ -0,0 +1,70 @@
+import json
+import nibabel as nib
+from me_pipeline.frame_counts import image_shape
+from me_pipeline.planner import *
+from me_pipeline.profiles import PROFILE_DB_NAME, ProfileDB, ResourceUsage
+from me_pipeline.stages import FUNCTIONAL_STAGES
+from .test_frame_counts import write_image
+from .test_stages import GRAPH, params_files, record, workdir  # noqa: F401
+
+
+def write_runs(tmp_path):
+    mag = {1: [write_image(tmp_path / f"run1_e{echo}.nii.gz", (10, 10, 5, 20)) for echo in (1, 2)]}
+    phase = {1: [write_image(tmp_path / f"run1_e{echo}_ph.nii.gz", (10, 10, 5, 20)) for echo in (1, 2)]}
+    mag[2] = phase[2] = [write_image(tmp_path / "run2.nii", (10, 10, 5, 8), nib.Nifti2Image)]
+    return {"mag": mag, "phase": phase}
+
+
+def test_describe_runs(tmp_path):
+    runs = describe_runs(write_runs(tmp_path))
+    assert runs[0] == {"run": 1, "echoes": 2, "phase": True, "frames": 20, "matrix": [10, 10, 5], "voxel_frames": 20000}
+    assert runs[1] == {"run": 2, "echoes": 1, "phase": False, "frames": 8, "matrix": [10, 10, 5], "voxel_frames": 4000}
+
+    # shapes fall back to the sidecar, and are unknown without one
+    (tmp_path / "run3.nii.gz").write_bytes(b"not an image")
+    assert image_shape(tmp_path / "run3.nii.gz") is None
+    (tmp_path / "run3.json").write_text(json.dumps({"dcmmeta_shape": [10, 10, 5, 30]}))
+    assert image_shape(tmp_path / "run3.nii.gz") == (10, 10, 5, 30)
+    images = describe_images([tmp_path / "run3.nii.gz"])
+    assert images == [{"file": str(tmp_path / "run3.nii.gz"), "matrix": [10, 10, 5]}]
+
+
+def test_plan_job(tmp_path):
+    runs = describe_runs(write_runs(tmp_path))
+    profiles = ProfileDB(tmp_path / PROFILE_DB_NAME)
+    start = FUNCTIONAL_STAGES.names[1]
+    plan = plan_job("sub-01_ses-1", FUNCTIONAL_STAGES, tmp_path, [], runs, 10.0, profiles, start=start)
+    assert plan.stages == FUNCTIONAL_STAGES.names[1:] and plan.skipped == FUNCTIONAL_STAGES.names[:1]
+
+    # without profiles, the estimate comes from the voxel-frames of the runs
+    assert plan.estimate == model_estimate("functional", runs)
+    assert plan.estimate.cpu_hours == FUNCTIONAL_CPU_HOURS_PER_GVOX * 24000 / 1e9 and plan.notes
+
+    # with a profile of the job, from the profile (scaled to the size of the dataset)
+    profiles.record(FUNCTIONAL_STAGES.profile(start), 5.0, ResourceUsage(1024.0, 1800.0, 60.0))
+    plan = plan_job("sub-01_ses-1", FUNCTIONAL_STAGES, tmp_path, [], runs, 10.0, profiles, start=start)
+    assert plan.estimate.source == "profile" and plan.estimate.cpu_hours == 1.0
+    assert plan.estimate.peak_ram_gb == 2.0 * 1.2 and not plan.notes
+
+    # totals add up the CPU time, and the memory and disk of the jobs that run at once
+    other = plan_job("sub-02_ses-1", FUNCTIONAL_STAGES, tmp_path, [], runs, 10.0, start=start)
+    totals = plan_totals([plan, other], jobs=2)
+    assert totals["jobs"] == totals["jobs_to_run"] == 2 and totals["runs"] == 4 and totals["frames"] == 56
+    assert totals["cpu_hours"] == plan.estimate.cpu_hours + other.estimate.cpu_hours
+    assert totals["peak_ram_gb"] == plan.estimate.peak_ram_gb + other.estimate.peak_ram_gb
+    assert plan_totals([plan, other])["peak_ram_gb"] == plan.estimate.peak_ram_gb
+    assert "2 echoes + phase, 20 frames, 10x10x5" in format_plan([plan, other])
+    write_plan([plan, other], tmp_path / "plan.json", jobs=2)
+    assert json.loads((tmp_path / "plan.json").read_text())["totals"] == totals
+
+
+def test_plan_stage_graph(workdir):
+    # stages that are up to date are skipped
+    (workdir / "out").mkdir()
+    (workdir / "out" / "A.txt").touch()
+    record(workdir, "ABC")
+    plan = plan_job("sub-01", GRAPH, workdir, params_files(workdir), [], stage_graph=True)
+    assert plan.stages == ["D", "E"] and plan.skipped == ["A", "B", "C"]
+    record(workdir, "DE")
+    plan = plan_job("sub-01", GRAPH, workdir, params_files(workdir), [], stage_graph=True)
+    assert plan.stages == [] and plan.estimate.source == "none" and "nothing (up to date)" in format_plan([plan])
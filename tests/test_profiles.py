@@ -0,0 +1,54 @@
+import multiprocessing
+from me_pipeline.profiles import *
+from me_pipeline.scheduler import SUCCEEDED, JobScheduler, format_summary
+from me_pipeline.job_queue import JobQueue, QueueWorker
+from .test_scheduler import make_job
+
+
+def test_profile_estimates(tmp_path):
+    profiles = ProfileDB(tmp_path / PROFILE_DB_NAME)
+    assert profiles.estimate("functional/FMRI_PP") is None
+    profiles.record("functional/FMRI_PP", 100.0, ResourceUsage(1000.0, 60.0, 30.0))
+    profiles.record("functional/FMRI_PP", 200.0, ResourceUsage(1500.0, 60.0, 30.0))
+    # each sample is scaled to the size of the dataset, the largest one is padded
+    assert profiles.estimate("functional/FMRI_PP", 400.0) == 4000.0 * MEMORY_MARGIN
+    assert profiles.estimate("functional/FMRI_PP") == 1500.0 * MEMORY_MARGIN
+    for _ in range(MAX_SAMPLES):
+        profiles.record("functional/FMRI_PP", 100.0, ResourceUsage(10.0, 1.0, 1.0))
+    assert len(profiles.samples("functional/FMRI_PP")) == MAX_SAMPLES
+    assert profiles.estimate("functional/FMRI_PP", 100.0) == 10.0 * MEMORY_MARGIN
+    assert dataset_size([tmp_path / PROFILE_DB_NAME, tmp_path / "missing"]) > 0
+
+
+def record_sample(path):
+    ProfileDB(path).record("functional/FMRI_PP", 1.0, ResourceUsage(1.0, 1.0, 1.0))
+
+
+def test_profile_concurrent_record(tmp_path):
+    # workers sharing a database keep each other's samples
+    with multiprocessing.get_context("fork").Pool(5) as pool:
+        pool.map(record_sample, [tmp_path / "db" / PROFILE_DB_NAME] * 20)
+    assert len(ProfileDB(tmp_path / "db" / PROFILE_DB_NAME).samples("functional/FMRI_PP")) == 20
+
+
+def test_memory_admission(tmp_path):
+    profiles = ProfileDB(tmp_path / PROFILE_DB_NAME)
+    profiles.record("big", 1.0, ResourceUsage(100.0, 1.0, 1.0))
+    # fails if another job is running at the same time
+    script = "test ! -e running && touch running && sleep 0.2 && rm running"
+    jobs = [make_job(tmp_path, f"job{n}", script) for n in range(3)]
+    for job in jobs:
+        job.profile, job.size = "big", 1.0
+    results = JobScheduler(max_jobs=3, fail_fast=False, memory_budget=150.0, profiles=profiles).run(jobs)
+    assert [result.status for result in results] == [SUCCEEDED] * 3
+
+    # the resources of each job are measured and recorded
+    assert all(result.usage is not None and result.usage.peak_rss > 0 for result in results)
+    assert len(profiles.samples("big")) == 4 and "peak memory" in format_summary(results)
+
+    # workers of a queue admit jobs the same way
+    JobQueue(tmp_path / "queue").submit(jobs)
+    results = QueueWorker(
+        JobQueue(tmp_path / "queue"), max_jobs=3, poll_interval=0.05, memory_budget=150.0, profiles=profiles
+    ).run()
+    assert [result.status for result in results] == [SUCCEEDED] * 3
@@ -0,0 +1,360 @@
+import os
+import shutil
+from pathlib import Path
+import threading
+import time
+import numpy as np
+import nibabel as nib
+import pytest
+from me_pipeline.io.fourdfp import IFH, load_4dfp, save_4dfp
+from me_pipeline.resampling.assemble import FrameAssembler
+from me_pipeline.resampling.benchmark import _fourdfp_to_nifti, _nifti_to_fourdfp, make_synthetic_run, write_stubs
+from me_pipeline.resampling.engine import *
+from me_pipeline.resampling.executors import *
+from me_pipeline.resampling.native import *
+from me_pipeline.resampling.shiftmap import *
+from me_pipeline.resampling.transforms import *
+
+
+SHAPE = (20, 24, 16)
+EYES_333 = Path(__file__).resolve().parent.parent / "tools" / "refdir_extras" / "eyes_333z_not.4dfp.img"
+
+
+@pytest.fixture
+def resampler():
+    affine = np.diag([-3.0, 3.0, 3.0, 1.0])
+    epi = nib.Nifti1Image(np.zeros((*SHAPE, 3), dtype=np.float32), affine)
+    ref = nib.Nifti1Image(np.zeros(SHAPE, dtype=np.float32), affine)
+    return FramewiseResampler(ref, epi, 0.0005, "y-", postmat=np.eye(4))
+
+
+def test_parse_ped():
+    assert parse_ped("x") == (0, 1.0)
+    assert parse_ped("y-") == (1, -1.0)
+    with pytest.raises(ValueError):
+        parse_ped("w")
+
+
+def test_shift_map():
+    # 100 Hz field map with 0.5 ms dwell over 24 phase encoding lines shifts 1.2 voxels
+    fmap = np.full(SHAPE, 2 * np.pi * 100, dtype=np.float32)
+    assert np.allclose(shift_map(fmap, 0.0005, "y"), 1.2)
+
+
+def test_write_shift_maps(tmp_path):
+    # chunked output should match the per frame computation for every frame
+    fmap = np.random.default_rng(0).random((*SHAPE, 5)).astype(np.float32)
+    nib.Nifti1Image(fmap, np.eye(4)).to_filename(str(tmp_path / "fmap.nii"))
+    assert write_shift_maps(tmp_path / "fmap.nii", 0.0005, "y-", tmp_path / "fmap", chunk_size=2, scale=2 * np.pi) == 5
+    for i in range(5):
+        shift = nib.load(str(tmp_path / f"fmap_shift_{i:04d}.nii")).get_fdata()
+        assert np.allclose(shift, shift_map(fmap[..., i] * 2 * np.pi, 0.0005, "y"), atol=1e-5)
+        assert (tmp_path / f"fmap_{i:04d}.nii").exists()
+
+    # the maps of a range of frames can be written on their own
+    maps = write_frame_shift_maps(tmp_path / "fmap.nii", 2, 4, 0.0005, "y-", tmp_path / "task", scale=2 * np.pi)
+    assert maps == [(f"{tmp_path}/task_{i:04d}.nii", f"{tmp_path}/task_shift_{i:04d}.nii") for i in (2, 3)]
+    for i, (_, shift) in zip((2, 3), maps):
+        assert np.allclose(nib.load(shift).get_fdata(), shift_map(fmap[..., i] * 2 * np.pi, 0.0005, "y"), atol=1e-5)
+
+
+def test_multiply_defined():
+    image = np.array([1.0, 2.0, UNDEFINED], dtype=np.float32)
+    factor = np.array([2.0, UNDEFINED, 2.0], dtype=np.float32)
+    assert np.array_equal(multiply_defined(image, factor), np.array([2.0, 0.0, 0.0], dtype=np.float32))
+    image = np.array([1.0, np.nan, UNDEFINED], dtype=np.float32)
+    assert np.array_equal(zero_undefined(image), np.array([1.0, 0.0, 0.0], dtype=np.float32))
+
+
+def test_resample_frame_identity(resampler):
+    # with no motion, field map or bias the frame should come back unchanged
+    frame = np.random.default_rng(0).random(SHAPE).astype(np.float32) + 1
+    (out,) = resampler.resample_frame([frame], np.zeros(SHAPE, dtype=np.float32), np.eye(4))
+    assert np.allclose(out, frame, atol=1e-5)
+
+    # voxels mapped from outside the field of view are 0, as imgopr_4dfp -z writes them
+    shift = np.eye(4)
+    shift[0, 3] = 9.0
+    (out,) = resampler.resample_frame([frame], np.zeros(SHAPE, dtype=np.float32), shift)
+    assert np.all(out[:3] == 0) and np.all(out[3:] > 0)
+
+
+def test_resample_frame_shift(resampler):
+    # a uniform field map shifts the image along the phase encoding axis
+    frame = np.zeros(SHAPE, dtype=np.float32)
+    frame[:, 12, :] = 1
+    fmap = np.full(SHAPE, 2 * np.pi * 100 / 1.2, dtype=np.float32)
+    (out,) = resampler.resample_frame([frame], fmap, np.eye(4))
+    assert np.argmax(out[10, :, 8]) == 13
+
+
+def test_frame_assembler(tmp_path):
+    # frames arriving out of order are bias corrected into place, undefined voxels are set to 0
+    ifh = IFH(matrix_size=[*SHAPE, 1], scaling_factor=[3.0, 3.0, 3.0])
+    rng = np.random.default_rng(0)
+    frames = rng.random((*SHAPE, 3)).astype(np.float32) + 1
+    frames[0, 0, 0, 1] = UNDEFINED
+    bias = rng.random((*SHAPE, 3)).astype(np.float32)
+    for i in range(3):
+        save_4dfp(tmp_path / f"frame{i}", frames[..., i], ifh)
+        save_4dfp(tmp_path / f"bias{i}", bias[..., i], ifh)
+    assembler = FrameAssembler([tmp_path / "out"], 3, [tmp_path / f"bias{i}" for i in range(3)], remove_frames=True)
+    for i in (2, 0, 1):
+        assembler.add_frame(i, [tmp_path / f"frame{i}"])
+    assembler.close()
+    out = load_4dfp(tmp_path / "out").data
+    assert np.allclose(out[1:, ...], (frames * bias)[1:, ...])
+    assert out[0, 0, 0, 1] == 0
+    assert not (tmp_path / "frame0.4dfp.img").exists()
+
+
+def test_frame_assembler_undefined(tmp_path):
+    # voxels undefined in the frame or the bias are written as 0 (imgopr_4dfp -z), with or without a bias
+    ifh = IFH(matrix_size=[*SHAPE, 1], scaling_factor=[3.0, 3.0, 3.0])
+    frame = np.full(SHAPE, 2.0, dtype=np.float32)
+    frame[0, 0, 0], frame[1, 0, 0] = UNDEFINED, np.nan
+    bias = np.full(SHAPE, 3.0, dtype=np.float32)
+    bias[2, 0, 0] = UNDEFINED
+    save_4dfp(tmp_path / "frame", frame, ifh)
+    save_4dfp(tmp_path / "bias", bias, ifh)
+    for name, bias_frames, value in [("out", [tmp_path / "bias"], 6.0), ("nobias", None, 2.0)]:
+        assembler = FrameAssembler([tmp_path / name], 1, bias_frames)
+        assembler.add_frame(0, [tmp_path / "frame"])
+        assembler.close()
+        out = load_4dfp(tmp_path / name).data[..., 0]
+        undefined = np.zeros(SHAPE, dtype=bool)
+        undefined[0, 0, 0] = undefined[1, 0, 0] = True
+        undefined[2, 0, 0] = bias_frames is not None
+        assert np.all(out[undefined] == 0) and np.all(out[~undefined] == value)
+
+
+def test_fourdfp_layout(tmp_path, monkeypatch):
+    # frames written with the layout match what nifti_4dfp -4 makes of them
+    write_stubs(tmp_path / "bin", tools=["nifti_4dfp"], force=True)
+    monkeypatch.setenv("PATH", f"{tmp_path / 'bin'}:{os.environ['PATH']}")
+    ifh = IFH(matrix_size=[*SHAPE, 1], scaling_factor=[3.0, 3.0, 3.0], mmppix=[3.0, -3.0, -3.0], center=[30, -36, -24])
+    save_4dfp(tmp_path / "ref", np.zeros(SHAPE, dtype=np.float32), ifh)
+    _fourdfp_to_nifti(tmp_path / "ref", tmp_path / "ref")
+    ref_img = nib.load(str(tmp_path / "ref.nii"))
+    layout_ifh, order = fourdfp_layout(ref_img, tmp_path)
+    assert layout_ifh.mmppix == ifh.mmppix and layout_ifh.center == ifh.center
+    frame = np.random.default_rng(0).random(SHAPE).astype(np.float32)
+    nib.Nifti1Image(frame, ref_img.affine).to_filename(str(tmp_path / "frame.nii"))
+    _nifti_to_fourdfp(tmp_path / "frame.nii", tmp_path / "frame")
+    written = frame.ravel(order="F")[order].reshape(SHAPE, order="F")
+    assert np.array_equal(written, load_4dfp(tmp_path / "frame").frame(0))
+    assert not list(tmp_path.glob("voxel_indices*"))
+
+
+def stubbed_run(tmp_path, monkeypatch, n_frames=4):
+    # a synthetic run, with stubs for the 4dfp tools
+    write_stubs(tmp_path / "bin", tools=["nifti_4dfp"], force=True)
+    monkeypatch.setenv("PATH", f"{tmp_path / 'bin'}:{os.environ['PATH']}")
+    return make_synthetic_run(tmp_path / "run", n_frames=n_frames, n_echoes=2, matrix=(12, 14, 10))
+
+
+def resample_run(run, tmp_path, executor, postmat=None):
+    outputs = [str(epi).replace(".4dfp.img", "_out.4dfp.img") for epi in run.epis]
+    (tmp_path / "tmp").mkdir(exist_ok=True)
+    native_resampling(
+        run.epis,
+        outputs,
+        run.ref,
+        run.phase,
+        run.xr3dmat,
+        run.dwell,
+        run.ped,
+        run.n_frames,
+        tmp_path / "tmp",
+        executor,
+        bias=run.bias,
+        postmat=postmat or run.postmat,
+    )
+    return outputs
+
+
+def test_native_resampling(tmp_path, monkeypatch):
+    run = stubbed_run(tmp_path, monkeypatch)
+    bias = load_4dfp(run.bias).frame(0)
+    ref = load_4dfp(run.ref)
+    outputs = resample_run(run, tmp_path, FrameExecutor("thread", max_workers=2, frames_per_task=2))
+    for epi, output in zip(run.epis, outputs):
+        out = load_4dfp(output)
+        assert out.shape == (*run.matrix, run.n_frames)
+        assert out.ifh.mmppix == ref.ifh.mmppix and out.ifh.center == ref.ifh.center
+
+        # the reference shares the grid of the echoes, so frames come out in the 4dfp voxel order of the echoes
+        for i in range(run.n_frames):
+            expected = load_4dfp(epi).frame(i) * bias
+            error = np.abs(out.frame(i) - expected).mean()
+            assert error < 0.1 * np.abs(expected).mean()
+            assert error < 0.5 * np.abs(out.frame(i) - expected[:, ::-1, ::-1]).mean()
+
+    # frames are read from the 4dfp echoes, without a nifti copy of them
+    assert not [path for path in run.directory.glob("*echo*.nii")]
+
+    # with the reference moved 2 voxels along x, voxels mapped from outside the field of view are 0
+    postmat = np.eye(4)
+    postmat[0, 3] = 6.0
+    np.savetxt(tmp_path / "shift.mat", postmat)
+    outputs = resample_run(run, tmp_path, FrameExecutor("thread", max_workers=2), tmp_path / "shift.mat")
+    for epi, output in zip(run.epis, outputs):
+        out = load_4dfp(output)
+        assert np.all(out.data[-2:] == 0)
+        expected = load_4dfp(epi).frame(0)[2:] * bias[2:]
+        assert np.abs(out.frame(0)[:-2] - expected).mean() < 0.1 * np.abs(expected).mean()
+
+
+def test_native_resampling_workers(tmp_path, monkeypatch):
+    # tasks run on several threads at once: every task waits for the other before resampling
+    run = stubbed_run(tmp_path, monkeypatch)
+    barrier = threading.Barrier(2, timeout=30)
+    threads = set()
+    resample_frame = FramewiseResampler.resample_frame
+
+    def wait_for_workers(self, *args, **kwargs):
+        threads.add(threading.get_ident())
+        barrier.wait()
+        return resample_frame(self, *args, **kwargs)
+
+    monkeypatch.setattr(FramewiseResampler, "resample_frame", wait_for_workers)
+    resample_run(run, tmp_path, FrameExecutor("thread", max_workers=2, frames_per_task=2))
+    assert len(threads) == 2
+    with pytest.raises(ValueError):
+        resample_run(run, tmp_path, FrameExecutor("process", max_workers=2))
+
+
+def test_nifti_layout(tmp_path, monkeypatch):
+    # frames read with the layout match the nifti_4dfp -n conversion of the whole image
+    write_stubs(tmp_path / "bin", tools=["nifti_4dfp"], force=True)
+    monkeypatch.setenv("PATH", f"{tmp_path / 'bin'}:{os.environ['PATH']}")
+    ifh = IFH(matrix_size=[*SHAPE, 2], scaling_factor=[3.0, 3.0, 3.0], mmppix=[3.0, -3.0, -3.0], center=[30, -36, -24])
+    save_4dfp(tmp_path / "epi", np.random.default_rng(0).random((*SHAPE, 2)).astype(np.float32), ifh)
+    _fourdfp_to_nifti(tmp_path / "epi", tmp_path / "epi")
+    converted = nib.load(str(tmp_path / "epi.nii"))
+    img, order = nifti_layout(tmp_path / "epi", tmp_path / "layout")
+    assert np.allclose(img.affine, converted.affine) and img.shape[:3] == converted.shape[:3]
+    for i in range(2):
+        frame = frame_to_nifti(load_4dfp(tmp_path / "epi").frame(i), order, img.shape)
+        assert np.array_equal(frame, converted.get_fdata(dtype=np.float32)[..., i])
+    assert not list(tmp_path.glob("layout_voxel_indices*")) and (tmp_path / "layout.nii").exists()
+
+
+def _square(frames, offset):
+    return [i * i + offset for i in frames]
+
+
+@pytest.mark.parametrize("mode", EXECUTOR_MODES)
+def test_frame_executor(mode):
+    # every frame should be processed exactly once, in chunks of frames_per_task
+    executor = FrameExecutor(mode, max_workers=2, frames_per_task=3)
+    results = sorted(executor.run(_square, 10, 1))
+    assert [frames for frames, _ in results] == [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]
+    assert [value for _, values in results for value in values] == [i * i + 1 for i in range(10)]
+
+
+def test_frame_executor_back_pressure():
+    # no more than max_pending tasks should ever be in flight
+    lock = threading.Lock()
+    in_flight = [0, 0]
+
+    def task(frames):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        time.sleep(0.01)
+        with lock:
+            in_flight[0] -= 1
+
+    executor = FrameExecutor("thread", max_workers=4, max_pending=2)
+    assert len(list(executor.run(task, 20))) == 20
+    assert in_flight[1] <= 2
+
+
+def test_pin_command():
+    # commands are only pinned inside pinned workers
+    assert pin_command(["ls"]) == ["ls"]
+    executor = FrameExecutor("thread", max_workers=1, pin_cpus=True)
+    ((_, command),) = list(executor.run(lambda frames: pin_command(["ls"]), 1))
+    assert command[-1] == "ls"
+    if shutil.which("taskset") is not None:
+        assert command[:2] == ["taskset", "-c"]
+
+
+def test_read_xr3d(tmp_path):
+    t4s = np.stack([np.eye(4) for _ in range(3)])
+    t4s[:, 0, 3] = [1.0, 2.0, 3.0]
+    lines = []
+    for j, t4 in enumerate(t4s, 1):
+        lines += [f"t4 frame {j}"] + [" ".join(f"{v:10.6f}" for v in row) for row in t4] + ["scale: 1.0", ""]
+    (tmp_path / "xr3d.mat").write_text("\n".join(["  t4 frame 9", "not a t4"] + lines))
+    assert np.allclose(read_xr3d(tmp_path / "xr3d.mat"), t4s)
+
+
+def test_fourdfp_to_fsl_mm():
+    # voxel (i, j, k) of the 4dfp is voxel (i, ny - 1 - j, nz - 1 - k) of its nifti
+    nii = nib.Nifti1Image(np.zeros((48, 64, 48), dtype=np.float32), np.diag([-3.0, 3.0, 3.0, 1.0]))
+    fourdfp_to_fsl = fourdfp_to_fsl_mm(EYES_333, nii)
+    fourdfp_mm = np.array([3.0 * 6 - 73.5, -3.0 * 11 + 87.0, -3.0 * 21 + 84.0, 1.0])
+    assert np.allclose(fourdfp_to_fsl @ fourdfp_mm, [3.0 * 5, 3.0 * 53, 3.0 * 27, 1.0])
+
+    # the voxel order of the conversion gives the same matrix
+    i, j, k = np.meshgrid(*[np.arange(n) for n in (48, 64, 48)], indexing="ij")
+    order = np.ravel_multi_index((i, 63 - j, 47 - k), (48, 64, 48), order="F").ravel(order="F")
+    assert np.allclose(fourdfp_to_fsl_mm(EYES_333, nii, order), fourdfp_to_fsl)
+
+
+def test_fourdfp_voxel_map():
+    # voxel (i, j, k) of the 4dfp is voxel (k, i, ny - 1 - j) of its nifti (axes swapped as for a sagittal image)
+    shape = (4, 5, 6)
+    nifti_shape = (6, 4, 5)
+    i, j, k = np.meshgrid(*[np.arange(n) for n in nifti_shape], indexing="ij")
+    order = np.ravel_multi_index((j, 4 - k, i), shape, order="F").ravel(order="F")
+    voxel_map = fourdfp_voxel_map(order, shape, nifti_shape)
+    assert np.allclose(voxel_map @ [1, 2, 3, 1], [3, 1, 2, 1])
+    assert np.allclose(voxel_map @ [0, 0, 0, 1], [0, 0, 4, 1])
+
+    # single slices map to the remaining axis
+    assert np.allclose(fourdfp_voxel_map(np.arange(20), (4, 5, 1), (4, 5, 1)), np.eye(4))
+
+    # a shuffled order is not an affine map of the voxels
+    with pytest.raises(ValueError):
+        fourdfp_voxel_map(np.random.default_rng(0).permutation(order.size), shape, nifti_shape)
+
+
+def test_xr3d_to_fsl(tmp_path, monkeypatch):
+    t4s = np.stack([np.eye(4) for _ in range(3)])
+    t4s[:, :3, 3] = np.arange(9).reshape(3, 3) + 0.123456789
+    lines = []
+    for j, t4 in enumerate(t4s, 1):
+        lines += [f"t4 frame {j}"] + [" ".join(f"{v:10.6f}" for v in row) for row in t4] + ["", "scale: 1.0"]
+    (tmp_path / "xr3d.mat").write_text("\n".join(lines) + "\n")
+
+    # aff_conv is faked by writing the t4 it was given as the matrix
+    calls = []
+
+    def aff_conv(args, **kwargs):
+        calls.append(args)
+        np.savetxt(args[-1], np.array([row.split() for row in Path(args[4]).read_text().splitlines()[:4]], dtype=float))
+
+    monkeypatch.setattr("me_pipeline.resampling.transforms.subprocess_run", aff_conv)
+    frame_to_xr3d = xr3d_to_fsl(tmp_path / "xr3d.mat", "epi", "epi_nii", 2, tmp_path)
+    assert len(calls) == 2
+    assert np.allclose(frame_to_xr3d, t4s[:2], atol=1e-6)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["xr3d.mat"]
+    with pytest.raises(ValueError):
+        xr3d_to_fsl(tmp_path / "xr3d.mat", "epi", "epi_nii", 4, tmp_path)
+
+
+def test_frame_transforms():
+    # a 4dfp translation is the same translation in fsl mm when the axes aren't flipped
+    t4 = np.eye(4)
+    t4[:3, 3] = [1.0, 2.0, 3.0]
+    frame_to_xr3d = t4_to_fsl(np.stack([t4, np.eye(4)]), np.diag([1.0, 1.0, 1.0, 1.0]))
+    assert np.allclose(frame_to_xr3d[0], t4)
+    postmat = np.diag([2.0, 2.0, 2.0, 1.0])
+    transforms = FrameTransforms(frame_to_xr3d, postmat)
+    assert len(transforms) == 2
+    assert np.allclose(transforms.frame_to_out[0], postmat @ t4)
+    assert np.allclose(transforms.out_to_frame @ transforms.frame_to_out, np.eye(4))
+    assert np.allclose(transforms.xr3d_to_frame[0][:3, 3], [-1.0, -2.0, -3.0])
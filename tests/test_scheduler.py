@@ -0,0 +1,97 @@
+import pytest
+from me_pipeline.scheduler import *
+
+
+def make_job(tmp_path, name, script, cpus=None):
+    def set_cpus(n):
+        cpus[name] = n
+
+    return PipelineJob(
+        name=name,
+        command=["sh", "-c", script],
+        cwd=tmp_path,
+        log_file=tmp_path / "logs" / f"{name}.log",
+        set_cpus=set_cpus if cpus is not None else None,
+    )
+
+
+def fail_callback(*args):
+    raise RuntimeError("callback failed")
+
+
+def test_cpus_per_job():
+    assert cpus_per_job(64, 8, 100) == 8
+    assert cpus_per_job(64, 8, 2) == 32
+    assert cpus_per_job(4, 8, 100) == 1
+
+
+def test_scheduler_runs_jobs(tmp_path):
+    cpus = {}
+    jobs = [make_job(tmp_path, f"job{n}", f"echo $OMP_NUM_THREADS; pwd; touch done{n}", cpus) for n in range(4)]
+    results = JobScheduler(max_jobs=2, cpu_budget=8).run(jobs)
+    assert [result.status for result in results] == [SUCCEEDED] * 4
+    assert cpus == {f"job{n}": 4 for n in range(4)}
+    assert all((tmp_path / f"done{n}").exists() for n in range(4))
+    assert (tmp_path / "logs" / "job0.log").read_text().splitlines() == ["4", str(tmp_path)]
+    assert "4 succeeded, 0 failed, 0 skipped" in format_summary(results)
+
+
+def test_scheduler_fail_fast(tmp_path):
+    jobs = [
+        make_job(tmp_path, "fails", "exit 3"),
+        make_job(tmp_path, "running", "sleep 30"),
+        make_job(tmp_path, "queued", "touch queued"),
+    ]
+    results = JobScheduler(max_jobs=2, fail_fast=True).run(jobs)
+    assert [(result.status, result.returncode) for result in results[::2]] == [(FAILED, 3), (SKIPPED, None)]
+    # the running job is terminated (or never started)
+    assert results[1].status in (FAILED, SKIPPED) and results[1].wall_time < 30
+    assert not (tmp_path / "queued").exists()
+
+
+def test_scheduler_continue_on_error(tmp_path):
+    jobs = [make_job(tmp_path, "fails", "exit 1"), make_job(tmp_path, "succeeds", "true")]
+    results = JobScheduler(max_jobs=1, fail_fast=False).run(jobs)
+    assert [result.status for result in results] == [FAILED, SUCCEEDED]
+    assert "1 succeeded, 1 failed, 0 skipped" in format_summary(results)
+
+
+def test_scheduler_dependencies(tmp_path):
+    jobs = [
+        make_job(tmp_path, "c", "test -e a && test -e b && touch c"),
+        make_job(tmp_path, "a", "sleep 0.2; touch a"),
+        make_job(tmp_path, "b", "touch b"),
+        make_job(tmp_path, "d", "exit 1"),
+        make_job(tmp_path, "e", "touch e"),
+        make_job(tmp_path, "f", "touch f"),
+    ]
+    jobs[0].after = ["a", "b", "other"]
+    jobs[4].after = ["f"]
+    jobs[5].after = ["d"]
+    results = JobScheduler(max_jobs=3, fail_fast=False).run(jobs)
+    # jobs run after their dependencies, and are skipped (along with their dependents) when one fails
+    assert [result.status for result in results] == [SUCCEEDED, SUCCEEDED, SUCCEEDED, FAILED, SKIPPED, SKIPPED]
+    assert (tmp_path / "c").exists() and not (tmp_path / "e").exists()
+
+    jobs[1].after = ["c"]
+    with pytest.raises(ValueError):
+        JobScheduler().run(jobs)
+
+
+def test_scheduler_retries(tmp_path):
+    # fails on the first attempt only
+    jobs = [make_job(tmp_path, "flaky", "test -e tried && echo ok || (touch tried; exit 1)")]
+    results = JobScheduler(retries=1).run(jobs)
+    assert (results[0].status, results[0].attempts) == (SUCCEEDED, 2)
+    assert "# attempt 2" in (tmp_path / "logs" / "flaky.log").read_text()
+    assert ", 2 attempts" in format_summary(results)
+
+
+def test_scheduler_callback_errors(tmp_path):
+    # a job whose set_cpus fails isn't run, on_success errors don't fail a job that succeeded
+    jobs = [make_job(tmp_path, "bad_cpus", "touch bad_cpus"), make_job(tmp_path, "bad_success", "true")]
+    jobs[0].set_cpus = fail_callback
+    jobs[1].on_success = fail_callback
+    results = JobScheduler(max_jobs=2, cpu_budget=2, fail_fast=False).run(jobs)
+    assert [result.status for result in results] == [FAILED, SUCCEEDED]
+    assert not (tmp_path / "bad_cpus").exists()
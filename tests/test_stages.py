@@ -0,0 +1,184 @@
+import json
+import multiprocessing
+import os
+import pytest
+from me_pipeline.manifest import MANIFEST_NAME, StageManifest, read_params, script_code
+from me_pipeline.scheduler import FAILED, SKIPPED, SUCCEEDED, JobScheduler
+from me_pipeline.stages import *
+
+# stands in for a csh pipeline: records the module it was entered at, fails if asked to and writes outputs
+SCRIPT = """#!/bin/sh
+test "$4" = 1 || exit 2
+echo "$3" >> calls.txt
+test -e "fail_$3" && exit 1
+mkdir -p out && touch "out/$3.txt"
+exit 0
+"""
+
+# stands in for the modules of a csh pipeline, to find the params fields each module reads
+CSH_SCRIPT = """#!/bin/csh -f
+source $1
+set wrkdir = $cwd
+if ($enter == A) goto A;
+A:
+cp $raw out/A.txt
+if ( $doexit ) exit
+B:
+echo $b_option $num_cpus
+if ( $doexit ) exit
+C:
+fake_sub.csh $1 $2 || exit $status
+if ( $doexit ) exit
+D:
+E:
+"""
+
+GRAPH = StageGraph(
+    "test",
+    "fake_pp.csh",
+    [
+        Stage("A", outputs=("out/A.txt",), inputs=("runs.json",)),
+        Stage("B", ("A",)),
+        Stage("C", ("A",)),
+        Stage("D", ("B", "C")),
+        Stage("E", ("C",)),
+    ],
+)
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "fake_pp.csh").write_text(SCRIPT)
+    (bin_dir / "fake_pp.csh").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    workdir = tmp_path / "sub-01"
+    workdir.mkdir()
+    (tmp_path / "raw.txt").write_text("raw data")
+    (workdir / "params").write_text(f"set raw = {tmp_path / 'raw.txt'}\nset b_option = 1\nset c_option = 1\n")
+    (workdir / "instructions").write_text("set num_cpus = 8\n")
+    return workdir
+
+
+def params_files(workdir):
+    return [str(workdir / "params"), str(workdir / "instructions")]
+
+
+def run(workdir, **kwargs):
+    jobs = GRAPH.jobs("sub-01", workdir, params_files(workdir), workdir / "logs", **kwargs)
+    results = JobScheduler(max_jobs=4, fail_fast=False).run(jobs)
+    calls = []
+    if (workdir / "calls.txt").exists():
+        calls = (workdir / "calls.txt").read_text().split()
+        (workdir / "calls.txt").unlink()
+    return {result.name.split("/")[1]: result.status for result in results}, calls
+
+
+def record(workdir, names):
+    for name in names:
+        StageManifest(workdir).record(GRAPH.name, GRAPH.script, GRAPH.stages[name], params_files(workdir))
+
+
+def test_stage_graph_validation():
+    with pytest.raises(ValueError):
+        StageGraph("test", "x.csh", [Stage("A", ("B",)), Stage("B")])
+    with pytest.raises(ValueError):
+        StageGraph("test", "x.csh", [Stage("A", ("C",))])
+    with pytest.raises(ValueError):
+        StageGraph("test", "x.csh", [Stage("A"), Stage("A")])
+    assert GRAPH.dependents(["C"]) == {"C", "D", "E"}
+    assert STRUCTURAL_STAGES.names[0] == "T1_DCM" and FUNCTIONAL_STAGES.names[0] == "FMRI_PP"
+    assert FUNCTIONAL_STAGES.dependents(["FC_QC"]) == {"FC_QC"}
+
+
+def test_stage_graph_resume(workdir):
+    # everything runs the first time, dependents after the stages they require
+    statuses, calls = run(workdir)
+    assert statuses == {name: SUCCEEDED for name in "ABCDE"}
+    assert calls[0] == "A" and calls.index("D") > max(calls.index("B"), calls.index("C"))
+    assert sorted(json.loads((workdir / MANIFEST_NAME).read_text())["stages"]["test"]) == list("ABCDE")
+
+    # nothing runs again
+    assert GRAPH.plan(workdir, params_files(workdir)) == []
+
+    # a failed stage skips its dependents, and the next run resumes from it
+    (workdir / "fail_C").touch()
+    statuses, calls = run(workdir, start="C")
+    assert statuses == {"C": FAILED, "D": SKIPPED, "E": SKIPPED}
+    (workdir / "fail_C").unlink()
+    assert GRAPH.plan(workdir, params_files(workdir)) == ["C", "D", "E"]
+    statuses, calls = run(workdir)
+    assert sorted(calls) == ["C", "D", "E"]
+
+    # missing outputs make a stage stale, module_exit only runs the start stage
+    (workdir / "out" / "A.txt").unlink()
+    assert GRAPH.plan(workdir, params_files(workdir)) == list("ABCDE")
+    assert run(workdir, start="B", only=True)[1] == ["B"]
+
+
+def test_script_code(workdir):
+    bin_dir = workdir.parent / "bin"
+    (bin_dir / "fake_pp.csh").write_text(CSH_SCRIPT)
+    (bin_dir / "fake_sub.csh").write_text("source $1\necho $c_option\n")
+    (bin_dir / "fake_sub.csh").chmod(0o755)
+    variables, code = script_code("fake_pp.csh", "C")
+    assert {"c_option", "enter", "cwd"} <= variables and not {"raw", "b_option"} & variables
+    assert "raw" in script_code("fake_pp.csh", "A")[0]
+    assert script_code("fake_pp.csh")[0] >= variables | {"raw", "b_option", "num_cpus"}
+
+    # the code of a module includes the scripts it calls
+    (bin_dir / "fake_sub.csh").write_text("source $1\necho $c_option $other\n")
+    os.utime(bin_dir / "fake_sub.csh", ns=(0, 10**9))
+    assert script_code("fake_pp.csh", "C")[1] != code
+    assert read_params(params_files(workdir)) == {
+        "raw": str(workdir.parent / "raw.txt"),
+        "b_option": "1",
+        "c_option": "1",
+        "num_cpus": "8",
+    }
+
+
+def test_manifest_staleness(workdir):
+    bin_dir = workdir.parent / "bin"
+    (bin_dir / "fake_pp.csh").write_text(CSH_SCRIPT)
+    (bin_dir / "fake_sub.csh").write_text("source $1\necho $c_option\n")
+    (bin_dir / "fake_sub.csh").chmod(0o755)
+    (workdir / "out").mkdir()
+    (workdir / "out" / "A.txt").touch()
+    record(workdir, "ABCDE")
+    assert GRAPH.plan(workdir, params_files(workdir)) == []
+
+    # num_cpus doesn't change the outputs, other params fields only affect the stages that read them
+    (workdir / "instructions").write_text("set num_cpus = 2\n")
+    assert GRAPH.plan(workdir, params_files(workdir)) == []
+    (workdir / "params").write_text((workdir / "params").read_text().replace("c_option = 1", "c_option = 2"))
+    assert GRAPH.plan(workdir, params_files(workdir)) == ["C", "D", "E"]
+
+    # a stage that ran again makes the stages that require it stale
+    record(workdir, "C")
+    assert GRAPH.plan(workdir, params_files(workdir)) == ["D", "E"]
+    record(workdir, "DE")
+
+    # so does a changed input file, whether named in the params or listed in a declared JSON input
+    (workdir.parent / "raw.txt").write_text("new raw data")
+    assert GRAPH.plan(workdir, params_files(workdir)) == list("ABCDE")
+    record(workdir, "ABCDE")
+    (workdir.parent / "listed.txt").write_text("x")
+    (workdir / "runs.json").write_text(json.dumps({"mag": {"1": [str(workdir.parent / "listed.txt")]}}))
+    assert GRAPH.plan(workdir, params_files(workdir)) == list("ABCDE")
+    record(workdir, "A")
+    entry = json.loads((workdir / MANIFEST_NAME).read_text())["stages"]["test"]["A"]
+    assert sorted(entry["state"]["inputs"]) == sorted(
+        str(path) for path in [workdir.parent / "raw.txt", workdir / "runs.json", workdir.parent / "listed.txt"]
+    )
+    assert entry["outputs"] == ["out/A.txt"]
+
+
+def test_manifest_concurrent_record(workdir):
+    # stages completing in different processes at once all keep their entries
+    (workdir / "out").mkdir()
+    (workdir / "out" / "A.txt").touch()
+    with multiprocessing.get_context("fork").Pool(5) as pool:
+        pool.starmap(record, [(workdir, name) for name in "ABCDE" * 4])
+    assert sorted(json.loads((workdir / MANIFEST_NAME).read_text())["stages"]["test"]) == list("ABCDE")
@@ -0,0 +1,71 @@
+import json
+import os
+import subprocess
+import sys
+import pytest
+from me_pipeline.profiles import ResourceUsage
+from me_pipeline.scheduler import SUCCEEDED, JobScheduler
+from me_pipeline.tracing import *
+from .test_scheduler import make_job
+
+# stands in for a csh pipeline: enters modules, runs tools and writes temp files
+SCRIPT = """
+echo "fake_pp.csh A $(date +%s.%N)" >> $ME_PIPELINE_TRACE
+sleep 0.5
+echo "fake_pp.csh B $(date +%s.%N)" >> $ME_PIPELINE_TRACE
+echo "fake_sub.csh B1 $(date +%s.%N)" >> $ME_PIPELINE_TRACE
+head -c 1000000 /dev/zero > $TMPDIR/big
+sleep 0.5
+rm $TMPDIR/big
+"""
+
+
+def test_read_stages(tmp_path):
+    (tmp_path / "stages").write_text("a.csh A 0\na.csh B 10.N\nb.csh B1 12\nb.csh B2 15\na.csh C 20\nnonsense\n")
+    stages = read_stages(tmp_path / "stages", 30)
+    assert [(stage["label"], stage["start"], stage["end"], stage["depth"]) for stage in stages] == [
+        ("A", 0, 10, 0),
+        ("B", 10, 20, 0),
+        ("B1", 12, 15, 1),
+        ("B2", 15, 20, 1),
+        ("C", 20, 30, 0),
+    ]
+    assert process_name(["/bin/csh", "-f", "/opt/bin/fake_pp.csh", "params"], "csh") == "fake_pp.csh"
+    assert process_name(["/usr/bin/fslmaths", "in", "out"], "fslmaths") == "fslmaths"
+    assert process_name(["sh", "-c", "echo 1 > /tmp/x"], "sh") == "sh"
+    assert process_name([], "kworker") == "kworker"
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc"), reason="processes are only sampled from /proc")
+def test_job_tracer(tmp_path):
+    tracer = JobTracer("sub-01", tmp_path / "sub-01_functional.trace.json", "functional", tmp_path, 0.05, 0.05)
+    env = tracer.env(dict(os.environ))
+    process = subprocess.Popen(["sh", "-c", SCRIPT], env=env, start_new_session=True)
+    tracer.start(process.pid)
+    process.wait()
+    tracer.stop(process.returncode, ResourceUsage(10.0, 0.5, 1.0))
+
+    events = json.loads((tmp_path / "sub-01_functional.trace.json").read_text())["traceEvents"]
+    stages = {event["name"]: event for event in events if event.get("cat") == STAGE}
+    assert sorted(stages) == ["A", "B", "B1"] and stages["B1"]["tid"] == stages["B"]["tid"] + 1
+    tools = [event for event in events if event.get("cat") == TOOL]
+    assert [event["name"] for event in tools if event["name"] == "sleep"] == ["sleep", "sleep"]
+    stages_of_tools = {event["args"]["stage"] for event in tools if event["name"] == "sleep"}
+    assert stages_of_tools == {"fake_pp.csh:A", "fake_sub.csh:B1"}
+    assert stages["B1"]["args"]["peak_disk"] > 0.9
+    # the temp directory of the job is removed since it is empty
+    assert not (tmp_path / "sub-01_functional").exists()
+
+    summary = summarize_traces([tmp_path])
+    assert summary[JOB]["functional"]["count"] == 1
+    assert summary[TOOL]["sleep"]["count"] == 2 and summary[STAGE]["fake_sub.csh:B1"]["wall_time"] >= 0
+    report = format_report(summary, top=5)
+    assert "Stages by total wall time:" in report and "sleep" in report
+
+
+def test_scheduler_traces_jobs(tmp_path):
+    job = make_job(tmp_path, "sub-01", f"{sys.executable} -c 'print(1)'")
+    job.trace_file = tmp_path / "logs" / "sub-01.trace.json"
+    assert JobScheduler().run([job])[0].status == SUCCEEDED
+    trace = json.loads(job.trace_file.read_text())
+    assert [event["name"] for event in trace["traceEvents"] if event.get("cat") == JOB] == ["sub-01"]